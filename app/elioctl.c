@@ -20,7 +20,7 @@
 
 static void print_help(int status){
 	printf("Usage:\n");
-	printf("\telioctl setup-snapshot [-c <cache size>] [-f fallocate] [-i (ignore snap errors)] <block device> <cow file> <minor>\n");
+	printf("\telioctl setup-snapshot [-c <cache size>] [-f fallocate] [-i (ignore snap errors)] [-w <cow workers>] <block device> <cow file> <minor>\n");
 	printf("\telioctl reload-snapshot [-c <cache size>] [-i (ignore snap errors)] <block device> <cow file> <minor>\n");
 	printf("\telioctl reload-incremental [-c <cache size>] [-i (ignore snap errors)] <block device> <cow file> <minor>\n");
 	printf("\telioctl destroy <minor>\n");
@@ -28,6 +28,9 @@ static void print_help(int status){
 	printf("\telioctl transition-to-snapshot [-f fallocate] <cow file> <minor>\n");
 	printf("\telioctl reconfigure [-c <cache size>] <minor>\n");
 	printf("\telioctl info <minor>\n");
+	printf("\telioctl stats <minor>\n");
+	printf("\telioctl changed-blocks [-s <start block>] [-n <block count>] <minor>\n");
+	printf("\telioctl set-unused-blocks [-s <start block>] <bitmap file> <minor>\n");
 	printf("\telioctl get-free-minor\n");
 	printf("\telioctl help\n\n");
 	printf("<cow file> should be specified as an absolute path.\n");
@@ -103,13 +106,13 @@ error:
 
 static int handle_setup_snap(int argc, char **argv){
 	int ret, c;
-	unsigned int minor;
+	unsigned int minor, cow_workers = 0;
 	unsigned long cache_size = 0, fallocated_space = 0;
 	bool ignore_snap_errors = false;
 	char *bdev, *cow;
 
-	//get cache size, fallocated space and ignore errors on snap dev params, if given
-	while((c = getopt(argc, argv, "c:f:i")) != -1){
+	//get cache size, fallocated space, ignore errors on snap dev and cow workers params, if given
+	while((c = getopt(argc, argv, "c:f:iw:")) != -1){
 		switch(c){
 		case 'c':
 			ret = parse_ul(optarg, &cache_size);
@@ -122,6 +125,10 @@ static int handle_setup_snap(int argc, char **argv){
 		case 'i':
 			ignore_snap_errors = true;
 			break;
+		case 'w':
+			ret = parse_ui(optarg, &cow_workers);
+			if(ret) goto error;
+			break;
 		default:
 			errno = EINVAL;
 			goto error;
@@ -139,7 +146,7 @@ static int handle_setup_snap(int argc, char **argv){
 	ret = parse_ui(argv[optind + 2], &minor);
 	if(ret) goto error;
 
-	return elastio_snap_setup_snapshot(minor, bdev, cow, fallocated_space, cache_size, ignore_snap_errors);
+	return elastio_snap_setup_snapshot_workers(minor, bdev, cow, fallocated_space, cache_size, ignore_snap_errors, cow_workers);
 
 error:
 	perror("error interpreting setup snapshot parameters");
@@ -397,6 +404,196 @@ error:
 	return 0;
 }
 
+static int handle_stats(int argc, char **argv){
+	int ret;
+	unsigned int minor;
+	struct elastio_snap_stats stats;
+
+	if(argc != 2){
+		errno = EINVAL;
+		goto error;
+	}
+
+	ret = parse_ui(argv[1], &minor);
+	if(ret) goto error;
+
+	ret = elastio_snap_stats(minor, &stats);
+	if(ret == 0) {
+		printf("{\n");
+		printf("\t\"minor\": %u,\n", stats.minor);
+		printf("\t\"bios_traced\": %llu,\n", stats.bios_traced);
+		printf("\t\"bios_cow\": %llu,\n", stats.bios_cow);
+		printf("\t\"bytes_cow\": %llu,\n", stats.bytes_cow);
+		printf("\t\"clones_submitted\": %llu,\n", stats.clones_submitted);
+		printf("\t\"clones_received\": %llu,\n", stats.clones_received);
+		printf("\t\"clones_processed\": %llu,\n", stats.clones_processed);
+		printf("\t\"cow_queue_depth\": %llu,\n", stats.cow_queue_depth);
+		printf("\t\"sset_queue_depth\": %llu,\n", stats.sset_queue_depth);
+		printf("\t\"sect_hits\": %llu,\n", stats.sect_hits);
+		printf("\t\"sect_misses\": %llu,\n", stats.sect_misses);
+		printf("\t\"sect_loads\": %llu,\n", stats.sect_loads);
+		printf("\t\"sect_evictions\": %llu,\n", stats.sect_evictions);
+		printf("\t\"cleanups\": %llu,\n", stats.cleanups);
+		printf("\t\"cow_file_used\": %llu,\n", stats.cow_file_used);
+		printf("\t\"cow_file_max\": %llu,\n", stats.cow_file_max);
+		printf("\t\"reads_base\": %llu,\n", stats.reads_base);
+		printf("\t\"reads_cow\": %llu,\n", stats.reads_cow);
+		printf("\t\"reads_mixed\": %llu,\n", stats.reads_mixed);
+		printf("\t\"bios_cow_skipped\": %llu,\n", stats.bios_cow_skipped);
+		printf("\t\"bytes_clone_skipped\": %llu,\n", stats.bytes_clone_skipped);
+		printf("\t\"clone_pages\": %llu,\n", stats.clone_pages);
+		printf("\t\"clone_pages_max\": %llu,\n", stats.clone_pages_max);
+		printf("\t\"page_pool_size\": %llu,\n", stats.page_pool_size);
+		printf("\t\"page_pool_free\": %llu,\n", stats.page_pool_free);
+		printf("\t\"bytes_unused_skipped\": %llu\n", stats.bytes_unused_skipped);
+		printf("}\n");
+	}
+
+	return ret;
+
+error:
+	perror("error interpreting stats parameters");
+	print_help(-1);
+	return 0;
+}
+
+#define CHANGED_BLOCKS_BATCH 4096
+
+static int handle_changed_blocks(int argc, char **argv){
+	int ret, c;
+	unsigned int minor, i;
+	unsigned long start = 0, count = ~0UL;
+	unsigned long long nr_changed = 0;
+	struct changed_blocks_params params;
+	bool first = true;
+
+	//get the range to query, if given
+	while((c = getopt(argc, argv, "s:n:")) != -1){
+		switch(c){
+		case 's':
+			ret = parse_ul(optarg, &start);
+			if(ret) goto error;
+			break;
+		case 'n':
+			ret = parse_ul(optarg, &count);
+			if(ret) goto error;
+			break;
+		default:
+			errno = EINVAL;
+			goto error;
+		}
+	}
+
+	if(argc - optind != 1){
+		errno = EINVAL;
+		goto error;
+	}
+
+	ret = parse_ui(argv[optind], &minor);
+	if(ret) goto error;
+
+	memset(&params, 0, sizeof(params));
+	params.start = start;
+	params.count = count;
+	params.max_extents = CHANGED_BLOCKS_BATCH;
+	params.extents = malloc(CHANGED_BLOCKS_BATCH * sizeof(struct changed_block_extent));
+	if(!params.extents) return -1;
+
+	ret = elastio_snap_changed_blocks(minor, &params);
+	if(ret) goto out;
+
+	printf("{\n");
+	printf("\t\"minor\": %u,\n", minor);
+	printf("\t\"extents\": [");
+
+	//query the range in batches until a batch comes back short
+	while(1){
+		for(i = 0; i < params.nr_extents; i++){
+			printf("%s\n\t\t[%llu, %llu]", (first)? "" : ",", params.extents[i].start, params.extents[i].count);
+			first = false;
+		}
+		nr_changed += params.nr_changed;
+
+		if(params.nr_extents < CHANGED_BLOCKS_BATCH) break;
+
+		params.count -= params.next - params.start;
+		params.start = params.next;
+
+		ret = elastio_snap_changed_blocks(minor, &params);
+		if(ret) break;
+	}
+
+	printf("%s],\n", (first)? "" : "\n\t");
+	printf("\t\"nr_changed\": %llu\n", nr_changed);
+	printf("}\n");
+
+out:
+	free(params.extents);
+	return ret;
+
+error:
+	perror("error interpreting changed blocks parameters");
+	print_help(-1);
+	return 0;
+}
+
+static int handle_set_unused_blocks(int argc, char **argv){
+	int ret, c;
+	unsigned int minor;
+	unsigned long start = 0;
+	unsigned char *bitmap;
+	long size;
+	FILE *f;
+
+	//get the block of the first bit, if given
+	while((c = getopt(argc, argv, "s:")) != -1){
+		switch(c){
+		case 's':
+			ret = parse_ul(optarg, &start);
+			if(ret) goto error;
+			break;
+		default:
+			errno = EINVAL;
+			goto error;
+		}
+	}
+
+	if(argc - optind != 2){
+		errno = EINVAL;
+		goto error;
+	}
+
+	ret = parse_ui(argv[optind + 1], &minor);
+	if(ret) goto error;
+
+	//the bitmap file holds a bit per block, least significant bit of each byte first
+	f = fopen(argv[optind], "rb");
+	if(!f) return -1;
+
+	if(fseek(f, 0, SEEK_END) || (size = ftell(f)) < 0 || fseek(f, 0, SEEK_SET)){
+		fclose(f);
+		return -1;
+	}
+
+	bitmap = malloc(size ? size : 1);
+	if(!bitmap || fread(bitmap, 1, size, f) != (size_t)size){
+		free(bitmap);
+		fclose(f);
+		return -1;
+	}
+	fclose(f);
+
+	ret = elastio_snap_set_unused_blocks(minor, start, (unsigned long long)size * 8, bitmap);
+
+	free(bitmap);
+	return ret;
+
+error:
+	perror("error interpreting set unused blocks parameters");
+	print_help(-1);
+	return 0;
+}
+
 static int handle_get_free_minor(int argc){
 	int minor;
 
@@ -442,6 +639,9 @@ int main(int argc, char **argv){
 	else if(!strcmp(argv[1], "transition-to-snapshot")) ret = handle_transition_snap(argc - 1, argv + 1);
 	else if(!strcmp(argv[1], "reconfigure")) ret = handle_reconfigure(argc - 1, argv + 1);
 	else if(!strcmp(argv[1], "info")) ret = handle_info(argc - 1, argv + 1);
+	else if(!strcmp(argv[1], "stats")) ret = handle_stats(argc - 1, argv + 1);
+	else if(!strcmp(argv[1], "changed-blocks")) ret = handle_changed_blocks(argc - 1, argv + 1);
+	else if(!strcmp(argv[1], "set-unused-blocks")) ret = handle_set_unused_blocks(argc - 1, argv + 1);
 	else if(!strcmp(argv[1], "get-free-minor")) ret = handle_get_free_minor(argc - 1);
 	else if(!strcmp(argv[1], "help")) print_help(0);
 	else print_help(-1);
@@ -10,6 +10,7 @@
 #include <fcntl.h>
 #include <errno.h>
 #include <sys/ioctl.h>
+#include <sys/mman.h>
 #include <string.h>
 #include <stdio.h>
 #include <sys/stat.h>
@@ -125,20 +126,28 @@ int elastio_snap_set_reload_params(unsigned int minor, bool snapshot, const stru
 }
 
 int elastio_snap_setup_snapshot(unsigned int minor, char *bdev, char *cow, unsigned long fallocated_space, unsigned long cache_size, bool ignore_snap_errors){
+	return elastio_snap_setup_snapshot_workers(minor, bdev, cow, fallocated_space, cache_size, ignore_snap_errors, 0);
+}
+
+int elastio_snap_setup_snapshot_workers(unsigned int minor, char *bdev, char *cow, unsigned long fallocated_space, unsigned long cache_size, bool ignore_snap_errors, unsigned int cow_workers){
 	int fd, ret;
-	struct setup_params sp;
+	struct setup_workers_params swp;
+	struct setup_params *sp = &swp.setup;
 
 	fd = open("/dev/elastio-snap-ctl", O_RDONLY);
 	if(fd < 0) return -1;
 
-	sp.minor = minor;
-	sp.bdev = bdev;
-	sp.cow = cow;
-	sp.fallocated_space = fallocated_space;
-	sp.cache_size = cache_size;
-	sp.ignore_snap_errors = ignore_snap_errors;
-
-	ret = ioctl(fd, IOCTL_SETUP_SNAP, &sp);
+	sp->minor = minor;
+	sp->bdev = bdev;
+	sp->cow = cow;
+	sp->fallocated_space = fallocated_space;
+	sp->cache_size = cache_size;
+	sp->ignore_snap_errors = ignore_snap_errors;
+	swp.cow_workers = cow_workers;
+
+	//the module default is used without the worker count, which modules without IOCTL_SETUP_SNAP_WORKERS also accept
+	if(cow_workers) ret = ioctl(fd, IOCTL_SETUP_SNAP_WORKERS, &swp);
+	else ret = ioctl(fd, IOCTL_SETUP_SNAP, sp);
 	if (ret == 0) {
 		struct reload_script_params rp;
 
@@ -313,6 +322,108 @@ int elastio_snap_info(unsigned int minor, struct elastio_snap_info *info){
 	return ret;
 }
 
+int elastio_snap_stats(unsigned int minor, struct elastio_snap_stats *stats){
+	int fd, ret;
+	struct elastio_snap_stats_params params;
+
+	if(!stats){
+		errno = EINVAL;
+		return -1;
+	}
+
+	fd = open("/dev/elastio-snap-ctl", O_RDONLY);
+	if(fd < 0) return -1;
+
+	params.minor = minor;
+	params.size = sizeof(struct elastio_snap_stats);
+	params.stats = stats;
+
+	ret = ioctl(fd, IOCTL_ELASTIO_SNAP_STATS, &params);
+
+	close(fd);
+	return ret;
+}
+
+int elastio_snap_changed_blocks(unsigned int minor, struct changed_blocks_params *params){
+	int fd, ret;
+
+	if(!params || !params->extents){
+		errno = EINVAL;
+		return -1;
+	}
+
+	fd = open("/dev/elastio-snap-ctl", O_RDONLY);
+	if(fd < 0) return -1;
+
+	params->minor = minor;
+
+	ret = ioctl(fd, IOCTL_CHANGED_BLOCKS, params);
+
+	close(fd);
+	return ret;
+}
+
+static size_t changed_blocks_map_size(unsigned int max_extents){
+	size_t page = sysconf(_SC_PAGESIZE);
+
+	return (max_extents * sizeof(struct changed_block_extent) + page - 1) / page * page;
+}
+
+const struct changed_block_extent *elastio_snap_map_changed_blocks(unsigned int minor, struct changed_blocks_params *params){
+	int fd, ret;
+	void *extents;
+
+	if(!params){
+		errno = EINVAL;
+		return NULL;
+	}
+
+	fd = open("/dev/elastio-snap-ctl", O_RDONLY);
+	if(fd < 0) return NULL;
+
+	params->minor = minor;
+	params->extents = NULL;
+
+	ret = ioctl(fd, IOCTL_CHANGED_BLOCKS, params);
+	if(ret){
+		close(fd);
+		return NULL;
+	}
+
+	//the mapping keeps the extents alive after the control device is closed
+	extents = mmap(NULL, changed_blocks_map_size(params->max_extents), PROT_READ, MAP_SHARED, fd, 0);
+
+	close(fd);
+	return (extents == MAP_FAILED)? NULL : extents;
+}
+
+int elastio_snap_unmap_changed_blocks(const struct changed_block_extent *extents, unsigned int max_extents){
+	return munmap((void *)extents, changed_blocks_map_size(max_extents));
+}
+
+int elastio_snap_set_unused_blocks(unsigned int minor, unsigned long long start, unsigned long long count, const unsigned char *bitmap){
+	int fd, ret;
+	struct unused_blocks_params params;
+
+	if(!bitmap){
+		errno = EINVAL;
+		return -1;
+	}
+
+	fd = open("/dev/elastio-snap-ctl", O_RDONLY);
+	if(fd < 0) return -1;
+
+	params.minor = minor;
+	params.start = start;
+	params.count = count;
+	params.bitmap = bitmap;
+
+	ret = ioctl(fd, IOCTL_SET_UNUSED_BLOCKS, &params);
+
+	close(fd);
+	return ret;
+}
+
 int elastio_snap_get_free_minor(void){
 	int fd, ret, minor;
 
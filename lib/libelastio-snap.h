@@ -17,6 +17,8 @@ extern "C" {
 
 int elastio_snap_setup_snapshot(unsigned int minor, char *bdev, char *cow, unsigned long fallocated_space, unsigned long cache_size, bool ignore_snap_errors);
 
+int elastio_snap_setup_snapshot_workers(unsigned int minor, char *bdev, char *cow, unsigned long fallocated_space, unsigned long cache_size, bool ignore_snap_errors, unsigned int cow_workers);
+
 int elastio_snap_reload_snapshot(unsigned int minor, char *bdev, char *cow, unsigned long cache_size, bool ignore_snap_errors);
 
 int elastio_snap_reload_incremental(unsigned int minor, char *bdev, char *cow, unsigned long cache_size, bool ignore_snap_errors);
@@ -31,6 +33,46 @@ int elastio_snap_reconfigure(unsigned int minor, unsigned long cache_size);
 
 int elastio_snap_info(unsigned int minor, struct elastio_snap_info *info);
 
+int elastio_snap_stats(unsigned int minor, struct elastio_snap_stats *stats);
+
+/**
+ * Get the changed blocks of a range of the device as extents.
+ *
+ * params->start, params->count, params->max_extents and params->extents
+ * must be set. If params->nr_extents comes back equal to max_extents, the
+ * query can be continued from params->next.
+ *
+ * @returns 0 on success, otherwise -1
+ */
+int elastio_snap_changed_blocks(unsigned int minor, struct changed_blocks_params *params);
+
+/**
+ * Same as elastio_snap_changed_blocks(), but the extents are mapped
+ * read-only from the module instead of being copied. params->extents is
+ * ignored.
+ *
+ * @returns the extents, to be released with elastio_snap_unmap_changed_blocks(),
+ *          otherwise NULL
+ */
+const struct changed_block_extent *elastio_snap_map_changed_blocks(unsigned int minor, struct changed_blocks_params *params);
+
+int elastio_snap_unmap_changed_blocks(const struct changed_block_extent *extents, unsigned int max_extents);
+
+/**
+ * Mark blocks of an active snapshot as unused by the filesystem at snapshot
+ * time. Their original data is not copied when they are overwritten and the
+ * snapshot reads them as zeros.
+ *
+ * Bit i of bitmap (least significant bit of each byte first) stands for
+ * block start + i, start must be a multiple of 8. The bitmap should be built
+ * from the snapshot device, so that it matches the snapshot exactly, and not
+ * from a filesystem whose journal still needs recovery.
+ *
+ * @returns 0 on success, otherwise -1. errno is EOPNOTSUPP on systems whose
+ *          page size is not 4096 bytes.
+ */
+int elastio_snap_set_unused_blocks(unsigned int minor, unsigned long long start, unsigned long long count, const unsigned char *bitmap);
+
 /**
  * Get the first available minor.
  *
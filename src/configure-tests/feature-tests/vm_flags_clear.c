@@ -0,0 +1,16 @@
+// SPDX-License-Identifier: GPL-2.0-only
+
+/*
+ * Copyright (C) 2023 Elastio Software Inc.
+ */
+
+// 6.3 <= kernel_version
+
+#include "includes.h"
+MODULE_LICENSE("GPL");
+
+static inline void dummy(void){
+	struct vm_area_struct *vma;
+
+	vm_flags_clear(vma, VM_MAYWRITE);
+}
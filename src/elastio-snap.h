@@ -29,6 +29,12 @@ struct setup_params{
 	                         //it should be not 0 if a snap device is used as a memory-mapped file
 };
 
+//setup_params leads the struct, so the layout and ioctl number of IOCTL_SETUP_SNAP stay unchanged
+struct setup_workers_params{
+	struct setup_params setup; //in: see above
+	unsigned int cow_workers; //in: number of cow worker threads in snapshot mode (0 for the module default)
+};
+
 struct reload_params{
 	char *bdev; //name of block device to snapshot
 	char *cow; //name of cow file for snapshot
@@ -52,6 +58,9 @@ struct reconfigure_params{
 
 #define COW_UUID_SIZE 16
 
+//maximum number of cow worker threads per snapshot device
+#define ELASTIO_SNAP_MAX_COW_WORKERS 16
+
 // For x86_64 we support 4 KiB pages only
 // For aarch64 we use the size configured in kernel
 #ifdef CONFIG_ARM64_PAGE_SHIFT
@@ -69,6 +78,12 @@ struct reconfigure_params{
 
 #define COW_VERSION_0 0
 #define COW_VERSION_CHANGED_BLOCKS 1
+#define COW_VERSION_SECTION_SUMMARY 2
+#define COW_VERSION_UNUSED_BLOCKS 3 //a snapshot mapping of 1 is a block the filesystem did not use, it reads as zeros
+
+//the section summary bitmap is kept in the unused part of the header
+#define COW_SUMMARY_OFFSET 512
+#define COW_SUMMARY_BITS ((COW_HEADER_SIZE - COW_SUMMARY_OFFSET) * 8)
 
 struct cow_header{
 	uint32_t magic; //COW header magic
@@ -79,6 +94,7 @@ struct cow_header{
 	uint8_t uuid[COW_UUID_SIZE]; //uuid for this series of snapshots
 	uint64_t version; //version of cow file format
 	uint64_t nr_changed_blocks; //number of changed blocks since last snapshot
+	uint64_t summary_sects; //number of index sections covered by each bit of the summary bitmap
 };
 
 struct elastio_snap_info{
@@ -98,6 +114,85 @@ struct elastio_snap_info{
 	                         //it should be not 0 if a snap device is used as a memory-mapped file
 };
 
+//version of struct elastio_snap_stats filled in by this module, newer versions only append fields
+#define ELASTIO_SNAP_STATS_VERSION 4
+
+struct elastio_snap_stats{
+	unsigned int minor; //minor number of the device
+	unsigned int version; //version of the struct filled in by the module
+	unsigned long long bios_traced; //write bios traced on the base device
+	unsigned long long bios_cow; //write bios whose original data had to be copied
+	unsigned long long bytes_cow; //bytes of data appended to the cow file
+	unsigned long long clones_submitted; //read clones submitted to the base device
+	unsigned long long clones_received; //read clones completed and queued for the cow threads
+	unsigned long long clones_processed; //read clones processed by the cow threads
+	unsigned long long cow_queue_depth; //bios currently queued for the cow threads
+	unsigned long long sset_queue_depth; //sector sets currently queued for the incremental thread
+	unsigned long long sect_hits; //cow index accesses to sections that were in memory
+	unsigned long long sect_misses; //cow index accesses to sections that were not in memory
+	unsigned long long sect_loads; //cow index sections read back from the cow file
+	unsigned long long sect_evictions; //cow index sections evicted to stay within the cache size
+	unsigned long long cleanups; //runs of the cow index cache cleanup
+	unsigned long long cow_file_used; //bytes of the cow file in use
+	unsigned long long cow_file_max; //maximum size of the cow file (in bytes)
+	unsigned long long reads_base; //snapshot reads served from the base device only
+	unsigned long long reads_cow; //snapshot reads served from the cow file only
+	unsigned long long reads_mixed; //snapshot reads served from both the base device and the cow file
+	unsigned long long bios_cow_skipped; //write bios passed through because the original data of all their blocks was already read
+	unsigned long long bytes_clone_skipped; //bytes not read back from the base device because their original data was already read
+	unsigned long long clone_pages; //pages currently held by read clones
+	unsigned long long clone_pages_max; //most pages held by read clones at once
+	unsigned long long page_pool_size; //pages reserved for read clones
+	unsigned long long page_pool_free; //pages of the reserve not in use
+	unsigned long long bytes_unused_skipped; //bytes not read back because the filesystem did not use them at snapshot time, also counted in bytes_clone_skipped
+};
+
+/*
+ * The stats are passed by pointer with their size, so the ioctl number stays
+ * the same as fields are appended. Only the first size bytes of the struct are
+ * filled in, callers built against an older version get the fields they know.
+ */
+struct elastio_snap_stats_params{
+	unsigned int minor; //in: minor number of the device
+	unsigned int size; //in: size of the buffer stats points to, out: number of bytes filled in
+	struct elastio_snap_stats *stats; //in: buffer for the stats
+};
+
+struct changed_block_extent{
+	unsigned long long start; //first block of the extent
+	unsigned long long count; //number of blocks in the extent
+};
+
+//largest number of extents a single changed blocks query may return
+#define ELASTIO_SNAP_MAX_CHANGED_EXTENTS (1 << 20)
+
+struct changed_blocks_params{
+	unsigned int minor; //in: minor number of the device
+	unsigned int max_extents; //in: number of extents that fit in extents
+	unsigned long long start; //in: first block of the range to query
+	unsigned long long count; //in: number of blocks in the range to query
+	struct changed_block_extent *extents; //in: buffer for the extents, NULL to fill the read-only mmap view of the control device instead
+	unsigned int nr_extents; //out: number of extents returned
+	unsigned long long next; //out: block after the last one examined, where to continue if all max_extents were returned
+	unsigned long long nr_changed; //out: number of changed blocks in the returned extents
+};
+
+/*
+ * Blocks the filesystem did not use at snapshot time are neither copied to
+ * the cow file when they are overwritten nor read from the base device, the
+ * snapshot reads them as zeros. The bitmap is best built from the free space
+ * maps read from the snapshot device itself, anything read before the
+ * snapshot was taken may already be out of date. Maps of a filesystem whose
+ * journal still needs recovery can miss blocks allocated in the journal.
+ * Only supported when the page size is 4096 bytes, -EOPNOTSUPP otherwise.
+ */
+struct unused_blocks_params{
+	unsigned int minor; //in: minor number of the device
+	unsigned long long start; //in: block of the first bit of the bitmap, a multiple of 8
+	unsigned long long count; //in: number of bits in the bitmap
+	const unsigned char *bitmap; //in: bit i (least significant bit of each byte first) is set if block start + i is unused
+};
+
 #define IOCTL_SETUP_SNAP _IOW(ELASTIO_IOCTL_MAGIC, 1, struct setup_params) //in: see above
 #define IOCTL_RELOAD_SNAP _IOW(ELASTIO_IOCTL_MAGIC, 2, struct reload_params) //in: see above
 #define IOCTL_RELOAD_INC _IOW(ELASTIO_IOCTL_MAGIC, 3, struct reload_params) //in: see above
@@ -107,5 +202,9 @@ struct elastio_snap_info{
 #define IOCTL_RECONFIGURE _IOW(ELASTIO_IOCTL_MAGIC, 7, struct reconfigure_params) //in: see above
 #define IOCTL_ELASTIO_SNAP_INFO _IOR(ELASTIO_IOCTL_MAGIC, 8, struct elastio_snap_info) //in: see above
 #define IOCTL_GET_FREE _IOR(ELASTIO_IOCTL_MAGIC, 9, int)
+#define IOCTL_ELASTIO_SNAP_STATS _IOWR(ELASTIO_IOCTL_MAGIC, 10, struct elastio_snap_stats_params) //in/out: see above
+#define IOCTL_CHANGED_BLOCKS _IOWR(ELASTIO_IOCTL_MAGIC, 11, struct changed_blocks_params) //in/out: see above
+#define IOCTL_SET_UNUSED_BLOCKS _IOW(ELASTIO_IOCTL_MAGIC, 12, struct unused_blocks_params) //in: see above
+#define IOCTL_SETUP_SNAP_WORKERS _IOW(ELASTIO_IOCTL_MAGIC, 13, struct setup_workers_params) //in: see above
 
 #endif /* ELASTIO_SNAP_H_ */
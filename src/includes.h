@@ -32,5 +32,11 @@
 #include <linux/random.h>
 #include <asm/div64.h>
 #include <linux/mm.h>
+#include <linux/mempool.h>
+#include <linux/sort.h>
+#include <linux/rbtree.h>
+#include <linux/percpu.h>
+#include <linux/kobject.h>
+#include <linux/sysfs.h>
 
 #endif
@@ -840,25 +840,37 @@ static void bio_free_pages(struct bio *bio){
 #define CONTROL_DEVICE_NAME "elastio-snap-ctl"
 #define SNAP_DEVICE_NAME "elastio-snap%d"
 #define SNAP_COW_THREAD_NAME_FMT "elastio_snap_cow%d"
+#define SNAP_COW_WORKER_NAME_FMT "elastio_snap_cow%d.%u"
 #define SNAP_MRF_THREAD_NAME_FMT "elastio_snap_mrf%d"
 #define INC_THREAD_NAME_FMT "elastio_snap_inc%d"
+#define COW_FLUSH_THREAD_NAME_FMT "elastio_snap_flush%d"
+
+//maximum number of queued writes a cow worker looks through for one it can process
+#define SNAP_COW_WORKER_SCAN_MAX 32
+
+//number of cow data blocks read at once for snapshot reads and for each step of readahead
+#define SNAP_READ_BUF_BLOCKS 64
+
+//number of blocks of a snapshot read whose mappings fit in the buffer of a cow worker, larger reads allocate their own
+#define SNAP_READ_MAPPINGS 1024
 
 //macro for iterating over snap_devices (requires a null check on dev)
 #define tracer_for_each(dev, i) for(i = ACCESS_ONCE(lowest_minor), dev = ACCESS_ONCE(snap_devices[i]); i <= ACCESS_ONCE(highest_minor); i++, dev = ACCESS_ONCE(snap_devices[i]))
 #define tracer_for_each_full(dev, i) for(i = 0, dev = ACCESS_ONCE(snap_devices[i]); i < elastio_snap_max_snap_devices; i++, dev = ACCESS_ONCE(snap_devices[i]))
 
 #ifdef USE_BDOPS_SUBMIT_BIO
-//returns true if tracing struct's base device fops matches that of bio
-#define tracer_matches_bio(dev, bio) (elastio_snap_get_bd_ops(dev->sd_base_dev) == elastio_snap_bio_bi_disk(bio)->fops)
+//key of the disk a bio is submitted to, the same for all tracing structs of the disk
+#define tracer_bio_key(bio) ((unsigned long)elastio_snap_bio_bi_disk(bio))
+#define tracer_dev_key(dev) ((unsigned long)(dev)->sd_base_dev->bd_disk)
 #else
-//returns true if tracing struct's base device queue matches that of bio
-#define tracer_matches_bio(dev, bio) (bdev_get_queue((dev)->sd_base_dev) == elastio_snap_bio_get_queue(bio))
+#define tracer_bio_key(bio) ((unsigned long)elastio_snap_bio_get_queue(bio))
+#define tracer_dev_key(dev) ((unsigned long)bdev_get_queue((dev)->sd_base_dev))
 #endif
 
 //returns true if tracing struct's sector range matches the sector of the bio
 #define tracer_sector_matches_bio(dev, bio) (bio_sector(bio) >= (dev)->sd_sect_off && bio_sector(bio) < (dev)->sd_sect_off + (dev)->sd_size)
 
-//should be called along with tracer_matches_bio to be valid. returns true if bio is a write, has a size,
+//should be called on the tracing struct found by tracer_lookup_bio() to be valid. returns true if bio is a write, has a size,
 //tracing struct is in non-fail state, and the device's sector range matches the bio
 #define tracer_should_trace_bio(dev, bio) (bio_data_dir(bio) && !bio_is_discard(bio) && bio_size(bio) && !tracer_read_fail_state(dev) && tracer_sector_matches_bio(dev, bio))
 
@@ -882,6 +894,10 @@ static void bio_free_pages(struct bio *bio){
 #define SECTOR_TO_BLOCK(sect) ((sect) / SECTORS_PER_BLOCK)
 #define BLOCK_TO_SECTOR(block) ((block) * SECTORS_PER_BLOCK)
 
+//snapshot mapping of a block the filesystem did not use, it reads as zeros. Block 1 of a cow file always holds the index.
+//Files holding such mappings are marked with COW_VERSION_UNUSED_BLOCKS.
+#define COW_UNUSED_MAPPING 1
+
 //macros for compilation
 #define MAYBE_UNUSED(x) (void)(x)
 
@@ -895,8 +911,34 @@ static void bio_free_pages(struct bio *bio){
 
 #define LOW_MEMORY_FAIL_PERCENT 20
 
+//the cow caches are shrunk while available memory is less than this many percent above the fail threshold
+#define LOW_MEMORY_DEGRADE_MARGIN 10
+
+//a shrunk cow cache gets this fraction of its configured size
+#define LOW_MEMORY_DEGRADE_CACHE_DIV 4
+
+//interval between checks of the available memory (in milliseconds)
+#define LOW_MEMORY_CHECK_INTERVAL 100
+
+//maximum number of cow data blocks gathered into a single write
+#define COW_WRITE_BATCH_MAX 1024
+
+//maximum number of cow index sections evicted or written back at once
+#define COW_WRITEBACK_SECTS 16
+
+//latency histograms have a bucket per power of two, starting with everything below 1us
+#define SNAP_HIST_BUCKETS 32
+#define SNAP_HIST_SHIFT 10
+
 //macros for working with bios
 #define BIO_SET_SIZE 256
+#define SSET_POOL_SIZE BIO_SET_SIZE
+#define BIO_QUEUE_NODE_POOL_SIZE BIO_SET_SIZE
+#define TP_POOL_SIZE BIO_SET_SIZE
+
+//the page reserve of the read clones of a snapshot gets this fraction of its cache size, and at least the pages of one clone
+#define CLONE_PAGE_POOL_DIV 32
+#define BIO_SECTOR_MAP_POOL_SIZE BIO_SET_SIZE
 #define bio_last_sector(bio) (bio_sector(bio) + (bio_size(bio) / SECTOR_SIZE))
 
 /* don't perform COW operation */
@@ -932,6 +974,13 @@ static unsigned long elastio_snap_cow_ext_buf_size = sizeof(struct fiemap_extent
 static unsigned long elastio_snap_cow_max_memory_default = (300 * 1024 * 1024);
 static unsigned int elastio_snap_cow_fallocate_percentage_default = 10;
 static unsigned int elastio_snap_max_snap_devices = ELASTIO_SNAP_DEFAULT_SNAP_DEVICES;
+static unsigned int elastio_snap_cow_write_batch = 256;
+static unsigned int elastio_snap_cow_workers_default = 1;
+static unsigned int elastio_snap_cow_read_cache = 256;
+static unsigned int elastio_snap_cow_readahead = 32;
+static unsigned int elastio_snap_cow_dirty_ratio = 0;
+static unsigned int elastio_snap_cow_flush_interval = 1000;
+static unsigned int elastio_snap_low_memory_percent = LOW_MEMORY_FAIL_PERCENT;
 static int elastio_snap_debug = 0;
 
 module_param_named(may_hook_syscalls, elastio_snap_may_hook_syscalls, int, S_IRUGO);
@@ -949,6 +998,27 @@ MODULE_PARM_DESC(cow_fallocate_percentage_default, "default space allocated to t
 module_param_named(max_snap_devices, elastio_snap_max_snap_devices, uint, S_IRUGO);
 MODULE_PARM_DESC(max_snap_devices, "maximum number of tracers available");
 
+module_param_named(cow_write_batch, elastio_snap_cow_write_batch, uint, 0);
+MODULE_PARM_DESC(cow_write_batch, "maximum number of cow data blocks gathered into a single write");
+
+module_param_named(cow_workers_default, elastio_snap_cow_workers_default, uint, 0);
+MODULE_PARM_DESC(cow_workers_default, "default number of cow worker threads per device in snapshot mode");
+
+module_param_named(cow_read_cache, elastio_snap_cow_read_cache, uint, 0);
+MODULE_PARM_DESC(cow_read_cache, "number of recently read cow data blocks cached per snapshot device (0 to disable)");
+
+module_param_named(cow_readahead, elastio_snap_cow_readahead, uint, 0);
+MODULE_PARM_DESC(cow_readahead, "number of blocks read ahead from the cow file on sequential snapshot reads");
+
+module_param_named(cow_dirty_ratio, elastio_snap_cow_dirty_ratio, uint, S_IRUGO | S_IWUSR);
+MODULE_PARM_DESC(cow_dirty_ratio, "percentage of the cached cow index sections allowed to be dirty before a background flusher writes them back (0 disables the flusher)");
+
+module_param_named(cow_flush_interval, elastio_snap_cow_flush_interval, uint, S_IRUGO | S_IWUSR);
+MODULE_PARM_DESC(cow_flush_interval, "interval between runs of the background cow index flusher (in milliseconds)");
+
+module_param_named(low_memory_percent, elastio_snap_low_memory_percent, uint, S_IRUGO | S_IWUSR);
+MODULE_PARM_DESC(low_memory_percent, "percentage of available physical memory below which snapshots are put into the failed state (0 disables the check)");
+
 module_param_named(debug, elastio_snap_debug, int, S_IRUGO | S_IWUSR);
 MODULE_PARM_DESC(debug, "enables debug logging");
 
@@ -965,35 +1035,55 @@ struct sset_list{
 	struct sector_set *tail;
 };
 
+struct bio_queue_node{
+	struct rb_node node; //entry in the write index of the queue
+	struct bio *bio; //queued write
+	sector_t sect; //first sector of the write
+	sector_t end; //end sector of the write
+	unsigned long seq; //order the write was queued in
+	uint64_t queued; //time the write was queued at (in nanoseconds)
+};
+
 struct bio_queue{
-	struct bio_list bios;
+	struct bio_list bios; //queued bios, only the writes if the queue is indexed
+	struct bio_list reads; //queued reads of an indexed queue
+	struct rb_root index; //queued writes of an indexed queue, sorted by sector
+	sector_t index_span; //length of the longest write in the index
+	unsigned long index_cnt; //number of writes in the index
+	unsigned long unindexed; //number of queued writes that could not be added to the index
+	unsigned long seq; //number of writes queued so far
+	int indexed; //whether reads are queued separately from the writes
+	int read_turn; //whether a read is dequeued ahead of the next write
 	spinlock_t lock;
 	wait_queue_head_t event;
+	unsigned long gen; //incremented whenever a queued bio may have become ready
+	unsigned long depth; //number of queued bios
 };
 
 struct sset_queue{
 	struct sset_list ssets;
 	spinlock_t lock;
 	wait_queue_head_t event;
+	unsigned long depth; //number of queued sector sets
 };
 
+//the bi_private of a read clone, so its completion finds where it started without a lookup
 struct bio_sector_map{
-	struct bio *bio;
-	sector_t sect;
-	unsigned int size;
-	struct bio_sector_map *next;
-};
-
-struct bsector_list {
-	struct bio_sector_map* head;
-	struct bio_sector_map* tail;
+	struct tracing_params *tp; //tracing params of the write the clone was made for
+	sector_t sect; //sector the clone started at, before its iterator was advanced
+	unsigned int size; //size of the clone (in bytes)
+	struct bio_sector_map *next; //next extra map of the tracing params
 };
 
 struct tracing_params{
 	struct bio *orig_bio;
 	struct snap_device *dev;
 	atomic_t refs;
-	struct bsector_list bio_sects;
+	unsigned int nr_maps; //number of read clones made for the orig_bio
+	struct bio_sector_map first_map; //map of the first read clone, most bios need only one
+	struct bio_sector_map *extra_maps; //maps of the other read clones, allocated from bio_sector_map_pool
+	uint64_t start; //time the orig_bio started to be traced at (in nanoseconds)
+	uint64_t clone_start; //time the last read clone was submitted at (in nanoseconds)
 };
 
 #ifdef USE_BDOPS_SUBMIT_BIO
@@ -1008,29 +1098,131 @@ struct tracing_ops {
 
 struct cow_section{
 	char has_data; //zero if this section has mappings (on file or in memory)
-	unsigned long usage; //counter that keeps track of how often this section is used
+	char referenced; //set when the section is used, cleared when the eviction clock passes it
+	char dirty; //whether the mappings in memory differ from the ones on file
+	struct list_head clock; //entry in the eviction clock of the shard while the mappings are allocated
 	uint64_t *mappings; //array of block addresses
+	unsigned long *changed; //blocks changed in incremental mode while the mappings were not in memory, merged into them on sync
+};
+
+struct cow_shard{
+	struct mutex lock; //serializes the cow workers using the sections of this shard
+	unsigned long allocated_sects; //number of currently allocated sections of this shard
+	unsigned long allowed_sects; //the maximum number of sections of this shard that may be allocated at once
+	struct list_head clock; //allocated sections of this shard, the next one to be considered for eviction first
+	unsigned long dirty_sects; //number of allocated sections of this shard that are dirty
+	unsigned long changed_sects; //number of sections of this shard with a change bitmap, counted against allowed_sects
+	char *wb_buf; //buffer for merging adjacent sections into a single write
+	unsigned int batch_cnt; //number of data blocks currently held in the write batch
+	uint64_t *batch_blocks; //block numbers of the data held in the write batch
+	unsigned int *batch_hash; //first batch entry + 1 of each chain of blocks with the same hash, 0 if the chain is empty
+	unsigned int *batch_next; //next batch entry + 1 in the chain of each batch entry, 0 at the end of the chain
+	char *batch_data; //data waiting to be appended to the cow file
 };
 
 struct cow_manager{
 	struct file *filp; //the file the cow manager is writing to
 	uint32_t flags; //flags representing current state of cow manager
-	uint64_t curr_pos; //current write head position
+	uint64_t curr_pos; //current write head position, protected by pos_lock
+	spinlock_t pos_lock; //allows several shards to reserve space for their data
 	uint64_t data_offset; //starting offset of data
 	uint64_t file_max; //max size of the file before an error is thrown
 	uint64_t seqid; //sequence id, increments on each transition to snapshot mode
 	uint64_t version; //version of cow file format
-	uint64_t nr_changed_blocks; //number of changed blocks since last snapshot
+	atomic64_t nr_changed_blocks; //number of changed blocks since last snapshot
 	uint8_t uuid[COW_UUID_SIZE]; //uuid for this series of snaphots
 	unsigned int log_sect_pages; //log2 of the number of pages needed to store a section
 	unsigned long sect_size; //size of a section in number of elements it can contain
-	unsigned long allocated_sects; //number of currently allocated sections
 	unsigned long total_sects; //total sections the cm log represents
-	unsigned long allowed_sects; //the maximum number of sections that may be allocated at once
+	unsigned long summary_sects; //number of sections represented by each bit of the summary
+	unsigned long *summary; //bitmap of groups of sections which have mappings, persisted in the header
+	unsigned int batch_max; //maximum number of data blocks held in a write batch
+	unsigned int batch_hash_size; //number of chains in the hash of each write batch, a power of 2 not below batch_max
+	unsigned int nr_shards; //number of shards, section i belongs to shard i / COW_WRITEBACK_SECTS % nr_shards
+	struct cow_shard *shards; //per shard section accounting and write batches
+	struct mutex io_lock; //protects io_users
+	unsigned int io_users; //number of file operations in progress, the file is unlocked while non-zero
 	struct cow_section *sects; //pointer to the array of sections of mappings
 	struct snap_device *dev;
 };
 
+struct snap_cow_worker{
+	struct snap_device *dev; //device the worker belongs to
+	struct task_struct *thread; //worker thread, the first worker runs as sd_cow_thread
+	bool busy; //whether a bio is being processed, protected by the cow bio queue lock
+	int is_write; //direction of the bio being processed
+	sector_t sect; //first sector of the bio being processed
+	sector_t end; //end sector of the bio being processed
+	char *read_buf; //buffer for cow data of snapshot reads
+	uint64_t *read_mappings; //buffer for the mappings of snapshot reads
+};
+
+struct snap_read_cache{
+	struct mutex lock; //protects the cache
+	unsigned long nr_blocks; //number of cow data blocks the cache holds
+	uint64_t *pos; //cow file block held by each slot, 0 if the slot is empty
+	char *data; //data of the cached blocks
+	sector_t next_block; //block following the last snapshot read
+	sector_t ra_end; //block following the last readahead
+	struct snap_device *dev; //device the cache belongs to
+	struct work_struct ra_work; //reads the pending readahead outside of the cow workers
+	char *ra_buf; //buffer for the cow data of readahead
+	sector_t ra_pending_start; //first block of the pending readahead
+	sector_t ra_pending_end; //block following the pending readahead, ra_pending_start if there is none
+};
+
+enum snap_stat{
+	SNAP_STAT_BIOS_TRACED,
+	SNAP_STAT_BIOS_COW,
+	SNAP_STAT_BYTES_COW,
+	SNAP_STAT_SECT_HITS,
+	SNAP_STAT_SECT_MISSES,
+	SNAP_STAT_SECT_LOADS,
+	SNAP_STAT_SECT_EVICTIONS,
+	SNAP_STAT_CLEANUPS,
+	SNAP_STAT_BIOS_COW_SKIPPED,
+	SNAP_STAT_BYTES_CLONE_SKIPPED,
+	SNAP_STAT_BYTES_UNUSED_SKIPPED,
+	SNAP_STAT_READS_COW, //the read counters follow the order of the READ_MODE_* values
+	SNAP_STAT_READS_BASE,
+	SNAP_STAT_READS_MIXED,
+	SNAP_STAT_NR,
+};
+
+enum snap_hist{
+	SNAP_HIST_TRACE, //from tracing a write to the release of the original bio
+	SNAP_HIST_CLONE_READ, //from submitting a read clone to its completion
+	SNAP_HIST_COW_QUEUE, //time a cow write spends queued for the cow threads
+	SNAP_HIST_COW_WRITE, //service time of snap_handle_write_bio()
+	SNAP_HIST_SNAP_READ, //service time of snap_handle_read_bio()
+	SNAP_HIST_NR,
+};
+
+struct snap_stats_cpu{
+	uint64_t cnt[SNAP_STAT_NR]; //counters of one cpu, indexed by enum snap_stat
+	uint64_t hist[SNAP_HIST_NR][SNAP_HIST_BUCKETS]; //log2 latency histograms of one cpu, indexed by enum snap_hist
+};
+
+struct snap_stats{
+	struct kobject kobj; //sysfs directory of the device, the stats are freed when it is released
+	struct snap_stats_cpu __percpu *cpu; //lock-free counters of each cpu
+	struct snap_device *dev; //device currently using the stats, protected by snap_stats_lock
+};
+
+struct tracer_lookup_entry{
+	unsigned long key; //disk the device is on, see tracer_dev_key()
+	sector_t start; //first sector of the device on the disk
+	sector_t end; //sector following the device
+	sector_t max_end; //highest end of the entries of the same disk up to this one
+	struct snap_device *dev;
+};
+
+struct tracer_lookup{
+	struct rcu_head rcu;
+	unsigned int nr; //number of entries
+	struct tracer_lookup_entry entries[]; //traced devices, sorted by disk and first sector
+};
+
 struct snap_device{
 	unsigned int sd_minor; //minor number of the snapshot
 	unsigned long sd_state; //current state of the snapshot
@@ -1052,6 +1244,11 @@ struct snap_device{
 	struct inode *sd_cow_inode; //cow file inode
 	struct fiemap_extent *sd_cow_extents; //cow file extents
 	unsigned int sd_cow_ext_cnt; //cow file extents count
+	unsigned long *sd_preserved; //bitmap of the blocks whose original data is already read for the cow file, snapshot mode only
+	unsigned long *sd_unused; //bitmap of the blocks the filesystem did not use at snapshot time, set by userspace, snapshot mode only
+	mempool_t *sd_page_pool; //reserve of pages for read clones, snapshot mode only
+	atomic_long_t sd_clone_pages; //number of pages currently held by read clones
+	unsigned long sd_clone_pages_max; //high-water mark of sd_clone_pages
 #ifdef USE_BDOPS_SUBMIT_BIO
 	struct block_device_operations *sd_orig_ops; //block device's original operations sructure with the submit bio function
 	struct tracing_ops *sd_tracing_ops; //block device's operations sructure, copy of the original one,
@@ -1061,6 +1258,12 @@ struct snap_device{
 	make_request_fn *sd_orig_mrf; //block device's original make request function
 	struct task_struct *sd_cow_thread; //thread for handling file read/writes
 	struct bio_queue sd_cow_bios; //list of outstanding cow bios
+	unsigned int sd_cow_workers; //number of cow worker threads in snapshot mode
+	struct snap_cow_worker sd_workers[ELASTIO_SNAP_MAX_COW_WORKERS]; //cow worker threads
+	struct snap_read_cache *sd_read_cache; //recently read cow data blocks
+	struct task_struct *sd_flush_thread; //thread writing dirty cow index sections back in the background
+	bool sd_mem_degraded; //whether the cow cache is shrunk because memory is low, protected by the ioctl mutex
+	struct snap_stats *sd_stats; //performance counters, kept across transitions of the device
 	struct task_struct *sd_mrf_thread; //thread for handling file read/writes
 	struct bio_queue sd_orig_bios; //list of outstanding original bios
 	struct sset_queue sd_pending_ssets; //list of outstanding sector sets
@@ -1075,7 +1278,36 @@ struct snap_device{
 	atomic64_t sd_processed_cnt; //count of read clones processed in snap_cow_thread()
 };
 
+//state of an open control device file
+struct ctrl_view{
+	struct mutex lock; //protects the buffer against concurrent mmaps, taken under the ioctl mutex
+	void *buf; //extents of the last changed blocks query made without a user buffer, mapped read-only
+	unsigned long size; //size of the buffer (in bytes)
+};
+
+static int ctrl_open(struct inode *inode, struct file *filp);
+static int ctrl_release(struct inode *inode, struct file *filp);
+static int ctrl_mmap(struct file *filp, struct vm_area_struct *vma);
 static long ctrl_ioctl(struct file *filp, unsigned int cmd, unsigned long arg);
+static int cow_flush_data(struct cow_manager *cm);
+
+//counters may be updated before the stats of a device are set up, those updates are not counted
+#define snap_stat_add(dev, stat, val) do{ if((dev)->sd_stats) this_cpu_add((dev)->sd_stats->cpu->cnt[stat], val); }while(0)
+#define snap_stat_inc(dev, stat) snap_stat_add(dev, stat, 1)
+
+static inline uint64_t snap_now_ns(void){
+	return ktime_to_ns(ktime_get());
+}
+
+//bucket 0 holds latencies below 2^SNAP_HIST_SHIFT ns, bucket i those in [2^(SNAP_HIST_SHIFT+i-1), 2^(SNAP_HIST_SHIFT+i)) ns
+static inline unsigned int snap_hist_bucket(uint64_t start){
+	uint64_t now = snap_now_ns();
+	unsigned int bucket = (now > start)? fls64((now - start) >> SNAP_HIST_SHIFT) : 0;
+
+	return min(bucket, (unsigned int)SNAP_HIST_BUCKETS - 1);
+}
+
+#define snap_hist_add(dev, hist, start) do{ if((dev)->sd_stats) this_cpu_inc((dev)->sd_stats->cpu->hist[hist][snap_hist_bucket(start)]); }while(0)
 
 #ifdef HAVE_BDOPS_OPEN_INODE
 //#if LINUX_VERSION_CODE < KERNEL_VERSION(2,6,28)
@@ -1140,7 +1372,9 @@ static const struct file_operations snap_control_fops = {
 	.owner = THIS_MODULE,
 	.unlocked_ioctl = ctrl_ioctl,
 	.compat_ioctl = ctrl_ioctl,
-	.open = nonseekable_open,
+	.mmap = ctrl_mmap,
+	.open = ctrl_open,
+	.release = ctrl_release,
 	.llseek = noop_llseek,
 };
 
@@ -1178,7 +1412,27 @@ static int major;
 static struct mutex ioctl_mutex;
 static unsigned int highest_minor, lowest_minor;
 static struct snap_device **snap_devices;
+static struct kmem_cache *sset_cache;
+static mempool_t *sset_pool;
+static struct kmem_cache *bio_queue_node_cache;
+static mempool_t *bio_queue_node_pool;
+static struct kmem_cache *tp_cache;
+static mempool_t *tp_pool;
+static struct kmem_cache *bio_sector_map_cache;
+static mempool_t *bio_sector_map_pool;
 static struct proc_dir_entry *info_proc;
+static struct kobject *elastio_snap_kobj;
+static DEFINE_SPINLOCK(snap_stats_lock);
+static struct tracer_lookup *tracer_lookup_table; //read under rcu, replaced under the ioctl mutex
+
+enum snap_mem_state{
+	SNAP_MEM_OK,
+	SNAP_MEM_DEGRADE, //cow caches are shrunk
+	SNAP_MEM_FAIL, //snapshots are failed
+};
+
+static atomic_t snap_mem_state = ATOMIC_INIT(SNAP_MEM_OK);
+static struct delayed_work snap_mem_work;
 static void **system_call_table = NULL;
 
 #if !SYS_MOUNT_ADDR
@@ -1731,240 +1985,260 @@ error:
 
 #define SECTOR_INVALID ~(u64)0
 
-sector_t sector_by_offset(struct snap_device *dev, size_t offset)
+static int __cow_extent_cmp(const void *a, const void *b){
+	const struct fiemap_extent *ea = a, *eb = b;
+
+	if(ea->fe_logical < eb->fe_logical) return -1;
+	if(ea->fe_logical > eb->fe_logical) return 1;
+	return 0;
+}
+
+static void __cow_extent_swap(void *a, void *b, int size){
+	struct fiemap_extent tmp = *(struct fiemap_extent *)a;
+
+	*(struct fiemap_extent *)a = *(struct fiemap_extent *)b;
+	*(struct fiemap_extent *)b = tmp;
+}
+
+/*
+ * Sorts the extent table by logical offset and merges extents that are
+ * contiguous both logically and physically, so lookups can binary search
+ * it and each lookup covers as long a run as possible. Returns the new
+ * number of extents.
+ */
+static unsigned int cow_extents_normalize(struct fiemap_extent *extents, unsigned int cnt){
+	unsigned int i, out = 0;
+
+	if(!cnt) return 0;
+
+	sort(extents, cnt, sizeof(struct fiemap_extent), __cow_extent_cmp, __cow_extent_swap);
+
+	for(i = 1; i < cnt; i++){
+		struct fiemap_extent *prev = &extents[out];
+
+		if(extents[i].fe_logical == prev->fe_logical + prev->fe_length &&
+				extents[i].fe_physical == prev->fe_physical + prev->fe_length){
+			prev->fe_length += extents[i].fe_length;
+			prev->fe_flags |= extents[i].fe_flags & FIEMAP_EXTENT_LAST;
+			continue;
+		}
+
+		extents[++out] = extents[i];
+	}
+
+	return out + 1;
+}
+
+/*
+ * Maps a byte offset of the cow file to a sector of the base device. If
+ * remaining is not NULL, it receives the number of bytes from offset to the
+ * end of the physically contiguous extent.
+ */
+static sector_t sector_by_offset(struct snap_device *dev, size_t offset, size_t *remaining)
 {
-	unsigned int i;
-	struct fiemap_extent *extent = dev->sd_cow_extents;
-	for (i = 0; i < dev->sd_cow_ext_cnt; i++) {
-		if (offset >= extent[i].fe_logical && offset < extent[i].fe_logical + extent[i].fe_length)
-			return (extent[i].fe_physical + (offset - extent[i].fe_logical)) >> 9;
+	unsigned int lo = 0, hi = dev->sd_cow_ext_cnt, mid;
+	struct fiemap_extent *extent;
+
+	while (lo < hi) {
+		mid = lo + (hi - lo) / 2;
+		extent = &dev->sd_cow_extents[mid];
+
+		if (offset < extent->fe_logical) {
+			hi = mid;
+		} else if (offset >= extent->fe_logical + extent->fe_length) {
+			lo = mid + 1;
+		} else {
+			if (remaining) *remaining = extent->fe_logical + extent->fe_length - offset;
+			return (extent->fe_physical + (offset - extent->fe_logical)) >> 9;
+		}
 	}
 
 	return SECTOR_INVALID;
 }
 
-int file_write_block(struct snap_device *dev, void *block, size_t offset, size_t len)
+//drops the cow file mapping the pages were marked with, so that tracing ignored their writes
+static void __file_dio_bio_clear_mappings(struct bio *bio){
+	struct bio_vec *bvec;
+#ifdef HAVE_BVEC_ITER_ALL
+	struct bvec_iter_all iter;
+#else
+	int i = 0;
+#endif
+
+#ifdef HAVE_BVEC_ITER_ALL
+	bio_for_each_segment_all(bvec, bio, iter) {
+#else
+	bio_for_each_segment_all(bvec, bio, i) {
+#endif
+		bvec->bv_page->mapping = NULL;
+	}
+}
+
+static void __file_dio_bio_free(struct bio *bio){
+	__file_dio_bio_clear_mappings(bio);
+	bio_free_pages(bio);
+	bio_put(bio);
+}
+
+/*
+ * Builds a bio covering up to len bytes of the cow file starting at offset.
+ * The bio never crosses an extent boundary and is filled with as many
+ * pages as it can hold. The number of bytes covered is returned in bytes_out.
+ */
+static int __file_dio_bio_alloc(struct snap_device *dev, int is_write, size_t offset, size_t len, struct bio **bio_out, size_t *bytes_out)
 {
 	int ret;
-	int bytes;
-	char *data;
+	struct bio *new_bio = NULL;
 	struct page *pg;
-	struct bio_set *bs;
-	struct bio *new_bio;
-	struct block_device *bdev;
+	struct block_device *bdev = dev->sd_base_dev;
 	sector_t start_sect;
-	int sectors_processed;
-	int iterations_done;
-	int bytes_written;
+	size_t remaining = 0, bytes = 0;
+	unsigned int pages, i, pg_bytes;
 
-	ret = 0;
-	bs = dev_bioset(dev);
-	bdev = dev->sd_base_dev;
-	sectors_processed = 0;
-
-	WARN_ON(len > SECTORS_PER_BLOCK);
-
-write_bio:
-	start_sect = sector_by_offset(dev, offset);
+	start_sect = sector_by_offset(dev, offset, &remaining);
 	if (start_sect == SECTOR_INVALID) {
-		LOG_WARN("Possible write IO to the end of file (offset=%lu)", offset);
+		LOG_WARN("Possible %s IO to the end of file (offset=%lu)", (is_write)? "write" : "read", offset);
 		ret = -EFAULT;
-		goto out;
+		goto error;
 	}
 
+	len = min(len, remaining);
+	pages = min_t(size_t, DIV_ROUND_UP(len, PAGE_SIZE), BIO_MAX_PAGES);
+
 #ifdef HAVE_BIO_ALLOC_2
-	new_bio = bio_alloc(GFP_NOIO, 1);
+	new_bio = bio_alloc(GFP_NOIO, pages);
 #else
-	new_bio = bio_alloc(bdev, 1, 0, GFP_KERNEL);
+	new_bio = bio_alloc(bdev, pages, 0, GFP_NOIO);
 #endif
 	if(!new_bio){
 		ret = -ENOMEM;
-		LOG_ERROR(ret, "error allocating bio (write) - bs = %p", bs);
-		goto out;
+		LOG_ERROR(ret, "error allocating bio (%s)", (is_write)? "write" : "read");
+		goto error;
 	}
 
 	elastio_snap_bio_set_dev(new_bio, bdev);
-	elastio_snap_set_bio_ops(new_bio, REQ_OP_WRITE, 0);
+	elastio_snap_set_bio_ops(new_bio, (is_write)? REQ_OP_WRITE : REQ_OP_READ, 0);
 	bio_sector(new_bio) = start_sect;
 	bio_idx(new_bio) = 0;
 
-	pg = alloc_page(GFP_NOIO);
-	if(!pg){
-		ret = -ENOMEM;
-		LOG_ERROR(ret, "error allocating read bio page");
-		goto out;
-	}
-
-	data = kmap(pg);
-	iterations_done = 0;
-	bytes_written = 0;
+	for (i = 0; i < pages && bytes < len; i++) {
+		pg = alloc_page(GFP_NOIO);
+		if(!pg){
+			ret = -ENOMEM;
+			LOG_ERROR(ret, "error allocating bio page");
+			goto error;
+		}
 
-	do {
-		bytes_written = iterations_done * SECTOR_SIZE;
-		memcpy(data + bytes_written, block + sectors_processed * SECTOR_SIZE, SECTOR_SIZE);
-		offset += SECTOR_SIZE;
-		sectors_processed++;
-		iterations_done++;
-	} while (sectors_processed < len &&
-			sector_by_offset(dev, offset) == start_sect + iterations_done);
+		pg_bytes = min_t(size_t, len - bytes, PAGE_SIZE);
+		if (bio_add_page(new_bio, pg, pg_bytes, 0) != pg_bytes) {
+			__free_page(pg);
+			break;
+		}
 
-	kunmap(pg);
+		if (dev->sd_cow_inode)
+			pg->mapping = dev->sd_cow_inode->i_mapping;
 
-	bytes_written = iterations_done * SECTOR_SIZE;
-	bytes = bio_add_page(new_bio, pg, bytes_written, 0);
-	if(bytes != bytes_written){
-		LOG_DEBUG("bio_add_page() error!");
-		__free_page(pg);
-		ret = -EFAULT;
-		goto out;
+		bytes += pg_bytes;
 	}
 
-	if (dev->sd_cow_inode)
-		pg->mapping = dev->sd_cow_inode->i_mapping;
-
-	ret = elastio_snap_submit_bio_wait(new_bio);
-	if (ret) {
-		LOG_ERROR(ret, "submit_bio_wait() error!");
-		goto out;
+	if (!bytes) {
+		ret = -EFAULT;
+		LOG_DEBUG("bio_add_page() error!");
+		goto error;
 	}
 
-	pg->mapping = NULL;
-	bio_free_pages(new_bio);
-	bio_put(new_bio);
-	new_bio = NULL;
-
-	if (sectors_processed != len)
-		goto write_bio;
-
-out:
-	if (new_bio) {
-		pg->mapping = NULL;
-		bio_free_pages(new_bio);
-		bio_put(new_bio);
-	}
+	*bio_out = new_bio;
+	*bytes_out = bytes;
+	return 0;
 
+error:
+	if (new_bio) __file_dio_bio_free(new_bio);
+	*bio_out = NULL;
+	*bytes_out = 0;
 	return ret;
 }
 
-int file_read_block(struct snap_device *dev, void *buf, size_t offset, size_t len)
+static void __file_dio_bio_copy(struct bio *bio, void *buf, int to_bio)
 {
-	int ret;
-	int bytes;
-	struct page *pg;
-	struct bio_set *bs;
-	struct bio *new_bio;
-	struct block_device *bdev;
-	sector_t start_sect;
 	struct bio_vec *bvec;
+	char *data;
+	size_t done = 0;
 #ifdef HAVE_BVEC_ITER_ALL
 	struct bvec_iter_all iter;
 #else
 	int i = 0;
 #endif
-	int sectors_processed;
-	int iterations_done;
-	int bytes_to_read;
-	int buf_offset;
 
-	ret = 0;
-	bs = dev_bioset(dev);
-	bdev = dev->sd_base_dev;
-	sectors_processed = 0;
-
-	WARN_ON(len > SECTORS_PER_BLOCK);
-
-read_bio:
-	start_sect = sector_by_offset(dev, offset);
-	if (start_sect == SECTOR_INVALID) {
-		LOG_WARN("Possible read IO to the end of file (offset=%lu)", offset);
-		ret = -EFAULT;
-		goto out;
-	}
-
-#ifdef HAVE_BIO_ALLOC_2
-	new_bio = bio_alloc(GFP_NOIO, 1);
+#ifdef HAVE_BVEC_ITER_ALL
+	bio_for_each_segment_all(bvec, bio, iter) {
 #else
-	new_bio = bio_alloc(bdev, 1, 0, GFP_KERNEL);
+	bio_for_each_segment_all(bvec, bio, i) {
 #endif
-	if(!new_bio){
-		ret = -ENOMEM;
-		LOG_ERROR(ret, "error allocating bio (read) - bs = %p", bs);
-		goto out;
+		data = kmap(bvec->bv_page);
+		if (to_bio) memcpy(data + bvec->bv_offset, buf + done, bvec->bv_len);
+		else memcpy(buf + done, data + bvec->bv_offset, bvec->bv_len);
+		kunmap(bvec->bv_page);
+		done += bvec->bv_len;
 	}
+}
 
-	elastio_snap_bio_set_dev(new_bio, bdev);
-	elastio_snap_set_bio_ops(new_bio, REQ_OP_READ, 0);
-	bio_sector(new_bio) = start_sect;
-	bio_idx(new_bio) = 0;
+static int file_dio(struct snap_device *dev, int is_write, void *buf, size_t offset, size_t len)
+{
+	int ret;
+	struct bio *new_bio;
+	size_t bytes, done = 0;
 
-	//allocate a page and add it to our bio
-	pg = alloc_page(GFP_NOIO);
-	if(!pg){
-		ret = -ENOMEM;
-		LOG_ERROR(ret, "error allocating read bio page");
-		goto out;
-	}
+	len *= SECTOR_SIZE;
 
-	iterations_done = 0;
-	bytes_to_read = 0;
-	buf_offset = sectors_processed * SECTOR_SIZE;
+	while (done < len) {
+		ret = __file_dio_bio_alloc(dev, is_write, offset + done, len - done, &new_bio, &bytes);
+		if (ret) goto error;
 
-	do {
-		offset += SECTOR_SIZE;
-		sectors_processed++;
-		iterations_done++;
-	} while (sectors_processed < len &&
-			sector_by_offset(dev, offset) == start_sect + iterations_done);
+		if (is_write) __file_dio_bio_copy(new_bio, buf + done, 1);
 
-	bytes_to_read = iterations_done * SECTOR_SIZE;
-	bytes = bio_add_page(new_bio, pg, bytes_to_read, 0);
-	if(bytes != bytes_to_read){
-		LOG_DEBUG("bio_add_page() error!");
-		__free_page(pg);
-		ret = -EFAULT;
-		goto out;
-	}
+		ret = elastio_snap_submit_bio_wait(new_bio);
+		if (ret) {
+			LOG_ERROR(ret, "submit_bio_wait() error!");
+			__file_dio_bio_free(new_bio);
+			goto error;
+		}
 
-	if (dev->sd_cow_inode)
-		pg->mapping = dev->sd_cow_inode->i_mapping;
+		if (!is_write) __file_dio_bio_copy(new_bio, buf + done, 0);
 
-	ret = elastio_snap_submit_bio_wait(new_bio);
-	if (ret) {
-		LOG_ERROR(ret, "submit_bio_wait() error!");
-		goto out;
+		__file_dio_bio_free(new_bio);
+		done += bytes;
 	}
 
-#ifdef HAVE_BVEC_ITER_ALL
-		bio_for_each_segment_all(bvec, new_bio, iter) {
-#else
-		bio_for_each_segment_all(bvec, new_bio, i) {
-#endif
-			struct page *pg = bvec->bv_page;
-			char *data = kmap(pg);
-			WARN_ON(bytes_to_read != bvec->bv_len);
-			memcpy(buf + buf_offset, data, bytes_to_read);
-			kunmap(pg);
-			// in an impossible case if we have more
-			// than one page (should never happen)
-			break;
-		}
+	return 0;
 
-	pg->mapping = NULL;
-	bio_free_pages(new_bio);
-	bio_put(new_bio);
-	new_bio = NULL;
+error:
+	return ret;
+}
 
-	if (sectors_processed != len)
-		goto read_bio;
+int file_write_block(struct snap_device *dev, void *block, size_t offset, size_t len)
+{
+	return file_dio(dev, 1, block, offset, len);
+}
 
-out:
-	if (new_bio) {
-		pg->mapping = NULL;
-		bio_free_pages(new_bio);
-		bio_put(new_bio);
-	}
+int file_read_block(struct snap_device *dev, void *buf, size_t offset, size_t len)
+{
+	return file_dio(dev, 0, buf, offset, len);
+}
 
-	return ret;
+/*
+ * Several cow workers may access the cow file at the same time, so the file
+ * stays unlocked for as long as any of them has an operation in progress.
+ */
+static void __cow_file_io_begin(struct cow_manager *cm){
+	mutex_lock(&cm->io_lock);
+	if(!cm->io_users++) file_unlock(cm->filp);
+	mutex_unlock(&cm->io_lock);
+}
+
+static void __cow_file_io_end(struct cow_manager *cm){
+	mutex_lock(&cm->io_lock);
+	if(!--cm->io_users) file_lock(cm->filp);
+	mutex_unlock(&cm->io_lock);
 }
 
 static inline ssize_t elastio_snap_kernel_read(struct cow_manager *cm, void *buf, size_t count, loff_t *pos){
@@ -1975,20 +2249,20 @@ static inline ssize_t elastio_snap_kernel_read(struct cow_manager *cm, void *buf
 		//#if LINUX_VERSION_CODE < KERNEL_VERSION(4,14,0)
 		mm_segment_t old_fs;
 
-		file_unlock(cm->filp);
+		__cow_file_io_begin(cm);
 
 		old_fs = get_fs();
 		set_fs(get_ds());
 		ret = vfs_read(cm->filp, (char __user *)buf, count, pos);
 		set_fs(old_fs);
 
-		file_lock(cm->filp);
+		__cow_file_io_end(cm);
 
 		return ret;
 #else
-		file_unlock(cm->filp);
+		__cow_file_io_begin(cm);
 		ret = kernel_read(cm->filp, buf, count, pos);
-		file_lock(cm->filp);
+		__cow_file_io_end(cm);
 		return ret;
 #endif
 	} else {
@@ -2010,7 +2284,7 @@ static inline ssize_t elastio_snap_kernel_write(struct cow_manager *cm, void *bu
 		//#if LINUX_VERSION_CODE < KERNEL_VERSION(4,14,0)
 		mm_segment_t old_fs;
 
-		file_unlock(cm->filp);
+		__cow_file_io_begin(cm);
 
 		old_fs = get_fs();
 		set_fs(get_ds());
@@ -2018,12 +2292,12 @@ static inline ssize_t elastio_snap_kernel_write(struct cow_manager *cm, void *bu
 		ret = vfs_write(cm->filp, (__force const char __user *)buf, count, pos);
 		set_fs(old_fs);
 
-		file_lock(cm->filp);
+		__cow_file_io_end(cm);
 		return ret;
 #else
-		file_unlock(cm->filp);
+		__cow_file_io_begin(cm);
 		ret = kernel_write(cm->filp, buf, count, pos);
-		file_lock(cm->filp);
+		__cow_file_io_end(cm);
 		return ret;
 #endif
 	} else {
@@ -2308,10 +2582,48 @@ mnt_error:
 
 /***************************COW MANAGER FUNCTIONS**************************/
 
+//runs of COW_WRITEBACK_SECTS adjacent sections share a shard, so that eviction and writeback can write them together
+#define cow_shard_idx(cm, sect_idx) ((unsigned long)(sect_idx) / COW_WRITEBACK_SECTS % (cm)->nr_shards)
+#define cow_shard_of(cm, sect_idx) (&(cm)->shards[cow_shard_idx(cm, sect_idx)])
+
+//number of change bitmaps that take as much memory as the mappings of a section
+#define COW_CHANGED_PER_SECT (sizeof(uint64_t) * 8)
+
+//number of sections worth of memory taken by the change bitmaps of a shard
+#define cow_shard_changed_cost(cs) DIV_ROUND_UP((cs)->changed_sects, COW_CHANGED_PER_SECT)
+
+//the change bitmaps of a shard may take up to half of its budget, beyond that they are merged into their sections
+#define cow_shard_changed_max(cs) ((cs)->allowed_sects * COW_CHANGED_PER_SECT / 2)
+
+#define cow_shard_over_budget(cs) ((cs)->allocated_sects + cow_shard_changed_cost(cs) > (cs)->allowed_sects)
+
+//number of sections the shard may allocate next to its change bitmaps
+static inline unsigned long cow_shard_sect_budget(const struct cow_shard *cs){
+	unsigned long cost = cow_shard_changed_cost(cs);
+
+	return (cs->allowed_sects > cost)? cs->allowed_sects - cost : 0;
+}
+
+static void __cow_set_dirty(struct cow_manager *cm, unsigned long sect_idx){
+	if(cm->sects[sect_idx].dirty) return;
+
+	cm->sects[sect_idx].dirty = 1;
+	cow_shard_of(cm, sect_idx)->dirty_sects++;
+}
+
+static void __cow_clear_dirty(struct cow_manager *cm, unsigned long sect_idx){
+	if(!cm->sects[sect_idx].dirty) return;
+
+	cm->sects[sect_idx].dirty = 0;
+	cow_shard_of(cm, sect_idx)->dirty_sects--;
+}
+
 static void __cow_free_section(struct cow_manager *cm, unsigned long sect_idx){
 	free_pages((unsigned long)cm->sects[sect_idx].mappings, cm->log_sect_pages);
 	cm->sects[sect_idx].mappings = NULL;
-	cm->allocated_sects--;
+	__cow_clear_dirty(cm, sect_idx);
+	list_del(&cm->sects[sect_idx].clock);
+	cow_shard_of(cm, sect_idx)->allocated_sects--;
 }
 
 static int __cow_alloc_section(struct cow_manager *cm, unsigned long sect_idx, int zero){
@@ -2324,26 +2636,40 @@ static int __cow_alloc_section(struct cow_manager *cm, unsigned long sect_idx, i
 	}
 
 	cm->sects[sect_idx].has_data = 1;
-	cm->allocated_sects++;
+	cm->sects[sect_idx].referenced = 1;
+	cm->sects[sect_idx].dirty = 0;
+	list_add_tail(&cm->sects[sect_idx].clock, &cow_shard_of(cm, sect_idx)->clock);
+	cow_shard_of(cm, sect_idx)->allocated_sects++;
 
 	return 0;
 }
 
-static int __cow_load_section(struct cow_manager *cm, unsigned long sect_idx){
+static int __cow_read_section(struct cow_manager *cm, unsigned long sect_idx, uint64_t *mappings){
 	int i, ret;
 	int sect_size_bytes = COW_SECTION_SIZE * sizeof(uint64_t);
 
-	ret = __cow_alloc_section(cm, sect_idx, 0);
-	if(ret) goto error;
-
 	for (i = 0; i < sect_size_bytes / COW_BLOCK_SIZE; i++) {
-		int mapping_offset = (COW_BLOCK_SIZE / sizeof(cm->sects[sect_idx].mappings[0])) * i;
+		int mapping_offset = (COW_BLOCK_SIZE / sizeof(mappings[0])) * i;
 		int cow_file_offset = COW_BLOCK_SIZE * i;
 
-		ret = file_read(cm, cm->sects[sect_idx].mappings + mapping_offset, COW_HEADER_SIZE + cm->sect_size*sect_idx * sizeof(uint64_t) + cow_file_offset, COW_BLOCK_SIZE);
-		if(ret) goto error;
+		ret = file_read(cm, mappings + mapping_offset, COW_HEADER_SIZE + cm->sect_size*sect_idx * sizeof(uint64_t) + cow_file_offset, COW_BLOCK_SIZE);
+		if(ret) return ret;
 	}
 
+	return 0;
+}
+
+static int __cow_load_section(struct cow_manager *cm, unsigned long sect_idx){
+	int ret;
+
+	ret = __cow_alloc_section(cm, sect_idx, 0);
+	if(ret) goto error;
+
+	ret = __cow_read_section(cm, sect_idx, cm->sects[sect_idx].mappings);
+	if(ret) goto error;
+
+	snap_stat_inc(cm->dev, SNAP_STAT_SECT_LOADS);
+
 	return 0;
 
 error:
@@ -2352,27 +2678,71 @@ error:
 	return ret;
 }
 
-static int __cow_write_section(struct cow_manager *cm, unsigned long sect_idx){
-	int i, ret;
-	int sect_size_bytes = COW_SECTION_SIZE * sizeof(uint64_t);
+static int __cow_write_sections(struct cow_manager *cm, struct cow_shard *cs, unsigned long first, unsigned long cnt){
+	int ret;
+	unsigned long i;
+	size_t sect_bytes = cm->sect_size * sizeof(uint64_t);
+	void *buf = cm->sects[first].mappings;
 
-	for (i = 0; i < sect_size_bytes / COW_BLOCK_SIZE; i++) {
-		int mapping_offset = (COW_BLOCK_SIZE / sizeof(cm->sects[sect_idx].mappings[0])) * i;
-		int cow_file_offset = COW_BLOCK_SIZE * i;
+	//adjacent sections are gathered into the buffer of the shard so they can be written at once
+	if(cnt > 1){
+		buf = cs->wb_buf;
+		for(i = 0; i < cnt; i++) memcpy(cs->wb_buf + i * sect_bytes, cm->sects[first + i].mappings, sect_bytes);
+	}
 
-		ret = file_write(cm, cm->sects[sect_idx].mappings + mapping_offset, COW_HEADER_SIZE + cm->sect_size*sect_idx * sizeof(uint64_t) + cow_file_offset, COW_BLOCK_SIZE);
-		if(ret){
-			LOG_ERROR(ret, "error writing cow manager section to file");
-			return ret;
-		}
+	ret = file_write(cm, buf, COW_HEADER_SIZE + first * sect_bytes, cnt * sect_bytes);
+	if(ret){
+		LOG_ERROR(ret, "error writing cow manager sections %lu-%lu to file", first, first + cnt - 1);
+		return ret;
 	}
 
+	for(i = 0; i < cnt; i++) __cow_clear_dirty(cm, first + i);
+
 	return 0;
 }
 
-static int __cow_file_extents_zero_fill_ahead(struct cow_manager *cm)
-{
-	int ret;
+static int __cow_sect_idx_cmp(const void *a, const void *b){
+	unsigned long x = *(const unsigned long *)a, y = *(const unsigned long *)b;
+
+	return (x > y) - (x < y);
+}
+
+static int __cow_write_sorted_sections(struct cow_manager *cm, struct cow_shard *cs, unsigned long *idx, unsigned int cnt){
+	int ret;
+	unsigned int i, run;
+
+	sort(idx, cnt, sizeof(unsigned long), __cow_sect_idx_cmp, NULL);
+
+	for(i = 0; i < cnt; i += run){
+		for(run = 1; i + run < cnt && idx[i + run] == idx[i] + run; run++);
+
+		ret = __cow_write_sections(cm, cs, idx[i], run);
+		if(ret) return ret;
+	}
+
+	return 0;
+}
+
+static int __cow_write_dirty_sections(struct cow_manager *cm){
+	int ret;
+	unsigned long i, first, cnt;
+
+	//every section is written back, so runs may cross the shards
+	for(i = 0; i < cm->total_sects; i = first + cnt){
+		for(first = i; first < cm->total_sects && !cm->sects[first].dirty; first++);
+		for(cnt = 0; first + cnt < cm->total_sects && cnt < COW_WRITEBACK_SECTS && cm->sects[first + cnt].dirty; cnt++);
+		if(!cnt) break;
+
+		ret = __cow_write_sections(cm, &cm->shards[0], first, cnt);
+		if(ret) return ret;
+	}
+
+	return 0;
+}
+
+static int __cow_file_extents_zero_fill_ahead(struct cow_manager *cm)
+{
+	int ret;
 	char *buf;
 	uint64_t write_max = COW_BLOCK_SIZE * 1024;
 	uint64_t curr_size = cm->curr_pos * COW_BLOCK_SIZE;
@@ -2400,21 +2770,115 @@ static int __cow_file_extents_zero_fill_ahead(struct cow_manager *cm)
 	return ret;
 }
 
-static int __cow_sync_and_free_sections(struct cow_manager *cm, unsigned long thresh, bool fill_ahead){
+/*
+ * Frees allocated sections of the shard until no more than target are left.
+ * Sections are taken in clock order, those used since the clock last passed
+ * them are skipped once. Only dirty sections are written back to the file.
+ */
+static int __cow_evict_sections(struct cow_manager *cm, struct cow_shard *cs, unsigned long target){
 	int ret;
-	unsigned long i;
+	unsigned int cnt, dirty;
+	unsigned long idx[COW_WRITEBACK_SECTS];
+	struct cow_section *sect, *tmp;
+	LIST_HEAD(victims);
+
+	while(cs->allocated_sects > target){
+		//take a batch of victims off the clock, so their dirty sections can be written together
+		for(cnt = 0, dirty = 0; cnt < COW_WRITEBACK_SECTS && cnt < cs->allocated_sects - target; ){
+			sect = list_first_entry(&cs->clock, struct cow_section, clock);
+
+			if(target && sect->referenced){
+				sect->referenced = 0;
+				list_move_tail(&sect->clock, &cs->clock);
+				continue;
+			}
 
-	for(i=0; i<cm->total_sects && (!thresh || cm->allocated_sects > cm->allowed_sects/2); i++){
-		if(cm->sects[i].mappings && (!thresh || cm->sects[i].usage <= thresh)){
-			ret = __cow_write_section(cm, i);
+			list_move_tail(&sect->clock, &victims);
+			if(sect->dirty) idx[dirty++] = sect - cm->sects;
+			cnt++;
+		}
+
+		if(dirty){
+			ret = __cow_write_sorted_sections(cm, cs, idx, dirty);
 			if(ret){
-				LOG_ERROR(ret, "error writing cow manager section %lu to file", i);
+				list_splice(&victims, &cs->clock);
 				return ret;
 			}
+		}
+
+		list_for_each_entry_safe(sect, tmp, &victims, clock){
+			__cow_free_section(cm, sect - cm->sects);
+		}
+
+		if(target) snap_stat_add(cm->dev, SNAP_STAT_SECT_EVICTIONS, cnt);
+	}
+
+	return 0;
+}
+
+/*
+ * Folds the blocks recorded in the change bitmaps of the sections into their
+ * mappings, so that the index on file marks them as changed. Blocks that were
+ * counted again while their mapping was already set are uncounted here.
+ */
+static int __cow_merge_changed_section(struct cow_manager *cm, unsigned long sect_idx){
+	int ret;
+	unsigned long j;
+	struct cow_section *sect = &cm->sects[sect_idx];
+
+	if(!sect->mappings){
+		if(!sect->has_data) ret = __cow_alloc_section(cm, sect_idx, 1);
+		else ret = __cow_load_section(cm, sect_idx);
+		if(ret) return ret;
+	}
+
+	for_each_set_bit(j, sect->changed, cm->sect_size){
+		if(!sect->mappings[j]) sect->mappings[j] = 1;
+		else if(cm->version >= COW_VERSION_CHANGED_BLOCKS) atomic64_dec(&cm->nr_changed_blocks);
+	}
+
+	__cow_set_dirty(cm, sect_idx);
+	if(cm->version >= COW_VERSION_SECTION_SUMMARY) set_bit(sect_idx / cm->summary_sects, cm->summary);
+
+	kfree(sect->changed);
+	sect->changed = NULL;
+	cow_shard_of(cm, sect_idx)->changed_sects--;
 
-			__cow_free_section(cm, i);
+	return 0;
+}
+
+static int __cow_merge_changed(struct cow_manager *cm){
+	int ret;
+	unsigned long i;
+
+	for(i = 0; i < cm->total_sects; i++){
+		if(!cm->sects[i].changed) continue;
+
+		ret = __cow_merge_changed_section(cm, i);
+		if(ret) return ret;
+
+		if(cow_shard_over_budget(cow_shard_of(cm, i))){
+			ret = __cow_cleanup_mappings(cm, cow_shard_idx(cm, i));
+			if(ret) return ret;
 		}
-		cm->sects[i].usage = 0;
+	}
+
+	return 0;
+}
+
+static int __cow_sync_and_free_sections(struct cow_manager *cm, bool fill_ahead){
+	int ret;
+	unsigned int shard;
+
+	ret = __cow_merge_changed(cm);
+	if(ret) return ret;
+
+	ret = __cow_write_dirty_sections(cm);
+	if(ret) return ret;
+
+	for(shard = 0; shard < cm->nr_shards; shard++){
+		ret = __cow_evict_sections(cm, &cm->shards[shard], 0);
+		if(ret) return ret;
 	}
 
 	if (fill_ahead && __cow_file_extents_zero_fill_ahead(cm)) {
@@ -2425,34 +2889,33 @@ static int __cow_sync_and_free_sections(struct cow_manager *cm, unsigned long th
 	return 0;
 }
 
-static int __cow_cleanup_mappings(struct cow_manager *cm){
+//gets the shard back within its budget, the shard must be locked
+static int __cow_fit_shard(struct cow_manager *cm, unsigned int shard){
 	int ret;
-	unsigned long less, greater, i, granularity, thresh = 0;
-
-	//find the max usage of the sections of the cm
-	for(i=0; i<cm->total_sects; i++){
-		if(cm->sects[i].usage > thresh) thresh = cm->sects[i].usage;
-	}
-
-	//find the (approximate) median usage of the sections of the cm
-	thresh /= 2;
-	granularity = thresh;
-	while(granularity > 0){
-		granularity = granularity >> 1;
-		less = 0;
-		greater = 0;
-		for(i=0; i<cm->total_sects; i++){
-			if(cm->sects[i].usage <= thresh) less++;
-			else greater++;
-		}
+	unsigned long i;
+	struct cow_shard *cs = &cm->shards[shard];
+
+	//if the change bitmaps took more than their share, as after the budget was cut, some are merged into their sections
+	for(i = 0; i < cm->total_sects && cs->changed_sects > cow_shard_changed_max(cs); i++){
+		if(!cm->sects[i].changed || cow_shard_idx(cm, i) != shard) continue;
 
-		if(greater > less) thresh += granularity;
-		else if(greater < less) thresh -= granularity;
-		else break;
+		ret = __cow_merge_changed_section(cm, i);
+		if(ret) return ret;
+
+		ret = __cow_evict_sections(cm, cs, cow_shard_sect_budget(cs));
+		if(ret) return ret;
 	}
 
-	//deallocate sections of the cm with less usage than the median
-	ret = __cow_sync_and_free_sections(cm, thresh, false);
+	//evict just enough sections to get back within the limit of the shard
+	return __cow_evict_sections(cm, cs, cow_shard_sect_budget(cs));
+}
+
+static int __cow_cleanup_mappings(struct cow_manager *cm, unsigned int shard){
+	int ret;
+
+	snap_stat_inc(cm->dev, SNAP_STAT_CLEANUPS);
+
+	ret = __cow_fit_shard(cm, shard);
 	if(ret){
 		LOG_ERROR(ret, "error cleaning cow manager mappings");
 		return ret;
@@ -2461,6 +2924,51 @@ static int __cow_cleanup_mappings(struct cow_manager *cm){
 	return 0;
 }
 
+static int __cow_writeback_shard(struct cow_manager *cm, struct cow_shard *cs, unsigned long target){
+	unsigned int cnt = 0;
+	unsigned long idx[COW_WRITEBACK_SECTS];
+	struct cow_section *sect;
+
+	//the sections that are next to be evicted are written first, they stay allocated
+	list_for_each_entry(sect, &cs->clock, clock){
+		if(cnt == COW_WRITEBACK_SECTS || cs->dirty_sects - cnt <= target) break;
+		if(sect->dirty) idx[cnt++] = sect - cm->sects;
+	}
+
+	if(!cnt) return 0;
+	return __cow_write_sorted_sections(cm, cs, idx, cnt);
+}
+
+/*
+ * Writes dirty sections back until no more than dirty_ratio percent of the
+ * sections each shard may allocate are dirty. The shard lock is dropped between
+ * batches so that the cow threads are not held up for long.
+ */
+static int cow_writeback(struct cow_manager *cm, unsigned int dirty_ratio){
+	int ret = 0;
+	unsigned int shard;
+	unsigned long target, written;
+	struct cow_shard *cs;
+
+	if(!cm->shards) return 0;
+
+	for(shard = 0; shard < cm->nr_shards && !ret; shard++){
+		cs = &cm->shards[shard];
+
+		do{
+			mutex_lock(&cs->lock);
+			target = cs->allowed_sects * dirty_ratio / 100;
+			written = cs->dirty_sects;
+			if(cs->dirty_sects > target) ret = __cow_writeback_shard(cm, cs, target);
+			written -= cs->dirty_sects;
+			mutex_unlock(&cs->lock);
+		}while(!ret && written && !kthread_should_stop());
+	}
+
+	if(ret) LOG_ERROR(ret, "error writing back cow manager sections");
+	return ret;
+}
+
 static int __cow_write_header(struct cow_manager *cm, int is_clean){
 	int ret;
 	struct cow_header *ch = kzalloc(COW_HEADER_SIZE, GFP_KERNEL);
@@ -2479,7 +2987,12 @@ static int __cow_write_header(struct cow_manager *cm, int is_clean){
 	ch->seqid = cm->seqid;
 	memcpy(ch->uuid, cm->uuid, COW_UUID_SIZE);
 	ch->version = cm->version;
-	ch->nr_changed_blocks = cm->nr_changed_blocks;
+	ch->nr_changed_blocks = atomic64_read(&cm->nr_changed_blocks);
+
+	if(cm->version >= COW_VERSION_SECTION_SUMMARY){
+		ch->summary_sects = cm->summary_sects;
+		memcpy((char *)ch + COW_SUMMARY_OFFSET, cm->summary, COW_SUMMARY_BITS / 8);
+	}
 
 	ret = file_write(cm, ch, 0, COW_HEADER_SIZE);
 	if(ret){
@@ -2523,6 +3036,13 @@ static int __cow_open_header(struct cow_manager *cm, int index_only, int reset_v
 		goto error;
 	}
 
+	//a newer format may give the mappings a meaning this module doesn't know of
+	if(ch->version > COW_VERSION_UNUSED_BLOCKS){
+		ret = -EINVAL;
+		LOG_ERROR(-EINVAL, "unsupported cow file version: %llu", (unsigned long long)ch->version);
+		goto error;
+	}
+
 	LOG_DEBUG("cow header opened with file pos = %llu, seqid = %llu", ((unsigned long long)ch->fpos), (unsigned long long)ch->seqid);
 
 	if(reset_vmalloc) cm->flags = ch->flags & ~(1 << COW_VMALLOC_UPPER);
@@ -2533,7 +3053,17 @@ static int __cow_open_header(struct cow_manager *cm, int index_only, int reset_v
 	cm->seqid = ch->seqid;
 	memcpy(cm->uuid, ch->uuid, COW_UUID_SIZE);
 	cm->version = ch->version;
-	cm->nr_changed_blocks = ch->nr_changed_blocks;
+	atomic64_set(&cm->nr_changed_blocks, ch->nr_changed_blocks);
+
+	if(cm->version >= COW_VERSION_SECTION_SUMMARY){
+		if(ch->summary_sects != cm->summary_sects){
+			ret = -EINVAL;
+			LOG_ERROR(ret, "cow file summary granularity %llu does not match %lu", (unsigned long long)ch->summary_sects, cm->summary_sects);
+			goto error;
+		}
+
+		memcpy(cm->summary, (char *)ch + COW_SUMMARY_OFFSET, COW_SUMMARY_BITS / 8);
+	}
 
 	ret = __cow_write_header_dirty(cm);
 	if(ret) goto error;
@@ -2547,12 +3077,30 @@ error:
 	return ret;
 }
 
+static void __cow_free_shards(struct cow_manager *cm){
+	unsigned int i;
+
+	if(!cm->shards) return;
+
+	for(i = 0; i < cm->nr_shards; i++){
+		if(cm->shards[i].batch_data) vfree(cm->shards[i].batch_data);
+		if(cm->shards[i].batch_blocks) kfree(cm->shards[i].batch_blocks);
+		if(cm->shards[i].batch_hash) kfree(cm->shards[i].batch_hash);
+		if(cm->shards[i].batch_next) kfree(cm->shards[i].batch_next);
+		if(cm->shards[i].wb_buf) vfree(cm->shards[i].wb_buf);
+	}
+
+	kfree(cm->shards);
+	cm->shards = NULL;
+}
+
 static void cow_free_members(struct cow_manager *cm){
 	unsigned long i;
 
 	if(cm->sects){
 		for(i = 0; i < cm->total_sects; i++){
 			if(cm->sects[i].mappings) free_pages((unsigned long)cm->sects[i].mappings, cm->log_sect_pages);
+			kfree(cm->sects[i].changed);
 		}
 
 		if(cm->flags & (1 << COW_VMALLOC_UPPER)) vfree(cm->sects);
@@ -2561,6 +3109,13 @@ static void cow_free_members(struct cow_manager *cm){
 		cm->sects = NULL;
 	}
 
+	if(cm->summary){
+		kfree(cm->summary);
+		cm->summary = NULL;
+	}
+
+	__cow_free_shards(cm);
+
 	if(cm->filp){
 		file_unlink_and_close_force(cm->filp);
 		cm->filp = NULL;
@@ -2575,7 +3130,10 @@ static void cow_free(struct cow_manager *cm){
 static int cow_sync_and_free(struct cow_manager *cm){
 	int ret;
 
-	ret = __cow_sync_and_free_sections(cm, 0, false);
+	ret = cow_flush_data(cm);
+	if(ret) goto error;
+
+	ret = __cow_sync_and_free_sections(cm, false);
 	if(ret) goto error;
 
 	ret = __cow_close_header(cm);
@@ -2588,6 +3146,8 @@ static int cow_sync_and_free(struct cow_manager *cm){
 		else kfree(cm->sects);
 	}
 
+	if(cm->summary) kfree(cm->summary);
+	__cow_free_shards(cm);
 	kfree(cm);
 
 	return 0;
@@ -2757,10 +3317,10 @@ static int elastio_snap_get_cow_file_extents(struct snap_device *dev, struct fil
 			if (dev->sd_cow_extents) {
 				ret = copy_from_user(dev->sd_cow_extents, cow_ext_buf, fiemap_mapped_extents_size);
 				if (!ret) {
-					dev->sd_cow_ext_cnt = fiemap_info.fi_extents_mapped;
-					WARN(dev->sd_cow_ext_cnt == max_num_extents, "max num of extents read, increase cow_ext_buf_size");
+					WARN(fiemap_info.fi_extents_mapped == max_num_extents, "max num of extents read, increase cow_ext_buf_size");
+					dev->sd_cow_ext_cnt = cow_extents_normalize(dev->sd_cow_extents, fiemap_info.fi_extents_mapped);
 					extent = dev->sd_cow_extents;
-					for (i_ext = 0; i_ext < fiemap_info.fi_extents_mapped; ++i_ext, ++extent) {
+					for (i_ext = 0; i_ext < dev->sd_cow_ext_cnt; ++i_ext, ++extent) {
 						LOG_DEBUG("   cow file extent: log 0x%llx, phy 0x%llx, len %llu", extent->fe_logical, extent->fe_physical, extent->fe_length);
 					}
 				}
@@ -2783,7 +3343,10 @@ out:
 static int cow_sync_and_close(struct cow_manager *cm){
 	int ret;
 
-	ret = __cow_sync_and_free_sections(cm, 0, true);
+	ret = cow_flush_data(cm);
+	if(ret) goto error;
+
+	ret = __cow_sync_and_free_sections(cm, true);
 	if(ret) goto error;
 
 	ret = __cow_close_header(cm);
@@ -2831,6 +3394,76 @@ static unsigned long __cow_calculate_allowed_sects(unsigned long cache_size, uns
 	else return (cache_size - (total_sects * sizeof(struct cow_section))) / (COW_SECTION_SIZE * sizeof(uint64_t));
 }
 
+static int __cow_alloc_summary(struct cow_manager *cm){
+	//each bit covers as many sections as needed to fit the bitmap into the header
+	cm->summary_sects = max(1UL, DIV_ROUND_UP(cm->total_sects, (unsigned long)COW_SUMMARY_BITS));
+
+	cm->summary = kzalloc(COW_SUMMARY_BITS / 8, GFP_KERNEL);
+	if(!cm->summary){
+		LOG_ERROR(-ENOMEM, "error allocating cow summary bitmap");
+		return -ENOMEM;
+	}
+
+	return 0;
+}
+
+static void __cow_restore_has_data(struct cow_manager *cm){
+	unsigned long i;
+
+	//cow files without a summary may have mappings in any section
+	if(cm->version < COW_VERSION_SECTION_SUMMARY){
+		for(i = 0; i < cm->total_sects; i++) cm->sects[i].has_data = 1;
+		return;
+	}
+
+	for(i = 0; i < cm->total_sects; i++){
+		if(test_bit(i / cm->summary_sects, cm->summary)) cm->sects[i].has_data = 1;
+	}
+}
+
+static void __cow_set_allowed_sects(struct cow_manager *cm, unsigned long cache_size){
+	unsigned int i;
+	unsigned long allowed = __cow_calculate_allowed_sects(cache_size, cm->total_sects);
+
+	//the cache is split evenly between the shards
+	for(i = 0; i < cm->nr_shards; i++) cm->shards[i].allowed_sects = allowed / cm->nr_shards;
+}
+
+static int __cow_alloc_shards(struct cow_manager *cm, unsigned int nr_shards, unsigned long cache_size){
+	unsigned int i;
+
+	cm->nr_shards = clamp(nr_shards, 1U, (unsigned int)ELASTIO_SNAP_MAX_COW_WORKERS);
+	cm->batch_max = clamp(elastio_snap_cow_write_batch, 1U, (unsigned int)COW_WRITE_BATCH_MAX);
+	for(cm->batch_hash_size = 1; cm->batch_hash_size < cm->batch_max; cm->batch_hash_size <<= 1);
+	spin_lock_init(&cm->pos_lock);
+	mutex_init(&cm->io_lock);
+	cm->io_users = 0;
+
+	cm->shards = kzalloc(cm->nr_shards * sizeof(struct cow_shard), GFP_KERNEL);
+	if(!cm->shards) goto error;
+
+	for(i = 0; i < cm->nr_shards; i++){
+		mutex_init(&cm->shards[i].lock);
+		INIT_LIST_HEAD(&cm->shards[i].clock);
+
+		cm->shards[i].batch_blocks = kmalloc(cm->batch_max * sizeof(uint64_t), GFP_KERNEL);
+		cm->shards[i].batch_hash = kzalloc(cm->batch_hash_size * sizeof(unsigned int), GFP_KERNEL);
+		cm->shards[i].batch_next = kmalloc(cm->batch_max * sizeof(unsigned int), GFP_KERNEL);
+		cm->shards[i].batch_data = vmalloc(cm->batch_max * COW_BLOCK_SIZE);
+		cm->shards[i].wb_buf = vmalloc(COW_WRITEBACK_SECTS * cm->sect_size * sizeof(uint64_t));
+		if(!cm->shards[i].batch_blocks || !cm->shards[i].batch_hash || !cm->shards[i].batch_next || !cm->shards[i].batch_data || !cm->shards[i].wb_buf) goto error;
+	}
+
+	__cow_set_allowed_sects(cm, cache_size);
+
+	return 0;
+
+error:
+	LOG_ERROR(-ENOMEM, "error allocating cow shards");
+	__cow_free_shards(cm);
+	return -ENOMEM;
+}
+
 static int cow_reload(struct snap_device *dev, const char *path, uint64_t elements, unsigned long sect_size, unsigned long cache_size, int index_only, struct cow_manager **cm_out){
 	int ret;
 	struct cow_manager *cm;
@@ -2847,15 +3480,19 @@ static int cow_reload(struct snap_device *dev, const char *path, uint64_t elemen
 	ret = file_open(path, 0, &cm->filp);
 	if(ret) goto error;
 
-	cm->allocated_sects = 0;
 	cm->sect_size = sect_size;
 	cm->log_sect_pages = get_order(sect_size * sizeof(uint64_t));
 	cm->total_sects = NUM_SEGMENTS(elements, cm->log_sect_pages + PAGE_SHIFT - 3);
-	cm->allowed_sects = __cow_calculate_allowed_sects(cache_size, cm->total_sects);
 	cm->data_offset = COW_HEADER_SIZE + (cm->total_sects * (sect_size * sizeof(uint64_t)));
 	dev->sd_cow_inode = cm->filp->f_inode;
 	cm->dev = dev;
 
+	ret = __cow_alloc_summary(cm);
+	if(ret) goto error;
+
+	ret = __cow_alloc_shards(cm, dev->sd_cow_workers, cache_size);
+	if(ret) goto error;
+
 	ret = __cow_open_header(cm, index_only, 1);
 	if(ret) goto error;
 
@@ -2872,6 +3509,9 @@ static int cow_reload(struct snap_device *dev, const char *path, uint64_t elemen
 		}
 	}
 
+	//sections with mappings on file must be loaded before they are used
+	__cow_restore_has_data(cm);
+
 	*cm_out = cm;
 	return 0;
 
@@ -2884,6 +3524,8 @@ error:
 		else kfree(cm->sects);
 	}
 
+	if(cm->summary) kfree(cm->summary);
+	__cow_free_shards(cm);
 	if(cm) kfree(cm);
 
 	*cm_out = NULL;
@@ -2906,10 +3548,9 @@ static int cow_init(struct snap_device *dev, const char *path, uint64_t elements
 	ret = file_open(path, O_CREAT | O_TRUNC, &cm->filp);
 	if(ret) goto error;
 
-	cm->version = COW_VERSION_CHANGED_BLOCKS;
-	cm->nr_changed_blocks = 0;
+	cm->version = COW_VERSION_SECTION_SUMMARY;
+	atomic64_set(&cm->nr_changed_blocks, 0);
 	cm->flags = 0;
-	cm->allocated_sects = 0;
 	cm->file_max = file_max;
 	cm->sect_size = sect_size;
 	cm->seqid = seqid;
@@ -2947,11 +3588,16 @@ static int cow_init(struct snap_device *dev, const char *path, uint64_t elements
 
 	cm->log_sect_pages = get_order(sect_size * sizeof(uint64_t));
 	cm->total_sects = NUM_SEGMENTS(elements, cm->log_sect_pages + PAGE_SHIFT - 3);
-	cm->allowed_sects = __cow_calculate_allowed_sects(cache_size, cm->total_sects);
 	cm->data_offset = COW_HEADER_SIZE + (cm->total_sects * (sect_size * sizeof(uint64_t)));
 	cm->curr_pos = cm->data_offset / COW_BLOCK_SIZE;
 	cm->dev = dev;
 
+	ret = __cow_alloc_summary(cm);
+	if(ret) goto error;
+
+	ret = __cow_alloc_shards(cm, dev->sd_cow_workers, cache_size);
+	if(ret) goto error;
+
 	if(uuid) memcpy(cm->uuid, uuid, COW_UUID_SIZE);
 	else generate_random_uuid(cm->uuid);
 
@@ -2990,6 +3636,8 @@ error:
 		else kfree(cm->sects);
 	}
 
+	if(cm->summary) kfree(cm->summary);
+	__cow_free_shards(cm);
 	if(cm) kfree(cm);
 
 	*cm_out = NULL;
@@ -3003,15 +3651,37 @@ static int cow_truncate_to_index(struct cow_manager *cm){
 }
 
 static void cow_modify_cache_size(struct cow_manager *cm, unsigned long cache_size){
-	cm->allowed_sects = __cow_calculate_allowed_sects(cache_size, cm->total_sects);
+	__cow_set_allowed_sects(cm, cache_size);
 }
 
-static int cow_read_mapping(struct cow_manager *cm, uint64_t pos, uint64_t *out){
+//evicts sections until no shard holds more than it is allowed to, rather than waiting for the next cleanup
+static int cow_shrink(struct cow_manager *cm){
+	int ret = 0;
+	unsigned int i;
+	struct cow_shard *cs;
+
+	if(!cm->shards) return 0;
+
+	for(i = 0; i < cm->nr_shards && !ret; i++){
+		cs = &cm->shards[i];
+
+		mutex_lock(&cs->lock);
+		if(cow_shard_over_budget(cs) || cs->changed_sects > cow_shard_changed_max(cs)) ret = __cow_fit_shard(cm, i);
+		mutex_unlock(&cs->lock);
+	}
+
+	if(ret) LOG_ERROR(ret, "error shrinking cow manager cache");
+	return ret;
+}
+
+static int __cow_read_mapping(struct cow_manager *cm, uint64_t pos, uint64_t *out){
 	int ret;
 	uint64_t sect_idx = pos;
 	unsigned long sect_pos = do_div(sect_idx, cm->sect_size);
+	struct cow_shard *cs = cow_shard_of(cm, sect_idx);
 
-	cm->sects[sect_idx].usage++;
+	cm->sects[sect_idx].referenced = 1;
+	snap_stat_inc(cm->dev, (cm->sects[sect_idx].mappings)? SNAP_STAT_SECT_HITS : SNAP_STAT_SECT_MISSES);
 
 	if(!cm->sects[sect_idx].mappings){
 		if(!cm->sects[sect_idx].has_data){
@@ -3026,11 +3696,11 @@ static int cow_read_mapping(struct cow_manager *cm, uint64_t pos, uint64_t *out)
 	*out = cm->sects[sect_idx].mappings[sect_pos];
 
 #ifdef NETLINK_DEBUG
-	trace_event_cow(EVENT_COW_READ_MAPPING, pos, *out);
+	trace_event_cow(EVENT_COW_READ_MAPPING, cm->dev->sd_minor, pos, *out);
 #endif
 
-	if(cm->allocated_sects > cm->allowed_sects){
-		ret = __cow_cleanup_mappings(cm);
+	if(cow_shard_over_budget(cs)){
+		ret = __cow_cleanup_mappings(cm, cow_shard_idx(cm, sect_idx));
 		if(ret) goto error;
 	}
 
@@ -3039,17 +3709,135 @@ static int cow_read_mapping(struct cow_manager *cm, uint64_t pos, uint64_t *out)
 error:
 	LOG_ERROR(ret, "error reading cow mapping");
 #ifdef NETLINK_DEBUG
-	trace_event_generic(EVENT_DRIVER_ERROR, ret);
+	trace_event_generic(EVENT_DRIVER_ERROR, cm->dev->sd_minor, ret);
 #endif
 	return ret;
 }
 
+static struct cow_shard *cow_lock_shard(struct cow_manager *cm, uint64_t pos){
+	struct cow_shard *cs;
+
+	do_div(pos, cm->sect_size);
+	cs = cow_shard_of(cm, pos);
+	mutex_lock(&cs->lock);
+
+	return cs;
+}
+
+static int cow_read_mapping(struct cow_manager *cm, uint64_t pos, uint64_t *out){
+	int ret;
+	struct cow_shard *cs = cow_lock_shard(cm, pos);
+
+	ret = __cow_read_mapping(cm, pos, out);
+	mutex_unlock(&cs->lock);
+
+	return ret;
+}
+
+static int cow_read_mappings(struct cow_manager *cm, uint64_t pos, unsigned long cnt, uint64_t *out){
+	int ret;
+	unsigned long i = 0, run;
+	uint64_t sect_idx;
+	struct cow_shard *cs;
+
+	while(i < cnt){
+		//read all of the requested mappings of a section under a single lock of its shard
+		sect_idx = pos + i;
+		run = min((unsigned long)(cm->sect_size - do_div(sect_idx, cm->sect_size)), cnt - i);
+
+		cs = cow_lock_shard(cm, pos + i);
+		for(; run; run--, i++){
+			ret = __cow_read_mapping(cm, pos + i, &out[i]);
+			if(ret){
+				mutex_unlock(&cs->lock);
+				return ret;
+			}
+		}
+		mutex_unlock(&cs->lock);
+	}
+
+	return 0;
+}
+
+/*
+ * Fills ext with the changed blocks of [start, end) as runs, stopping at the
+ * first block that would need an extent beyond max. Evicted mappings are read
+ * into a scratch buffer rather than back into the cache, so a query doesn't
+ * push out the sections the cow workers are using.
+ */
+static int cow_changed_extents(struct cow_manager *cm, uint64_t start, uint64_t end, struct changed_block_extent *ext, unsigned int max, unsigned int *nr_out, uint64_t *next_out){
+	int ret;
+	unsigned int nr = 0;
+	uint64_t block = start, sect_idx;
+	unsigned long sect_pos, run, i;
+	uint64_t *buf, *mappings;
+	struct cow_section *sect;
+	struct cow_shard *cs;
+
+	buf = vmalloc(cm->sect_size * sizeof(uint64_t));
+	if(!buf){
+		ret = -ENOMEM;
+		LOG_ERROR(ret, "error allocating section buffer");
+		return ret;
+	}
+
+	while(block < end){
+		sect_idx = block;
+		sect_pos = do_div(sect_idx, cm->sect_size);
+		run = min_t(uint64_t, end - block, cm->sect_size - sect_pos);
+		sect = &cm->sects[sect_idx];
+
+		cs = cow_lock_shard(cm, block);
+		mappings = sect->mappings;
+
+		if(!mappings && sect->has_data){
+			ret = __cow_read_section(cm, sect_idx, buf);
+			if(ret){
+				mutex_unlock(&cs->lock);
+				goto error;
+			}
+			mappings = buf;
+		}
+
+		for(i = sect_pos; i < sect_pos + run; i++, block++){
+			if(!(mappings && mappings[i]) && !(sect->changed && test_bit(i, sect->changed))) continue;
+
+			if(nr && ext[nr - 1].start + ext[nr - 1].count == block){
+				ext[nr - 1].count++;
+			}else if(nr < max){
+				ext[nr].start = block;
+				ext[nr].count = 1;
+				nr++;
+			}else{
+				mutex_unlock(&cs->lock);
+				goto out;
+			}
+		}
+		mutex_unlock(&cs->lock);
+
+		cond_resched();
+	}
+
+out:
+	vfree(buf);
+	*nr_out = nr;
+	*next_out = block;
+	return 0;
+
+error:
+	LOG_ERROR(ret, "error reading changed blocks");
+	vfree(buf);
+	return ret;
+}
+
 static int __cow_write_mapping(struct cow_manager *cm, uint64_t pos, uint64_t val){
 	int ret;
 	uint64_t sect_idx = pos;
 	unsigned long sect_pos = do_div(sect_idx, cm->sect_size);
+	struct cow_shard *cs = cow_shard_of(cm, sect_idx);
 
-	cm->sects[sect_idx].usage++;
+	cm->sects[sect_idx].referenced = 1;
+	snap_stat_inc(cm->dev, (cm->sects[sect_idx].mappings)? SNAP_STAT_SECT_HITS : SNAP_STAT_SECT_MISSES);
 
 	if(!cm->sects[sect_idx].mappings){
 		if(!cm->sects[sect_idx].has_data){
@@ -3061,16 +3849,18 @@ static int __cow_write_mapping(struct cow_manager *cm, uint64_t pos, uint64_t va
 		}
 	}
 
-	if(cm->version >= COW_VERSION_CHANGED_BLOCKS && !cm->sects[sect_idx].mappings[sect_pos]) cm->nr_changed_blocks++;
+	if(cm->version >= COW_VERSION_CHANGED_BLOCKS && !cm->sects[sect_idx].mappings[sect_pos]) atomic64_inc(&cm->nr_changed_blocks);
+	if(cm->version >= COW_VERSION_SECTION_SUMMARY) set_bit((unsigned long)sect_idx / cm->summary_sects, cm->summary);
 
 #ifdef NETLINK_DEBUG
-	trace_event_cow(EVENT_COW_WRITE_MAPPING, pos, val);
+	trace_event_cow(EVENT_COW_WRITE_MAPPING, cm->dev->sd_minor, pos, val);
 #endif
 
 	cm->sects[sect_idx].mappings[sect_pos] = val;
+	__cow_set_dirty(cm, sect_idx);
 
-	if(cm->allocated_sects > cm->allowed_sects){
-		ret = __cow_cleanup_mappings(cm);
+	if(cow_shard_over_budget(cs)){
+		ret = __cow_cleanup_mappings(cm, cow_shard_idx(cm, sect_idx));
 		if(ret) goto error;
 	}
 
@@ -3079,103 +3869,421 @@ static int __cow_write_mapping(struct cow_manager *cm, uint64_t pos, uint64_t va
 error:
 	LOG_ERROR(ret, "error writing cow mapping");
 #ifdef NETLINK_DEBUG
-	trace_event_generic(EVENT_DRIVER_ERROR, ret);
+	trace_event_generic(EVENT_DRIVER_ERROR, cm->dev->sd_minor, ret);
 #endif
 	return ret;
 }
-#define __cow_write_current_mapping(cm, pos) __cow_write_mapping(cm, pos, (cm)->curr_pos)
-#define cow_write_filler_mapping(cm, pos) __cow_write_mapping(cm, pos, 1)
 
-static int __cow_write_data(struct cow_manager *cm, void *buf){
+static int cow_write_filler_mappings(struct cow_manager *cm, uint64_t pos, uint64_t count){
 	int ret;
-	char *abs_path = NULL;
-	int abs_path_len;
-	uint64_t curr_size = cm->curr_pos * COW_BLOCK_SIZE;
+	uint64_t sect_idx;
+	unsigned long sect_pos, run, i;
+	struct cow_shard *cs;
+
+	while(count){
+		sect_idx = pos;
+		sect_pos = do_div(sect_idx, cm->sect_size);
+		run = min_t(uint64_t, count, cm->sect_size - sect_pos);
+		cs = cow_shard_of(cm, sect_idx);
+
+		//the background flusher may be writing back sections of the same shard
+		mutex_lock(&cs->lock);
+
+		//rather than loading the mappings, a bit per block records the change until the index is synced
+		if(!cm->sects[sect_idx].mappings && !cm->sects[sect_idx].changed && cs->changed_sects < cow_shard_changed_max(cs)){
+			cm->sects[sect_idx].changed = kzalloc(BITS_TO_LONGS(cm->sect_size) * sizeof(unsigned long), GFP_NOIO | __GFP_NOWARN);
+			if(cm->sects[sect_idx].changed) cs->changed_sects++;
+		}
 
-	if(curr_size >= cm->file_max) {
-		ret = -EFBIG;
+		if(cm->sects[sect_idx].changed){
+			for(i = sect_pos; i < sect_pos + run; i++){
+				if(!__test_and_set_bit(i, cm->sects[sect_idx].changed) && cm->version >= COW_VERSION_CHANGED_BLOCKS) atomic64_inc(&cm->nr_changed_blocks);
+			}
 
-		if (cm->filp)
-			file_get_absolute_pathname(cm->filp, &abs_path, &abs_path_len);
+#ifdef NETLINK_DEBUG
+			trace_event_cow(EVENT_COW_WRITE_MAPPING, cm->dev->sd_minor, pos, 1);
+#endif
 
-		if(!abs_path){
-			LOG_ERROR(ret, "cow file max size exceeded (%llu/%llu)", curr_size, cm->file_max);
-		}else{
-			LOG_ERROR(ret, "cow file '%s' max size exceeded (%llu/%llu)", abs_path, curr_size, cm->file_max);
-			kfree(abs_path);
+			//the new bitmap may have pushed the shard over its budget
+			if(cow_shard_over_budget(cs)){
+				ret = __cow_cleanup_mappings(cm, cow_shard_idx(cm, sect_idx));
+				if(ret) goto error;
+			}
+
+			mutex_unlock(&cs->lock);
+			pos += run;
+			count -= run;
+			continue;
 		}
 
-		goto error;
-	}
+		//mappings that are in memory anyway, or sections that got no bitmap, are set directly
+		cm->sects[sect_idx].referenced = 1;
+		snap_stat_inc(cm->dev, (cm->sects[sect_idx].mappings)? SNAP_STAT_SECT_HITS : SNAP_STAT_SECT_MISSES);
+
+		if(!cm->sects[sect_idx].mappings){
+			if(!cm->sects[sect_idx].has_data){
+				ret = __cow_alloc_section(cm, sect_idx, 1);
+				if(ret) goto error;
+			}else{
+				ret = __cow_load_section(cm, sect_idx);
+				if(ret) goto error;
+			}
+		}
+
+		//set the whole run within this section at once
+		for(i = sect_pos; i < sect_pos + run; i++){
+			if(cm->version >= COW_VERSION_CHANGED_BLOCKS && !cm->sects[sect_idx].mappings[i]) atomic64_inc(&cm->nr_changed_blocks);
+			cm->sects[sect_idx].mappings[i] = 1;
+		}
+		__cow_set_dirty(cm, sect_idx);
+
+		if(cm->version >= COW_VERSION_SECTION_SUMMARY) set_bit((unsigned long)sect_idx / cm->summary_sects, cm->summary);
 
 #ifdef NETLINK_DEBUG
-	trace_event_cow(EVENT_COW_WRITE_DATA, 0, 0);
+		trace_event_cow(EVENT_COW_WRITE_MAPPING, cm->dev->sd_minor, pos, 1);
 #endif
 
-	ret = file_write(cm, buf, curr_size, COW_BLOCK_SIZE);
-	if(ret) goto error;
+		if(cow_shard_over_budget(cs)){
+			ret = __cow_cleanup_mappings(cm, cow_shard_idx(cm, sect_idx));
+			if(ret) goto error;
+		}
+		mutex_unlock(&cs->lock);
 
-	cm->curr_pos++;
+		pos += run;
+		count -= run;
+	}
 
 	return 0;
 
 error:
-	LOG_ERROR(ret, "error writing cow data");
+	mutex_unlock(&cs->lock);
+	LOG_ERROR(ret, "error writing cow filler mappings");
 #ifdef NETLINK_DEBUG
-	trace_event_generic(EVENT_DRIVER_ERROR, ret);
+	trace_event_generic(EVENT_DRIVER_ERROR, cm->dev->sd_minor, ret);
 #endif
 	return ret;
 }
 
-static int cow_write_current(struct cow_manager *cm, uint64_t block, void *buf){
-	int ret;
-	uint64_t block_mapping;
+//reserves room for cnt data blocks, the other shards may be appending their data concurrently
+static int __cow_reserve_data(struct cow_manager *cm, unsigned int cnt, uint64_t *pos_out){
+	char *abs_path = NULL;
+	int abs_path_len;
+	uint64_t pos, curr_size, len = (uint64_t)cnt * COW_BLOCK_SIZE;
 
-	//read this mapping from the cow manager
-	ret = cow_read_mapping(cm, block, &block_mapping);
-	if(ret) goto error;
+	spin_lock(&cm->pos_lock);
+	pos = cm->curr_pos;
+	curr_size = pos * COW_BLOCK_SIZE;
+	if(curr_size + len <= cm->file_max) cm->curr_pos += cnt;
+	spin_unlock(&cm->pos_lock);
+
+	if(curr_size + len > cm->file_max) {
+		if (cm->filp)
+			file_get_absolute_pathname(cm->filp, &abs_path, &abs_path_len);
 
-	//if the block mapping already exists return so we don't overwrite it
-	if(block_mapping) return 0;
+		if(!abs_path){
+			LOG_ERROR(-EFBIG, "cow file max size exceeded (%llu/%llu)", curr_size + len, cm->file_max);
+		}else{
+			LOG_ERROR(-EFBIG, "cow file '%s' max size exceeded (%llu/%llu)", abs_path, curr_size + len, cm->file_max);
+			kfree(abs_path);
+		}
 
-	//write the mapping
-	ret = __cow_write_current_mapping(cm, block);
+		return -EFBIG;
+	}
+
+	*pos_out = pos;
+	return 0;
+}
+
+static int __cow_flush_shard(struct cow_manager *cm, struct cow_shard *cs){
+	int ret;
+	unsigned int i, cnt = cs->batch_cnt;
+	uint64_t pos, curr_size, len = (uint64_t)cnt * COW_BLOCK_SIZE;
+
+	if(!cnt) return 0;
+
+	ret = __cow_reserve_data(cm, cnt, &pos);
 	if(ret) goto error;
+	curr_size = pos * COW_BLOCK_SIZE;
 
-	//write the data
-	ret = __cow_write_data(cm, buf);
+#ifdef NETLINK_DEBUG
+	trace_event_cow(EVENT_COW_WRITE_DATA, cm->dev->sd_minor, 0, 0);
+#endif
+
+	//append all of the gathered blocks at once
+	ret = file_write(cm, cs->batch_data, curr_size, len);
 	if(ret) goto error;
 
+	cs->batch_cnt = 0;
+	memset(cs->batch_hash, 0, cm->batch_hash_size * sizeof(unsigned int));
+	snap_stat_add(cm->dev, SNAP_STAT_BYTES_COW, len);
+
+	//the data is on file, the mappings can be published now
+	for(i = 0; i < cnt; i++){
+		ret = __cow_write_mapping(cm, cs->batch_blocks[i], pos + i);
+		if(ret) goto error;
+	}
+
+	return 0;
+
+error:
+	LOG_ERROR(ret, "error writing cow data");
+#ifdef NETLINK_DEBUG
+	trace_event_generic(EVENT_DRIVER_ERROR, cm->dev->sd_minor, ret);
+#endif
+	return ret;
+}
+
+static int cow_flush_data(struct cow_manager *cm){
+	int ret = 0;
+	unsigned int i;
+
+	if(!cm->shards) return 0;
+
+	for(i = 0; i < cm->nr_shards && !ret; i++){
+		mutex_lock(&cm->shards[i].lock);
+		ret = __cow_flush_shard(cm, &cm->shards[i]);
+		mutex_unlock(&cm->shards[i].lock);
+	}
+
+	return ret;
+}
+
+//returns 1 if the data of the block has already been preserved, the shard of the block must be locked
+static int __cow_block_preserved(struct cow_manager *cm, struct cow_shard *cs, uint64_t block){
+	int ret;
+	unsigned int i;
+	uint64_t block_mapping;
+
+	//read this mapping from the cow manager
+	ret = __cow_read_mapping(cm, block, &block_mapping);
+	if(ret) return ret;
+
+	if(block_mapping) return 1;
+
+	//the block may also be waiting in the write batch without a mapping yet, only its hash chain is searched
+	for(i = cs->batch_hash[block & (cm->batch_hash_size - 1)]; i; i = cs->batch_next[i - 1]){
+		if(cs->batch_blocks[i - 1] == block) return 1;
+	}
+
+	return 0;
+}
+
+static int cow_write_current(struct cow_manager *cm, uint64_t block, void *buf){
+	int ret;
+	unsigned int hash;
+	struct cow_shard *cs = cow_lock_shard(cm, block);
+
+	//if the block has already been preserved return so we don't overwrite it
+	ret = __cow_block_preserved(cm, cs, block);
+	if(ret < 0) goto error;
+	if(ret) goto out;
+
+	if(cs->batch_cnt == cm->batch_max){
+		ret = __cow_flush_shard(cm, cs);
+		if(ret) goto error;
+	}
+
+	//gather the data, it is written along with the following blocks
+	hash = block & (cm->batch_hash_size - 1);
+	cs->batch_blocks[cs->batch_cnt] = block;
+	cs->batch_next[cs->batch_cnt] = cs->batch_hash[hash];
+	cs->batch_hash[hash] = cs->batch_cnt + 1;
+	memcpy(cs->batch_data + (size_t)cs->batch_cnt * COW_BLOCK_SIZE, buf, COW_BLOCK_SIZE);
+	cs->batch_cnt++;
+
+out:
+	mutex_unlock(&cs->lock);
 	return 0;
 
 error:
+	mutex_unlock(&cs->lock);
 	LOG_ERROR(ret, "error writing cow data and mapping");
 	return ret;
 }
 
-static int cow_read_data(struct cow_manager *cm, void *out_buf, uint64_t block_pos, unsigned long block_off, unsigned long len){
+static int __cow_direct_bio_alloc(struct snap_device *dev, sector_t sect, unsigned int pages, struct bio **bio_out){
+	struct bio *new_bio;
+
+	pages = min_t(unsigned int, pages, BIO_MAX_PAGES);
+
+#ifdef HAVE_BIO_ALLOC_2
+	new_bio = bio_alloc(GFP_NOIO, pages);
+#else
+	new_bio = bio_alloc(dev->sd_base_dev, pages, 0, GFP_NOIO);
+#endif
+	if(!new_bio){
+		LOG_ERROR(-ENOMEM, "error allocating direct cow write bio");
+		*bio_out = NULL;
+		return -ENOMEM;
+	}
+
+	elastio_snap_bio_set_dev(new_bio, dev->sd_base_dev);
+	elastio_snap_set_bio_ops(new_bio, REQ_OP_WRITE, 0);
+	bio_sector(new_bio) = sect;
+	bio_idx(new_bio) = 0;
+
+	*bio_out = new_bio;
+	return 0;
+}
+
+//writes a run of cnt blocks starting at block to the cow file blocks starting at pos, then publishes their mappings
+static int __cow_write_direct_run(struct cow_manager *cm, struct bio *bio, uint64_t block, uint64_t pos, unsigned int cnt){
 	int ret;
-	char *read_buf = kzalloc(COW_BLOCK_SIZE, GFP_KERNEL);
+	unsigned int i;
+	struct cow_shard *cs;
 
 #ifdef NETLINK_DEBUG
-	trace_event_cow(EVENT_COW_READ_DATA, 0, 0);
+	trace_event_cow(EVENT_COW_WRITE_DATA, cm->dev->sd_minor, pos, cnt);
 #endif
 
-	if(block_off >= COW_BLOCK_SIZE) return -EINVAL;
+	ret = elastio_snap_submit_bio_wait(bio);
+	__file_dio_bio_clear_mappings(bio);
+	bio_put(bio);
+	if(ret) goto error;
+
+	snap_stat_add(cm->dev, SNAP_STAT_BYTES_COW, (uint64_t)cnt * COW_BLOCK_SIZE);
+
+	//the data is on disk, the mappings can be published now
+	for(i = 0; i < cnt; i++){
+		cs = cow_lock_shard(cm, block + i);
+		ret = __cow_write_mapping(cm, block + i, pos + i);
+		mutex_unlock(&cs->lock);
+		if(ret) goto error;
+	}
 
-	ret = file_read(cm, read_buf, (block_pos * COW_BLOCK_SIZE), COW_BLOCK_SIZE);
+	return 0;
+
+error:
+	LOG_ERROR(ret, "error writing cow data directly");
+#ifdef NETLINK_DEBUG
+	trace_event_generic(EVENT_DRIVER_ERROR, cm->dev->sd_minor, ret);
+#endif
+	return ret;
+}
+
+/*
+ * Writes the blocks of a completed read clone straight to their place in the
+ * cow file on the base device, reusing the pages of the clone instead of
+ * copying them into the write batch. This is only valid while the cow file is
+ * closed and its extents are known, so that none of its data can be in the
+ * page cache. Each page must hold exactly one block. Blocks that have already
+ * been preserved are skipped, like in cow_write_current().
+ */
+static int cow_write_current_direct(struct cow_manager *cm, struct bio *clone){
+	int ret;
+	struct snap_device *dev = cm->dev;
+	struct bio *bio = NULL;
+	struct page *pg;
+	sector_t sect, next_sect = 0;
+	uint64_t pos, block = SECTOR_TO_BLOCK(bio_sector(clone)), run_block = 0, run_pos = 0;
+	unsigned int run_cnt = 0, left = bio_size(clone) / PAGE_SIZE;
+	struct cow_shard *cs;
+	struct bio_vec *bvec;
+#ifdef HAVE_BVEC_ITER_ALL
+	struct bvec_iter_all iter;
+#else
+	int i = 0;
+#endif
+
+#ifdef HAVE_BVEC_ITER_ALL
+	bio_for_each_segment_all(bvec, clone, iter) {
+#else
+	bio_for_each_segment_all(bvec, clone, i) {
+#endif
+		pg = bvec->bv_page;
+		left--;
+
+		cs = cow_lock_shard(cm, block);
+		ret = __cow_block_preserved(cm, cs, block);
+		mutex_unlock(&cs->lock);
+		if(ret < 0) goto error;
+
+		if(ret){
+			//the run can't go on across a block that is skipped
+			if(bio){
+				ret = __cow_write_direct_run(cm, bio, run_block, run_pos, run_cnt);
+				bio = NULL;
+				if(ret) goto error;
+			}
+
+			block++;
+			continue;
+		}
+
+		ret = __cow_reserve_data(cm, 1, &pos);
+		if(ret) goto error;
+
+		sect = sector_by_offset(dev, pos * COW_BLOCK_SIZE, NULL);
+		if(sect == SECTOR_INVALID){
+			ret = -EFAULT;
+			LOG_ERROR(ret, "cow file block %llu is not mapped", pos);
+			goto error;
+		}
+
+		//a run goes on while its blocks follow each other in the cow file and on disk
+		if(!bio || pos != run_pos + run_cnt || sect != next_sect || bio_add_page(bio, pg, PAGE_SIZE, 0) != PAGE_SIZE){
+			if(bio){
+				ret = __cow_write_direct_run(cm, bio, run_block, run_pos, run_cnt);
+				bio = NULL;
+				if(ret) goto error;
+			}
+
+			ret = __cow_direct_bio_alloc(dev, sect, left + 1, &bio);
+			if(ret) goto error;
+
+			if(bio_add_page(bio, pg, PAGE_SIZE, 0) != PAGE_SIZE){
+				ret = -EFAULT;
+				LOG_ERROR(ret, "error adding page to direct cow write bio");
+				goto error;
+			}
+
+			run_block = block;
+			run_pos = pos;
+			run_cnt = 0;
+		}
+
+		//writes of pages belonging to the cow file are not traced
+		if(dev->sd_cow_inode) pg->mapping = dev->sd_cow_inode->i_mapping;
+
+		run_cnt++;
+		next_sect = sect + SECTORS_PER_BLOCK;
+		block++;
+	}
+
+	if(bio){
+		ret = __cow_write_direct_run(cm, bio, run_block, run_pos, run_cnt);
+		bio = NULL;
+		if(ret) goto error;
+	}
+
+	return 0;
+
+error:
+	if(bio){
+		__file_dio_bio_clear_mappings(bio);
+		bio_put(bio);
+	}
+
+	LOG_ERROR(ret, "error writing cow data and mapping directly");
+	return ret;
+}
+
+static int cow_read_data(struct cow_manager *cm, void *out_buf, uint64_t block_pos, unsigned long cnt){
+	int ret;
+
+#ifdef NETLINK_DEBUG
+	trace_event_cow(EVENT_COW_READ_DATA, cm->dev->sd_minor, block_pos, cnt);
+#endif
+
+	ret = file_read(cm, out_buf, (block_pos * COW_BLOCK_SIZE), cnt * COW_BLOCK_SIZE);
 	if(ret){
 		LOG_ERROR(ret, "error reading cow data");
 #ifdef NETLINK_DEBUG
-		trace_event_generic(EVENT_DRIVER_ERROR, ret);
+		trace_event_generic(EVENT_DRIVER_ERROR, cm->dev->sd_minor, ret);
 #endif
-		kfree(read_buf);
 		return ret;
 	}
 
-	memcpy(out_buf, read_buf + block_off, len);
-	kfree(read_buf);
-
 	return 0;
 }
 
@@ -3208,23 +4316,199 @@ static struct sector_set *sset_list_pop(struct sset_list *sl){
 	return sset;
 }
 
+static struct sector_set *__sset_list_merge(struct sector_set *a, struct sector_set *b){
+	struct sector_set head, *tail = &head;
+
+	while(a && b){
+		if(a->sect <= b->sect){
+			tail->next = a;
+			a = a->next;
+		}else{
+			tail->next = b;
+			b = b->next;
+		}
+		tail = tail->next;
+	}
+
+	tail->next = (a)? a : b;
+	return head.next;
+}
+
+static struct sector_set *__sset_list_sort(struct sector_set *head){
+	struct sector_set *slow, *fast, *mid;
+
+	if(!head || !head->next) return head;
+
+	//split the list in half and merge the sorted halves
+	slow = head;
+	fast = head->next;
+	while(fast && fast->next){
+		slow = slow->next;
+		fast = fast->next->next;
+	}
+
+	mid = slow->next;
+	slow->next = NULL;
+
+	return __sset_list_merge(__sset_list_sort(head), __sset_list_sort(mid));
+}
+
+static void sset_list_sort(struct sset_list *sl){
+	struct sector_set *sset;
+
+	sl->head = __sset_list_sort(sl->head);
+
+	sl->tail = sl->head;
+	for(sset = sl->head; sset; sset = sset->next) sl->tail = sset;
+}
+
+static struct sector_set *sset_alloc(void){
+	return mempool_alloc(sset_pool, GFP_NOIO);
+}
+
+static void sset_free(struct sector_set *sset){
+	mempool_free(sset, sset_pool);
+}
+
 /****************************BIO QUEUE FUNCTIONS****************************/
 
-static void bio_queue_init(struct bio_queue *bq){
+static void __bio_queue_init(struct bio_queue *bq, int indexed){
 	bio_list_init(&bq->bios);
+	bio_list_init(&bq->reads);
+	bq->index = RB_ROOT;
+	bq->index_span = 0;
+	bq->index_cnt = 0;
+	bq->unindexed = 0;
+	bq->seq = 0;
+	bq->indexed = indexed;
+	bq->read_turn = 0;
 	spin_lock_init(&bq->lock);
 	init_waitqueue_head(&bq->event);
+	bq->gen = 0;
+	bq->depth = 0;
 }
+#define bio_queue_init(bq) __bio_queue_init(bq, 0)
+#define bio_queue_init_indexed(bq) __bio_queue_init(bq, 1)
 
 static int bio_queue_empty(const struct bio_queue *bq){
-	return bio_list_empty(&bq->bios);
+	return bio_list_empty(&bq->bios) && bio_list_empty(&bq->reads);
+}
+
+static int __bio_queue_node_cmp(const struct bio_queue_node *bqn, sector_t sect, const struct bio *bio){
+	if(bqn->sect != sect) return (bqn->sect < sect)? -1 : 1;
+	if(bqn->bio != bio) return ((unsigned long)bqn->bio < (unsigned long)bio)? -1 : 1;
+	return 0;
+}
+
+static void __bio_queue_index_insert(struct bio_queue *bq, struct bio_queue_node *bqn){
+	struct rb_node **link = &bq->index.rb_node, *parent = NULL;
+
+	while(*link){
+		parent = *link;
+		if(__bio_queue_node_cmp(rb_entry(parent, struct bio_queue_node, node), bqn->sect, bqn->bio) < 0) link = &parent->rb_right;
+		else link = &parent->rb_left;
+	}
+
+	rb_link_node(&bqn->node, parent, link);
+	rb_insert_color(&bqn->node, &bq->index);
+
+	bq->index_cnt++;
+	if(bqn->end - bqn->sect > bq->index_span) bq->index_span = bqn->end - bqn->sect;
+}
+
+static struct bio_queue_node *__bio_queue_index_find(const struct bio_queue *bq, const struct bio *bio){
+	int cmp;
+	struct rb_node *node = bq->index.rb_node;
+	struct bio_queue_node *bqn;
+
+	while(node){
+		bqn = rb_entry(node, struct bio_queue_node, node);
+		cmp = __bio_queue_node_cmp(bqn, bio_sector(bio), bio);
+		if(!cmp) return bqn;
+
+		node = (cmp < 0)? node->rb_right : node->rb_left;
+	}
+
+	return NULL;
+}
+
+static void __bio_queue_index_erase(struct bio_queue *bq, struct bio_queue_node *bqn){
+	rb_erase(&bqn->node, &bq->index);
+	if(!--bq->index_cnt) bq->index_span = 0;
+
+	mempool_free(bqn, bio_queue_node_pool);
+}
+
+/*
+ * Returns 1 if an indexed write queued before seq overlaps [sect, end]. No write
+ * is longer than index_span, so only the writes starting from index_span sectors
+ * before sect up to end need to be looked at.
+ */
+static int __bio_queue_index_overlap(const struct bio_queue *bq, sector_t sect, sector_t end, unsigned long seq){
+	struct rb_node *node = bq->index.rb_node, *first = NULL;
+	struct bio_queue_node *bqn;
+	sector_t lo = (sect > bq->index_span)? sect - bq->index_span : 0;
+
+	//find the first write starting at or after lo
+	while(node){
+		bqn = rb_entry(node, struct bio_queue_node, node);
+		if(bqn->sect >= lo){
+			first = node;
+			node = node->rb_left;
+		}else{
+			node = node->rb_right;
+		}
+	}
+
+	for(node = first; node; node = rb_next(node)){
+		bqn = rb_entry(node, struct bio_queue_node, node);
+		if(bqn->sect > end) break;
+		if(bqn->end >= sect && (long)(bqn->seq - seq) < 0) return 1;
+	}
+
+	return 0;
+}
+
+static int __bio_queue_read_blocked(const struct bio_queue *bq, const struct bio *bio){
+	//writes missing from the index can't be searched, so reads wait for them to be dequeued
+	if(bq->unindexed) return 1;
+
+	return __bio_queue_index_overlap(bq, bio_sector(bio), bio_last_sector(bio), bq->seq);
 }
 
 static void bio_queue_add(struct bio_queue *bq, struct bio *bio){
 	unsigned long flags;
+	struct bio_queue_node *bqn = NULL;
+
+	//we may be called from a bio completion, so the index node can't wait for memory
+	if(bq->indexed && bio_data_dir(bio)){
+		bqn = mempool_alloc(bio_queue_node_pool, GFP_ATOMIC);
+		if(bqn){
+			bqn->bio = bio;
+			bqn->sect = bio_sector(bio);
+			bqn->end = bio_last_sector(bio);
+			bqn->queued = snap_now_ns();
+		}
+	}
 
 	spin_lock_irqsave(&bq->lock, flags);
-	bio_list_add(&bq->bios, bio);
+	if(!bq->indexed){
+		bio_list_add(&bq->bios, bio);
+	}else if(!bio_data_dir(bio)){
+		bio_list_add(&bq->reads, bio);
+	}else{
+		bio_list_add(&bq->bios, bio);
+
+		if(bqn){
+			bqn->seq = bq->seq;
+			__bio_queue_index_insert(bq, bqn);
+		}else{
+			bq->unindexed++;
+		}
+		bq->seq++;
+	}
+	bq->gen++;
+	bq->depth++;
 	spin_unlock_irqrestore(&bq->lock, flags);
 	wake_up(&bq->event);
 }
@@ -3235,52 +4519,168 @@ static struct bio *bio_queue_dequeue(struct bio_queue *bq){
 
 	spin_lock_irqsave(&bq->lock, flags);
 	bio = bio_list_pop(&bq->bios);
+	if(bio) bq->depth--;
 	spin_unlock_irqrestore(&bq->lock, flags);
 
 	return bio;
 }
 
-static int bio_overlap(const struct bio *bio1, const struct bio *bio2){
-	return max(bio_sector(bio1), bio_sector(bio2)) <= min(bio_sector(bio1) + (bio_size(bio1) / SECTOR_SIZE), bio_sector(bio2) + (bio_size(bio2) / SECTOR_SIZE));
+//returns the time the write was queued at, or 0 if it was not in the index
+static uint64_t __bio_queue_unlink_write(struct bio_queue *bq, struct bio *bio, struct bio *prev){
+	struct bio_queue_node *bqn;
+	uint64_t queued = 0;
+
+	if(prev) prev->bi_next = bio->bi_next;
+	else bq->bios.head = bio->bi_next;
+
+	if(bq->bios.tail == bio) bq->bios.tail = prev;
+	bio->bi_next = NULL;
+
+	bqn = __bio_queue_index_find(bq, bio);
+	if(bqn){
+		queued = bqn->queued;
+		__bio_queue_index_erase(bq, bqn);
+	}else{
+		bq->unindexed--;
+	}
+
+	return queued;
 }
 
-static struct bio *bio_queue_dequeue_delay_read(struct bio_queue *bq){
+/*
+ * Dequeues the next bio of an indexed queue. Reads and writes take turns, but a
+ * read is held back while any queued write overlaps it, so that the writes are
+ * processed in order until the read is able to see their data.
+ */
+static struct bio *bio_queue_dequeue_delay_read(struct bio_queue *bq, uint64_t *queued){
 	unsigned long flags;
-	struct bio *bio, *tmp, *prev = NULL;
+	struct bio *read, *bio = NULL;
+	int read_ready;
 
+	*queued = 0;
 	spin_lock_irqsave(&bq->lock, flags);
-	bio = bio_list_pop(&bq->bios);
 
-	if(!bio_data_dir(bio)){
-		bio_list_for_each(tmp, &bq->bios){
-			if(bio_data_dir(tmp) && bio_overlap(bio, tmp)){
-				if(prev) prev->bi_next = bio;
-				else bq->bios.head = bio;
+	read = bq->reads.head;
+	read_ready = read && !__bio_queue_read_blocked(bq, read);
 
-				if(bq->bios.tail == tmp) bq->bios.tail = bio;
+	if(read_ready && (bq->read_turn || bio_list_empty(&bq->bios))){
+		bio = bio_list_pop(&bq->reads);
+		bq->read_turn = 0;
+	}else if(!bio_list_empty(&bq->bios)){
+		bio = bq->bios.head;
+		*queued = __bio_queue_unlink_write(bq, bio, NULL);
+		bq->read_turn = 1;
+	}
 
-				bio->bi_next = tmp->bi_next;
-				tmp->bi_next = NULL;
-				bio = tmp;
+	if(bio) bq->depth--;
+	spin_unlock_irqrestore(&bq->lock, flags);
 
-				goto out;
-			}
-			prev = tmp;
+	return bio;
+}
+
+static int __snap_cow_worker_conflict(const struct snap_device *dev, const struct bio *bio){
+	unsigned int i;
+	const struct snap_cow_worker *w;
+	int is_write = bio_data_dir(bio);
+	sector_t sect = bio_sector(bio), end = bio_last_sector(bio);
+
+	//never run alongside an overlapping bio if either of them is a write
+	for(i = 0; i < dev->sd_cow_workers; i++){
+		w = &dev->sd_workers[i];
+		if(w->busy && (is_write || w->is_write) && max(sect, w->sect) <= min(end, w->end)) return 1;
+	}
+
+	return 0;
+}
+
+static int __snap_cow_write_ready(const struct snap_device *dev, const struct bio *bio, const struct bio *prev){
+	const struct bio_queue *bq = &dev->sd_cow_bios;
+	const struct bio_queue_node *bqn;
+
+	if(__snap_cow_worker_conflict(dev, bio)) return 0;
+
+	//the first queued write has nothing ahead of it, the others wait for earlier overlapping writes
+	if(!prev) return 1;
+	if(bq->unindexed) return 0;
+
+	bqn = __bio_queue_index_find(bq, bio);
+	return bqn && !__bio_queue_index_overlap(bq, bqn->sect, bqn->end, bqn->seq);
+}
+
+/*
+ * Dequeues a bio that may be processed alongside the bios the other workers are
+ * busy with, preserving the ordering bio_queue_dequeue_delay_read() gives a single
+ * worker. Only the first SNAP_COW_WORKER_SCAN_MAX writes are considered. If there
+ * is nothing ready, NULL is returned and gen is set to the queue generation the
+ * caller should wait to change.
+ */
+static struct bio *snap_cow_worker_dequeue(struct snap_cow_worker *w, unsigned long *gen, uint64_t *queued){
+	unsigned long flags;
+	unsigned int i;
+	struct snap_device *dev = w->dev;
+	struct bio_queue *bq = &dev->sd_cow_bios;
+	struct bio *read, *bio, *prev = NULL;
+	int read_ready;
+
+	*queued = 0;
+	spin_lock_irqsave(&bq->lock, flags);
+
+	read = bq->reads.head;
+	read_ready = read && !__bio_queue_read_blocked(bq, read) && !__snap_cow_worker_conflict(dev, read);
+
+	if(read_ready && (bq->read_turn || bio_list_empty(&bq->bios))) goto dequeue_read;
+
+	for(bio = bq->bios.head, i = 0; bio && i < SNAP_COW_WORKER_SCAN_MAX; prev = bio, bio = bio->bi_next, i++){
+		if(__snap_cow_write_ready(dev, bio, prev)){
+			*queued = __bio_queue_unlink_write(bq, bio, prev);
+			bq->read_turn = 1;
+			goto out;
 		}
 	}
 
+	//no write was ready, so the read may go out of turn
+	if(read_ready) goto dequeue_read;
+
+	bio = NULL;
+	*gen = bq->gen;
+	goto out;
+
+dequeue_read:
+	bio = bio_list_pop(&bq->reads);
+	bq->read_turn = 0;
+
 out:
+	if(bio){
+		bq->depth--;
+		w->busy = true;
+		w->is_write = bio_data_dir(bio);
+		w->sect = bio_sector(bio);
+		w->end = bio_last_sector(bio);
+	}
+
 	spin_unlock_irqrestore(&bq->lock, flags);
 
 	return bio;
 }
 
+static void snap_cow_worker_done(struct snap_cow_worker *w){
+	unsigned long flags;
+	struct bio_queue *bq = &w->dev->sd_cow_bios;
+
+	spin_lock_irqsave(&bq->lock, flags);
+	w->busy = false;
+	bq->gen++;
+	spin_unlock_irqrestore(&bq->lock, flags);
+	wake_up(&bq->event);
+}
+
 /****************************SSET QUEUE FUNCTIONS****************************/
 
 static void sset_queue_init(struct sset_queue *sq){
 	sset_list_init(&sq->ssets);
 	spin_lock_init(&sq->lock);
 	init_waitqueue_head(&sq->event);
+	sq->depth = 0;
 }
 
 static int sset_queue_empty(const struct sset_queue *sq){
@@ -3292,19 +4692,19 @@ static void sset_queue_add(struct sset_queue *sq, struct sector_set *sset){
 
 	spin_lock_irqsave(&sq->lock, flags);
 	sset_list_add(&sq->ssets, sset);
+	sq->depth++;
 	spin_unlock_irqrestore(&sq->lock, flags);
 	wake_up(&sq->event);
 }
 
-static struct sector_set *sset_queue_dequeue(struct sset_queue *sq){
+static void sset_queue_dequeue_all(struct sset_queue *sq, struct sset_list *sl){
 	unsigned long flags;
-	struct sector_set *sset;
 
 	spin_lock_irqsave(&sq->lock, flags);
-	sset = sset_list_pop(&sq->ssets);
+	*sl = sq->ssets;
+	sset_list_init(&sq->ssets);
+	sq->depth = 0;
 	spin_unlock_irqrestore(&sq->lock, flags);
-
-	return sset;
 }
 
 /***************************TRACING PARAMS FUNCTIONS**************************/
@@ -3312,7 +4712,7 @@ static struct sector_set *sset_queue_dequeue(struct sset_queue *sq){
 static int tp_alloc(struct snap_device *dev, struct bio *bio, struct tracing_params **tp_out){
 	struct tracing_params *tp;
 
-	tp = kzalloc(1 * sizeof(struct tracing_params), GFP_NOIO);
+	tp = mempool_alloc(tp_pool, GFP_NOIO);
 	if(!tp){
 		LOG_ERROR(-ENOMEM, "error allocating tracing parameters struct");
 		*tp_out = tp;
@@ -3321,8 +4721,10 @@ static int tp_alloc(struct snap_device *dev, struct bio *bio, struct tracing_par
 
 	tp->dev = dev;
 	tp->orig_bio = bio;
-	tp->bio_sects.head = NULL;
-	tp->bio_sects.tail = NULL;
+	tp->nr_maps = 0;
+	tp->extra_maps = NULL;
+	tp->start = snap_now_ns();
+	tp->clone_start = 0;
 	atomic_set(&tp->refs, 1);
 
 	*tp_out = tp;
@@ -3336,45 +4738,49 @@ static void tp_get(struct tracing_params *tp){
 static void tp_put(struct tracing_params *tp){
 	//drop a reference to the tp
 	if(atomic_dec_and_test(&tp->refs)){
-		struct bio_sector_map *next, *curr = NULL;
+		struct bio_sector_map *next, *map;
 
 		//if there are no references left, its safe to release the orig_bio
+		snap_hist_add(tp->dev, SNAP_HIST_TRACE, tp->start);
 		bio_queue_add(&tp->dev->sd_orig_bios, tp->orig_bio);
 
 #ifdef NETLINK_DEBUG
-		trace_event_bio(EVENT_BIO_RELEASED, tp->orig_bio, 0);
+		trace_event_bio(EVENT_BIO_RELEASED, tp->dev->sd_minor, tp->orig_bio, 0);
 #endif
 
-		// free nodes in the sector map list
-		for (curr = tp->bio_sects.head; curr != NULL; curr = next)
-		{
-			next = curr->next;
-			kfree(curr);
+		//the first map is part of the tp, only the others were allocated
+		for(map = tp->extra_maps; map; map = next){
+			next = map->next;
+			mempool_free(map, bio_sector_map_pool);
 		}
-		kfree(tp);
+		mempool_free(tp, tp_pool);
 	}
 }
 
-static int tp_add(struct tracing_params* tp, struct bio* bio) {
-	struct bio_sector_map* map;
-	map = kzalloc(1 * sizeof(struct bio_sector_map), GFP_NOIO);
-	if (!map) {
-		LOG_ERROR(-ENOMEM, "error allocating new bio_sector_map struct");
-		return -ENOMEM;
-	}
+//returns the map for the next read clone of the tp, which starts at sect
+static int tp_add(struct tracing_params *tp, sector_t sect, struct bio_sector_map **map_out){
+	struct bio_sector_map *map;
 
-	map->bio = bio;
-	map->sect = bio_sector(bio);
-	map->size = bio_size(bio);
-	map->next = NULL;
-	if (tp->bio_sects.head == NULL) {
-		tp->bio_sects.head = map;
-		tp->bio_sects.tail = map;
-	}
-	else {
-		tp->bio_sects.tail->next = map;
-		tp->bio_sects.tail = map;
+	if(!tp->nr_maps){
+		map = &tp->first_map;
+		map->next = NULL;
+	}else{
+		map = mempool_alloc(bio_sector_map_pool, GFP_NOIO);
+		if(!map){
+			LOG_ERROR(-ENOMEM, "error allocating new bio_sector_map struct");
+			*map_out = NULL;
+			return -ENOMEM;
+		}
+
+		map->next = tp->extra_maps;
+		tp->extra_maps = map;
 	}
+
+	map->tp = tp;
+	map->sect = sect;
+	tp->nr_maps++;
+
+	*map_out = map;
 	return 0;
 }
 
@@ -3475,8 +4881,8 @@ static int bio_needs_cow(struct bio *bio, struct snap_device *dev){
 
 #ifndef HAVE_BIO_BI_POOL
 static void bio_destructor_tp(struct bio *bio){
-	struct tracing_params *tp = bio->bi_private;
-	bio_free(bio, dev_bioset(tp->dev));
+	struct bio_sector_map *map = bio->bi_private;
+	bio_free(bio, dev_bioset(map->tp->dev));
 }
 
 static void bio_destructor_snap_dev(struct bio *bio){
@@ -3485,16 +4891,65 @@ static void bio_destructor_snap_dev(struct bio *bio){
 }
 #endif
 
-static void bio_free_clone(struct bio *bio){
+static unsigned long snap_page_pool_size(unsigned long cache_size){
+	if(!cache_size) cache_size = elastio_snap_cow_max_memory_default;
+	return max_t(unsigned long, cache_size / CLONE_PAGE_POOL_DIV / PAGE_SIZE, BIO_MAX_PAGES);
+}
+
+/*
+ * Pages of read clones come from the page allocator while it has some to
+ * spare and from the reserve of the device otherwise. The reserve is refilled
+ * as the cow threads free the clones they are done with, so a clone always
+ * gets its pages eventually.
+ */
+static struct page *snap_clone_page_alloc(struct snap_device *dev){
+	struct page *pg;
+	unsigned long used;
+
+	if(dev->sd_page_pool) pg = mempool_alloc(dev->sd_page_pool, GFP_NOIO);
+	else pg = alloc_page(GFP_NOIO);
+	if(!pg) return NULL;
+
+	//the high-water mark may miss a concurrent update, which is fine for a statistic
+	used = atomic_long_inc_return(&dev->sd_clone_pages);
+	if(used > ACCESS_ONCE(dev->sd_clone_pages_max)) dev->sd_clone_pages_max = used;
+
+	return pg;
+}
+
+static void snap_clone_page_free(struct snap_device *dev, struct page *pg){
+	atomic_long_dec(&dev->sd_clone_pages);
+
+	if(dev->sd_page_pool) mempool_free(pg, dev->sd_page_pool);
+	else __free_page(pg);
+}
+
+static void bio_free_clone(struct snap_device *dev, struct bio *bio){
+	struct bio_vec *bvec;
+#ifdef HAVE_BVEC_ITER_ALL
+	struct bvec_iter_all iter;
+#else
+	int i = 0;
+#endif
+
 #ifdef NETLINK_DEBUG
-	trace_event_bio(EVENT_BIO_FREE, bio, 0);
+	trace_event_bio(EVENT_BIO_FREE, dev->sd_minor, bio, 0);
 #endif
-	bio_free_pages(bio);
+
+#ifdef HAVE_BVEC_ITER_ALL
+	bio_for_each_segment_all(bvec, bio, iter) {
+#else
+	bio_for_each_segment_all(bvec, bio, i) {
+#endif
+		if(bvec->bv_page) snap_clone_page_free(dev, bvec->bv_page);
+	}
+
 	bio_put(bio);
 }
 
-static int bio_make_read_clone(struct block_device *bdev, struct bio_set *bs, struct tracing_params *tp, struct bio *orig_bio, sector_t sect, unsigned int pages, struct bio **bio_out, unsigned int *bytes_added){
+static int bio_make_read_clone(struct block_device *bdev, struct bio_set *bs, struct bio_sector_map *map, struct bio *orig_bio, sector_t sect, unsigned int pages, struct bio **bio_out, unsigned int *bytes_added){
 	int ret;
+	struct tracing_params *tp = map->tp;
 	struct bio *new_bio;
 	struct page *pg;
 	unsigned int i, bytes, total = 0, actual_pages = (pages > BIO_MAX_PAGES)? BIO_MAX_PAGES : pages;
@@ -3517,7 +4972,7 @@ static int bio_make_read_clone(struct block_device *bdev, struct bio_set *bs, st
 
 	//populate read bio
 	tp_get(tp);
-	new_bio->bi_private = tp;
+	new_bio->bi_private = map;
 	new_bio->bi_end_io = on_bio_read_complete;
 	elastio_snap_bio_copy_dev(new_bio, orig_bio);
 	elastio_snap_set_bio_ops(new_bio, REQ_OP_READ, 0);
@@ -3545,7 +5000,7 @@ static int bio_make_read_clone(struct block_device *bdev, struct bio_set *bs, st
 	//fill the bio with pages
 	for(i = 0; i < actual_pages; i++){
 		//allocate a page and add it to our bio
-		pg = alloc_page(GFP_NOIO);
+		pg = snap_clone_page_alloc(tp->dev);
 		if(!pg){
 			ret = -ENOMEM;
 			LOG_ERROR(ret, "error allocating read bio page %u", i);
@@ -3555,7 +5010,7 @@ static int bio_make_read_clone(struct block_device *bdev, struct bio_set *bs, st
 		//add the page to the bio
 		bytes = bio_add_page(new_bio, pg, PAGE_SIZE, 0);
 		if(bytes != PAGE_SIZE){
-			__free_page(pg);
+			snap_clone_page_free(tp->dev, pg);
 			break;
 		}
 
@@ -3565,7 +5020,7 @@ static int bio_make_read_clone(struct block_device *bdev, struct bio_set *bs, st
 	*bytes_added = total;
 	*bio_out = new_bio;
 #ifdef NETLINK_DEBUG
-	trace_event_bio(EVENT_BIO_CLONED, new_bio, 0);
+	trace_event_bio(EVENT_BIO_CLONED, tp->dev->sd_minor, new_bio, (uint64_t)orig_bio);
 #endif
 	return 0;
 
@@ -3573,60 +5028,157 @@ error:
 	if(ret) LOG_ERROR(ret, "error creating read clone of write bio");
 
 #ifdef NETLINK_DEBUG
-	trace_event_generic(EVENT_DRIVER_ERROR, ret);
+	trace_event_generic(EVENT_DRIVER_ERROR, tp->dev->sd_minor, ret);
 #endif
 
-	if(new_bio) bio_free_clone(new_bio);
+	//the clone took a reference to the tp, the caller still holds its own
+	if(new_bio){
+		bio_free_clone(tp->dev, new_bio);
+		tp_put(tp);
+	}
 
 	*bytes_added = 0;
 	*bio_out = NULL;
 	return ret;
 }
 
+/****************************SNAP READ CACHE FUNCTIONS****************************/
+
+static void snap_read_ahead_work(struct work_struct *work);
+
+static void snap_read_cache_free(struct snap_read_cache *rc){
+	if(!rc) return;
+
+	if(rc->ra_buf) vfree(rc->ra_buf);
+	if(rc->data) vfree(rc->data);
+	if(rc->pos) kfree(rc->pos);
+	kfree(rc);
+}
+
+static int snap_read_cache_alloc(struct snap_device *dev, unsigned long nr_blocks, struct snap_read_cache **rc_out){
+	int ret;
+	struct snap_read_cache *rc;
+
+	rc = kzalloc(sizeof(struct snap_read_cache), GFP_KERNEL);
+	if(!rc){
+		ret = -ENOMEM;
+		LOG_ERROR(ret, "error allocating snapshot read cache");
+		goto error;
+	}
+
+	mutex_init(&rc->lock);
+	rc->nr_blocks = nr_blocks;
+	rc->dev = dev;
+	INIT_WORK(&rc->ra_work, snap_read_ahead_work);
+
+	rc->pos = kcalloc(nr_blocks, sizeof(uint64_t), GFP_KERNEL);
+	if(!rc->pos){
+		ret = -ENOMEM;
+		LOG_ERROR(ret, "error allocating snapshot read cache slots");
+		goto error;
+	}
+
+	rc->data = vmalloc(nr_blocks * COW_BLOCK_SIZE);
+	if(!rc->data){
+		ret = -ENOMEM;
+		LOG_ERROR(ret, "error allocating snapshot read cache data");
+		goto error;
+	}
+
+	rc->ra_buf = vmalloc(SNAP_READ_BUF_BLOCKS * COW_BLOCK_SIZE);
+	if(!rc->ra_buf){
+		ret = -ENOMEM;
+		LOG_ERROR(ret, "error allocating snapshot readahead buffer");
+		goto error;
+	}
+
+	*rc_out = rc;
+	return 0;
+
+error:
+	snap_read_cache_free(rc);
+	*rc_out = NULL;
+	return ret;
+}
+
+static char *__snap_read_cache_find(struct snap_read_cache *rc, uint64_t pos){
+	uint64_t slot_idx = pos;
+	unsigned long slot = do_div(slot_idx, rc->nr_blocks);
+
+	//cow data never starts at block 0, so it marks an empty slot
+	if(rc->pos[slot] != pos) return NULL;
+	return rc->data + (size_t)slot * COW_BLOCK_SIZE;
+}
+
+static void snap_read_cache_fill(struct snap_read_cache *rc, uint64_t pos, unsigned long cnt, const char *buf){
+	unsigned long i, slot;
+	uint64_t slot_idx;
+
+	mutex_lock(&rc->lock);
+	for(i = 0; i < cnt; i++){
+		slot_idx = pos + i;
+		slot = do_div(slot_idx, rc->nr_blocks);
+
+		rc->pos[slot] = pos + i;
+		memcpy(rc->data + (size_t)slot * COW_BLOCK_SIZE, buf + (size_t)i * COW_BLOCK_SIZE, COW_BLOCK_SIZE);
+	}
+	mutex_unlock(&rc->lock);
+}
+
 /*******************BIO / SECTOR_SET PROCESSING LOGIC***********************/
 
-static int snap_read_bio_get_mode(const struct snap_device *dev, struct bio *bio, int *mode){
-	int ret, start_mode = 0;
-	bio_iter_t iter;
-	bio_iter_bvec_t bvec;
-	unsigned int bytes;
-	uint64_t block_mapping, curr_byte, curr_end_byte = bio_sector(bio) * SECTOR_SIZE;
+static int snap_read_bio_get_mode(const uint64_t *mappings, unsigned long nr_blocks){
+	unsigned long i, mapped = 0;
+
+	for(i = 0; i < nr_blocks; i++){
+		if(mappings[i]) mapped++;
+	}
+
+	if(!mapped) return READ_MODE_BASE_DEVICE;
+	if(mapped == nr_blocks) return READ_MODE_COW_FILE;
+	return READ_MODE_MIXED;
+}
+
+static int snap_read_cow_blocks(const struct snap_device *dev, char *buf, uint64_t pos, unsigned long cnt){
+	int ret;
+	unsigned long i = 0, miss;
+	struct snap_read_cache *rc = dev->sd_read_cache;
+	char *cached;
 
-	bio_for_each_segment(bvec, bio, iter){
-		//reset the number of bytes we have traversed for this bio_vec
-		bytes = 0;
+	if(!rc) return cow_read_data(dev->sd_cow, buf, pos, cnt);
 
-		//while we still have data left to be written into the page
-		while(bytes < bio_iter_len(bio, iter)){
-			//find the start and stop byte for our next write
-			curr_byte = curr_end_byte;
-			curr_end_byte += min(COW_BLOCK_SIZE - (curr_byte % COW_BLOCK_SIZE), ((uint64_t)bio_iter_len(bio, iter) - bytes));
+	while(i < cnt){
+		//copy out the cached blocks and count the ones following them that have to be read
+		mutex_lock(&rc->lock);
+		for(; i < cnt && (cached = __snap_read_cache_find(rc, pos + i)); i++){
+			memcpy(buf + (size_t)i * COW_BLOCK_SIZE, cached, COW_BLOCK_SIZE);
+		}
+		for(miss = 0; i + miss < cnt && !__snap_read_cache_find(rc, pos + i + miss); miss++);
+		mutex_unlock(&rc->lock);
 
-			//check if the mapping exists
-			ret = cow_read_mapping(dev->sd_cow, curr_byte / COW_BLOCK_SIZE, &block_mapping);
-			if(ret) goto error;
+		if(!miss) break;
 
-			if(!start_mode && block_mapping) start_mode = READ_MODE_COW_FILE;
-			else if(!start_mode && !block_mapping) start_mode = READ_MODE_BASE_DEVICE;
-			else if((start_mode == READ_MODE_COW_FILE && !block_mapping) || (start_mode == READ_MODE_BASE_DEVICE && block_mapping)){
-				*mode = READ_MODE_MIXED;
-				return 0;
-			}
+		ret = cow_read_data(dev->sd_cow, buf + (size_t)i * COW_BLOCK_SIZE, pos + i, miss);
+		if(ret) return ret;
 
-			//increment the number of bytes we have written
-			bytes += curr_end_byte - curr_byte;
-		}
+		snap_read_cache_fill(rc, pos + i, miss, buf + (size_t)i * COW_BLOCK_SIZE);
+		i += miss;
 	}
 
-	*mode = start_mode;
 	return 0;
+}
 
-error:
-	LOG_ERROR(ret, "error finding read mode");
-	return ret;
+static int snap_read_cow_run(const struct snap_device *dev, char *buf, const uint64_t *mappings, unsigned long idx, unsigned long nr_blocks, unsigned long *run_end){
+	unsigned long cnt = 1;
+
+	//gather the following blocks that are also contiguous in the cow file
+	while(idx + cnt < nr_blocks && cnt < SNAP_READ_BUF_BLOCKS && mappings[idx + cnt] == mappings[idx] + cnt) cnt++;
+
+	*run_end = idx + cnt;
+	return snap_read_cow_blocks(dev, buf, mappings[idx], cnt);
 }
 
-static int snap_handle_read_bio(const struct snap_device *dev, struct bio *bio){
+static int snap_handle_read_bio(const struct snap_device *dev, struct bio *bio, char *buf, uint64_t *mappings_buf){
 	int ret, mode;
 	struct bio_vec *bvec;
 #ifdef HAVE_BVEC_ITER_ALL
@@ -3637,9 +5189,11 @@ static int snap_handle_read_bio(const struct snap_device *dev, struct bio *bio){
 	void *orig_private;
 	bio_end_io_t *orig_end_io;
 	char *data;
-	sector_t bio_orig_sect, cur_block, cur_sect;
+	sector_t bio_orig_sect, cur_block, cur_sect, start_block;
 	unsigned int bio_orig_idx, bio_orig_size;
-	uint64_t block_mapping, bytes_to_copy, block_off, bvec_off;
+	unsigned long nr_blocks, idx, run_start = 0, run_end = 0;
+	uint64_t *mappings = NULL, bytes_to_copy, block_off, bvec_off;
+	unsigned long *unused = ACCESS_ONCE(dev->sd_unused);
 
 	//save the original state of the bio
 	orig_private = bio->bi_private;
@@ -3651,22 +5205,50 @@ static int snap_handle_read_bio(const struct snap_device *dev, struct bio *bio){
 	elastio_snap_bio_set_dev(bio, dev->sd_base_dev);
 	elastio_snap_set_bio_ops(bio, REQ_OP_READ, READ_SYNC);
 
-	//detect fastpath for bios completely contained within either the cow file or the base device
-	ret = snap_read_bio_get_mode(dev, bio, &mode);
+	//look up the mappings of all the blocks the bio touches at once
+	start_block = SECTOR_TO_BLOCK(bio_orig_sect);
+	nr_blocks = SECTOR_TO_BLOCK(bio_last_sector(bio) + SECTORS_PER_BLOCK - 1) - start_block;
+
+	if(nr_blocks <= SNAP_READ_MAPPINGS){
+		mappings = mappings_buf;
+	}else{
+		mappings = kmalloc(nr_blocks * sizeof(uint64_t), GFP_NOIO);
+		if(!mappings){
+			ret = -ENOMEM;
+			LOG_ERROR(ret, "error allocating mappings for read");
+			goto out;
+		}
+	}
+
+	ret = cow_read_mappings(dev->sd_cow, start_block, nr_blocks, mappings);
 	if(ret) goto out;
 
+	//blocks the filesystem did not use at snapshot time read as zeros, whatever was written to them since
+	if(unused){
+		//pairs with the barrier before the bitmap is published by the ioctl
+		smp_rmb();
+
+		for(idx = 0; idx < nr_blocks; idx++){
+			if(test_bit(start_block + idx, unused)) mappings[idx] = COW_UNUSED_MAPPING;
+		}
+	}
+
+	//detect fastpath for bios completely contained within either the cow file or the base device
+	mode = snap_read_bio_get_mode(mappings, nr_blocks);
+	snap_stat_inc(dev, SNAP_STAT_READS_COW + mode - READ_MODE_COW_FILE);
+
 	//submit the bio to the base device and wait for completion
 	if(mode != READ_MODE_COW_FILE){
 
 #ifdef NETLINK_DEBUG
-		trace_event_bio(EVENT_BIO_HANDLE_READ_BASE, bio, 0);
+		trace_event_bio(EVENT_BIO_HANDLE_READ_BASE, dev->sd_minor, bio, 0);
 #endif
 
 		ret = elastio_snap_submit_bio_wait(bio);
 		if(ret){
 			LOG_ERROR(ret, "error reading from base device for read");
 #ifdef NETLINK_DEBUG
-			trace_event_generic(EVENT_DRIVER_ERROR, ret);
+			trace_event_generic(EVENT_DRIVER_ERROR, dev->sd_minor, ret);
 #endif
 			goto out;
 		}
@@ -3680,7 +5262,7 @@ static int snap_handle_read_bio(const struct snap_device *dev, struct bio *bio){
 	if(mode != READ_MODE_BASE_DEVICE){
 
 #ifdef NETLINK_DEBUG
-		trace_event_bio(EVENT_BIO_HANDLE_READ_COW, bio, 0);
+		trace_event_bio(EVENT_BIO_HANDLE_READ_COW, dev->sd_minor, bio, 0);
 #endif
 
 	//reset the bio
@@ -3704,20 +5286,23 @@ static int snap_handle_read_bio(const struct snap_device *dev, struct bio *bio){
 
 			while(bvec_off < bvec->bv_offset + bvec->bv_len){
 				bytes_to_copy = min(bvec->bv_offset + bvec->bv_len - bvec_off, COW_BLOCK_SIZE - block_off);
-				//check if the mapping exists
-				ret = cow_read_mapping(dev->sd_cow, cur_block, &block_mapping);
-				if(ret){
-					kunmap(bvec->bv_page);
-					goto out;
-				}
+				idx = cur_block - start_block;
 
 				//if the mapping exists, read it into the page, overwriting the live data
-				if(block_mapping){
-					ret = cow_read_data(dev->sd_cow, data + bvec_off, block_mapping, block_off, bytes_to_copy);
-					if(ret){
-						kunmap(bvec->bv_page);
-						goto out;
+				if(mappings[idx] == COW_UNUSED_MAPPING){
+					memset(data + bvec_off, 0, bytes_to_copy);
+				}else if(mappings[idx]){
+					//the blocks are read in runs that are contiguous in the cow file
+					if(idx < run_start || idx >= run_end){
+						ret = snap_read_cow_run(dev, buf, mappings, idx, nr_blocks, &run_end);
+						if(ret){
+							kunmap(bvec->bv_page);
+							goto out;
+						}
+						run_start = idx;
 					}
+
+					memcpy(data + bvec_off, buf + (size_t)(idx - run_start) * COW_BLOCK_SIZE + block_off, bytes_to_copy);
 				}
 
 				cur_sect += bytes_to_copy / SECTOR_SIZE;
@@ -3734,13 +5319,13 @@ static int snap_handle_read_bio(const struct snap_device *dev, struct bio *bio){
 out:
 
 #ifdef NETLINK_DEBUG
-	trace_event_bio(EVENT_BIO_HANDLE_READ_DONE, bio, 0);
+	trace_event_bio(EVENT_BIO_HANDLE_READ_DONE, dev->sd_minor, bio, 0);
 #endif
 
 	if(ret) {
 
 #ifdef NETLINK_DEBUG
-		trace_event_generic(EVENT_DRIVER_ERROR, ret);
+		trace_event_generic(EVENT_DRIVER_ERROR, dev->sd_minor, ret);
 #endif
 
 		LOG_ERROR(ret, "error handling read bio");
@@ -3753,9 +5338,88 @@ out:
 	bio->bi_private = orig_private;
 	bio->bi_end_io = orig_end_io;
 
+	if(mappings && mappings != mappings_buf) kfree(mappings);
 	return ret;
 }
 
+/*
+ * Queues the readahead of the cow data of the blocks following a sequential
+ * snapshot read into the read cache. Readahead is started once half of the
+ * previous one has been consumed. It is read by a work item so the cow workers
+ * can go on serving reads meanwhile.
+ */
+static void snap_read_ahead(const struct snap_device *dev, sector_t sect, sector_t end){
+	int sequential;
+	struct snap_read_cache *rc = dev->sd_read_cache;
+	sector_t start_block = SECTOR_TO_BLOCK(sect), end_block = SECTOR_TO_BLOCK(end + SECTORS_PER_BLOCK - 1), ra_start, ra_end;
+	unsigned long ra;
+
+	if(!rc) return;
+
+	ra = min3((unsigned long)elastio_snap_cow_readahead, (unsigned long)SNAP_READ_BUF_BLOCKS, rc->nr_blocks);
+	if(!ra) return;
+
+	mutex_lock(&rc->lock);
+	sequential = (start_block == rc->next_block);
+	rc->next_block = end_block;
+
+	if(!sequential || end_block + ra / 2 < rc->ra_end){
+		mutex_unlock(&rc->lock);
+		return;
+	}
+
+	ra_start = max(end_block, rc->ra_end);
+	ra_end = min(end_block + ra, SECTOR_TO_BLOCK(dev->sd_size));
+	rc->ra_end = end_block + ra;
+
+	if(ra_start >= ra_end){
+		mutex_unlock(&rc->lock);
+		return;
+	}
+
+	//extend the pending readahead if it is followed by this one, otherwise the reader has moved on and it is replaced
+	if(rc->ra_pending_start == rc->ra_pending_end || ra_start != rc->ra_pending_end) rc->ra_pending_start = ra_start;
+	rc->ra_pending_end = ra_end;
+	mutex_unlock(&rc->lock);
+
+	schedule_work(&rc->ra_work);
+}
+
+//reads the pending readahead into the read cache, errors are left for the reads of those blocks to report
+static void snap_read_ahead_work(struct work_struct *work){
+	int ret;
+	struct snap_read_cache *rc = container_of(work, struct snap_read_cache, ra_work);
+	struct snap_device *dev = rc->dev;
+	uint64_t mappings[SNAP_READ_BUF_BLOCKS];
+	sector_t ra_start, ra_end;
+	unsigned long i, run, cnt;
+
+	mutex_lock(&rc->lock);
+	ra_start = rc->ra_pending_start;
+	ra_end = rc->ra_pending_end;
+	rc->ra_pending_start = rc->ra_pending_end;
+	mutex_unlock(&rc->lock);
+
+	for(; ra_start < ra_end; ra_start += cnt){
+		if(tracer_read_fail_state(dev)) return;
+
+		cnt = min_t(sector_t, ra_end - ra_start, SNAP_READ_BUF_BLOCKS);
+
+		ret = cow_read_mappings(dev->sd_cow, ra_start, cnt, mappings);
+		if(ret) return;
+
+		for(i = 0; i < cnt; i += run){
+			run = 1;
+			if(!mappings[i] || mappings[i] == COW_UNUSED_MAPPING) continue;
+
+			while(i + run < cnt && mappings[i + run] == mappings[i] + run) run++;
+
+			ret = snap_read_cow_blocks(dev, rc->ra_buf, mappings[i], run);
+			if(ret) return;
+		}
+	}
+}
+
 static int snap_handle_write_bio(const struct snap_device *dev, struct bio *bio){
 	int ret;
 	char *data;
@@ -3774,9 +5438,16 @@ static int snap_handle_write_bio(const struct snap_device *dev, struct bio *bio)
 	 * bio and can guarantee that we have access to its bvecs
 	 */
 #ifdef NETLINK_DEBUG
-	trace_event_bio(EVENT_BIO_HANDLE_WRITE, bio, 0);
+	trace_event_bio(EVENT_BIO_HANDLE_WRITE, dev->sd_minor, bio, 0);
 #endif
 
+	//while the cow file is closed its data goes straight to disk, so the pages of the clone can be written as they are
+	if(PAGE_SIZE == COW_BLOCK_SIZE && !dev->sd_cow->filp && dev->sd_cow_extents && test_bit(COW_ON_BDEV, &dev->sd_cow_state)){
+		ret = cow_write_current_direct(dev->sd_cow, bio);
+		if(ret) goto error;
+		goto out;
+	}
+
 #ifdef HAVE_BVEC_ITER_ALL
 	//iterate through the bio and handle each segment (which is guaranteed to be block aligned)
 	bio_for_each_segment_all(bvec, bio, iter) {
@@ -3801,8 +5472,9 @@ static int snap_handle_write_bio(const struct snap_device *dev, struct bio *bio)
 		kunmap(bvec->bv_page);
 	}
 
+out:
 #ifdef NETLINK_DEBUG
-	trace_event_bio(EVENT_BIO_HANDLE_WRITE_DONE, bio, 0);
+	trace_event_bio(EVENT_BIO_HANDLE_WRITE_DONE, dev->sd_minor, bio, 0);
 #endif
 
 	return 0;
@@ -3810,20 +5482,42 @@ static int snap_handle_write_bio(const struct snap_device *dev, struct bio *bio)
 error:
 
 #ifdef NETLINK_DEBUG
-	trace_event_generic(EVENT_DRIVER_ERROR, ret);
+	trace_event_generic(EVENT_DRIVER_ERROR, dev->sd_minor, ret);
 #endif
 
 	LOG_ERROR(ret, "error handling write bio");
 	return ret;
 }
 
-static int inc_handle_sset(const struct snap_device *dev, struct sector_set *sset){
-	int ret;
-	sector_t start_block = SECTOR_TO_BLOCK(sset->sect);
-	sector_t end_block = NUM_SEGMENTS(sset->sect + sset->len, COW_BLOCK_LOG_SIZE - SECTOR_SHIFT);
+static int inc_handle_ssets(const struct snap_device *dev, struct sset_list *sl){
+	int ret = 0;
+	struct sector_set *sset;
+	sector_t start_block, end_block, run_start = 0, run_end = 0;
 
-	for(; start_block < end_block; start_block++){
-		ret = cow_write_filler_mapping(dev->sd_cow, start_block);
+	//sort the batch so that overlapping and adjacent ranges can be merged
+	sset_list_sort(sl);
+
+	while((sset = sset_list_pop(sl))){
+		start_block = SECTOR_TO_BLOCK(sset->sect);
+		end_block = NUM_SEGMENTS(sset->sect + sset->len, COW_BLOCK_LOG_SIZE - SECTOR_SHIFT);
+		sset_free(sset);
+
+		if(run_end > run_start && start_block <= run_end){
+			if(end_block > run_end) run_end = end_block;
+			continue;
+		}
+
+		if(run_end > run_start){
+			ret = cow_write_filler_mappings(dev->sd_cow, run_start, run_end - run_start);
+			if(ret) goto error;
+		}
+
+		run_start = start_block;
+		run_end = end_block;
+	}
+
+	if(run_end > run_start){
+		ret = cow_write_filler_mappings(dev->sd_cow, run_start, run_end - run_start);
 		if(ret) goto error;
 	}
 
@@ -3831,6 +5525,7 @@ static int inc_handle_sset(const struct snap_device *dev, struct sector_set *sse
 
 error:
 	LOG_ERROR(ret, "error handling sset");
+	while((sset = sset_list_pop(sl))) sset_free(sset);
 	return ret;
 }
 
@@ -3856,7 +5551,7 @@ static int snap_mrf_thread(void *data){
 		//submit the original bio to the block IO layer
 		elastio_snap_bio_op_set_flag(bio, ELASTIO_SNAP_PASSTHROUGH);
 #ifdef NETLINK_DEBUG
-		trace_event_bio(EVENT_BIO_CALL_ORIG, bio, 0);
+		trace_event_bio(EVENT_BIO_CALL_ORIG, dev->sd_minor, bio, 0);
 #endif
 		ret = elastio_snap_call_mrf(dev->sd_orig_mrf, bio);
 #ifdef HAVE_MAKE_REQUEST_FN_INT
@@ -3869,61 +5564,92 @@ static int snap_mrf_thread(void *data){
 
 static int snap_cow_thread(void *data){
 	int ret, is_failed = 0;
-	struct snap_device *dev = data;
+	struct snap_cow_worker *w = data;
+	struct snap_device *dev = w->dev;
 	struct bio_queue *bq = &dev->sd_cow_bios;
 	struct bio *bio;
+	bool shared = dev->sd_cow_workers > 1, blocked = false;
+	unsigned long gen = 0;
+	uint64_t queued, start;
+	sector_t sect, end;
 
 	//give this thread the highest priority we are allowed
 	set_user_nice(current, MIN_NICE);
 
 	while(!kthread_should_stop() || !bio_queue_empty(bq) || atomic64_read(&dev->sd_submitted_cnt) != atomic64_read(&dev->sd_received_cnt)) {
-		//wait for a bio to process or a kthread_stop call
-		wait_event_interruptible(bq->event, kthread_should_stop() || !bio_queue_empty(bq));
+		//wait for a bio to process or a kthread_stop call, if none of the queued bios were ready wait for another worker to finish one
+		if(blocked) wait_event_interruptible(bq->event, ACCESS_ONCE(bq->gen) != gen);
+		else wait_event_interruptible(bq->event, kthread_should_stop() || !bio_queue_empty(bq));
 
 		/*
 		/ We should pertend that the snapshot device is alive and don't give EIO on read even if it's in the failed state,
 		/ in case, if dev->sd_ignore_snap_errors == true. This behavior is needed for the userspace apps to be not killed
 		/ by SIGBUS if they are using a the snapshot device as a memmap'd file. For this purpose, cow_free_members shouldn't
 		/ be called here. But it should be for the regular snapshot device readers.
+		/ With several workers or a flush thread the others may still be using the cow manager, so it is left to be freed on destroy.
 		*/
 		if(!is_failed && tracer_read_fail_state(dev)){
 			LOG_DEBUG("error detected in cow thread, cleaning up cow");
 			is_failed = 1;
 
-			if(dev->sd_cow) cow_free_members(dev->sd_cow);
+			if(dev->sd_cow && !shared && !dev->sd_flush_thread){
+				//the readahead must be done with the cow manager before it is freed
+				if(dev->sd_read_cache) cancel_work_sync(&dev->sd_read_cache->ra_work);
+				cow_free_members(dev->sd_cow);
+			}
 		}
 
+		blocked = false;
 		if(bio_queue_empty(bq)) continue;
 
 		//safely dequeue a bio
-		bio = bio_queue_dequeue_delay_read(bq);
+		if(shared){
+			bio = snap_cow_worker_dequeue(w, &gen, &queued);
+			if(!bio){
+				blocked = true;
+				continue;
+			}
+		}else{
+			bio = bio_queue_dequeue_delay_read(bq, &queued);
+		}
+
+		//reads are queued without a timestamp
+		if(queued) snap_hist_add(dev, SNAP_HIST_COW_QUEUE, queued);
 
 		//pass bio to handler
 		if(!bio_data_dir(bio)){
 			//if we're in the fail state just send back an IO error and free the bio
 			if(is_failed){
 				elastio_snap_bio_endio(bio, wrap_err_io(dev)); //end the bio with an IO error
-				continue;
-			}
+			}else{
+				sect = bio_sector(bio);
+				end = bio_last_sector(bio);
+
+				//reads must see the cow data gathered so far
+				start = snap_now_ns();
+				ret = cow_flush_data(dev->sd_cow);
+				if(!ret) ret = snap_handle_read_bio(dev, bio, w->read_buf, w->read_mappings);
+				snap_hist_add(dev, SNAP_HIST_SNAP_READ, start);
+				if(ret){
+					LOG_ERROR(ret, "error handling read bio in kernel thread");
+					tracer_set_fail_state(dev, ret);
+				}
 
-			ret = snap_handle_read_bio(dev, bio);
-			if(ret){
-				LOG_ERROR(ret, "error handling read bio in kernel thread");
-				tracer_set_fail_state(dev, ret);
-			}
+				elastio_snap_bio_endio(bio, (ret)? wrap_err_io(dev) : 0);
 
-			elastio_snap_bio_endio(bio, (ret)? wrap_err_io(dev) : 0);
-		}else{
-			if(is_failed){
-				bio_free_clone(bio);
-				continue;
+				//prefetch the cow data of the next blocks once the reader has its data
+				if(!ret) snap_read_ahead(dev, sect, end);
 			}
-
+		}else if(is_failed){
+			bio_free_clone(dev, bio);
+		}else{
 			// Handle write bio in all cases except just when an error have to be ignored and the snapshot is in the error state.
 			// NOTE: We can't rely on 'is_failed' value already. The actual error state might have already changed while the BIO was dequeued...
 			if (!dev->sd_ignore_snap_errors || tracer_read_fail_state(dev) == 0)
 			{
+				start = snap_now_ns();
 				ret = snap_handle_write_bio(dev, bio);
+				snap_hist_add(dev, SNAP_HIST_COW_WRITE, start);
 				if (ret) {
 					LOG_ERROR(ret, "error handling write bio in kernel thread");
 					tracer_set_fail_state(dev, ret);
@@ -3931,8 +5657,19 @@ static int snap_cow_thread(void *data){
 			}
 
 			atomic64_inc(&dev->sd_processed_cnt);
-			bio_free_clone(bio);
+			bio_free_clone(dev, bio);
+
+			//write out the gathered cow data once there is nothing more to add to it
+			if(bio_queue_empty(bq) && tracer_read_fail_state(dev) == 0){
+				ret = cow_flush_data(dev->sd_cow);
+				if(ret){
+					LOG_ERROR(ret, "error writing cow data in kernel thread");
+					tracer_set_fail_state(dev, ret);
+				}
+			}
 		}
+
+		if(shared) snap_cow_worker_done(w);
 	}
 
 	LOG_DEBUG("snap_cow_thread() done.");
@@ -3940,10 +5677,34 @@ static int snap_cow_thread(void *data){
 	return 0;
 }
 
+static int cow_flush_thread(void *data){
+	int ret;
+	struct snap_device *dev = data;
+
+	while(!kthread_should_stop()){
+		schedule_timeout_interruptible(max_t(unsigned long, msecs_to_jiffies(elastio_snap_cow_flush_interval), 1));
+		if(kthread_should_stop()) break;
+
+		//the cow manager is only written to while the cow file is open and there have been no errors
+		if(tracer_read_fail_state(dev) || !dev->sd_cow || !test_bit(ACTIVE, &dev->sd_state)) continue;
+
+		ret = cow_writeback(dev->sd_cow, elastio_snap_cow_dirty_ratio);
+		if(ret){
+			LOG_ERROR(ret, "error writing back cow sections in flush thread");
+			tracer_set_fail_state(dev, ret);
+		}
+	}
+
+	LOG_DEBUG("cow_flush_thread() done.");
+
+	return 0;
+}
+
 static int inc_sset_thread(void *data){
 	int ret, is_failed = 0;
 	struct snap_device *dev = data;
 	struct sset_queue *sq = &dev->sd_pending_ssets;
+	struct sset_list ssets;
 	struct sector_set *sset;
 
 	//give this thread the highest priority we are allowed
@@ -3957,50 +5718,255 @@ static int inc_sset_thread(void *data){
 			LOG_DEBUG("error detected in sset thread, cleaning up cow");
 			is_failed = 1;
 
-			if(dev->sd_cow) cow_free_members(dev->sd_cow);
+			//the flush thread may still be using the cow manager, it is freed on destroy then
+			if(dev->sd_cow && !dev->sd_flush_thread) cow_free_members(dev->sd_cow);
 		}
 
 		if(sset_queue_empty(sq)) continue;
 
-		//safely dequeue a sset
-		sset = sset_queue_dequeue(sq);
+		//safely dequeue all of the pending ssets at once
+		sset_queue_dequeue_all(sq, &ssets);
 
 		//if there has been a problem don't process any more, just free the ones we have
 		if(is_failed){
-			kfree(sset);
+			while((sset = sset_list_pop(&ssets))) sset_free(sset);
 			continue;
 		}
 
-		//pass the sset to the handler
-		ret = inc_handle_sset(dev, sset);
+		//pass the batch to the handler, it frees the sector sets
+		ret = inc_handle_ssets(dev, &ssets);
 		if(ret){
 			LOG_ERROR(ret, "error handling sector set in kernel thread");
 			tracer_set_fail_state(dev, ret);
 		}
-
-		//free the sector set
-		kfree(sset);
 	}
 
 	LOG_DEBUG("inc_sset_thread() done.");
 	return 0;
 }
 
+/***************************TRACER LOOKUP FUNCTIONS**************************/
+
+static int tracer_lookup_entry_cmp(const void *a, const void *b){
+	const struct tracer_lookup_entry *ea = a, *eb = b;
+
+	if(ea->key != eb->key) return (ea->key < eb->key)? -1 : 1;
+	if(ea->start != eb->start) return (ea->start < eb->start)? -1 : 1;
+	return 0;
+}
+
+static void tracer_lookup_free_rcu(struct rcu_head *head){
+	kfree(container_of(head, struct tracer_lookup, rcu));
+}
+
+//rebuilds the lookup table of tracing_mrf() from snap_devices, must be called whenever the traced devices change
+static void tracer_lookup_rebuild(void){
+	int i;
+	unsigned int nr = 0;
+	struct snap_device *dev;
+	struct tracer_lookup *tl, *old;
+	struct tracer_lookup_entry *e;
+
+	tracer_for_each_full(dev, i){
+		if(dev && !test_bit(UNVERIFIED, &dev->sd_state)) nr++;
+	}
+
+	//this may run while the base device is frozen
+	tl = kmalloc(sizeof(struct tracer_lookup) + nr * sizeof(struct tracer_lookup_entry), GFP_NOIO);
+	if(tl){
+		tl->nr = 0;
+		tracer_for_each_full(dev, i){
+			if(!dev || test_bit(UNVERIFIED, &dev->sd_state) || tl->nr == nr) continue;
+
+			e = &tl->entries[tl->nr++];
+			e->key = tracer_dev_key(dev);
+			e->start = dev->sd_sect_off;
+			e->end = dev->sd_sect_off + dev->sd_size;
+			e->dev = dev;
+		}
+
+		sort(tl->entries, tl->nr, sizeof(struct tracer_lookup_entry), tracer_lookup_entry_cmp, NULL);
+
+		for(i = 0; i < tl->nr; i++){
+			e = &tl->entries[i];
+			e->max_end = e->end;
+			if(i > 0 && e[-1].key == e->key && e[-1].max_end > e->max_end) e->max_end = e[-1].max_end;
+		}
+	}else{
+		//tracing_mrf() scans snap_devices while there is no table
+		LOG_WARN("warning: unable to allocate the device lookup table, falling back to scanning all devices");
+	}
+
+	old = tracer_lookup_table;
+	rcu_assign_pointer(tracer_lookup_table, tl);
+	if(old) call_rcu(&old->rcu, tracer_lookup_free_rcu);
+}
+
+static void tracer_lookup_destroy(void){
+	struct tracer_lookup *old = tracer_lookup_table;
+
+	rcu_assign_pointer(tracer_lookup_table, NULL);
+	if(old) call_rcu(&old->rcu, tracer_lookup_free_rcu);
+
+	//wait for the callbacks before the module goes away
+	rcu_barrier();
+}
+
+/*
+ * Finds the tracing struct of the device holding the first sector of the bio, or NULL.
+ * disk_dev is set to a tracing struct on the same disk as the bio, or NULL if the disk isn't traced.
+ */
+static struct snap_device *tracer_lookup_bio(struct bio *bio, struct snap_device **disk_dev){
+	int i;
+	unsigned int lo = 0, hi, mid;
+	unsigned long key = tracer_bio_key(bio);
+	sector_t sect = bio_sector(bio);
+	struct snap_device *dev = NULL;
+	const struct tracer_lookup *tl;
+	const struct tracer_lookup_entry *e;
+
+	*disk_dev = NULL;
+
+	rcu_read_lock();
+	tl = rcu_dereference(tracer_lookup_table);
+	if(!tl){
+		rcu_read_unlock();
+
+		tracer_for_each(dev, i){
+			if(!dev || test_bit(UNVERIFIED, &dev->sd_state) || tracer_dev_key(dev) != key) continue;
+
+			*disk_dev = dev;
+			if(tracer_sector_matches_bio(dev, bio)) return dev;
+		}
+
+		return NULL;
+	}
+
+	//find the first entry starting after the sector
+	hi = tl->nr;
+	while(lo < hi){
+		mid = lo + (hi - lo) / 2;
+		e = &tl->entries[mid];
+
+		if(e->key < key || (e->key == key && e->start <= sect)) lo = mid + 1;
+		else hi = mid;
+	}
+
+	//walk back over the entries of the disk which may still hold the sector
+	for(i = (int)lo - 1; i >= 0 && tl->entries[i].key == key && tl->entries[i].max_end > sect; i--){
+		if(sect < tl->entries[i].end){
+			dev = tl->entries[i].dev;
+			break;
+		}
+	}
+
+	if(dev) *disk_dev = dev;
+	else if(lo > 0 && tl->entries[lo - 1].key == key) *disk_dev = tl->entries[lo - 1].dev;
+	else if(lo < tl->nr && tl->entries[lo].key == key) *disk_dev = tl->entries[lo].dev;
+
+	rcu_read_unlock();
+
+	return dev;
+}
+
 /****************************BIO TRACING LOGIC*****************************/
 
+//marks blocks starting at sect (relative to the start of the base device) as preserved
+static void snap_mark_preserved(struct snap_device *dev, sector_t sect, unsigned int blocks){
+	unsigned long block;
+	unsigned long *preserved = dev->sd_preserved;
+
+	if(!preserved) return;
+
+	//clones of frequently rewritten blocks keep coming until their first one completes, leave their bits alone
+	for(block = SECTOR_TO_BLOCK(sect); blocks; block++, blocks--){
+		if(!test_bit(block, preserved)) set_bit(block, preserved);
+	}
+}
+
+/*
+ * The original data of blocks the filesystem did not use at snapshot time is
+ * never needed, so their first write just marks them preserved. They are only
+ * recorded as changed in the cow index by snap_record_unused_writes().
+ */
+static void snap_mark_unused_written(struct snap_device *dev, unsigned long block, unsigned long last_block){
+	unsigned long cnt = 0;
+	unsigned long *unused = ACCESS_ONCE(dev->sd_unused);
+
+	if(!unused) return;
+
+	//pairs with the barrier before the bitmap is published by the ioctl
+	smp_rmb();
+
+	for(block = find_next_bit(unused, last_block, block); block < last_block; block = find_next_bit(unused, last_block, block + 1)){
+		if(!test_and_set_bit(block, dev->sd_preserved)) cnt++;
+	}
+
+	if(cnt) snap_stat_add(dev, SNAP_STAT_BYTES_UNUSED_SKIPPED, (uint64_t)cnt * COW_BLOCK_SIZE);
+}
+
+//records the written blocks unused at snapshot time in the cow index, must be called while there is no cow thread
+static int snap_record_unused_writes(struct snap_device *dev){
+	int ret;
+	unsigned long i, bit, block, written, run_start = 0, run_len = 0;
+	unsigned long nr_words = BITS_TO_LONGS(SECTOR_TO_BLOCK(dev->sd_size + SECTORS_PER_BLOCK - 1));
+	unsigned long *unused = dev->sd_unused;
+
+	if(!unused) return 0;
+
+	for(i = 0; i < nr_words; i++){
+		written = unused[i] & dev->sd_preserved[i];
+		if(!written) continue;
+
+		for_each_set_bit(bit, &written, BITS_PER_LONG){
+			block = i * BITS_PER_LONG + bit;
+			if(run_len && run_start + run_len == block){
+				run_len++;
+				continue;
+			}
+
+			if(run_len){
+				ret = cow_write_filler_mappings(dev->sd_cow, run_start, run_len);
+				if(ret) goto error;
+			}
+
+			run_start = block;
+			run_len = 1;
+		}
+
+		//from now on the index makes these blocks read as zeros
+		unused[i] &= ~written;
+	}
+
+	if(run_len){
+		ret = cow_write_filler_mappings(dev->sd_cow, run_start, run_len);
+		if(ret) goto error;
+	}
+
+	return 0;
+
+error:
+	LOG_ERROR(ret, "error recording writes to unused blocks");
+	return ret;
+}
+
 static void __on_bio_read_complete(struct bio *bio, int err){
 	int ret;
-	struct tracing_params *tp = bio->bi_private;
+	struct bio_sector_map *map = bio->bi_private;
+	struct tracing_params *tp = map->tp;
 	struct snap_device *dev = tp->dev;
-	struct bio_sector_map* map = NULL;
+	sector_t sect;
+	unsigned int blocks;
 #ifndef HAVE_BVEC_ITER
 	unsigned short i = 0;
 #endif
 
 #ifdef NETLINK_DEBUG
-	trace_event_bio(EVENT_BIO_READ_COMPLETE, bio, 0);
+	trace_event_bio(EVENT_BIO_READ_COMPLETE, dev->sd_minor, bio, 0);
 #endif
 
+	snap_hist_add(dev, SNAP_HIST_CLONE_READ, tp->clone_start);
+
 	//check for read errors
 	if(err){
 		ret = err;
@@ -4011,14 +5977,14 @@ static void __on_bio_read_complete(struct bio *bio, int err){
 	//change the bio into a write bio
 	elastio_snap_set_bio_ops(bio, REQ_OP_WRITE, 0);
 
-	//reset the bio iterator to its original state
-	for(map = tp->bio_sects.head; map != NULL && map->bio != NULL; map = map->next) {
-		if(bio == map->bio){
-			bio_sector(bio) = map->sect - dev->sd_sect_off;
-			bio_idx(bio) = 0;
-			break;
-		}
-	}
+	//reset the bio iterator to its original state, the cow queue orders the clones by the range they cover
+	bio_sector(bio) = map->sect - dev->sd_sect_off;
+	bio_size(bio) = map->size;
+	bio_idx(bio) = 0;
+
+	//the cow thread may free the clone as soon as it is queued
+	sect = bio_sector(bio);
+	blocks = map->size / COW_BLOCK_SIZE;
 
 	/*
 	 * Reset the position in each bvec. Unnecessary with bvec iterators. Will cause multipage bvec capable kernels to
@@ -4047,8 +6013,14 @@ static void __on_bio_read_complete(struct bio *bio, int err){
 	atomic64_inc(&dev->sd_received_cnt);
 	smp_wmb();
 
+	/*
+	 * The original data of these blocks is in hand, later writes to them don't need to read it again. The bits are
+	 * only set once snapshot reads can find the queued clone, a write passed straight through must not overtake it.
+	 */
+	snap_mark_preserved(dev, sect, blocks);
+
 #ifdef NETLINK_DEBUG
-	trace_event_bio(EVENT_BIO_QUEUED, bio, 0);
+	trace_event_bio(EVENT_BIO_QUEUED, dev->sd_minor, bio, 0);
 #endif
 
 	tp_put(tp);
@@ -4058,11 +6030,12 @@ static void __on_bio_read_complete(struct bio *bio, int err){
 error:
 	LOG_ERROR(ret, "error during bio read complete callback");
 #ifdef NETLINK_DEBUG
-	trace_event_generic(EVENT_DRIVER_ERROR, ret);
+	trace_event_generic(EVENT_DRIVER_ERROR, dev->sd_minor, ret);
 #endif
 	tracer_set_fail_state(dev, ret);
+	//the clone's destructor may still use the map, which goes away with the tp
+	bio_free_clone(dev, bio);
 	tp_put(tp);
-	bio_free_clone(bio);
 }
 
 /** Resolves issue https://github.com/elastio/elastio-snap/issues/170 */
@@ -4098,20 +6071,67 @@ static void on_bio_read_complete(struct bio *bio){
 }
 #endif
 
+/***************************MEMORY PRESSURE FUNCTIONS**************************/
+
+//shrinks or restores the cow caches of the active devices, skipped while an ioctl holds the mutex
+static void snap_mem_degrade(bool degrade){
+	int i, ret;
+	unsigned long cache_size;
+	struct snap_device *dev;
+
+	if(!mutex_trylock(&ioctl_mutex)) return;
+
+	tracer_for_each(dev, i){
+		if(!dev || dev->sd_mem_degraded == degrade) continue;
+		if(test_bit(UNVERIFIED, &dev->sd_state) || !test_bit(ACTIVE, &dev->sd_state) || !dev->sd_cow) continue;
+		if(tracer_read_fail_state(dev)) continue;
+
+		cache_size = (dev->sd_cache_size)? dev->sd_cache_size : elastio_snap_cow_max_memory_default;
+		dev->sd_mem_degraded = degrade;
+
+		if(!degrade){
+			LOG_DEBUG("memory is available again, restoring cow cache of minor %d", i);
+			cow_modify_cache_size(dev->sd_cow, cache_size);
+			continue;
+		}
+
+		LOG_WARN("available memory is low, shrinking cow cache of minor %d", i);
+		cow_modify_cache_size(dev->sd_cow, cache_size / LOW_MEMORY_DEGRADE_CACHE_DIV);
+
+		ret = cow_shrink(dev->sd_cow);
+		if(ret) tracer_set_fail_state(dev, ret);
+	}
+
+	mutex_unlock(&ioctl_mutex);
+}
+
+//refreshes snap_mem_state, so that traced bios only need to read it
+static void snap_mem_check(struct work_struct *work){
+	int state = SNAP_MEM_OK;
+	unsigned int percent = ACCESS_ONCE(elastio_snap_low_memory_percent);
+	unsigned long available;
+	struct sysinfo si;
+
+	si_meminfo(&si);
+	available = (si.totalram)? (si_mem_available() * 100) / si.totalram : 100;
+
+	if(percent && available < percent) state = SNAP_MEM_FAIL;
+	else if(percent && available < percent + LOW_MEMORY_DEGRADE_MARGIN) state = SNAP_MEM_DEGRADE;
+
+	atomic_set(&snap_mem_state, state);
+	snap_mem_degrade(state != SNAP_MEM_OK);
+
+	schedule_delayed_work(&snap_mem_work, msecs_to_jiffies(LOW_MEMORY_CHECK_INTERVAL));
+}
+
 static int memory_is_too_low(struct snap_device *dev) {
 	int ret;
-	struct sysinfo si;
-	static __kernel_ulong_t totalram = 0;
-	if (totalram == 0) {
-		si_meminfo(&si);
-		totalram = si.totalram;
-	}
 
 	ret = tracer_read_fail_state(dev);
-	if (ret != -ENOMEM && ((si_mem_available() * 100) / totalram) < LOW_MEMORY_FAIL_PERCENT) {
-		LOG_WARN("physical memory usage has exceeded %d%% threshold. cow file update is stopped", (100 - LOW_MEMORY_FAIL_PERCENT));
+	if (ret != -ENOMEM && atomic_read(&snap_mem_state) == SNAP_MEM_FAIL) {
+		LOG_WARN("physical memory usage has exceeded %u%% threshold. cow file update is stopped", (100 - ACCESS_ONCE(elastio_snap_low_memory_percent)));
 #ifdef NETLINK_DEBUG
-		trace_event_generic(EVENT_DRIVER_ERROR, ret);
+		trace_event_generic(EVENT_DRIVER_ERROR, dev->sd_minor, ret);
 #endif
 		ret = -ENOMEM;
 		tracer_set_fail_state(dev, ret);
@@ -4123,7 +6143,9 @@ static int snap_trace_bio(struct snap_device *dev, struct bio *bio){
 	int ret;
 	struct bio *new_bio = NULL;
 	struct tracing_params *tp = NULL;
+	struct bio_sector_map *map;
 	sector_t start_sect, end_sect;
+	unsigned long block, last_block, run_start, run_end, skipped = 0;
 	unsigned int bytes, pages;
 	int max_sectors;
 
@@ -4132,7 +6154,7 @@ static int snap_trace_bio(struct snap_device *dev, struct bio *bio){
 	//just call the real mrf normally
 	if (!bio_needs_cow(bio, dev) || memory_is_too_low(dev) || tracer_read_fail_state(dev)) {
 #ifdef NETLINK_DEBUG
-		trace_event_bio(EVENT_BIO_CALL_ORIG, bio, 0);
+		trace_event_bio(EVENT_BIO_CALL_ORIG, dev->sd_minor, bio, 0);
 #endif
 		return elastio_snap_call_mrf(dev->sd_orig_mrf, bio);
 	}
@@ -4162,19 +6184,53 @@ static int snap_trace_bio(struct snap_device *dev, struct bio *bio){
 	start_sect = ROUND_DOWN(bio_sector(bio) - dev->sd_sect_off, SECTORS_PER_BLOCK) + dev->sd_sect_off;
 	end_sect = ROUND_UP(bio_sector(bio) + (bio_size(bio) / SECTOR_SIZE) - dev->sd_sect_off, SECTORS_PER_BLOCK) + dev->sd_sect_off;
 	pages = (end_sect - start_sect) / SECTORS_PER_PAGE;
+	block = SECTOR_TO_BLOCK(start_sect - dev->sd_sect_off);
+	last_block = SECTOR_TO_BLOCK(end_sect - dev->sd_sect_off);
+
+	snap_mark_unused_written(dev, block, last_block);
+
+	//if the original data of every block has already been read, the write can go straight through
+	if(dev->sd_preserved && find_next_zero_bit(dev->sd_preserved, last_block, block) >= last_block){
+		snap_stat_inc(dev, SNAP_STAT_BIOS_COW_SKIPPED);
+		snap_stat_add(dev, SNAP_STAT_BYTES_CLONE_SKIPPED, (uint64_t)(last_block - block) * COW_BLOCK_SIZE);
+#ifdef NETLINK_DEBUG
+		trace_event_bio(EVENT_BIO_CALL_ORIG, dev->sd_minor, bio, 0);
+#endif
+		return elastio_snap_call_mrf(dev->sd_orig_mrf, bio);
+	}
+
+	//allocate tracing_params struct to hold all pointers we will need across contexts
+	ret = tp_alloc(dev, bio, &tp);
+	if(ret) goto error;
+
+	snap_stat_inc(dev, SNAP_STAT_BIOS_COW);
+
+	//the clones of one bio are submitted back to back, they are all timed from the first one
+	tp->clone_start = snap_now_ns();
+
+next_run:
+	//only read the runs of blocks whose original data has not been read yet
+	if(dev->sd_preserved){
+		run_start = find_next_zero_bit(dev->sd_preserved, last_block, block);
+		run_end = (run_start < last_block)? find_next_bit(dev->sd_preserved, last_block, run_start) : last_block;
+		skipped += run_start - block;
+		if(run_start >= last_block) goto out;
 
-	//allocate tracing_params struct to hold all pointers we will need across contexts
-	ret = tp_alloc(dev, bio, &tp);
-	if(ret) goto error;
+		start_sect = BLOCK_TO_SECTOR(run_start) + dev->sd_sect_off;
+		pages = run_end - run_start;
+	}else{
+		run_end = last_block;
+	}
 
 retry:
-	//allocate and populate read bio clone. This bio may not have all the pages we need due to queue restrictions
-	ret = bio_make_read_clone(dev->sd_base_dev, dev_bioset(dev), tp, bio, start_sect, pages, &new_bio, &bytes);
+	//set pointers for read clone
+	ret = tp_add(tp, start_sect, &map);
 	if(ret) goto error;
 
-	//set pointers for read clone
-	ret = tp_add(tp, new_bio);
-	if (ret) goto error;
+	//allocate and populate read bio clone. This bio may not have all the pages we need due to queue restrictions
+	ret = bio_make_read_clone(dev->sd_base_dev, dev_bioset(dev), map, bio, start_sect, pages, &new_bio, &bytes);
+	if(ret) goto error;
+	map->size = bytes;
 
 	atomic64_inc(&dev->sd_submitted_cnt);
 	smp_wmb();
@@ -4183,7 +6239,7 @@ retry:
 	// submit the bios
 	//
 #ifdef NETLINK_DEBUG
-	trace_event_bio(EVENT_BIO_CALL_ORIG, new_bio, 0);
+	trace_event_bio(EVENT_BIO_CALL_ORIG, dev->sd_minor, new_bio, 0);
 #endif
 
 #ifdef USE_BDOPS_SUBMIT_BIO
@@ -4203,6 +6259,12 @@ retry:
 		goto retry;
 	}
 
+	block = run_end;
+	if(block < last_block) goto next_run;
+
+out:
+	if(skipped) snap_stat_add(dev, SNAP_STAT_BYTES_CLONE_SKIPPED, (uint64_t)skipped * COW_BLOCK_SIZE);
+
 	//drop our reference to the tp
 	tp_put(tp);
 
@@ -4212,8 +6274,7 @@ error:
 	LOG_ERROR(ret, "error tracing bio for snapshot");
 	tracer_set_fail_state(dev, ret);
 
-	//clean up the bio we allocated (but did not submit)
-	if(new_bio) bio_free_clone(new_bio);
+	//an unsubmitted clone has already been freed by bio_make_read_clone()
 	if(tp) tp_put(tp);
 
 	//this function only returns non-zero if the real mrf does not. Errors set the fail state.
@@ -4224,7 +6285,7 @@ static int inc_make_sset(struct snap_device *dev, sector_t sect, unsigned int le
 	struct sector_set *sset;
 
 	//allocate sector set to hold record of change sectors
-	sset = kmalloc(sizeof(struct sector_set), GFP_NOIO);
+	sset = sset_alloc();
 	if(!sset){
 		LOG_ERROR(-ENOMEM, "error allocating sector set");
 		return -ENOMEM;
@@ -4291,7 +6352,7 @@ out:
 	}
 
 #ifdef NETLINK_DEBUG
-	trace_event_bio(EVENT_BIO_CALL_ORIG, bio, 0);
+	trace_event_bio(EVENT_BIO_CALL_ORIG, dev->sd_minor, bio, 0);
 #endif
 
 	//call the original mrf
@@ -4306,50 +6367,52 @@ static MRF_RETURN_TYPE tracing_mrf(struct bio *bio){
 #else
 static MRF_RETURN_TYPE tracing_mrf(struct request_queue *q, struct bio *bio){
 #endif
-	int i, ret = 0;
-	struct snap_device *dev;
+	int ret = 0;
+	struct snap_device *dev, *disk_dev;
 	make_request_fn *orig_mrf = NULL;
 
 #ifdef NETLINK_DEBUG
-	trace_event_bio(EVENT_BIO_INCOMING_TRACING_MRF, bio, 0);
+	trace_event_bio(EVENT_BIO_INCOMING_TRACING_MRF, TRACE_NO_MINOR, bio, 0);
 #endif
 
 	MAYBE_UNUSED(ret);
 
 	smp_rmb();
-	tracer_for_each(dev, i){	// for each snap device
-		if(!dev || test_bit(UNVERIFIED, &dev->sd_state) || !tracer_matches_bio(dev, bio)) continue;
+	dev = tracer_lookup_bio(bio, &disk_dev);
 
-		orig_mrf = dev->sd_orig_mrf;
+	if(disk_dev){
+		orig_mrf = disk_dev->sd_orig_mrf;
 		if(elastio_snap_bio_op_flagged(bio, ELASTIO_SNAP_PASSTHROUGH)){
 #ifdef NETLINK_DEBUG
-			trace_event_bio(EVENT_BIO_CALL_ORIG, bio, 0);
+			trace_event_bio(EVENT_BIO_CALL_ORIG, disk_dev->sd_minor, bio, 0);
 #endif
 			elastio_snap_bio_op_clear_flag(bio, ELASTIO_SNAP_PASSTHROUGH);
 			goto call_orig;
 		}
+	}
 
-		if(tracer_should_trace_bio(dev, bio)){
-			if(test_bit(SNAPSHOT, &dev->sd_state)) {
+	if(dev && tracer_should_trace_bio(dev, bio)){
+		snap_stat_inc(dev, SNAP_STAT_BIOS_TRACED);
+
+		if(test_bit(SNAPSHOT, &dev->sd_state)) {
 #ifdef NETLINK_DEBUG
-				trace_event_bio(EVENT_BIO_SNAP, bio, 0);
+			trace_event_bio(EVENT_BIO_SNAP, dev->sd_minor, bio, 0);
 #endif
-				ret = snap_trace_bio(dev, bio);
-			}
-			else {
+			ret = snap_trace_bio(dev, bio);
+		}
+		else {
 #ifdef NETLINK_DEBUG
-				trace_event_bio(EVENT_BIO_INC, bio, 0);
+			trace_event_bio(EVENT_BIO_INC, dev->sd_minor, bio, 0);
 #endif
-				ret = inc_trace_bio(dev, bio);
-			}
-			goto out;
+			ret = inc_trace_bio(dev, bio);
 		}
+		goto out;
 	}
 
 call_orig:
 
 #ifdef NETLINK_DEBUG
-	trace_event_bio(EVENT_BIO_CALL_ORIG, bio, 0);
+	trace_event_bio(EVENT_BIO_CALL_ORIG, TRACE_NO_MINOR, bio, 0);
 #endif
 
 #ifdef USE_BDOPS_SUBMIT_BIO
@@ -4389,7 +6452,7 @@ static MRF_RETURN_TYPE snap_mrf(struct bio *bio){
 #endif
 
 #ifdef NETLINK_DEBUG
-	trace_event_bio(EVENT_BIO_INCOMING_SNAP_MRF, bio, 0);
+	trace_event_bio(EVENT_BIO_INCOMING_SNAP_MRF, dev->sd_minor, bio, 0);
 #endif
 
 	//if a write request somehow gets sent in, discard it
@@ -4432,6 +6495,226 @@ static int snap_merge_bvec(struct request_queue *q, struct bio *bio_bvm, struct
 #endif
 #endif
 
+/****************************SNAP STATS FUNCTIONS****************************/
+
+static void snap_stats_sum(const struct snap_stats *st, uint64_t *sums){
+	int cpu;
+	unsigned int i;
+	const struct snap_stats_cpu *c;
+
+	memset(sums, 0, SNAP_STAT_NR * sizeof(uint64_t));
+
+	//the counters are only ever added to, so a sum that races with an update is just slightly behind
+	for_each_possible_cpu(cpu){
+		c = per_cpu_ptr(st->cpu, cpu);
+		for(i = 0; i < SNAP_STAT_NR; i++) sums[i] += c->cnt[i];
+	}
+}
+
+static void tracer_elastio_snap_stats(const struct snap_device *dev, struct elastio_snap_stats *stats){
+	uint64_t sums[SNAP_STAT_NR];
+	const struct cow_manager *cm = dev->sd_cow;
+
+	if(dev->sd_stats) snap_stats_sum(dev->sd_stats, sums);
+	else memset(sums, 0, sizeof(sums));
+
+	stats->version = ELASTIO_SNAP_STATS_VERSION;
+	stats->bios_traced = sums[SNAP_STAT_BIOS_TRACED];
+	stats->bios_cow = sums[SNAP_STAT_BIOS_COW];
+	stats->bytes_cow = sums[SNAP_STAT_BYTES_COW];
+	stats->clones_submitted = atomic64_read(&dev->sd_submitted_cnt);
+	stats->clones_received = atomic64_read(&dev->sd_received_cnt);
+	stats->clones_processed = atomic64_read(&dev->sd_processed_cnt);
+	stats->cow_queue_depth = ACCESS_ONCE(dev->sd_cow_bios.depth);
+	stats->sset_queue_depth = ACCESS_ONCE(dev->sd_pending_ssets.depth);
+	stats->sect_hits = sums[SNAP_STAT_SECT_HITS];
+	stats->sect_misses = sums[SNAP_STAT_SECT_MISSES];
+	stats->sect_loads = sums[SNAP_STAT_SECT_LOADS];
+	stats->sect_evictions = sums[SNAP_STAT_SECT_EVICTIONS];
+	stats->cleanups = sums[SNAP_STAT_CLEANUPS];
+	stats->bios_cow_skipped = sums[SNAP_STAT_BIOS_COW_SKIPPED];
+	stats->bytes_clone_skipped = sums[SNAP_STAT_BYTES_CLONE_SKIPPED];
+	stats->bytes_unused_skipped = sums[SNAP_STAT_BYTES_UNUSED_SKIPPED];
+	stats->clone_pages = atomic_long_read(&dev->sd_clone_pages);
+	stats->clone_pages_max = ACCESS_ONCE(dev->sd_clone_pages_max);
+
+	if(dev->sd_page_pool){
+		stats->page_pool_size = ACCESS_ONCE(dev->sd_page_pool->min_nr);
+		stats->page_pool_free = ACCESS_ONCE(dev->sd_page_pool->curr_nr);
+	}else{
+		stats->page_pool_size = 0;
+		stats->page_pool_free = 0;
+	}
+	stats->reads_base = sums[SNAP_STAT_READS_BASE];
+	stats->reads_cow = sums[SNAP_STAT_READS_COW];
+	stats->reads_mixed = sums[SNAP_STAT_READS_MIXED];
+
+	if(!test_bit(UNVERIFIED, &dev->sd_state) && cm){
+		stats->cow_file_used = cm->curr_pos * COW_BLOCK_SIZE;
+		stats->cow_file_max = cm->file_max;
+	}else{
+		stats->cow_file_used = 0;
+		stats->cow_file_max = 0;
+	}
+}
+
+#define snap_stats_print(buf, len, stats, field) ((len) += scnprintf((buf) + (len), PAGE_SIZE - (len), #field " %llu\n", (stats)->field))
+
+static ssize_t snap_stats_show(struct kobject *kobj, struct kobj_attribute *attr, char *buf){
+	ssize_t len = 0;
+	int attached;
+	struct snap_stats *st = container_of(kobj, struct snap_stats, kobj);
+	struct elastio_snap_stats stats;
+
+	//the ioctl mutex can't be taken here, the device is destroyed while holding it and that waits for readers of this file
+	spin_lock(&snap_stats_lock);
+	attached = st->dev != NULL;
+	if(attached) tracer_elastio_snap_stats(st->dev, &stats);
+	spin_unlock(&snap_stats_lock);
+
+	if(!attached) return -ENODEV;
+
+	snap_stats_print(buf, len, &stats, bios_traced);
+	snap_stats_print(buf, len, &stats, bios_cow);
+	snap_stats_print(buf, len, &stats, bytes_cow);
+	snap_stats_print(buf, len, &stats, clones_submitted);
+	snap_stats_print(buf, len, &stats, clones_received);
+	snap_stats_print(buf, len, &stats, clones_processed);
+	snap_stats_print(buf, len, &stats, cow_queue_depth);
+	snap_stats_print(buf, len, &stats, sset_queue_depth);
+	snap_stats_print(buf, len, &stats, sect_hits);
+	snap_stats_print(buf, len, &stats, sect_misses);
+	snap_stats_print(buf, len, &stats, sect_loads);
+	snap_stats_print(buf, len, &stats, sect_evictions);
+	snap_stats_print(buf, len, &stats, cleanups);
+	snap_stats_print(buf, len, &stats, cow_file_used);
+	snap_stats_print(buf, len, &stats, cow_file_max);
+	snap_stats_print(buf, len, &stats, reads_base);
+	snap_stats_print(buf, len, &stats, reads_cow);
+	snap_stats_print(buf, len, &stats, reads_mixed);
+	snap_stats_print(buf, len, &stats, bios_cow_skipped);
+	snap_stats_print(buf, len, &stats, bytes_clone_skipped);
+	snap_stats_print(buf, len, &stats, clone_pages);
+	snap_stats_print(buf, len, &stats, clone_pages_max);
+	snap_stats_print(buf, len, &stats, page_pool_size);
+	snap_stats_print(buf, len, &stats, page_pool_free);
+	snap_stats_print(buf, len, &stats, bytes_unused_skipped);
+
+	return len;
+}
+
+static struct kobj_attribute snap_stats_attr = __ATTR(stats, S_IRUGO, snap_stats_show, NULL);
+
+static const char *snap_hist_names[SNAP_HIST_NR] = {
+	[SNAP_HIST_TRACE] = "trace",
+	[SNAP_HIST_CLONE_READ] = "clone_read",
+	[SNAP_HIST_COW_QUEUE] = "cow_queue",
+	[SNAP_HIST_COW_WRITE] = "cow_write",
+	[SNAP_HIST_SNAP_READ] = "snap_read",
+};
+
+static ssize_t snap_latency_show(struct kobject *kobj, struct kobj_attribute *attr, char *buf){
+	ssize_t len = 0;
+	int cpu;
+	unsigned int i, j;
+	uint64_t sums[SNAP_HIST_BUCKETS];
+	struct snap_stats *st = container_of(kobj, struct snap_stats, kobj);
+
+	//one line per histogram, its name followed by the count of every bucket
+	for(i = 0; i < SNAP_HIST_NR; i++){
+		memset(sums, 0, sizeof(sums));
+		for_each_possible_cpu(cpu){
+			for(j = 0; j < SNAP_HIST_BUCKETS; j++) sums[j] += per_cpu_ptr(st->cpu, cpu)->hist[i][j];
+		}
+
+		len += scnprintf(buf + len, PAGE_SIZE - len, "%s", snap_hist_names[i]);
+		for(j = 0; j < SNAP_HIST_BUCKETS; j++) len += scnprintf(buf + len, PAGE_SIZE - len, " %llu", sums[j]);
+		len += scnprintf(buf + len, PAGE_SIZE - len, "\n");
+	}
+
+	return len;
+}
+
+static ssize_t snap_latency_store(struct kobject *kobj, struct kobj_attribute *attr, const char *buf, size_t count){
+	int cpu;
+	struct snap_stats *st = container_of(kobj, struct snap_stats, kobj);
+
+	//any write resets the histograms, samples recorded concurrently may survive the reset
+	for_each_possible_cpu(cpu){
+		memset(per_cpu_ptr(st->cpu, cpu)->hist, 0, sizeof(per_cpu_ptr(st->cpu, cpu)->hist));
+	}
+
+	return count;
+}
+
+static struct kobj_attribute snap_latency_attr = __ATTR(latency, S_IRUGO | S_IWUSR, snap_latency_show, snap_latency_store);
+
+static void snap_stats_release(struct kobject *kobj){
+	struct snap_stats *st = container_of(kobj, struct snap_stats, kobj);
+
+	if(st->cpu) free_percpu(st->cpu);
+	kfree(st);
+}
+
+static struct kobj_type snap_stats_ktype = {
+	.release = snap_stats_release,
+	.sysfs_ops = &kobj_sysfs_ops,
+};
+
+static void snap_stats_free(struct snap_stats *st){
+	//removes the sysfs directory, the memory is released once nobody is reading the stats
+	if(st) kobject_put(&st->kobj);
+}
+
+static int snap_stats_alloc(unsigned int minor, struct snap_stats **st_out){
+	int ret;
+	struct snap_stats *st;
+
+	st = kzalloc(sizeof(struct snap_stats), GFP_KERNEL);
+	if(!st){
+		ret = -ENOMEM;
+		LOG_ERROR(ret, "error allocating stats struct");
+		goto error;
+	}
+
+	st->cpu = alloc_percpu(struct snap_stats_cpu);
+	if(!st->cpu){
+		ret = -ENOMEM;
+		LOG_ERROR(ret, "error allocating per-cpu counters");
+		kfree(st);
+		goto error;
+	}
+
+	//from here on the kobject owns the stats and frees them on its release
+	ret = kobject_init_and_add(&st->kobj, &snap_stats_ktype, elastio_snap_kobj, "%u", minor);
+	if(ret){
+		LOG_ERROR(ret, "error adding stats to sysfs");
+		kobject_put(&st->kobj);
+		goto error;
+	}
+
+	ret = sysfs_create_file(&st->kobj, &snap_stats_attr.attr);
+	if(ret){
+		LOG_ERROR(ret, "error creating sysfs stats file");
+		kobject_put(&st->kobj);
+		goto error;
+	}
+
+	ret = sysfs_create_file(&st->kobj, &snap_latency_attr.attr);
+	if(ret){
+		LOG_ERROR(ret, "error creating sysfs latency file");
+		kobject_put(&st->kobj);
+		goto error;
+	}
+
+	*st_out = st;
+	return 0;
+
+error:
+	*st_out = NULL;
+	return ret;
+}
+
 /*******************************SETUP HELPER FUNCTIONS********************************/
 
 static int bdev_is_already_traced(const struct block_device *bdev){
@@ -4597,6 +6880,7 @@ static int __tracer_transition_tracing(struct snap_device *dev, struct block_dev
 		LOG_DEBUG("starting tracing");
 		if (dev_ptr) *dev_ptr = dev;
 		smp_wmb();
+		tracer_lookup_rebuild();
 #ifdef USE_BDOPS_SUBMIT_BIO
 
 		if(new_ops) elastio_snap_set_bd_ops(bdev, new_ops);
@@ -4607,7 +6891,7 @@ static int __tracer_transition_tracing(struct snap_device *dev, struct block_dev
 		if(new_mrf) elastio_snap_set_bd_mrf(bdev, new_mrf);
 #endif
 #ifdef NETLINK_DEBUG
-		trace_event_generic(EVENT_TRACING_STARTED, 0);
+		trace_event_generic(EVENT_TRACING_STARTED, dev->sd_minor, 0);
 #endif
 	}else{
 		LOG_DEBUG("ending tracing");
@@ -4626,9 +6910,10 @@ static int __tracer_transition_tracing(struct snap_device *dev, struct block_dev
 #endif
 		if (dev_ptr) *dev_ptr = NULL;
 		smp_wmb();
+		tracer_lookup_rebuild();
 
 #ifdef NETLINK_DEBUG
-		trace_event_generic(EVENT_TRACING_FINISHED, 0);
+		trace_event_generic(EVENT_TRACING_FINISHED, dev->sd_minor, 0);
 #endif
 	}
 
@@ -4655,11 +6940,16 @@ static int __tracer_transition_tracing(struct snap_device *dev, struct block_dev
 static void __tracer_init(struct snap_device *dev){
 	LOG_DEBUG("initializing tracer");
 	atomic_set(&dev->sd_fail_code, 0);
-	bio_queue_init(&dev->sd_cow_bios);
+	bio_queue_init_indexed(&dev->sd_cow_bios);
 	bio_queue_init(&dev->sd_orig_bios);
 	sset_queue_init(&dev->sd_pending_ssets);
 }
 
+static unsigned int __tracer_cow_workers(unsigned int cow_workers){
+	if(!cow_workers) cow_workers = elastio_snap_cow_workers_default;
+	return clamp(cow_workers, 1U, (unsigned int)ELASTIO_SNAP_MAX_COW_WORKERS);
+}
+
 static int tracer_alloc(struct snap_device **dev_ptr){
 	int ret;
 	struct snap_device *dev;
@@ -4674,6 +6964,7 @@ static int tracer_alloc(struct snap_device **dev_ptr){
 	}
 
 	__tracer_init(dev);
+	dev->sd_cow_workers = __tracer_cow_workers(0);
 
 	*dev_ptr = dev;
 	return 0;
@@ -4760,6 +7051,8 @@ static void __tracer_copy_base_dev(const struct snap_device *src, struct snap_de
 	dest->sd_bdev_path = src->sd_bdev_path;
 	dest->sd_cow_state = src->sd_cow_state;
 	dest->sd_ignore_snap_errors = src->sd_ignore_snap_errors;
+	dest->sd_cow_workers = src->sd_cow_workers;
+	dest->sd_stats = src->sd_stats;
 }
 
 static int __tracer_destroy_cow(struct snap_device *dev, int close_method){
@@ -4882,7 +7175,7 @@ static int __tracer_setup_cow(struct snap_device *dev, struct block_device *bdev
 error:
 	LOG_ERROR(ret, "error setting up cow manager");
 #ifdef NETLINK_DEBUG
-	trace_event_generic(EVENT_DRIVER_ERROR, ret);
+	trace_event_generic(EVENT_DRIVER_ERROR, dev->sd_minor, ret);
 #endif
 	if(open_method != 3) __tracer_destroy_cow_free(dev);
 	if(cow_path_full != cow_path) kfree(cow_path_full);
@@ -4902,6 +7195,7 @@ static void __tracer_copy_cow(const struct snap_device *src, struct snap_device
 
 	dest->sd_cow_inode = src->sd_cow_inode;
 	dest->sd_cache_size = src->sd_cache_size;
+	dest->sd_mem_degraded = src->sd_mem_degraded;
 	dest->sd_falloc_size = src->sd_falloc_size;
 }
 
@@ -4959,6 +7253,22 @@ static void __tracer_destroy_snap(struct snap_device *dev){
 		dev->sd_mrf_thread = NULL;
 	}
 
+	if(dev->sd_preserved){
+		vfree(dev->sd_preserved);
+		dev->sd_preserved = NULL;
+	}
+
+	if(dev->sd_unused){
+		vfree(dev->sd_unused);
+		dev->sd_unused = NULL;
+	}
+
+	if(dev->sd_page_pool){
+		LOG_DEBUG("freeing read clone page pool");
+		mempool_destroy(dev->sd_page_pool);
+		dev->sd_page_pool = NULL;
+	}
+
 	if(dev->sd_gd){
 		LOG_DEBUG("freeing gendisk");
 #ifdef HAVE_DISK_LIVE
@@ -5006,6 +7316,23 @@ static int __tracer_bioset_init(struct snap_device *dev){
 static int __tracer_setup_snap(struct snap_device *dev, unsigned int minor, struct block_device *bdev, sector_t size){
 	int ret;
 
+	//the bitmap only lets writes skip reading old data, so snapshots work without it
+	if(PAGE_SIZE == COW_BLOCK_SIZE){
+		LOG_DEBUG("allocating preserved blocks bitmap");
+		dev->sd_preserved = vzalloc(BITS_TO_LONGS(SECTOR_TO_BLOCK(size + SECTORS_PER_BLOCK - 1)) * sizeof(unsigned long));
+		if(!dev->sd_preserved) LOG_WARN("error allocating preserved blocks bitmap, every traced write will be read back");
+	}
+
+	LOG_DEBUG("creating read clone page pool");
+	atomic_long_set(&dev->sd_clone_pages, 0);
+	dev->sd_clone_pages_max = 0;
+	dev->sd_page_pool = mempool_create_page_pool(snap_page_pool_size(dev->sd_cache_size), 0);
+	if(!dev->sd_page_pool){
+		ret = -ENOMEM;
+		LOG_ERROR(ret, "error creating read clone page pool");
+		goto error;
+	}
+
 	ret = __tracer_bioset_init(dev);
 	if(ret){
 		LOG_ERROR(ret, "error initializing bio set");
@@ -5138,18 +7465,93 @@ error:
 }
 
 static void __tracer_destroy_cow_thread(struct snap_device *dev){
+	unsigned int i;
+
+	if(dev->sd_flush_thread){
+		LOG_DEBUG("stopping cow flush thread");
+		kthread_stop(dev->sd_flush_thread);
+		dev->sd_flush_thread = NULL;
+	}
+
+	for(i = 1; i < ELASTIO_SNAP_MAX_COW_WORKERS; i++){
+		if(dev->sd_workers[i].thread){
+			LOG_DEBUG("stopping cow worker thread %u", i);
+			kthread_stop(dev->sd_workers[i].thread);
+			dev->sd_workers[i].thread = NULL;
+		}
+	}
+
 	if(dev->sd_cow_thread){
 		LOG_DEBUG("stopping cow thread");
 		kthread_stop(dev->sd_cow_thread);
 		dev->sd_cow_thread = NULL;
+		dev->sd_workers[0].thread = NULL;
+	}
+
+	for(i = 0; i < ELASTIO_SNAP_MAX_COW_WORKERS; i++){
+		if(dev->sd_workers[i].read_buf){
+			vfree(dev->sd_workers[i].read_buf);
+			dev->sd_workers[i].read_buf = NULL;
+		}
+
+		if(dev->sd_workers[i].read_mappings){
+			kfree(dev->sd_workers[i].read_mappings);
+			dev->sd_workers[i].read_mappings = NULL;
+		}
 	}
+
+	//no readahead is queued once the cow threads are stopped
+	if(dev->sd_read_cache) cancel_work_sync(&dev->sd_read_cache->ra_work);
+	snap_read_cache_free(dev->sd_read_cache);
+	dev->sd_read_cache = NULL;
 }
 
 static int __tracer_setup_cow_thread(struct snap_device *dev, unsigned int minor, int is_snap){
 	int ret;
+	unsigned int i;
+
+	for(i = 0; i < ELASTIO_SNAP_MAX_COW_WORKERS; i++){
+		dev->sd_workers[i].dev = dev;
+		dev->sd_workers[i].busy = false;
+	}
+
+	if(is_snap){
+		//the buffers for snapshot reads are allocated up front, the cow threads can't wait on reclaim
+		for(i = 0; i < dev->sd_cow_workers; i++){
+			dev->sd_workers[i].read_buf = vmalloc(SNAP_READ_BUF_BLOCKS * COW_BLOCK_SIZE);
+			if(!dev->sd_workers[i].read_buf){
+				ret = -ENOMEM;
+				LOG_ERROR(ret, "error allocating cow worker read buffer");
+				goto error;
+			}
+
+			dev->sd_workers[i].read_mappings = kmalloc(SNAP_READ_MAPPINGS * sizeof(uint64_t), GFP_KERNEL);
+			if(!dev->sd_workers[i].read_mappings){
+				ret = -ENOMEM;
+				LOG_ERROR(ret, "error allocating cow worker read mappings");
+				goto error;
+			}
+		}
+
+		if(elastio_snap_cow_read_cache){
+			ret = snap_read_cache_alloc(dev, elastio_snap_cow_read_cache, &dev->sd_read_cache);
+			if(ret) goto error;
+		}
+	}
+
+	if(elastio_snap_cow_dirty_ratio){
+		LOG_DEBUG("creating kernel cow flush thread");
+		dev->sd_flush_thread = kthread_create(cow_flush_thread, dev, COW_FLUSH_THREAD_NAME_FMT, minor);
+		if(IS_ERR(dev->sd_flush_thread)){
+			ret = PTR_ERR(dev->sd_flush_thread);
+			dev->sd_flush_thread = NULL;
+			LOG_ERROR(ret, "error creating kernel cow flush thread");
+			goto error;
+		}
+	}
 
 	LOG_DEBUG("creating kernel cow thread");
-	if(is_snap) dev->sd_cow_thread = kthread_create(snap_cow_thread, dev, SNAP_COW_THREAD_NAME_FMT, minor);
+	if(is_snap) dev->sd_cow_thread = kthread_create(snap_cow_thread, &dev->sd_workers[0], SNAP_COW_THREAD_NAME_FMT, minor);
 	else dev->sd_cow_thread = kthread_create(inc_sset_thread, dev, INC_THREAD_NAME_FMT, minor);
 
 	if(IS_ERR(dev->sd_cow_thread)){
@@ -5159,6 +7561,20 @@ static int __tracer_setup_cow_thread(struct snap_device *dev, unsigned int minor
 		goto error;
 	}
 
+	dev->sd_workers[0].thread = dev->sd_cow_thread;
+	if(!is_snap) return 0;
+
+	//the additional workers share the cow bio queue with the cow thread
+	for(i = 1; i < dev->sd_cow_workers; i++){
+		dev->sd_workers[i].thread = kthread_create(snap_cow_thread, &dev->sd_workers[i], SNAP_COW_WORKER_NAME_FMT, minor, i);
+		if(IS_ERR(dev->sd_workers[i].thread)){
+			ret = PTR_ERR(dev->sd_workers[i].thread);
+			dev->sd_workers[i].thread = NULL;
+			LOG_ERROR(ret, "error creating kernel cow worker thread");
+			goto error;
+		}
+	}
+
 	return 0;
 
 error:
@@ -5169,6 +7585,17 @@ error:
 #define __tracer_setup_inc_cow_thread(dev, minor)  __tracer_setup_cow_thread(dev, minor, 0)
 #define __tracer_setup_snap_cow_thread(dev, minor)  __tracer_setup_cow_thread(dev, minor, 1)
 
+static void __tracer_wake_cow_threads(struct snap_device *dev){
+	unsigned int i;
+
+	wake_up_process(dev->sd_cow_thread);
+	if(dev->sd_flush_thread) wake_up_process(dev->sd_flush_thread);
+
+	for(i = 1; i < ELASTIO_SNAP_MAX_COW_WORKERS; i++){
+		if(dev->sd_workers[i].thread) wake_up_process(dev->sd_workers[i].thread);
+	}
+}
+
 static void minor_range_recalculate(void){
 	unsigned int i, highest = 0, lowest = elastio_snap_max_snap_devices - 1;
 	struct snap_device *dev;
@@ -5200,7 +7627,24 @@ static inline void free_mrf_and_ops(struct snap_device *dev){
 	dev->sd_orig_mrf = NULL;
 }
 
+static void __tracer_attach_stats(struct snap_device *dev, struct snap_device *owner){
+	spin_lock(&snap_stats_lock);
+	dev->sd_stats->dev = owner;
+	spin_unlock(&snap_stats_lock);
+}
+
+static void __tracer_destroy_stats(struct snap_device *dev){
+	if(dev->sd_stats){
+		LOG_DEBUG("freeing stats");
+		snap_stats_free(dev->sd_stats);
+		dev->sd_stats = NULL;
+	}
+}
+
 static void __tracer_destroy_tracing(struct snap_device *dev){
+	//readers of the stats must not look at the device while it is being torn down
+	if(dev->sd_stats && dev->sd_stats->dev == dev) __tracer_attach_stats(dev, NULL);
+
 	if(dev->sd_orig_mrf){
 		if(__tracer_should_reset_mrf(dev)) {
 
@@ -5218,7 +7662,7 @@ static void __tracer_destroy_tracing(struct snap_device *dev){
 					LOG_ERROR(ret, "Failed to setup cow thread for device with minor %i and flush bio requests", dev->sd_minor);
 				}
 
-				wake_up_process(dev->sd_cow_thread);
+				__tracer_wake_cow_threads(dev);
 				wait_for_bio_complete(dev);
 				__tracer_destroy_cow_thread(dev);
 			}
@@ -5242,6 +7686,7 @@ static void __tracer_destroy_tracing(struct snap_device *dev){
 		smp_wmb();
 		snap_devices[dev->sd_minor] = NULL;
 		smp_wmb();
+		tracer_lookup_rebuild();
 	}
 
 	dev->sd_minor = 0;
@@ -5261,6 +7706,12 @@ static void __tracer_setup_tracing_unverified(struct snap_device *dev, unsigned
 static int __tracer_setup_tracing(struct snap_device *dev, unsigned int minor){
 	int ret = 0;
 
+	//a device taking over from another one on a transition keeps its stats
+	if(!dev->sd_stats){
+		ret = snap_stats_alloc(minor, &dev->sd_stats);
+		if(ret) return ret;
+	}
+
 	dev->sd_minor = minor;
 	minor_range_include(minor);
 
@@ -5298,6 +7749,8 @@ static int __tracer_setup_tracing(struct snap_device *dev, unsigned int minor){
 
 	if(ret) goto error;
 
+	__tracer_attach_stats(dev, dev);
+
 	return 0;
 
 error:
@@ -5317,13 +7770,14 @@ static void tracer_destroy(struct snap_device *dev){
 	__tracer_destroy_cow_path(dev);
 	__tracer_destroy_cow_free(dev);
 	__tracer_destroy_base_dev(dev);
+	__tracer_destroy_stats(dev);
 }
 
-static int tracer_setup_active_snap(struct snap_device *dev, unsigned int minor, const char *bdev_path, const char *cow_path, unsigned long fallocated_space, unsigned long cache_size, bool ignore_snap_errors){
+static int tracer_setup_active_snap(struct snap_device *dev, unsigned int minor, const char *bdev_path, const char *cow_path, unsigned long fallocated_space, unsigned long cache_size, bool ignore_snap_errors, unsigned int cow_workers){
 	int ret;
 
 #ifdef NETLINK_DEBUG
-	trace_event_generic(EVENT_SETUP_SNAPSHOT, 0);
+	trace_event_generic(EVENT_SETUP_SNAPSHOT, minor, 0);
 #endif
 
 	set_bit(SNAPSHOT, &dev->sd_state);
@@ -5331,6 +7785,7 @@ static int tracer_setup_active_snap(struct snap_device *dev, unsigned int minor,
 	clear_bit(UNVERIFIED, &dev->sd_state);
 
 	dev->sd_ignore_snap_errors = ignore_snap_errors;
+	dev->sd_cow_workers = __tracer_cow_workers(cow_workers);
 
 	//setup base device
 	ret = __tracer_setup_base_dev(dev, bdev_path);
@@ -5352,7 +7807,7 @@ static int tracer_setup_active_snap(struct snap_device *dev, unsigned int minor,
 	ret = __tracer_setup_snap_cow_thread(dev, minor);
 	if(ret) goto error;
 
-	wake_up_process(dev->sd_cow_thread);
+	__tracer_wake_cow_threads(dev);
 
 	//inject the tracing function
 	ret = __tracer_setup_tracing(dev, minor);
@@ -5370,9 +7825,9 @@ static int __tracer_setup_unverified(struct snap_device *dev, unsigned int minor
 
 #ifdef NETLINK_DEBUG
 	if (is_snap)
-		trace_event_generic(EVENT_SETUP_UNVERIFIED_SNAP, 0);
+		trace_event_generic(EVENT_SETUP_UNVERIFIED_SNAP, minor, 0);
 	else
-		trace_event_generic(EVENT_SETUP_UNVERIFIED_INC, 0);
+		trace_event_generic(EVENT_SETUP_UNVERIFIED_INC, minor, 0);
 #endif
 
 	if(is_snap) set_bit(SNAPSHOT, &dev->sd_state);
@@ -5411,7 +7866,7 @@ static int tracer_active_snap_to_inc(struct snap_device *old_dev){
 	int abs_path_len;
 
 #ifdef NETLINK_DEBUG
-	trace_event_generic(EVENT_TRANSITION_INC, 0);
+	trace_event_generic(EVENT_TRANSITION_INC, old_dev->sd_minor, 0);
 #endif
 
 	//allocate new tracer
@@ -5449,7 +7904,7 @@ static int tracer_active_snap_to_inc(struct snap_device *old_dev){
 		tracer_set_fail_state(dev, ret);
 
 		//must make up the new thread regardless of errors so that any queued ssets are cleaned up
-		wake_up_process(dev->sd_cow_thread);
+		__tracer_wake_cow_threads(dev);
 
 		//clean up the old device no matter what
 		__tracer_destroy_snap(old_dev);
@@ -5458,8 +7913,19 @@ static int tracer_active_snap_to_inc(struct snap_device *old_dev){
 		return ret;
 	}
 
+	//the incremental must see the writes to blocks that were unused in the snapshot as changes
+	ret = snap_record_unused_writes(old_dev);
+	if(ret){
+		tracer_set_fail_state(dev, ret);
+		__tracer_wake_cow_threads(dev);
+		__tracer_destroy_snap(old_dev);
+		kfree(old_dev);
+
+		return ret;
+	}
+
 	//wake up new cow thread. Must happen regardless of errors syncing the old cow thread in order to ensure no IO's are leaked.
-	wake_up_process(dev->sd_cow_thread);
+	__tracer_wake_cow_threads(dev);
 
 	//truncate the cow file
 	ret = cow_truncate_to_index(dev->sd_cow);
@@ -5493,7 +7959,7 @@ static int tracer_active_inc_to_snap(struct snap_device *old_dev, const char *co
 	struct snap_device *dev;
 
 #ifdef NETLINK_DEBUG
-	trace_event_generic(EVENT_TRANSITION_SNAP, 0);
+	trace_event_generic(EVENT_TRANSITION_SNAP, old_dev->sd_minor, 0);
 #endif
 
 	//allocate new tracer
@@ -5529,7 +7995,7 @@ static int tracer_active_inc_to_snap(struct snap_device *old_dev, const char *co
 
 	//stop the old cow thread and start the new one
 	__tracer_destroy_cow_thread(old_dev);
-	wake_up_process(dev->sd_cow_thread);
+	__tracer_wake_cow_threads(dev);
 
 	//destroy the unneeded fields of the old_dev and the old_dev itself
 	__tracer_destroy_cow_path(old_dev);
@@ -5550,9 +8016,15 @@ error:
 }
 
 static void tracer_reconfigure(struct snap_device *dev, unsigned long cache_size){
+	//the new size is shrunk again on the next memory check if memory is still low
+	dev->sd_mem_degraded = false;
 	dev->sd_cache_size = cache_size;
 	if(!cache_size) cache_size = elastio_snap_cow_max_memory_default;
 	if(test_bit(ACTIVE, &dev->sd_state)) cow_modify_cache_size(dev->sd_cow, cache_size);
+
+	//a failure leaves the reserve as it was, which is still usable
+	if(dev->sd_page_pool && mempool_resize(dev->sd_page_pool, snap_page_pool_size(cache_size)))
+		LOG_WARN("error resizing read clone page pool");
 }
 
 static void tracer_elastio_snap_info(const struct snap_device *dev, struct elastio_snap_info *info){
@@ -5569,7 +8041,7 @@ static void tracer_elastio_snap_info(const struct snap_device *dev, struct elast
 		info->seqid = dev->sd_cow->seqid;
 		memcpy(info->uuid, dev->sd_cow->uuid, COW_UUID_SIZE);
 		info->version = dev->sd_cow->version;
-		info->nr_changed_blocks = dev->sd_cow->nr_changed_blocks;
+		info->nr_changed_blocks = atomic64_read(&dev->sd_cow->nr_changed_blocks);
 	}else{
 		info->falloc_size = 0;
 		info->seqid = 0;
@@ -5637,7 +8109,7 @@ static int __verify_bdev_writable(const char *bdev_path, int *out){
 	return 0;
 }
 
-static int __ioctl_setup(unsigned int minor, const char *bdev_path, const char *cow_path, unsigned long fallocated_space, unsigned long cache_size, bool ignore_snap_errors, int is_snap, int is_reload){
+static int __ioctl_setup(unsigned int minor, const char *bdev_path, const char *cow_path, unsigned long fallocated_space, unsigned long cache_size, bool ignore_snap_errors, unsigned int cow_workers, int is_snap, int is_reload){
 	int ret, is_mounted;
 	struct snap_device *dev = NULL;
 
@@ -5668,7 +8140,7 @@ static int __ioctl_setup(unsigned int minor, const char *bdev_path, const char *
 
 	//route to the appropriate setup function
 	if(is_snap){
-		if(is_mounted) ret = tracer_setup_active_snap(dev, minor, bdev_path, cow_path, fallocated_space, cache_size, ignore_snap_errors);
+		if(is_mounted) ret = tracer_setup_active_snap(dev, minor, bdev_path, cow_path, fallocated_space, cache_size, ignore_snap_errors, cow_workers);
 		else ret = tracer_setup_unverified_snap(dev, minor, bdev_path, cow_path, cache_size, ignore_snap_errors);
 	}else{
 		if(!is_mounted) ret = tracer_setup_unverified_inc(dev, minor, bdev_path, cow_path, cache_size, ignore_snap_errors);
@@ -5689,9 +8161,9 @@ error:
 	return ret;
 }
 
-#define ioctl_setup_snap(minor, bdev_path, cow_path, fallocated_space, cache_size, ignore_snap_errors) __ioctl_setup(minor, bdev_path, cow_path, fallocated_space, cache_size, ignore_snap_errors, 1, 0)
-#define ioctl_reload_snap(minor, bdev_path, cow_path, cache_size, ignore_snap_errors) __ioctl_setup(minor, bdev_path, cow_path, 0, cache_size, ignore_snap_errors, 1, 1)
-#define ioctl_reload_inc(minor, bdev_path, cow_path, cache_size, ignore_snap_errors) __ioctl_setup(minor, bdev_path, cow_path, 0, cache_size, ignore_snap_errors, 0, 1)
+#define ioctl_setup_snap(minor, bdev_path, cow_path, fallocated_space, cache_size, ignore_snap_errors, cow_workers) __ioctl_setup(minor, bdev_path, cow_path, fallocated_space, cache_size, ignore_snap_errors, cow_workers, 1, 0)
+#define ioctl_reload_snap(minor, bdev_path, cow_path, cache_size, ignore_snap_errors) __ioctl_setup(minor, bdev_path, cow_path, 0, cache_size, ignore_snap_errors, 0, 1, 1)
+#define ioctl_reload_inc(minor, bdev_path, cow_path, cache_size, ignore_snap_errors) __ioctl_setup(minor, bdev_path, cow_path, 0, cache_size, ignore_snap_errors, 0, 0, 1)
 
 static int ioctl_destroy(unsigned int minor){
 	int ret;
@@ -5715,55 +8187,179 @@ static int ioctl_destroy(unsigned int minor){
 	return 0;
 }
 
-static int ioctl_transition_inc(unsigned int minor){
+static int ioctl_transition_inc(unsigned int minor){
+	int ret;
+	struct snap_device *dev;
+
+	LOG_DEBUG("received transition inc ioctl - %u", minor);
+
+	//verify that the minor number is valid
+	ret = verify_minor_in_use_not_busy(minor);
+	if(ret) goto error;
+
+	dev = snap_devices[minor];
+	wait_for_bio_complete(dev);
+
+	//check that the device is not in the fail state
+	ret = tracer_read_fail_state(dev);
+	if (ret) {
+		LOG_ERROR(ret, "device specified is in the fail state");
+		goto error;
+	}
+
+	//check that tracer is in active snapshot state
+	if(!test_bit(SNAPSHOT, &dev->sd_state) || !test_bit(ACTIVE, &dev->sd_state)){
+		ret = -EINVAL;
+		LOG_ERROR(ret, "device specified is not in active snapshot mode");
+		goto error;
+	}
+
+	ret = tracer_active_snap_to_inc(dev);
+	if(ret) goto error;
+
+	return 0;
+
+error:
+	LOG_ERROR(ret, "error during transition to incremental ioctl handler");
+	return ret;
+}
+
+static int ioctl_transition_snap(unsigned int minor, const char *cow_path, unsigned long fallocated_space){
+	int ret;
+	struct snap_device *dev;
+
+	LOG_DEBUG("received transition snap ioctl - %u : %s", minor, cow_path);
+
+	//verify that the minor number is valid
+	ret = verify_minor_in_use_not_busy(minor);
+	if(ret) goto error;
+
+	dev = snap_devices[minor];
+	wait_for_bio_complete(dev);
+
+	//check that the device is not in the fail state
+	if(tracer_read_fail_state(dev)){
+		ret = -EINVAL;
+		LOG_ERROR(ret, "device specified is in the fail state");
+		goto error;
+	}
+
+	//check that tracer is in active incremental state
+	if(test_bit(SNAPSHOT, &dev->sd_state) || !test_bit(ACTIVE, &dev->sd_state)){
+		ret = -EINVAL;
+		LOG_ERROR(ret, "device specified is not in active incremental mode");
+		goto error;
+	}
+
+	ret = tracer_active_inc_to_snap(dev, cow_path, fallocated_space);
+	if(ret) goto error;
+
+	return 0;
+
+error:
+	LOG_ERROR(ret, "error during transition to snapshot ioctl handler");
+	return ret;
+}
+
+static int ioctl_reconfigure(unsigned int minor, unsigned long cache_size){
+	int ret;
+	struct snap_device *dev;
+
+	LOG_DEBUG("received reconfigure ioctl - %u : %lu", minor, cache_size);
+
+	//verify that the minor number is valid
+	ret = verify_minor_in_use_not_busy(minor);
+	if(ret) goto error;
+
+	dev = snap_devices[minor];
+	wait_for_bio_complete(dev);
+
+	//check that the device is not in the fail state
+	if(tracer_read_fail_state(dev)){
+		ret = -EINVAL;
+		LOG_ERROR(ret, "device specified is in the fail state");
+		goto error;
+	}
+
+	tracer_reconfigure(dev, cache_size);
+
+	return 0;
+
+error:
+	LOG_ERROR(ret, "error during reconfigure ioctl handler");
+	return ret;
+}
+
+static int ioctl_elastio_snap_info(struct elastio_snap_info *info){
 	int ret;
 	struct snap_device *dev;
 
-	LOG_DEBUG("received transition inc ioctl - %u", minor);
+	LOG_DEBUG("received elastio-snap info ioctl - %u", info->minor);
 
 	//verify that the minor number is valid
-	ret = verify_minor_in_use_not_busy(minor);
+	ret = verify_minor_in_use(info->minor);
 	if(ret) goto error;
 
-	dev = snap_devices[minor];
-	wait_for_bio_complete(dev);
+	dev = snap_devices[info->minor];
 
-	//check that the device is not in the fail state
-	ret = tracer_read_fail_state(dev);
-	if (ret) {
-		LOG_ERROR(ret, "device specified is in the fail state");
-		goto error;
-	}
+	tracer_elastio_snap_info(dev, info);
 
-	//check that tracer is in active snapshot state
-	if(!test_bit(SNAPSHOT, &dev->sd_state) || !test_bit(ACTIVE, &dev->sd_state)){
+	return 0;
+
+error:
+	LOG_ERROR(ret, "error during reconfigure ioctl handler");
+	return ret;
+}
+
+static int ioctl_elastio_snap_stats(const struct elastio_snap_stats_params *params, struct elastio_snap_stats *stats){
+	int ret;
+
+	LOG_DEBUG("received elastio-snap stats ioctl - %u : %u", params->minor, params->size);
+
+	//newer versions of the struct only append fields, so any caller that knows the leading ones can be served
+	if(params->size < offsetof(struct elastio_snap_stats, bios_traced)){
 		ret = -EINVAL;
-		LOG_ERROR(ret, "device specified is not in active snapshot mode");
+		LOG_ERROR(ret, "stats buffer is too small");
 		goto error;
 	}
 
-	ret = tracer_active_snap_to_inc(dev);
+	//verify that the minor number is valid
+	ret = verify_minor_in_use(params->minor);
 	if(ret) goto error;
 
+	memset(stats, 0, sizeof(struct elastio_snap_stats));
+	stats->minor = params->minor;
+	tracer_elastio_snap_stats(snap_devices[params->minor], stats);
+
 	return 0;
 
 error:
-	LOG_ERROR(ret, "error during transition to incremental ioctl handler");
+	LOG_ERROR(ret, "error during stats ioctl handler");
 	return ret;
 }
 
-static int ioctl_transition_snap(unsigned int minor, const char *cow_path, unsigned long fallocated_space){
+static int ioctl_changed_blocks(struct ctrl_view *view, struct changed_blocks_params *params){
 	int ret;
+	unsigned int i;
+	unsigned long size;
+	uint64_t end;
 	struct snap_device *dev;
+	struct changed_block_extent *ext = NULL;
+	void *new_buf;
 
-	LOG_DEBUG("received transition snap ioctl - %u : %s", minor, cow_path);
+	LOG_DEBUG("received changed blocks ioctl - %u : %llu, %llu", params->minor, params->start, params->count);
+
+	if(!params->max_extents || params->max_extents > ELASTIO_SNAP_MAX_CHANGED_EXTENTS){
+		ret = -EINVAL;
+		LOG_ERROR(ret, "invalid number of extents");
+		goto error;
+	}
 
 	//verify that the minor number is valid
-	ret = verify_minor_in_use_not_busy(minor);
+	ret = verify_minor_in_use(params->minor);
 	if(ret) goto error;
 
-	dev = snap_devices[minor];
-	wait_for_bio_complete(dev);
+	dev = snap_devices[params->minor];
 
 	//check that the device is not in the fail state
 	if(tracer_read_fail_state(dev)){
@@ -5772,35 +8368,87 @@ static int ioctl_transition_snap(unsigned int minor, const char *cow_path, unsig
 		goto error;
 	}
 
-	//check that tracer is in active incremental state
-	if(test_bit(SNAPSHOT, &dev->sd_state) || !test_bit(ACTIVE, &dev->sd_state)){
+	//the index of a dormant device is on file only
+	if(!test_bit(ACTIVE, &dev->sd_state) || test_bit(UNVERIFIED, &dev->sd_state)){
 		ret = -EINVAL;
-		LOG_ERROR(ret, "device specified is not in active incremental mode");
+		LOG_ERROR(ret, "device specified is not active");
 		goto error;
 	}
 
-	ret = tracer_active_inc_to_snap(dev, cow_path, fallocated_space);
+	size = PAGE_ALIGN((unsigned long)params->max_extents * sizeof(struct changed_block_extent));
+	if(params->extents){
+		ext = vmalloc(size);
+	}else if(view->size < size){
+		//a mapping of the old buffer keeps its pages, it just won't see this query
+		new_buf = vmalloc_user(size);
+		if(new_buf){
+			mutex_lock(&view->lock);
+			vfree(view->buf);
+			view->buf = ext = new_buf;
+			view->size = size;
+			mutex_unlock(&view->lock);
+		}
+	}else{
+		ext = view->buf;
+	}
+
+	if(!ext){
+		ret = -ENOMEM;
+		LOG_ERROR(ret, "error allocating extents");
+		goto error;
+	}
+
+	params->nr_extents = 0;
+	params->next = params->start;
+	params->nr_changed = 0;
+
+	//the range is clamped to the end of the device, including a last partial block the index has room for
+	end = min_t(uint64_t, SECTOR_TO_BLOCK(dev->sd_size + SECTORS_PER_BLOCK - 1), (uint64_t)dev->sd_cow->total_sects * dev->sd_cow->sect_size);
+	if(params->start >= end) goto out;
+	if(params->count < end - params->start) end = params->start + params->count;
+
+	ret = cow_changed_extents(dev->sd_cow, params->start, end, ext, params->max_extents, &params->nr_extents, &params->next);
 	if(ret) goto error;
 
+	for(i = 0; i < params->nr_extents; i++) params->nr_changed += ext[i].count;
+
+	if(params->extents && copy_to_user((struct changed_block_extent __user *)params->extents, ext, params->nr_extents * sizeof(struct changed_block_extent))){
+		ret = -EFAULT;
+		LOG_ERROR(ret, "error copying extents to user space");
+		goto error;
+	}
+
+out:
+	if(params->extents) vfree(ext);
 	return 0;
 
 error:
-	LOG_ERROR(ret, "error during transition to snapshot ioctl handler");
+	LOG_ERROR(ret, "error during changed blocks ioctl handler");
+	if(params->extents) vfree(ext);
 	return ret;
 }
 
-static int ioctl_reconfigure(unsigned int minor, unsigned long cache_size){
+static int ioctl_set_unused_blocks(const struct unused_blocks_params *params){
 	int ret;
-	struct snap_device *dev;
+	unsigned long i, j, len;
+	uint64_t pos, end, nr_blocks;
+	unsigned char *buf = NULL;
+	unsigned long *unused = NULL;
+	struct snap_device *dev = NULL;
 
-	LOG_DEBUG("received reconfigure ioctl - %u : %lu", minor, cache_size);
+	LOG_DEBUG("received set unused blocks ioctl - %u : %llu, %llu", params->minor, params->start, params->count);
+
+	if(params->start % 8){
+		ret = -EINVAL;
+		LOG_ERROR(ret, "unused blocks bitmap does not start on a byte boundary");
+		goto error;
+	}
 
 	//verify that the minor number is valid
-	ret = verify_minor_in_use_not_busy(minor);
+	ret = verify_minor_in_use(params->minor);
 	if(ret) goto error;
 
-	dev = snap_devices[minor];
-	wait_for_bio_complete(dev);
+	dev = snap_devices[params->minor];
 
 	//check that the device is not in the fail state
 	if(tracer_read_fail_state(dev)){
@@ -5809,33 +8457,73 @@ static int ioctl_reconfigure(unsigned int minor, unsigned long cache_size){
 		goto error;
 	}
 
-	tracer_reconfigure(dev, cache_size);
+	//check that tracer is in active snapshot state
+	if(!test_bit(SNAPSHOT, &dev->sd_state) || !test_bit(ACTIVE, &dev->sd_state) || test_bit(UNVERIFIED, &dev->sd_state)){
+		ret = -EINVAL;
+		LOG_ERROR(ret, "device specified is not in active snapshot mode");
+		goto error;
+	}
 
-	return 0;
+	//writes to unused blocks are skipped by marking them preserved, the bitmap is only kept for 4096 byte pages
+	if(!dev->sd_preserved){
+		ret = -EOPNOTSUPP;
+		LOG_ERROR(ret, "device specified has no preserved blocks bitmap, page size is %lu", (unsigned long)PAGE_SIZE);
+		goto error;
+	}
 
-error:
-	LOG_ERROR(ret, "error during reconfigure ioctl handler");
-	return ret;
-}
+	//the range is clamped to the end of the device
+	nr_blocks = SECTOR_TO_BLOCK(dev->sd_size + SECTORS_PER_BLOCK - 1);
+	if(params->start >= nr_blocks) return 0;
+	end = (params->count < nr_blocks - params->start)? params->start + params->count : nr_blocks;
 
-static int ioctl_elastio_snap_info(struct elastio_snap_info *info){
-	int ret;
-	struct snap_device *dev;
+	buf = kmalloc(PAGE_SIZE, GFP_KERNEL);
+	if(!buf){
+		ret = -ENOMEM;
+		LOG_ERROR(ret, "error allocating bitmap buffer");
+		goto error;
+	}
 
-	LOG_DEBUG("received elastio-snap info ioctl - %u", info->minor);
+	unused = dev->sd_unused;
+	if(!unused){
+		unused = vzalloc(BITS_TO_LONGS(nr_blocks) * sizeof(unsigned long));
+		if(!unused){
+			ret = -ENOMEM;
+			LOG_ERROR(ret, "error allocating unused blocks bitmap");
+			goto error;
+		}
+	}
 
-	//verify that the minor number is valid
-	ret = verify_minor_in_use(info->minor);
-	if(ret) goto error;
+	for(pos = params->start; pos < end; pos += len * 8){
+		len = min_t(uint64_t, PAGE_SIZE, DIV_ROUND_UP(end - pos, 8));
 
-	dev = snap_devices[info->minor];
+		if(copy_from_user(buf, (const unsigned char __user *)params->bitmap + (pos - params->start) / 8, len)){
+			ret = -EFAULT;
+			LOG_ERROR(ret, "error copying unused blocks bitmap from user space");
+			goto error;
+		}
 
-	tracer_elastio_snap_info(dev, info);
+		for(i = 0; i < len; i++){
+			if(!buf[i]) continue;
 
+			for(j = 0; j < 8 && pos + i * 8 + j < end; j++){
+				if(buf[i] & (1 << j)) set_bit(pos + i * 8 + j, unused);
+			}
+		}
+	}
+
+	//the tracing path may only see the bitmap once it is filled
+	if(!dev->sd_unused){
+		smp_wmb();
+		dev->sd_unused = unused;
+	}
+
+	kfree(buf);
 	return 0;
 
 error:
-	LOG_ERROR(ret, "error during reconfigure ioctl handler");
+	LOG_ERROR(ret, "error during set unused blocks ioctl handler");
+	if(unused && unused != dev->sd_unused) vfree(unused);
+	kfree(buf);
 	return ret;
 }
 
@@ -5851,14 +8539,62 @@ static int get_free_minor(void)
 	return -ENOENT;
 }
 
+static int ctrl_open(struct inode *inode, struct file *filp){
+	struct ctrl_view *view;
+
+	view = kzalloc(sizeof(struct ctrl_view), GFP_KERNEL);
+	if(!view){
+		LOG_ERROR(-ENOMEM, "error allocating control device state");
+		return -ENOMEM;
+	}
+
+	mutex_init(&view->lock);
+	filp->private_data = view;
+
+	return nonseekable_open(inode, filp);
+}
+
+static int ctrl_release(struct inode *inode, struct file *filp){
+	struct ctrl_view *view = filp->private_data;
+
+	vfree(view->buf);
+	kfree(view);
+
+	return 0;
+}
+
+static int ctrl_mmap(struct file *filp, struct vm_area_struct *vma){
+	int ret;
+	struct ctrl_view *view = filp->private_data;
+
+	//the extents are only ever written by the module
+	if(vma->vm_flags & VM_WRITE) return -EPERM;
+#ifdef HAVE_VM_FLAGS_CLEAR
+	vm_flags_clear(vma, VM_MAYWRITE);
+#else
+	vma->vm_flags &= ~VM_MAYWRITE;
+#endif
+
+	mutex_lock(&view->lock);
+	ret = (view->buf)? remap_vmalloc_range(vma, view->buf, vma->vm_pgoff) : -ENODATA;
+	mutex_unlock(&view->lock);
+
+	return ret;
+}
+
 static long ctrl_ioctl(struct file *filp, unsigned int cmd, unsigned long arg){
 	int ret, idx;
 	char *bdev_path = NULL;
 	char *cow_path = NULL;
 	struct elastio_snap_info *info = NULL;
+	struct elastio_snap_stats stats;
+	struct elastio_snap_stats_params st_params;
+	struct changed_blocks_params cb_params;
+	struct unused_blocks_params ub_params;
 	unsigned int minor = 0;
 	unsigned long fallocated_space = 0, cache_size = 0;
 	bool ignore_snap_errors = false;
+	unsigned int cow_workers = 0;
 
 	LOG_DEBUG("ioctl command received: %d", cmd);
 	mutex_lock(&ioctl_mutex);
@@ -5869,7 +8605,24 @@ static long ctrl_ioctl(struct file *filp, unsigned int cmd, unsigned long arg){
 		ret = get_setup_params((struct setup_params __user *)arg, &minor, &bdev_path, &cow_path, &fallocated_space, &cache_size, &ignore_snap_errors);
 		if(ret) break;
 
-		ret = ioctl_setup_snap(minor, bdev_path, cow_path, fallocated_space, cache_size, ignore_snap_errors);
+		ret = ioctl_setup_snap(minor, bdev_path, cow_path, fallocated_space, cache_size, ignore_snap_errors, cow_workers);
+		if(ret) break;
+
+		elastio_snap_wait_for_release(snap_devices[minor]);
+
+		break;
+	case IOCTL_SETUP_SNAP_WORKERS:
+		//get the worker count from user space, the setup params in front of it are read as for IOCTL_SETUP_SNAP
+		ret = get_user(cow_workers, &((struct setup_workers_params __user *)arg)->cow_workers);
+		if(ret){
+			LOG_ERROR(ret, "error copying cow worker count from user space");
+			break;
+		}
+
+		ret = get_setup_params(&((struct setup_workers_params __user *)arg)->setup, &minor, &bdev_path, &cow_path, &fallocated_space, &cache_size, &ignore_snap_errors);
+		if(ret) break;
+
+		ret = ioctl_setup_snap(minor, bdev_path, cow_path, fallocated_space, cache_size, ignore_snap_errors, cow_workers);
 		if(ret) break;
 
 		elastio_snap_wait_for_release(snap_devices[minor]);
@@ -5961,6 +8714,63 @@ static long ctrl_ioctl(struct file *filp, unsigned int cmd, unsigned long arg){
 			break;
 		}
 
+		break;
+	case IOCTL_ELASTIO_SNAP_STATS:
+		//get params from user space
+		ret = copy_from_user(&st_params, (struct elastio_snap_stats_params __user *)arg, sizeof(struct elastio_snap_stats_params));
+		if(ret){
+			ret = -EFAULT;
+			LOG_ERROR(ret, "error copying elastio-snap-stats params from user space");
+			break;
+		}
+
+		ret = ioctl_elastio_snap_stats(&st_params, &stats);
+		if(ret) break;
+
+		//an older caller only gets the fields its version of the struct has room for
+		st_params.size = min_t(unsigned int, st_params.size, sizeof(struct elastio_snap_stats));
+
+		ret = copy_to_user((struct elastio_snap_stats __user *)st_params.stats, &stats, st_params.size);
+		if(!ret) ret = copy_to_user((struct elastio_snap_stats_params __user *)arg, &st_params, sizeof(struct elastio_snap_stats_params));
+		if(ret){
+			ret = -EFAULT;
+			LOG_ERROR(ret, "error copying elastio-snap-stats struct to user space");
+			break;
+		}
+
+		break;
+	case IOCTL_CHANGED_BLOCKS:
+		//get params from user space
+		ret = copy_from_user(&cb_params, (struct changed_blocks_params __user *)arg, sizeof(struct changed_blocks_params));
+		if(ret){
+			ret = -EFAULT;
+			LOG_ERROR(ret, "error copying changed blocks params from user space");
+			break;
+		}
+
+		ret = ioctl_changed_blocks(filp->private_data, &cb_params);
+		if(ret) break;
+
+		ret = copy_to_user((struct changed_blocks_params __user *)arg, &cb_params, sizeof(struct changed_blocks_params));
+		if(ret){
+			ret = -EFAULT;
+			LOG_ERROR(ret, "error copying changed blocks params to user space");
+			break;
+		}
+
+		break;
+	case IOCTL_SET_UNUSED_BLOCKS:
+		//get params from user space
+		ret = copy_from_user(&ub_params, (struct unused_blocks_params __user *)arg, sizeof(struct unused_blocks_params));
+		if(ret){
+			ret = -EFAULT;
+			LOG_ERROR(ret, "error copying unused blocks params from user space");
+			break;
+		}
+
+		ret = ioctl_set_unused_blocks(&ub_params);
+		if(ret) break;
+
 		break;
 	case IOCTL_GET_FREE:
 		idx = get_free_minor();
@@ -6002,6 +8812,15 @@ static void __tracer_active_to_dormant(struct snap_device *dev){
 	//stop the cow thread
 	__tracer_destroy_cow_thread(dev);
 
+	//writes to blocks unused at snapshot time must be in the index before it is closed
+	if(test_bit(SNAPSHOT, &dev->sd_state)){
+		ret = snap_record_unused_writes(dev);
+		if(ret) goto error;
+
+		//the snapshot index on file may now hold mappings that read as zeros
+		if(dev->sd_unused && dev->sd_cow->version < COW_VERSION_UNUSED_BLOCKS) dev->sd_cow->version = COW_VERSION_UNUSED_BLOCKS;
+	}
+
 	//close the cow manager
 	ret = __tracer_destroy_cow_sync_and_close(dev);
 	if(ret) goto error;
@@ -6053,7 +8872,7 @@ static void __tracer_unverified_snap_to_active(struct snap_device *dev, const ch
 	ret = __tracer_setup_snap_cow_thread(dev, minor);
 	if(ret) goto error;
 
-	wake_up_process(dev->sd_cow_thread);
+	__tracer_wake_cow_threads(dev);
 
 	//inject the tracing function
 	ret = __tracer_setup_tracing(dev, minor);
@@ -6105,7 +8924,7 @@ static void __tracer_unverified_inc_to_active(struct snap_device *dev, const cha
 	ret = __tracer_setup_inc_cow_thread(dev, minor);
 	if(ret) goto error;
 
-	wake_up_process(dev->sd_cow_thread);
+	__tracer_wake_cow_threads(dev);
 
 	//inject the tracing function
 	ret = __tracer_setup_tracing(dev, minor);
@@ -6137,7 +8956,7 @@ static void __tracer_dormant_to_active(struct snap_device *dev, const char __use
 
 	if(ret) goto error;
 
-	wake_up_process(dev->sd_cow_thread);
+	__tracer_wake_cow_threads(dev);
 
 	//set the state to active
 	smp_wmb();
@@ -6156,7 +8975,7 @@ error:
 static void auto_transition_dormant(unsigned int i){
 	mutex_lock(&ioctl_mutex);
 #ifdef NETLINK_DEBUG
-	trace_event_generic(EVENT_TRANSITION_DORMANT, 0);
+	trace_event_generic(EVENT_TRANSITION_DORMANT, i, 0);
 #endif
 	__tracer_active_to_dormant(snap_devices[i]);
 	mutex_unlock(&ioctl_mutex);
@@ -6168,7 +8987,7 @@ static void auto_transition_active(unsigned int i, const char __user *dir_name){
 	mutex_lock(&ioctl_mutex);
 
 #ifdef NETLINK_DEBUG
-	trace_event_generic(EVENT_TRANSITION_ACTIVE, 0);
+	trace_event_generic(EVENT_TRANSITION_ACTIVE, i, 0);
 #endif
 
 	if(test_bit(UNVERIFIED, &dev->sd_state)){
@@ -6818,7 +9637,7 @@ static int elastio_snap_proc_show(struct seq_file *m, void *v){
 
 				if(dev->sd_cow->version > COW_VERSION_0){
 					seq_printf(m, "\t\t\t\"version\": %llu,\n", dev->sd_cow->version);
-					seq_printf(m, "\t\t\t\"nr_changed_blocks\": %llu,\n", dev->sd_cow->nr_changed_blocks);
+					seq_printf(m, "\t\t\t\"nr_changed_blocks\": %llu,\n", (unsigned long long)atomic64_read(&dev->sd_cow->nr_changed_blocks));
 				}
 			}
 		}
@@ -6896,6 +9715,8 @@ static void agent_exit(void){
 
 	LOG_DEBUG("module exit");
 
+	cancel_delayed_work_sync(&snap_mem_work);
+
 	restore_system_call_table();
 
 	//unregister control device
@@ -6919,12 +9740,60 @@ static void agent_exit(void){
 		snap_devices = NULL;
 	}
 
+	tracer_lookup_destroy();
+
+	//the stats of the devices have been removed with them
+	if(elastio_snap_kobj){
+		kobject_put(elastio_snap_kobj);
+		elastio_snap_kobj = NULL;
+	}
+
+	if(sset_pool){
+		mempool_destroy(sset_pool);
+		sset_pool = NULL;
+	}
+
+	if(bio_queue_node_pool){
+		mempool_destroy(bio_queue_node_pool);
+		bio_queue_node_pool = NULL;
+	}
+
+	if(bio_sector_map_pool){
+		mempool_destroy(bio_sector_map_pool);
+		bio_sector_map_pool = NULL;
+	}
+
+	if(tp_pool){
+		mempool_destroy(tp_pool);
+		tp_pool = NULL;
+	}
+
+	if(bio_sector_map_cache){
+		kmem_cache_destroy(bio_sector_map_cache);
+		bio_sector_map_cache = NULL;
+	}
+
+	if(tp_cache){
+		kmem_cache_destroy(tp_cache);
+		tp_cache = NULL;
+	}
+
+	if(bio_queue_node_cache){
+		kmem_cache_destroy(bio_queue_node_cache);
+		bio_queue_node_cache = NULL;
+	}
+
+	if(sset_cache){
+		kmem_cache_destroy(sset_cache);
+		sset_cache = NULL;
+	}
+
 	//unregister our block device driver
 	LOG_DEBUG("unregistering device driver from the kernel");
 	unregister_blkdev(major, DRIVER_NAME);
 #ifdef NETLINK_DEBUG
-	trace_event_generic(EVENT_DRIVER_DEINIT, 0);
-	netlink_release();
+	trace_event_generic(EVENT_DRIVER_DEINIT, TRACE_NO_MINOR, 0);
+	nl_debug_release();
 #endif
 }
 module_exit(agent_exit);
@@ -6935,17 +9804,18 @@ static int __init agent_init(void){
 	LOG_DEBUG("module init");
 
 #ifdef NETLINK_DEBUG
-	ret = netlink_init();
+	ret = nl_debug_init();
 	if (ret) {
 		LOG_DEBUG("failing driver init");
 		return ret;
 	}
 
-	trace_event_generic(EVENT_DRIVER_INIT, 0);
+	trace_event_generic(EVENT_DRIVER_INIT, TRACE_NO_MINOR, 0);
 #endif
 
 	//init ioctl mutex
 	mutex_init(&ioctl_mutex);
+	INIT_DELAYED_WORK(&snap_mem_work, snap_mem_check);
 
 	//init minor range
 	if(elastio_snap_max_snap_devices == 0 || elastio_snap_max_snap_devices > ELASTIO_SNAP_MAX_SNAP_DEVICES){
@@ -6966,6 +9836,68 @@ static int __init agent_init(void){
 		goto error;
 	}
 
+	//create the sector set slab and its reserve
+	LOG_DEBUG("creating sector set pool");
+	sset_cache = kmem_cache_create("elastio_snap_sset", sizeof(struct sector_set), 0, 0, NULL);
+	if(!sset_cache){
+		ret = -ENOMEM;
+		LOG_ERROR(ret, "error creating sector set cache");
+		goto error;
+	}
+
+	sset_pool = mempool_create_slab_pool(SSET_POOL_SIZE, sset_cache);
+	if(!sset_pool){
+		ret = -ENOMEM;
+		LOG_ERROR(ret, "error creating sector set pool");
+		goto error;
+	}
+
+	//create the slab and reserve for the write index of the cow bio queues
+	LOG_DEBUG("creating bio queue node pool");
+	bio_queue_node_cache = kmem_cache_create("elastio_snap_bq_node", sizeof(struct bio_queue_node), 0, 0, NULL);
+	if(!bio_queue_node_cache){
+		ret = -ENOMEM;
+		LOG_ERROR(ret, "error creating bio queue node cache");
+		goto error;
+	}
+
+	bio_queue_node_pool = mempool_create_slab_pool(BIO_QUEUE_NODE_POOL_SIZE, bio_queue_node_cache);
+	if(!bio_queue_node_pool){
+		ret = -ENOMEM;
+		LOG_ERROR(ret, "error creating bio queue node pool");
+		goto error;
+	}
+
+	//create the slabs and reserves for tracing the writes that need copy on write
+	LOG_DEBUG("creating tracing params pools");
+	tp_cache = kmem_cache_create("elastio_snap_tp", sizeof(struct tracing_params), 0, 0, NULL);
+	if(!tp_cache){
+		ret = -ENOMEM;
+		LOG_ERROR(ret, "error creating tracing params cache");
+		goto error;
+	}
+
+	tp_pool = mempool_create_slab_pool(TP_POOL_SIZE, tp_cache);
+	if(!tp_pool){
+		ret = -ENOMEM;
+		LOG_ERROR(ret, "error creating tracing params pool");
+		goto error;
+	}
+
+	bio_sector_map_cache = kmem_cache_create("elastio_snap_bio_sect_map", sizeof(struct bio_sector_map), 0, 0, NULL);
+	if(!bio_sector_map_cache){
+		ret = -ENOMEM;
+		LOG_ERROR(ret, "error creating bio sector map cache");
+		goto error;
+	}
+
+	bio_sector_map_pool = mempool_create_slab_pool(BIO_SECTOR_MAP_POOL_SIZE, bio_sector_map_cache);
+	if(!bio_sector_map_pool){
+		ret = -ENOMEM;
+		LOG_ERROR(ret, "error creating bio sector map pool");
+		goto error;
+	}
+
 	//allocate global device array
 	LOG_DEBUG("allocate global device array");
 	snap_devices = kzalloc(elastio_snap_max_snap_devices * sizeof(struct snap_device*), GFP_KERNEL);
@@ -6975,6 +9907,15 @@ static int __init agent_init(void){
 		goto error;
 	}
 
+	//create the sysfs directory holding the stats of the devices
+	LOG_DEBUG("creating sysfs directory");
+	elastio_snap_kobj = kobject_create_and_add(DRIVER_NAME, kernel_kobj);
+	if(!elastio_snap_kobj){
+		ret = -ENOMEM;
+		LOG_ERROR(ret, "error creating sysfs directory");
+		goto error;
+	}
+
 	//register proc file
 	LOG_DEBUG("registering proc file");
 	info_proc = proc_create(INFO_PROC_FILE, 0, NULL, &elastio_snap_proc_fops);
@@ -6999,6 +9940,9 @@ static int __init agent_init(void){
 		}
 	}
 
+	//start watching the available memory
+	schedule_delayed_work(&snap_mem_work, 0);
+
 	return 0;
 
 error:
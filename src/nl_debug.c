@@ -7,35 +7,74 @@
 
 #include "nl_debug.h"
 
-static uint64_t seq_num = 1;
-struct sock *nl_sock = NULL;
-spinlock_t nl_spinlock;
+#include <linux/math64.h>
 
-static void nl_recv_msg(struct sk_buff *skb)
+#ifndef ACCESS_ONCE
+	#define ACCESS_ONCE(x) (*(volatile typeof(x) *)&(x))
+#endif
+
+static unsigned long trace_mask = ~0UL;
+module_param(trace_mask, ulong, S_IRUGO | S_IWUSR);
+MODULE_PARM_DESC(trace_mask, "bitmask of the debug events to record, bit n enables the events of type n");
+
+static unsigned int trace_minor = TRACE_NO_MINOR;
+module_param(trace_minor, uint, S_IRUGO | S_IWUSR);
+MODULE_PARM_DESC(trace_minor, "record only the debug events of this minor and those not tied to a device (4294967295 records all of them)");
+
+static unsigned int trace_ring_pages = 128;
+module_param(trace_ring_pages, uint, S_IRUGO);
+MODULE_PARM_DESC(trace_ring_pages, "size of the debug event ring of each cpu (in pages)");
+
+static void *trace_buf = NULL;
+static unsigned long trace_ring_size;
+static unsigned int trace_nr_records;
+
+static inline struct trace_ring_header *trace_ring(int cpu)
 {
-	nlmsg_free(skb);
+	return trace_buf + PAGE_SIZE + cpu * trace_ring_size;
 }
 
-int nl_send_event(enum msg_type_t type, const char *func, int line, struct params_t *params)
+int nl_send_event(enum msg_type_t type, unsigned int minor, const char *func, int line, struct params_t *params)
 {
-	struct sk_buff *skb;
+	struct trace_ring_header *ring;
 	struct msg_header_t *msg;
-	struct nlmsghdr *nlsk_mh;
 	struct timespec64 tspec;
+	unsigned long flags;
+	unsigned int filter = ACCESS_ONCE(trace_minor);
+	uint32_t slot;
+	uint64_t head;
+
+	if (!trace_buf || !(ACCESS_ONCE(trace_mask) & (1UL << type)))
+		return 0;
+
+	if (filter != TRACE_NO_MINOR && minor != TRACE_NO_MINOR && minor != filter)
+		return 0;
+
+	// the ring of a cpu only has one writer at a time once interrupts are off
+	local_irq_save(flags);
+	ring = trace_ring(smp_processor_id());
+	head = ring->head;
+
+	if (head - ACCESS_ONCE(ring->tail) >= trace_nr_records) {
+		ring->lost++;
+		local_irq_restore(flags);
+		return -ENOSPC;
+	}
+
+	// the consumer must be done with the slot before it is overwritten
+	smp_mb();
 
-	skb = nlmsg_new(NLMSG_DEFAULT_SIZE, GFP_ATOMIC);
-	nlsk_mh = nlmsg_put(skb, 0, 0, NLMSG_DONE, sizeof(struct msg_header_t), 0);
-	NETLINK_CB(skb).portid = 0;
-	NETLINK_CB(skb).dst_group = NL_MCAST_GROUP;
+	div_u64_rem(head, trace_nr_records, &slot);
+	msg = (void *)ring + PAGE_SIZE + slot * sizeof(struct msg_header_t);
 
-	spin_lock_bh(&nl_spinlock);
-	msg = nlmsg_data(nlsk_mh);
 	msg->type = type;
 	ktime_get_ts64(&tspec);
 	msg->timestamp = timespec64_to_ns(&tspec);
-	msg->seq_num = seq_num;
-	seq_num++;
+	// gaps in the sequence numbers of a cpu show where events were lost
+	msg->seq_num = head + ring->lost + 1;
+	msg->minor = minor;
 
+	memset(&msg->source, 0, sizeof(msg->source));
 	if (func) {
 		msg->source.line = line;
 		strncpy(msg->source.func, func, sizeof(msg->source.func));
@@ -43,30 +82,74 @@ int nl_send_event(enum msg_type_t type, const char *func, int line, struct param
 
 	memcpy(&msg->params, params, sizeof(*params));
 
-	nlmsg_multicast(nl_sock, skb, 0, NL_MCAST_GROUP, GFP_ATOMIC);
-	spin_unlock_bh(&nl_spinlock);
+	// publish the record only once it is complete
+	smp_wmb();
+	ring->head = head + 1;
+	local_irq_restore(flags);
+
 	return 0;
 }
 
-void netlink_release(void)
+static int trace_mmap(struct file *filp, struct vm_area_struct *vma)
+{
+	return remap_vmalloc_range(vma, trace_buf, vma->vm_pgoff);
+}
+
+static const struct file_operations trace_fops = {
+	.owner = THIS_MODULE,
+	.mmap = trace_mmap,
+	.open = nonseekable_open,
+	.llseek = noop_llseek,
+};
+
+static struct miscdevice trace_device = {
+	.minor = MISC_DYNAMIC_MINOR,
+	.name = TRACE_DEVICE_NAME,
+	.fops = &trace_fops,
+};
+
+void nl_debug_release(void)
 {
-	printk("netlink release\n");
-	sock_release(nl_sock->sk_socket);
+	printk("trace ring release\n");
+	misc_deregister(&trace_device);
+	vfree(trace_buf);
+	trace_buf = NULL;
 }
 
-int netlink_init(void)
+int nl_debug_init(void)
 {
-	struct netlink_kernel_cfg cfg = {
-		.input = nl_recv_msg,
-	};
+	int ret;
+	struct trace_ring_info *info;
+
+	printk("trace ring init\n");
+
+	trace_nr_records = ((unsigned long)trace_ring_pages * PAGE_SIZE) / sizeof(struct msg_header_t);
+	if (!trace_nr_records) {
+		printk("trace ring: ring size is too small\n");
+		return -EINVAL;
+	}
+
+	// the rings are zeroed and mapped to userspace as is
+	trace_ring_size = ((unsigned long)trace_ring_pages + 1) * PAGE_SIZE;
+	trace_buf = vmalloc_user(PAGE_SIZE + nr_cpu_ids * trace_ring_size);
+	if (!trace_buf) {
+		printk("trace ring: error allocating rings\n");
+		return -ENOMEM;
+	}
 
-	printk("netlink init\n");
-	spin_lock_init(&nl_spinlock);
+	info = trace_buf;
+	info->version = TRACE_RING_VERSION;
+	info->nr_rings = nr_cpu_ids;
+	info->ring_size = trace_ring_size;
+	info->record_size = sizeof(struct msg_header_t);
+	info->nr_records = trace_nr_records;
 
-	nl_sock = netlink_kernel_create(&init_net, NETLINK_USERSOCK, &cfg);
-	if (!nl_sock) {
-		printk("netlink: error creating socket\n");
-		return -ENOTSUPP;
+	ret = misc_register(&trace_device);
+	if (ret) {
+		printk("trace ring: error registering device\n");
+		vfree(trace_buf);
+		trace_buf = NULL;
+		return ret;
 	}
 
 	return 0;
@@ -6,15 +6,30 @@
  */
 
 #ifdef KERNEL_MODULE
-#include <net/sock.h>
-#include <linux/netlink.h>
-#include <linux/skbuff.h>
+#include <linux/module.h>
+#include <linux/miscdevice.h>
+#include <linux/fs.h>
+#include <linux/mm.h>
+#include <linux/vmalloc.h>
+#include <linux/bio.h>
 #endif
 
 #include "kernel-config.h"
 #include "elastio-snap.h"
 
-#define NL_MCAST_GROUP 1
+/*
+ * Events are written to a ring buffer per cpu, mapped by the consumer from TRACE_DEVICE_NAME.
+ * The mapping starts with a page holding struct trace_ring_info, followed by nr_rings rings
+ * of ring_size bytes each. A ring starts with a page holding struct trace_ring_header,
+ * followed by nr_records struct msg_header_t records.
+ *
+ * The kernel only advances head and the consumer only advances tail, both count records
+ * since the ring was created, so record i lives in slot i % nr_records. Events arriving
+ * while a ring is full are dropped and counted in lost.
+ */
+#define TRACE_DEVICE_NAME "elastio-snap-trace"
+#define TRACE_RING_VERSION 1
+#define TRACE_NO_MINOR 0xffffffff
 
 enum msg_type_t {
 	EVENT_DRIVER_INIT,
@@ -34,7 +49,7 @@ enum msg_type_t {
 	EVENT_BIO_CALL_ORIG,
 	EVENT_BIO_SNAP,
 	EVENT_BIO_INC,
-	EVENT_BIO_CLONED,
+	EVENT_BIO_CLONED,   // priv1 is the id of the original bio
 	EVENT_BIO_READ_COMPLETE,
 	EVENT_BIO_QUEUED,   // cloned bio enqueued for the cow thread
 	EVENT_BIO_RELEASED, // parent bio released
@@ -67,15 +82,30 @@ struct code_info_t {
 
 struct msg_header_t {
 	uint8_t type;
-	uint64_t seq_num;
+	uint64_t seq_num; // per cpu
 	uint64_t timestamp;
 	struct params_t params;
 	struct code_info_t source;
+	uint32_t minor; // TRACE_NO_MINOR if the event is not tied to a device
+} __attribute__((packed));
+
+struct trace_ring_info {
+	uint32_t version;
+	uint32_t nr_rings; // one per possible cpu
+	uint32_t ring_size; // in bytes, including the ring header
+	uint32_t record_size;
+	uint32_t nr_records; // per ring
+} __attribute__((packed));
+
+struct trace_ring_header {
+	uint64_t head; // records written, advanced by the kernel
+	uint64_t tail; // records consumed, advanced by the consumer
+	uint64_t lost; // records dropped because the ring was full
 } __attribute__((packed));
 
 #define TO_STR(_type) #_type
 
-#define trace_event_bio(_type, _bio, _priv) \
+#define trace_event_bio(_type, _minor, _bio, _priv) \
 ({ 											\
 	struct params_t params = { 0 };			\
 											\
@@ -88,27 +118,27 @@ struct msg_header_t {
 											\
 	params.priv1 = (_priv); 					\
 	params.priv2 = 0; 					\
-	nl_send_event(_type, __func__, __LINE__, &params); \
+	nl_send_event(_type, _minor, __func__, __LINE__, &params); \
 })
 
-#define trace_event_generic(_type, _priv) 	\
+#define trace_event_generic(_type, _minor, _priv) 	\
 ({ 											\
 	struct params_t params = { 0 }; 		\
 											\
 	params.priv1 = (_priv); 				\
 	params.priv2 = 0; 						\
-	nl_send_event(_type, __func__, __LINE__, &params); \
+	nl_send_event(_type, _minor, __func__, __LINE__, &params); \
 })
 
-#define trace_event_cow(_type, _priv1, _priv2)	\
+#define trace_event_cow(_type, _minor, _priv1, _priv2)	\
 ({ 												\
 	struct params_t params = { 0 }; 			\
 												\
 	params.priv1 = (_priv1); 					\
 	params.priv2 = (_priv2); 					\
-	nl_send_event(_type, __func__, __LINE__, &params); \
+	nl_send_event(_type, _minor, __func__, __LINE__, &params); \
 })
 
-int nl_send_event(enum msg_type_t type, const char *func, int line, struct params_t *params);
-void netlink_release(void);
-int netlink_init(void);
+int nl_send_event(enum msg_type_t type, unsigned int minor, const char *func, int line, struct params_t *params);
+void nl_debug_release(void);
+int nl_debug_init(void);
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-2.0-only
+
+#
+# Copyright (C) 2023 Elastio Software
+#
+
+#
+# Benchmark of the per bio overhead of tracing_mrf as the number of tracked
+# devices grows.
+#
+# A sparse loop-device image is split into partitions. The first one is never
+# tracked and receives the measured O_DIRECT writes, so every write goes
+# through tracing_mrf without being copied or tracked. The other partitions
+# are tracked one after another in incremental mode, on minors spread over
+# the whole minor range.
+#
+# Usage: sudo ./bench_tracing_lookup.py [--devices N] [--writes N]
+#
+
+import argparse
+import mmap
+import os
+import random
+import sys
+import time
+
+import elastio_snap
+import kmod
+import util
+
+BLOCK_SIZE = 4096
+
+
+def time_writes(device, writes):
+    """Returns the mean time of a 4k O_DIRECT write to random blocks of the device, in microseconds."""
+    buf = mmap.mmap(-1, BLOCK_SIZE)
+    buf.write(os.urandom(BLOCK_SIZE))
+    blocks = util.dev_size_bytes(device) // BLOCK_SIZE
+
+    fd = os.open(device, os.O_WRONLY | os.O_DIRECT)
+    try:
+        offsets = [random.randrange(blocks) * BLOCK_SIZE for _ in range(writes)]
+        start = time.perf_counter()
+        for off in offsets:
+            os.pwrite(fd, buf, off)
+        elapsed = time.perf_counter() - start
+    finally:
+        os.close(fd)
+
+    return elapsed / writes * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="tracing_mrf lookup benchmark")
+    parser.add_argument("--devices", type=int, default=32, help="maximum number of tracked devices")
+    parser.add_argument("--part-mb", type=int, default=64, help="size of each partition")
+    parser.add_argument("--writes", type=int, default=20000, help="number of timed writes per step")
+    args = parser.parse_args()
+
+    if os.geteuid() != 0:
+        print("Must be run as root")
+        return 1
+
+    max_minor = 254
+    minors = [i * max_minor // max(args.devices - 1, 1) for i in range(args.devices)]
+
+    module = kmod.Module("../src/elastio-snap.ko")
+    module.load(max_snap_devices=max_minor + 1)
+
+    backing = "/tmp/bench_tracing_lookup_{}.img".format(os.getpid())
+    with open(backing, "wb") as f:
+        f.truncate((args.devices + 1) * (args.part_mb + 1) * 1024 * 1024)
+
+    disk = util.loop_create(backing, args.devices + 1)
+    parts = util.get_partitions(disk)
+    target, tracked = parts[0], parts[1:]
+
+    mounts = []
+    active = []
+    try:
+        for part in tracked:
+            util.mkfs(part)
+            mount = "/tmp/bench_tracing_lookup_{}_{}".format(os.getpid(), len(mounts))
+            os.makedirs(mount, exist_ok=True)
+            util.mount(part, mount)
+            mounts.append(mount)
+
+        print("{:>8} {:>12} {:>12}".format("tracked", "us/write", "overhead"))
+        base = time_writes(target, args.writes)
+        print("{:>8} {:>12.2f} {:>12}".format(0, base, "-"))
+
+        steps = set(n for n in (1, 2, 4, 8, 16, 32, 64, 128) if n < args.devices) | {args.devices}
+        for n, (minor, part, mount) in enumerate(zip(minors, tracked, mounts), 1):
+            if elastio_snap.setup(minor, part, "{}/cow".format(mount)) != 0:
+                raise RuntimeError("setup of {} failed".format(part))
+            active.append(minor)
+
+            if elastio_snap.transition_to_incremental(minor) != 0:
+                raise RuntimeError("transition of {} failed".format(part))
+
+            if n in steps:
+                us = time_writes(target, args.writes)
+                print("{:>8} {:>12.2f} {:>+12.2f}".format(n, us, us - base))
+
+    finally:
+        for minor in active:
+            elastio_snap.destroy(minor)
+        for mount in mounts:
+            util.unmount(mount)
+            os.rmdir(mount)
+        util.loop_destroy(disk)
+        os.remove(backing)
+        module.unload()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-2.0-only
+
+#
+# Copyright (C) 2023 Elastio Software
+#
+
+#
+# Benchmark of update-img on a sparse loop-device image.
+#
+# A snapshot of a fresh file system is copied to a backup image, random
+# scattered extents are overwritten in incremental mode, and the backup is
+# then updated from the next snapshot by each update-img configuration.
+# All resulting images must be identical.
+#
+# Usage: sudo ./bench_update_img.py [--size-mb N] [--writes N] [--baseline /path/to/old/update-img]
+#
+
+import argparse
+import os
+import random
+import subprocess
+import sys
+import time
+
+import elastio_snap
+import kmod
+import util
+
+
+def run(cmd):
+    start = time.monotonic()
+    subprocess.check_call(cmd, stdout=subprocess.DEVNULL, timeout=3600)
+    return time.monotonic() - start
+
+
+def scatter_writes(path, size, writes, max_blocks):
+    block = 4096
+    with open(path, "r+b") as f:
+        for _ in range(writes):
+            count = random.randint(1, max_blocks)
+            offset = random.randrange(0, size // block - count) * block
+            f.seek(offset)
+            f.write(os.urandom(count * block))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="update-img benchmark")
+    parser.add_argument("--size-mb", type=int, default=4096, help="size of the sparse test volume")
+    parser.add_argument("--data-mb", type=int, default=1024, help="size of the file overwritten in incremental mode")
+    parser.add_argument("--writes", type=int, default=20000, help="number of scattered writes")
+    parser.add_argument("--max-blocks", type=int, default=64, help="maximum length of a write in blocks")
+    parser.add_argument("--baseline", help="previous update-img binary to compare against")
+    parser.add_argument("--minor", type=int, default=0)
+    args = parser.parse_args()
+
+    if os.geteuid() != 0:
+        print("Must be run as root")
+        return 1
+
+    configs = [
+        ("per-block, 1 job", ["../utils/update-img", "-j", "1", "-m", "4096"]),
+        ("coalesced, 1 job", ["../utils/update-img", "-j", "1"]),
+        ("coalesced, 4 jobs", ["../utils/update-img", "-j", "4"]),
+        ("coalesced, 16 jobs, 4M", ["../utils/update-img", "-j", "16", "-m", str(4 * 1024 * 1024)]),
+        ("coalesced, 8 jobs, direct", ["../utils/update-img", "-j", "8", "-d"]),
+    ]
+    if args.baseline:
+        configs.insert(0, ("baseline", [args.baseline]))
+
+    module = kmod.Module("../src/elastio-snap.ko")
+    module.load()
+
+    backing = "/tmp/bench_update_img_{}.img".format(os.getpid())
+    mount = "/tmp/bench_update_img_{}".format(os.getpid())
+    snap_device = "/dev/elastio-snap{}".format(args.minor)
+    backup = "{}.bkp".format(backing)
+    cow_prev = "{}/cow0".format(mount)
+    cow_next = "{}/cow1".format(mount)
+    data = "{}/data".format(mount)
+
+    with open(backing, "wb") as f:
+        f.truncate(args.size_mb * 1024 * 1024)
+    device = util.loop_create(backing)
+    util.mkfs(device)
+    os.makedirs(mount, exist_ok=True)
+    util.mount(device, mount)
+
+    try:
+        util.dd("/dev/urandom", data, args.data_mb, bs="1M")
+        os.sync()
+
+        if elastio_snap.setup(args.minor, device, cow_prev) != 0:
+            raise RuntimeError("setup failed")
+
+        util.dd(snap_device, backup, args.size_mb, bs="1M")
+        elastio_snap.transition_to_incremental(args.minor)
+
+        scatter_writes(data, args.data_mb * 1024 * 1024, args.writes, args.max_blocks)
+        os.sync()
+
+        if elastio_snap.transition_to_snapshot(args.minor, cow_next) != 0:
+            raise RuntimeError("transition to snapshot failed")
+
+        print("volume {} MB, {} scattered writes".format(args.size_mb, args.writes))
+
+        reference = None
+        for i, (name, cmd) in enumerate(configs):
+            image = "{}.{}".format(backup, i)
+            subprocess.check_call(["cp", "--sparse=always", backup, image])
+            subprocess.check_call(["sh", "-c", "sync; echo 3 > /proc/sys/vm/drop_caches"])
+
+            elapsed = run(cmd + [snap_device, cow_prev, image])
+            md5 = util.md5sum(image)
+            os.remove(image)
+
+            if reference is None:
+                reference = md5
+            status = "ok" if md5 == reference else "MISMATCH"
+            print("{:<28} {:8.2f} s  {}".format(name, elapsed, status))
+
+    finally:
+        elastio_snap.destroy(args.minor)
+        util.unmount(mount)
+        util.loop_destroy(device)
+        os.rmdir(mount)
+        os.remove(backing)
+        if os.path.exists(backup):
+            os.remove(backup)
+        module.unload()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,185 @@
+# SPDX-License-Identifier: GPL-2.0-only
+
+#
+# Copyright (C) 2023 Elastio Software
+#
+
+#
+# Read-only parser for the on-disk COW file format (see doc/STRUCTURE.md).
+# The file is memory-mapped and the section index is exposed as a zero-copy
+# numpy view, so even multi-GB indexes are never copied into Python objects.
+#
+
+import mmap
+import os
+import struct
+
+import numpy as np
+
+COW_HEADER_SIZE = 4096
+COW_MAGIC = 4776
+COW_UUID_SIZE = 16
+COW_BLOCK_SIZE = 4096
+
+# number of mappings held by one index section, COW_SECTION_SIZE in the module is PAGE_SIZE
+COW_SECTION_SIZE = os.sysconf("SC_PAGESIZE")
+
+# bit offsets of the header flags
+COW_CLEAN = 0
+COW_INDEX_ONLY = 1
+COW_VMALLOC_UPPER = 2
+
+COW_VERSION_0 = 0
+COW_VERSION_CHANGED_BLOCKS = 1
+COW_VERSION_SECTION_SUMMARY = 2
+COW_VERSION_UNUSED_BLOCKS = 3
+
+# snapshot mapping of a block the filesystem did not use, block 1 always holds the index
+COW_UNUSED_MAPPING = 1
+
+# the section summary bitmap is kept in the unused part of the header
+COW_SUMMARY_OFFSET = 512
+COW_SUMMARY_BITS = (COW_HEADER_SIZE - COW_SUMMARY_OFFSET) * 8
+
+# struct cow_header from src/elastio-snap.h
+_cow_header = struct.Struct("<IIQQQ{}sQQQ".format(COW_UUID_SIZE))
+
+
+class CowFile:
+    """
+    Memory-mapped view of a COW file.
+
+    The index length can only be derived from the file itself when the COW
+    file was truncated to its index (incremental mode). For data tracking
+    files, pass the number of blocks of the traced device.
+
+    The section size is not recorded in the file, it is the page size of the
+    machine that wrote it. Pass sect_size to read a file from another machine.
+    """
+
+    def __init__(self, path, blocks=None, block_size=COW_BLOCK_SIZE, sect_size=COW_SECTION_SIZE):
+        self.path = path
+        self.block_size = block_size
+        self.sect_size = sect_size
+
+        with open(path, "rb") as f:
+            self.size = os.fstat(f.fileno()).st_size
+            if self.size < COW_HEADER_SIZE:
+                raise ValueError("{}: file is smaller than the cow header".format(path))
+
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            (self.magic, self.flags, self.fpos, self.fsize, self.seqid, self.uuid,
+             self.version, self.nr_changed_blocks, self.summary_sects) = _cow_header.unpack_from(self._mm, 0)
+
+            if self.magic != COW_MAGIC:
+                raise ValueError("{}: bad magic number {}".format(path, self.magic))
+
+            if self.version > COW_VERSION_UNUSED_BLOCKS:
+                raise ValueError("{}: unsupported cow file version {}".format(path, self.version))
+
+            if blocks is None:
+                if not self.index_only:
+                    raise ValueError("{}: number of blocks is required for a data tracking cow file".format(path))
+                entries = (self.size - COW_HEADER_SIZE) // 8
+                blocks = entries
+            else:
+                entries = -(-blocks // sect_size) * sect_size
+
+            if COW_HEADER_SIZE + entries * 8 > self.size:
+                raise ValueError("{}: file is too small for an index of {} blocks".format(path, blocks))
+
+            self.blocks = blocks
+            self.total_sects = -(-entries // sect_size)
+            self.data_offset = COW_HEADER_SIZE + entries * 8
+            self._index = np.frombuffer(self._mm, dtype="<u8", count=entries, offset=COW_HEADER_SIZE)
+        except Exception:
+            self._mm.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._mm is None:
+            return
+
+        # the mapping can't be closed while the index view is still alive
+        self._index = None
+        self._mm.close()
+        self._mm = None
+
+    @property
+    def clean(self):
+        return bool(self.flags & (1 << COW_CLEAN))
+
+    @property
+    def index_only(self):
+        return bool(self.flags & (1 << COW_INDEX_ONLY))
+
+    @property
+    def index(self):
+        """Read-only uint64 view of the mappings, one entry per block of the device."""
+        return self._index[:self.blocks]
+
+    @property
+    def summary(self):
+        """
+        Boolean array with one entry per index section, False if the section
+        has no mappings. None if the file predates the section summary.
+        """
+        if self.version < COW_VERSION_SECTION_SUMMARY or not self.summary_sects:
+            return None
+
+        bits = np.frombuffer(self._mm, dtype=np.uint8, count=COW_SUMMARY_BITS // 8, offset=COW_SUMMARY_OFFSET)
+        groups = np.unpackbits(bits, bitorder="little")
+        return np.repeat(groups, self.summary_sects)[:self.total_sects].astype(bool)
+
+    def changed_blocks(self, start=0, end=None):
+        """Returns the numbers of the blocks in [start, end) that have a mapping."""
+        end = self.blocks if end is None else min(end, self.blocks)
+        summary = self.summary
+        if summary is None:
+            return np.flatnonzero(self.index[start:end]) + start
+
+        # only scan the sections the summary marks as used
+        found = []
+        for sect in np.flatnonzero(summary):
+            lo = max(start, int(sect) * self.sect_size)
+            hi = min(end, (int(sect) + 1) * self.sect_size)
+            if lo < hi:
+                found.append(np.flatnonzero(self._index[lo:hi]) + lo)
+
+        return np.concatenate(found) if found else np.empty(0, dtype=np.intp)
+
+    def changed_extents(self, start=0, end=None):
+        """Returns (start, length) arrays of the runs of changed blocks in [start, end)."""
+        blocks = self.changed_blocks(start, end)
+        if not blocks.size:
+            return blocks, blocks
+
+        breaks = np.flatnonzero(np.diff(blocks) != 1) + 1
+        starts = blocks[np.concatenate(([0], breaks))]
+        ends = blocks[np.concatenate((breaks - 1, [blocks.size - 1]))]
+        return starts, ends - starts + 1
+
+    def read_block(self, block):
+        """
+        Returns the preserved data of the block, or None if it was not copied.
+        Blocks the filesystem did not use at snapshot time read as zeros.
+        """
+        if self.index_only:
+            raise ValueError("{}: cow file holds no data".format(self.path))
+
+        pos = int(self.index[block])
+        if not pos:
+            return None
+        if pos == COW_UNUSED_MAPPING:
+            return bytes(self.block_size)
+
+        offset = pos * self.block_size
+        return self._mm[offset:offset + self.block_size]
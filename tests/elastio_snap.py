@@ -40,7 +40,54 @@ struct elastio_snap_info {
     bool ignore_snap_errors;
 };
 
+struct elastio_snap_stats {
+    unsigned int minor;
+    unsigned int version;
+    unsigned long long bios_traced;
+    unsigned long long bios_cow;
+    unsigned long long bytes_cow;
+    unsigned long long clones_submitted;
+    unsigned long long clones_received;
+    unsigned long long clones_processed;
+    unsigned long long cow_queue_depth;
+    unsigned long long sset_queue_depth;
+    unsigned long long sect_hits;
+    unsigned long long sect_misses;
+    unsigned long long sect_loads;
+    unsigned long long sect_evictions;
+    unsigned long long cleanups;
+    unsigned long long cow_file_used;
+    unsigned long long cow_file_max;
+    unsigned long long reads_base;
+    unsigned long long reads_cow;
+    unsigned long long reads_mixed;
+    unsigned long long bios_cow_skipped;
+    unsigned long long bytes_clone_skipped;
+    unsigned long long clone_pages;
+    unsigned long long clone_pages_max;
+    unsigned long long page_pool_size;
+    unsigned long long page_pool_free;
+    unsigned long long bytes_unused_skipped;
+};
+
+struct changed_block_extent {
+    unsigned long long start;
+    unsigned long long count;
+};
+
+struct changed_blocks_params {
+    unsigned int minor;
+    unsigned int max_extents;
+    unsigned long long start;
+    unsigned long long count;
+    struct changed_block_extent *extents;
+    unsigned int nr_extents;
+    unsigned long long next;
+    unsigned long long nr_changed;
+};
+
 int elastio_snap_setup_snapshot(unsigned int minor, char *bdev, char *cow, unsigned long fallocated_space, unsigned long cache_size, bool ignore_snap_errors);
+int elastio_snap_setup_snapshot_workers(unsigned int minor, char *bdev, char *cow, unsigned long fallocated_space, unsigned long cache_size, bool ignore_snap_errors, unsigned int cow_workers);
 int elastio_snap_reload_snapshot(unsigned int minor, char *bdev, char *cow, unsigned long cache_size, bool ignore_snap_errors);
 int elastio_snap_reload_incremental(unsigned int minor, char *bdev, char *cow, unsigned long cache_size, bool ignore_snap_errors);
 int elastio_snap_destroy(unsigned int minor);
@@ -48,6 +95,11 @@ int elastio_snap_transition_incremental(unsigned int minor);
 int elastio_snap_transition_snapshot(unsigned int minor, char *cow, unsigned long fallocated_space);
 int elastio_snap_reconfigure(unsigned int minor, unsigned long cache_size);
 int elastio_snap_info(unsigned int minor, struct elastio_snap_info *info);
+int elastio_snap_stats(unsigned int minor, struct elastio_snap_stats *stats);
+int elastio_snap_changed_blocks(unsigned int minor, struct changed_blocks_params *params);
+const struct changed_block_extent *elastio_snap_map_changed_blocks(unsigned int minor, struct changed_blocks_params *params);
+int elastio_snap_unmap_changed_blocks(const struct changed_block_extent *extents, unsigned int max_extents);
+int elastio_snap_set_unused_blocks(unsigned int minor, unsigned long long start, unsigned long long count, const unsigned char *bitmap);
 int elastio_snap_get_free_minor(void);
 """)
 
@@ -65,14 +117,15 @@ class State:
     ACTIVE = 2
     UNVERIFIED = 4
 
-def setup(minor, device, cow_file, fallocated_space=0, cache_size=0, ignore_snap_errors=False):
-    ret = lib.elastio_snap_setup_snapshot(
+def setup(minor, device, cow_file, fallocated_space=0, cache_size=0, ignore_snap_errors=False, cow_workers=0):
+    ret = lib.elastio_snap_setup_snapshot_workers(
         minor,
         device.encode("utf-8"),
         cow_file.encode("utf-8"),
         fallocated_space,
         cache_size,
-        ignore_snap_errors
+        ignore_snap_errors,
+        cow_workers
     )
 
     if ret != 0:
@@ -185,6 +238,59 @@ def info(minor):
         "ignore_snap_errors": di.ignore_snap_errors
     }
 
+def stats(minor):
+    ds = ffi.new("struct elastio_snap_stats *")
+    ret = lib.elastio_snap_stats(minor, ds)
+    if ret != 0:
+        return None
+
+    fields = [name for name, _ in ffi.typeof("struct elastio_snap_stats").fields]
+    return {name: getattr(ds, name) for name in fields}
+
+def stats_sysfs(minor):
+    with open("/sys/kernel/elastio-snap/{}/stats".format(minor), "r") as f:
+        return {name: int(value) for name, value in (line.split() for line in f)}
+
+def changed_blocks(minor, start=0, count=2 ** 64 - 1, max_extents=4096, mapped=False):
+    """
+    Returns the changed blocks of [start, start + count) as a list of
+    (start, count) extents, querying max_extents of them at a time.
+    """
+    params = ffi.new("struct changed_blocks_params *")
+    params.start = start
+    params.count = count
+    params.max_extents = max_extents
+    if not mapped:
+        buf = ffi.new("struct changed_block_extent[]", max_extents)
+        params.extents = buf
+
+    extents = []
+    while True:
+        if mapped:
+            ext = lib.elastio_snap_map_changed_blocks(minor, params)
+            if ext == ffi.NULL:
+                return None
+            extents.extend((ext[i].start, ext[i].count) for i in range(params.nr_extents))
+            lib.elastio_snap_unmap_changed_blocks(ext, max_extents)
+        else:
+            if lib.elastio_snap_changed_blocks(minor, params) != 0:
+                return None
+            extents.extend((buf[i].start, buf[i].count) for i in range(params.nr_extents))
+
+        if params.nr_extents < max_extents:
+            return extents
+
+        params.count -= params.next - params.start
+        params.start = params.next
+
+def set_unused_blocks(minor, bitmap, start=0):
+    """Marks the blocks whose bits are set in bitmap (bytes, least significant bit first) as unused at snapshot time."""
+    ret = lib.elastio_snap_set_unused_blocks(minor, start, len(bitmap) * 8, bitmap)
+    if ret != 0:
+        return ffi.errno
+
+    return 0
+
 def get_free_minor():
     ret = lib.elastio_snap_get_free_minor()
     if (ret < 0):
@@ -194,3 +300,7 @@ def get_free_minor():
 def version():
     with open("/sys/module/elastio-snap/version", "r") as v:
         return v.read().strip()
+
+def set_param(name, value):
+    with open("/sys/module/elastio-snap/parameters/{}".format(name), "w") as p:
+        p.write(str(value))
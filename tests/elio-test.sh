@@ -85,6 +85,11 @@ if ! pip3 list 2>/dev/null | grep -q cffi ; then
     pip3 install cffi
 fi
 
+if ! pip3 list 2>/dev/null | grep -q numpy ; then
+    echo "Python module NumPy is not installed. Installing it..."
+    pip3 install numpy
+fi
+
 echo
 echo "elastio-snap: $(git rev-parse --short HEAD)"
 echo "kernel: $(uname -r)"
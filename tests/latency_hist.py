@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-2.0-only
+
+#
+# Copyright (C) 2023 Elastio Software
+#
+
+#
+# Reader of the per-device latency histograms in
+# /sys/kernel/elastio-snap/<minor>/latency.
+#
+# Every histogram has a bucket per power of two: bucket 0 counts the
+# latencies below 1us, bucket i those in [2^(9+i), 2^(10+i)) ns.
+#
+# Usage: sudo ./latency_hist.py [--reset] <minor>
+#
+
+import argparse
+import sys
+
+HIST_BUCKETS = 32
+HIST_SHIFT = 10
+
+
+def path(minor):
+    return "/sys/kernel/elastio-snap/{}/latency".format(minor)
+
+
+def read(minor):
+    """Returns a dict mapping each histogram name to its list of bucket counts."""
+    with open(path(minor), "r") as f:
+        return {name: [int(c) for c in counts] for name, *counts in (line.split() for line in f)}
+
+
+def reset(minor):
+    with open(path(minor), "w") as f:
+        f.write("1")
+
+
+def bucket_bounds(bucket):
+    """Returns the [low, high) latency range of a bucket in nanoseconds."""
+    if bucket == 0:
+        return 0, 1 << HIST_SHIFT
+    return 1 << (HIST_SHIFT + bucket - 1), 1 << (HIST_SHIFT + bucket)
+
+
+def percentile(counts, pct):
+    """Returns the upper bound in nanoseconds of the bucket holding the given percentile."""
+    total = sum(counts)
+    if not total:
+        return 0
+
+    seen = 0
+    for bucket, count in enumerate(counts):
+        seen += count
+        if seen * 100 >= total * pct:
+            return bucket_bounds(bucket)[1]
+
+    return bucket_bounds(len(counts) - 1)[1]
+
+
+def format_ns(ns):
+    for unit, div in (("s", 10 ** 9), ("ms", 10 ** 6), ("us", 10 ** 3)):
+        if ns >= div:
+            return "{:g}{}".format(round(ns / div, 1), unit)
+    return "{}ns".format(ns)
+
+
+def render(hists, width=40):
+    lines = []
+    for name, counts in hists.items():
+        total = sum(counts)
+        lines.append("{}: {} samples, p50 < {}, p99 < {}".format(
+            name, total, format_ns(percentile(counts, 50)), format_ns(percentile(counts, 99))))
+        if not total:
+            continue
+
+        used = [b for b, c in enumerate(counts) if c]
+        peak = max(counts)
+        for bucket in range(used[0], used[-1] + 1):
+            low, high = bucket_bounds(bucket)
+            bar = "#" * (counts[bucket] * width // peak)
+            lines.append("  {:>7} - {:<7} {:>10} {}".format(format_ns(low), format_ns(high), counts[bucket], bar))
+
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="elastio-snap latency histograms")
+    parser.add_argument("minor", type=int)
+    parser.add_argument("--reset", action="store_true", help="reset the histograms after printing them")
+    args = parser.parse_args()
+
+    print(render(read(args.minor)))
+    if args.reset:
+        reset(args.minor)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-2.0-only
+
+#
+# Copyright (C) 2023 Elastio Software
+#
+
+import os
+import unittest
+
+import numpy as np
+
+import cow_file
+import elastio_snap
+import util
+from devicetestcase import DeviceTestCase
+
+
+class TestCowFile(DeviceTestCase):
+    def setUp(self):
+        self.cow_file = "cow.snap"
+        self.cow_full_path = "{}/{}".format(self.mount, self.cow_file)
+        self.blocks = util.dev_size_bytes(self.device) // cow_file.COW_BLOCK_SIZE
+
+        util.test_track(self._testMethodName, started=True)
+
+    def tearDown(self):
+        util.test_track(self._testMethodName, started=False)
+
+    def test_parse_index_only(self):
+        testfile = "{}/testfile".format(self.mount)
+        cow_next = "{}/cow_next.snap".format(self.mount)
+
+        self.assertEqual(elastio_snap.setup(self.minor, self.device, self.cow_full_path), 0)
+        self.addCleanup(elastio_snap.destroy, self.minor)
+        self.assertEqual(elastio_snap.transition_to_incremental(self.minor), 0)
+
+        util.dd("/dev/urandom", testfile, 8, bs="1M")
+        self.addCleanup(os.remove, testfile)
+        os.sync()
+
+        snapdev = elastio_snap.info(self.minor)
+        self.assertEqual(elastio_snap.transition_to_snapshot(self.minor, cow_next), 0)
+        self.addCleanup(os.remove, self.cow_full_path)
+
+        with cow_file.CowFile(self.cow_full_path) as cow:
+            self.assertTrue(cow.clean)
+            self.assertTrue(cow.index_only)
+            self.assertEqual(cow.version, cow_file.COW_VERSION_SECTION_SUMMARY)
+            self.assertEqual(cow.uuid.hex(), snapdev["uuid"])
+            self.assertGreaterEqual(cow.blocks, self.blocks)
+
+            changed = cow.changed_blocks()
+            self.assertEqual(len(changed), cow.nr_changed_blocks)
+            self.assertGreaterEqual(len(changed), 8 * 1024 * 1024 // cow_file.COW_BLOCK_SIZE)
+
+            starts, lengths = cow.changed_extents()
+            self.assertEqual(lengths.sum(), len(changed))
+
+            # the summary must cover every section with mappings
+            self.assertIsNotNone(cow.summary)
+            self.assertTrue(cow.summary[changed // cow.sect_size].all())
+            self.assertEqual(len(np.flatnonzero(cow.index)), len(changed))
+
+    def test_parse_index_only_rewritten(self):
+        testfile = "{}/testfile".format(self.mount)
+        cow_next = "{}/cow_next.snap".format(self.mount)
+
+        # A cache of a few sections makes the mappings of the snapshot go back to the file before the transition
+        self.assertEqual(elastio_snap.setup(self.minor, self.device, self.cow_full_path, cache_size=256 * 1024), 0)
+        self.addCleanup(elastio_snap.destroy, self.minor)
+
+        util.dd("/dev/urandom", testfile, 8, bs="1M")
+        self.addCleanup(os.remove, testfile)
+        os.sync()
+
+        self.assertEqual(elastio_snap.transition_to_incremental(self.minor), 0)
+
+        # The same blocks change again while incremental, they must only be counted once
+        util.dd("/dev/urandom", testfile, 8, bs="1M", conv="notrunc")
+        os.sync()
+
+        self.assertEqual(elastio_snap.transition_to_snapshot(self.minor, cow_next), 0)
+        self.addCleanup(os.remove, self.cow_full_path)
+
+        with cow_file.CowFile(self.cow_full_path) as cow:
+            self.assertTrue(cow.index_only)
+
+            changed = cow.changed_blocks()
+            self.assertEqual(len(changed), cow.nr_changed_blocks)
+            self.assertGreaterEqual(len(changed), 8 * 1024 * 1024 // cow_file.COW_BLOCK_SIZE)
+            self.assertTrue(cow.summary[changed // cow.sect_size].all())
+
+    def test_changed_blocks_query(self):
+        testfile = "{}/testfile".format(self.mount)
+        cow_next = "{}/cow_next.snap".format(self.mount)
+
+        # A small cache leaves most of the changes in evicted sections or bitmaps
+        self.assertEqual(elastio_snap.setup(self.minor, self.device, self.cow_full_path, cache_size=256 * 1024), 0)
+        self.addCleanup(elastio_snap.destroy, self.minor)
+        self.assertEqual(elastio_snap.transition_to_incremental(self.minor), 0)
+
+        util.dd("/dev/urandom", testfile, 8, bs="1M")
+        self.addCleanup(os.remove, testfile)
+        os.sync()
+
+        def blocks(extents):
+            return np.concatenate([np.arange(start, start + count) for start, count in extents])
+
+        # Small batches make the queries continue from where the previous one stopped
+        copied = elastio_snap.changed_blocks(self.minor, max_extents=2)
+        mapped = elastio_snap.changed_blocks(self.minor, max_extents=2, mapped=True)
+        self.assertIsNotNone(copied)
+        self.assertIsNotNone(mapped)
+
+        copied = blocks(copied)
+        self.assertGreaterEqual(len(copied), 8 * 1024 * 1024 // cow_file.COW_BLOCK_SIZE)
+        self.assertTrue(np.isin(copied, blocks(mapped)).all())
+
+        # A range query only returns the blocks within the range
+        start, count = int(copied[0]) + 1, 100
+        ranged = elastio_snap.changed_blocks(self.minor, start, count)
+        self.assertTrue(all(s >= start and s + c <= start + count for s, c in ranged))
+
+        # The changes found before the transition must all be in the index it writes
+        self.assertEqual(elastio_snap.transition_to_snapshot(self.minor, cow_next), 0)
+        self.addCleanup(os.remove, self.cow_full_path)
+
+        with cow_file.CowFile(self.cow_full_path) as cow:
+            self.assertTrue(np.isin(copied, cow.changed_blocks()).all())
+
+    def test_data_tracking_needs_blocks(self):
+        self.assertEqual(elastio_snap.setup(self.minor, self.device, self.cow_full_path), 0)
+        self.addCleanup(elastio_snap.destroy, self.minor)
+
+        with self.assertRaises(ValueError):
+            cow_file.CowFile(self.cow_full_path)
+
+        with cow_file.CowFile(self.cow_full_path, blocks=self.blocks) as cow:
+            self.assertFalse(cow.index_only)
+            self.assertEqual(cow.magic, cow_file.COW_MAGIC)
+            self.assertEqual(cow.index.size, self.blocks)
+            self.assertEqual(cow.data_offset, cow_file.COW_HEADER_SIZE + cow.total_sects * cow.sect_size * 8)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -51,7 +51,7 @@ class TestMultipart(DeviceTestCaseMultipart):
             self.assertEqual(snapdev["state"], elastio_snap.State.ACTIVE | elastio_snap.State.SNAPSHOT)
             self.assertEqual(snapdev["cow"], "/{}".format(self.cow_file))
             self.assertEqual(snapdev["bdev"], self.devices[i])
-            self.assertEqual(snapdev["version"], 1)
+            self.assertEqual(snapdev["version"], 2)
 
         # Destroy snapshot devices
         for i in reversed(range(self.part_count)):
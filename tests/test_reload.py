@@ -114,7 +114,7 @@ class TestReload(DeviceTestCase):
         self.assertTrue(os.path.exists(self.cow_full_path))
         self.assertTrue(os.path.exists(self.snap_device))
 
-        self.check_snap_info(0, elastio_snap.State.ACTIVE | elastio_snap.State.SNAPSHOT, False, 1)
+        self.check_snap_info(0, elastio_snap.State.ACTIVE | elastio_snap.State.SNAPSHOT, False, 2)
 
 
     def test_reload_verified_inc(self):
@@ -141,7 +141,7 @@ class TestReload(DeviceTestCase):
         self.assertTrue(os.path.exists(self.cow_full_path))
         self.assertFalse(os.path.exists(self.snap_device))
 
-        self.check_snap_info(0, elastio_snap.State.ACTIVE, False, 1)
+        self.check_snap_info(0, elastio_snap.State.ACTIVE, False, 2)
 
 
     def check_snap_info(self, error, state, ignore_snap_errors, version = 0):
@@ -109,7 +109,7 @@ class TestSetup(DeviceTestCase):
         self.assertEqual(snapdev["state"], elastio_snap.State.ACTIVE | elastio_snap.State.SNAPSHOT)
         self.assertEqual(snapdev["cow"], "/{}".format(self.cow_file))
         self.assertEqual(snapdev["bdev"], self.device)
-        self.assertEqual(snapdev["version"], 1)
+        self.assertEqual(snapdev["version"], 2)
         self.assertEqual(snapdev["ignore_snap_errors"], False)
         self.assertEqual(snapdev["flags"], elastio_snap.Flags.COW_ON_BDEV)
 
@@ -139,7 +139,7 @@ class TestSetup(DeviceTestCase):
         self.assertEqual(snapdev["state"], elastio_snap.State.ACTIVE | elastio_snap.State.SNAPSHOT)
         self.assertEqual(snapdev["cow"], "/{}".format(cow_file))
         self.assertEqual(snapdev["bdev"], device)
-        self.assertEqual(snapdev["version"], 1)
+        self.assertEqual(snapdev["version"], 2)
         self.assertEqual(snapdev["ignore_snap_errors"], False)
         self.assertEqual(snapdev["flags"], elastio_snap.Flags.COW_ON_BDEV)
 
@@ -157,7 +157,7 @@ class TestSetup(DeviceTestCase):
         self.assertEqual(snapdev["state"], elastio_snap.State.ACTIVE | elastio_snap.State.SNAPSHOT)
         self.assertEqual(snapdev["cow"], "/{}".format(self.cow_file))
         self.assertEqual(snapdev["bdev"], self.device)
-        self.assertEqual(snapdev["version"], 1)
+        self.assertEqual(snapdev["version"], 2)
         self.assertEqual(snapdev["ignore_snap_errors"], True)
         self.assertEqual(snapdev["flags"], elastio_snap.Flags.COW_ON_BDEV)
 
@@ -10,9 +10,11 @@ import math
 import errno
 import os
 import platform
+import time
 import unittest
 
 import elastio_snap
+import latency_hist
 import util
 from devicetestcase import DeviceTestCase
 
@@ -67,6 +69,139 @@ class TestSnapshot(DeviceTestCase):
         md5_snap = util.md5sum(snapfile)
         self.assertEqual(md5_orig, md5_snap)
 
+    def test_modify_origin_cow_workers(self):
+        dev_size_mb = util.dev_size_mb(self.device)
+        file_size_mb = math.floor(dev_size_mb * 0.05)
+
+        testfile = "{}/testfile".format(self.mount)
+        snapfile = "{}/testfile".format(self.snap_mount)
+
+        util.dd("/dev/urandom", testfile, file_size_mb, bs="1M")
+        os.sync()
+
+        self.addCleanup(os.remove, testfile)
+        md5_orig = util.md5sum(testfile)
+
+        self.assertEqual(elastio_snap.setup(self.minor, self.device, self.cow_full_path, cow_workers=4), 0)
+        self.addCleanup(elastio_snap.destroy, self.minor)
+
+        util.dd("/dev/urandom", testfile, file_size_mb, bs="1M")
+        os.sync()
+
+        opts = "nouuid,norecovery,ro" if (self.fs == "xfs") else "ro"
+        util.mount(self.snap_device, self.snap_mount, opts)
+        self.addCleanup(util.unmount, self.snap_mount)
+
+        md5_snap = util.md5sum(snapfile)
+        self.assertEqual(md5_orig, md5_snap)
+
+        info = elastio_snap.info(self.minor)
+        self.assertEqual(info["error"], 0)
+
+    def test_modify_origin_small_cache(self):
+        dev_size_mb = util.dev_size_mb(self.device)
+        file_size_mb = math.floor(dev_size_mb * 0.05)
+
+        testfile = "{}/testfile".format(self.mount)
+        snapfile = "{}/testfile".format(self.snap_mount)
+
+        util.dd("/dev/urandom", testfile, file_size_mb, bs="1M")
+        os.sync()
+
+        self.addCleanup(os.remove, testfile)
+        md5_orig = util.md5sum(testfile)
+
+        # A cache of a few sections makes the index sections be evicted and reloaded all the time
+        self.assertEqual(elastio_snap.setup(self.minor, self.device, self.cow_full_path, cache_size=256 * 1024), 0)
+        self.addCleanup(elastio_snap.destroy, self.minor)
+
+        util.dd("/dev/urandom", testfile, file_size_mb, bs="1M", conv="notrunc")
+        os.sync()
+
+        opts = "nouuid,norecovery,ro" if (self.fs == "xfs") else "ro"
+        util.mount(self.snap_device, self.snap_mount, opts)
+        self.addCleanup(util.unmount, self.snap_mount)
+
+        md5_snap = util.md5sum(snapfile)
+        self.assertEqual(md5_orig, md5_snap)
+
+    def test_modify_origin_cow_flusher(self):
+        dev_size_mb = util.dev_size_mb(self.device)
+        file_size_mb = math.floor(dev_size_mb * 0.05)
+
+        testfile = "{}/testfile".format(self.mount)
+        snapfile = "{}/testfile".format(self.snap_mount)
+
+        util.dd("/dev/urandom", testfile, file_size_mb, bs="1M")
+        os.sync()
+
+        self.addCleanup(os.remove, testfile)
+        md5_orig = util.md5sum(testfile)
+
+        # The flush thread is started on setup, while the module parameter is set
+        elastio_snap.set_param("cow_flush_interval", 10)
+        elastio_snap.set_param("cow_dirty_ratio", 10)
+        self.addCleanup(elastio_snap.set_param, "cow_flush_interval", 1000)
+        self.addCleanup(elastio_snap.set_param, "cow_dirty_ratio", 0)
+
+        self.assertEqual(elastio_snap.setup(self.minor, self.device, self.cow_full_path, cache_size=256 * 1024), 0)
+        self.addCleanup(elastio_snap.destroy, self.minor)
+
+        util.dd("/dev/urandom", testfile, file_size_mb, bs="1M", conv="notrunc")
+        os.sync()
+
+        opts = "nouuid,norecovery,ro" if (self.fs == "xfs") else "ro"
+        util.mount(self.snap_device, self.snap_mount, opts)
+        self.addCleanup(util.unmount, self.snap_mount)
+
+        md5_snap = util.md5sum(snapfile)
+        self.assertEqual(md5_orig, md5_snap)
+
+        info = elastio_snap.info(self.minor)
+        self.assertEqual(info["error"], 0)
+
+    def test_low_memory_fails_snapshot(self):
+        testfile = "{}/testfile".format(self.mount)
+
+        self.assertEqual(elastio_snap.setup(self.minor, self.device, self.cow_full_path), 0)
+        self.addCleanup(elastio_snap.destroy, self.minor)
+
+        # Available memory is always below 100%, wait for the next memory check to see it
+        elastio_snap.set_param("low_memory_percent", 100)
+        self.addCleanup(elastio_snap.set_param, "low_memory_percent", 20)
+        time.sleep(0.5)
+
+        util.dd("/dev/zero", testfile, 1, bs="1M")
+        self.addCleanup(os.remove, testfile)
+        os.sync()
+
+        info = elastio_snap.info(self.minor)
+        self.assertEqual(info["error"], -errno.ENOMEM)
+
+    def test_read_snapshot_device(self):
+        dev_size_mb = util.dev_size_mb(self.device)
+        file_size_mb = math.floor(dev_size_mb * 0.05)
+
+        testfile = "{}/testfile".format(self.mount)
+
+        util.dd("/dev/urandom", testfile, file_size_mb, bs="1M")
+        os.sync()
+        self.addCleanup(os.remove, testfile)
+
+        self.assertEqual(elastio_snap.setup(self.minor, self.device, self.cow_full_path), 0)
+        self.addCleanup(elastio_snap.destroy, self.minor)
+
+        md5_before = util.md5sum(self.snap_device)
+
+        # The overwritten blocks are now read from the cow file, sequentially and in merged runs
+        util.dd("/dev/urandom", testfile, file_size_mb, bs="1M", conv="notrunc")
+        os.sync()
+
+        with open("/proc/sys/vm/drop_caches", "w") as f:
+            f.write("3")
+
+        self.assertEqual(util.md5sum(self.snap_device), md5_before)
+
     def test_track_writes(self):
         testfile = "{}/testfile".format(self.mount)
 
@@ -86,6 +221,146 @@ class TestSnapshot(DeviceTestCase):
         end_nr = info["nr_changed_blocks"]
         self.assertGreater(end_nr, start_nr)
 
+    def test_stats(self):
+        testfile = "{}/testfile".format(self.mount)
+
+        self.assertEqual(elastio_snap.setup(self.minor, self.device, self.cow_full_path), 0)
+        self.addCleanup(elastio_snap.destroy, self.minor)
+
+        start = elastio_snap.stats(self.minor)
+        self.assertIsNotNone(start)
+
+        util.dd("/dev/urandom", testfile, 1, bs="1M")
+        self.addCleanup(os.remove, testfile)
+        os.sync()
+
+        util.dd("/dev/urandom", testfile, 1, bs="1M", conv="notrunc")
+        os.sync()
+
+        stats = elastio_snap.stats(self.minor)
+        self.assertGreaterEqual(stats["version"], 1)
+        self.assertGreater(stats["bios_traced"], start["bios_traced"])
+        self.assertGreater(stats["bios_cow"], start["bios_cow"])
+        self.assertGreater(stats["bytes_cow"], start["bytes_cow"])
+        self.assertGreater(stats["cow_file_used"], start["cow_file_used"])
+        self.assertLessEqual(stats["cow_file_used"], stats["cow_file_max"])
+
+        # The read clones took their pages from the reserve of the snapshot or from the page allocator
+        self.assertGreater(stats["page_pool_size"], 0)
+        self.assertLessEqual(stats["page_pool_free"], stats["page_pool_size"])
+        self.assertGreater(stats["clone_pages_max"], 0)
+        self.assertLessEqual(stats["clone_pages"], stats["clone_pages_max"])
+
+        # sysfs reports the same counters, they can only have grown since
+        sysfs = elastio_snap.stats_sysfs(self.minor)
+        self.assertGreaterEqual(sysfs["bios_traced"], stats["bios_traced"])
+        self.assertEqual(sysfs["cow_file_max"], stats["cow_file_max"])
+
+    def test_skip_preserved_reads(self):
+        testfile = "{}/testfile".format(self.mount)
+        snapfile = "{}/testfile".format(self.snap_mount)
+
+        util.dd("/dev/urandom", testfile, 1, bs="1M")
+        self.addCleanup(os.remove, testfile)
+        os.sync()
+        md5_orig = util.md5sum(testfile)
+
+        self.assertEqual(elastio_snap.setup(self.minor, self.device, self.cow_full_path), 0)
+        self.addCleanup(elastio_snap.destroy, self.minor)
+
+        util.dd("/dev/urandom", testfile, 1, bs="1M", conv="notrunc", oflag="direct")
+        start = elastio_snap.stats(self.minor)
+
+        # The original data of these blocks has been read already, it must not be read again
+        util.dd("/dev/urandom", testfile, 1, bs="1M", conv="notrunc", oflag="direct")
+        os.sync()
+
+        stats = elastio_snap.stats(self.minor)
+        self.assertGreaterEqual(stats["version"], 2)
+        self.assertGreaterEqual(stats["bytes_clone_skipped"] - start["bytes_clone_skipped"], 1024 * 1024)
+        self.assertGreater(stats["bios_cow_skipped"], start["bios_cow_skipped"])
+
+        opts = "nouuid,norecovery,ro" if (self.fs == "xfs") else "ro"
+        util.mount(self.snap_device, self.snap_mount, opts)
+        self.addCleanup(util.unmount, self.snap_mount)
+
+        self.assertEqual(util.md5sum(snapfile), md5_orig)
+
+    def test_skip_unused_blocks(self):
+        if self.fs != "ext4":
+            self.skipTest("The free space of the snapshot is read with dumpe2fs")
+
+        if os.sysconf("SC_PAGESIZE") != 4096:
+            self.skipTest("Unused blocks are only supported with 4096 byte pages")
+
+        testfile = "{}/testfile".format(self.mount)
+        newfile = "{}/newfile".format(self.mount)
+        snapfile = "{}/testfile".format(self.snap_mount)
+        block_size = 4096
+
+        util.dd("/dev/urandom", testfile, 1, bs="1M")
+        self.addCleanup(os.remove, testfile)
+        os.sync()
+        md5_orig = util.md5sum(testfile)
+
+        self.assertEqual(elastio_snap.setup(self.minor, self.device, self.cow_full_path), 0)
+        self.addCleanup(elastio_snap.destroy, self.minor)
+
+        # The free space is read from the snapshot, where it can't change anymore
+        bitmap = util.ext4_unused_bitmap(self.snap_device, block_size)
+        self.assertEqual(elastio_snap.set_unused_blocks(self.minor, bitmap), 0)
+        start = elastio_snap.stats(self.minor)
+
+        # A new file only takes blocks that were free in the snapshot, their old data is not copied
+        util.dd("/dev/urandom", newfile, 16, bs="1M")
+        self.addCleanup(os.remove, newfile)
+        os.sync()
+
+        stats = elastio_snap.stats(self.minor)
+        self.assertGreaterEqual(stats["version"], 4)
+        self.assertGreaterEqual(stats["bytes_unused_skipped"] - start["bytes_unused_skipped"], 16 * 1024 * 1024)
+        self.assertLess(stats["bytes_cow"] - start["bytes_cow"], 16 * 1024 * 1024)
+
+        # The snapshot reads the unused blocks as zeros
+        fd = os.open(self.snap_device, os.O_RDONLY)
+        try:
+            for block in (i for i in range(len(bitmap) * 8) if bitmap[i // 8] & (1 << (i % 8))):
+                self.assertEqual(os.pread(fd, block_size, block * block_size), bytes(block_size))
+        finally:
+            os.close(fd)
+
+        util.mount(self.snap_device, self.snap_mount, "ro")
+        self.assertEqual(util.md5sum(snapfile), md5_orig)
+        self.assertFalse(os.path.exists("{}/newfile".format(self.snap_mount)))
+        util.unmount(self.snap_mount)
+
+        # The blocks written since are still changes for the incremental
+        self.assertEqual(elastio_snap.transition_to_incremental(self.minor), 0)
+        changed = elastio_snap.changed_blocks(self.minor)
+        self.assertGreaterEqual(sum(count for _, count in changed), 16 * 1024 * 1024 // block_size)
+
+    def test_latency_histograms(self):
+        testfile = "{}/testfile".format(self.mount)
+
+        self.assertEqual(elastio_snap.setup(self.minor, self.device, self.cow_full_path), 0)
+        self.addCleanup(elastio_snap.destroy, self.minor)
+
+        util.dd("/dev/urandom", testfile, 1, bs="1M")
+        self.addCleanup(os.remove, testfile)
+        os.sync()
+
+        util.dd("/dev/urandom", testfile, 1, bs="1M", conv="notrunc")
+        os.sync()
+
+        hists = latency_hist.read(self.minor)
+        for name in ["trace", "clone_read", "cow_queue", "cow_write"]:
+            self.assertEqual(len(hists[name]), latency_hist.HIST_BUCKETS)
+            self.assertGreater(sum(hists[name]), 0)
+
+        # a few writes of the file system may be traced right after the reset
+        latency_hist.reset(self.minor)
+        self.assertLess(sum(latency_hist.read(self.minor)["trace"]), sum(hists["trace"]))
+
     def test_next_available_minor(self):
         self.assertEqual(elastio_snap.get_free_minor(), 0)
 
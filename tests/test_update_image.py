@@ -9,6 +9,7 @@ import math
 import errno
 import os
 import platform
+import subprocess
 import unittest
 
 import elastio_snap
@@ -77,6 +78,76 @@ class TestUpdateImage(DeviceTestCase):
         self.addCleanup(util.unmount, temp_dir)
         self.assertEqual(util.file_lines(read_testfile), iterations - 1)
 
+    def test_update_engines_match(self):
+        cow_paths = ["{}/{}".format(self.mount, "cow{}".format(i)) for i in range(0, 2)]
+        images = ["{}.{}".format(self.snap_bkp, i) for i in range(0, 3)]
+        testfile = "{}/testfile".format(self.mount)
+
+        self.assertEqual(elastio_snap.setup(self.minor, self.device, cow_paths[0]), 0)
+        self.addCleanup(elastio_snap.destroy, self.minor)
+
+        util.dd(self.snap_device, images[0], self.size_mb, bs="1M")
+        self.assertEqual(elastio_snap.transition_to_incremental(self.minor), 0)
+
+        util.dd("/dev/urandom", testfile, 32, bs="1M")
+        self.addCleanup(os.remove, testfile)
+        os.sync()
+
+        self.assertEqual(elastio_snap.transition_to_snapshot(self.minor, cow_paths[1]), 0)
+
+        for image in images:
+            if image != images[0]:
+                util.dd(images[0], image, self.size_mb, bs="1M")
+            self.addCleanup(os.remove, image)
+
+        # the old block by block copy, the default engine and direct I/O with many jobs
+        util.update_img(self.snap_device, cow_paths[0], images[0], ["--jobs", "1", "--max-io", "4096"])
+        util.update_img(self.snap_device, cow_paths[0], images[1])
+        util.update_img(self.snap_device, cow_paths[0], images[2], ["--jobs", "8", "--direct"])
+
+        self.assertEqual(util.md5sum(images[0]), util.md5sum(images[1]))
+        self.assertEqual(util.md5sum(images[0]), util.md5sum(images[2]))
+        self.assertEqual(util.md5sum(images[0]), util.md5sum(self.snap_device))
+
+    def test_export_apply(self):
+        cow_paths = ["{}/{}".format(self.mount, "cow{}".format(i)) for i in range(0, 2)]
+        images = ["{}.{}".format(self.snap_bkp, i) for i in range(0, 2)]
+        stream = "./delta.bin"
+        testfile = "{}/testfile".format(self.mount)
+
+        self.assertEqual(elastio_snap.setup(self.minor, self.device, cow_paths[0]), 0)
+        self.addCleanup(elastio_snap.destroy, self.minor)
+
+        for image in images:
+            util.dd(self.snap_device, image, self.size_mb, bs="1M")
+            self.addCleanup(os.remove, image)
+
+        self.assertEqual(elastio_snap.transition_to_incremental(self.minor), 0)
+
+        util.dd("/dev/urandom", testfile, 16, bs="1M")
+        self.addCleanup(os.remove, testfile)
+        os.sync()
+
+        self.assertEqual(elastio_snap.transition_to_snapshot(self.minor, cow_paths[1]), 0)
+
+        util.update_img(self.snap_device, cow_paths[0], images[0])
+
+        util.export_img(self.snap_device, cow_paths[0], stream, ["--checksum"])
+        self.addCleanup(os.remove, stream)
+
+        # the stream holds only the changed blocks
+        self.assertLess(os.path.getsize(stream), os.path.getsize(images[1]))
+
+        util.apply_img(stream, images[1])
+        self.assertEqual(util.md5sum(images[0]), util.md5sum(images[1]))
+
+        # a truncated stream must be rejected
+        with open(stream, "r+b") as f:
+            f.truncate(os.path.getsize(stream) // 2)
+
+        with self.assertRaises(subprocess.CalledProcessError):
+            util.apply_img(stream, images[1])
+
  
 if __name__ == "__main__":
     unittest.main()
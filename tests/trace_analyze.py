@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-2.0-only
+
+#
+# Copyright (C) 2023 Elastio Software
+#
+
+#
+# Offline analysis of the debug events of a module built with NETLINK_DEBUG=y.
+#
+# "record" drains the event rings into a compact binary file, "report"
+# rebuilds the lifecycle of every traced bio from it:
+#
+#   original bio: BIO_INCOMING_TRACING_MRF -> ... -> BIO_RELEASED
+#   read clone:   BIO_CLONED -> BIO_READ_COMPLETE -> BIO_QUEUED ->
+#                 BIO_HANDLE_WRITE -> BIO_HANDLE_WRITE_DONE -> BIO_FREE
+#
+# A clone is tied to its original bio through the priv1 field of BIO_CLONED.
+# Bio ids are kernel pointers and get reused, so a new lifecycle starts at
+# every BIO_INCOMING_TRACING_MRF or BIO_CLONED event of an id. Everything is
+# computed over numpy arrays, so millions of events take seconds.
+#
+# Usage: sudo ./trace_analyze.py record -o trace.bin [--duration SECONDS] [--minor N]
+#        ./trace_analyze.py report trace.bin [--interval SECONDS]
+#
+
+import argparse
+import sys
+import time
+
+import numpy as np
+
+import trace_ring
+from trace_ring import EVENT
+
+FILE_MAGIC = b"ESTRACE1"
+
+# the fields of msg_header_t worth keeping, plus the cpu the event was recorded on
+RECORD_DTYPE = np.dtype([
+    ("type", "u1"),
+    ("cpu", "<u2"),
+    ("minor", "<u4"),
+    ("seq_num", "<u8"),
+    ("timestamp", "<u8"),
+    ("id", "<u8"),
+    ("size", "<u4"),
+    ("sector", "<u8"),
+    ("flags", "u1"),
+    ("priv1", "<u8"),
+    ("priv2", "<u8"),
+])
+
+ORIG_STAGES = ["BIO_INCOMING_TRACING_MRF", "BIO_SNAP", "BIO_RELEASED"]
+CLONE_STAGES = ["BIO_CLONED", "BIO_READ_COMPLETE", "BIO_QUEUED", "BIO_HANDLE_WRITE",
+                "BIO_HANDLE_WRITE_DONE", "BIO_FREE"]
+
+
+def to_records(msgs, cpus):
+    out = np.empty(msgs.size, dtype=RECORD_DTYPE)
+    for name in RECORD_DTYPE.names:
+        out[name] = cpus if name == "cpu" else msgs[name]
+    return out
+
+
+def record(path, duration=None, minor=None, interval=0.05):
+    """Drains the event rings into path until the duration elapses or SIGINT."""
+    if minor is not None:
+        trace_ring.set_filter(minor=minor)
+
+    total = 0
+    end = None if duration is None else time.monotonic() + duration
+    with trace_ring.TraceRing() as ring, open(path, "wb") as f:
+        f.write(FILE_MAGIC)
+        f.write(np.uint32(RECORD_DTYPE.itemsize).tobytes())
+        lost = ring.lost
+
+        try:
+            while end is None or time.monotonic() < end:
+                time.sleep(interval)
+                msgs, cpus = ring.drain()
+                to_records(msgs, cpus).tofile(f)
+                total += msgs.size
+        except KeyboardInterrupt:
+            pass
+
+        msgs, cpus = ring.drain()
+        to_records(msgs, cpus).tofile(f)
+        total += msgs.size
+        lost = ring.lost - lost
+
+    return total, lost
+
+
+def load(path):
+    with open(path, "rb") as f:
+        if f.read(len(FILE_MAGIC)) != FILE_MAGIC:
+            raise ValueError("{}: not a trace file".format(path))
+        if int(np.frombuffer(f.read(4), dtype="<u4")[0]) != RECORD_DTYPE.itemsize:
+            raise ValueError("{}: unsupported record size".format(path))
+        events = np.fromfile(f, dtype=RECORD_DTYPE)
+
+    return events[np.argsort(events["timestamp"], kind="stable")]
+
+
+def lifecycles(events, stages, start):
+    """
+    Splits the events of the given stages into lifecycles, a new one starting
+    at every start event of an id. Returns the id and a timestamp per stage
+    of every lifecycle (0 where the stage was not seen) and the size of the
+    bio at its first stage.
+    """
+    codes = np.array([EVENT[s] for s in stages])
+    ev = events[np.isin(events["type"], codes)]
+
+    # group the events of an id, in time order
+    ev = ev[np.lexsort((ev["timestamp"], ev["id"]))]
+    new = (ev["type"] == EVENT[start])
+    new[1:] |= ev["id"][1:] != ev["id"][:-1]
+    if ev.size:
+        new[0] = True
+    life = np.cumsum(new) - 1
+    nr = int(life[-1]) + 1 if ev.size else 0
+
+    ts = np.zeros((nr, len(stages)), dtype=np.uint64)
+    lut = np.zeros(256, dtype=np.intp)
+    lut[codes] = np.arange(codes.size)
+    stage = lut[ev["type"]]
+
+    # events are in time order, assigning them backwards leaves the first one of each stage
+    ts[life[::-1], stage[::-1]] = ev["timestamp"][::-1]
+
+    firsts = np.flatnonzero(new)
+    return ev["id"][firsts], ts, ev["size"][firsts], ev["priv1"][firsts]
+
+
+def link_clones(orig_ids, orig_start, clone_origs, clone_start):
+    """
+    Returns the index of the original bio lifecycle of every clone, the last
+    one of the original bio id started before the clone, or -1.
+    """
+    ids = np.concatenate((orig_ids, clone_origs))
+    ts = np.concatenate((orig_start, clone_start))
+    is_clone = np.concatenate((np.zeros(orig_ids.size, bool), np.ones(clone_origs.size, bool)))
+    pos = np.concatenate((np.arange(orig_ids.size), np.full(clone_origs.size, -1)))
+
+    # originals sort before their clones on equal timestamps
+    order = np.lexsort((is_clone, ts, ids))
+    ids, pos, is_clone = ids[order], pos[order], is_clone[order]
+
+    # carry the position of the latest original forward, then drop carries across ids
+    idx = np.where(pos >= 0, np.arange(pos.size), 0)
+    idx = np.maximum.accumulate(idx) if idx.size else idx
+    valid = (pos[idx] >= 0) & (ids[idx] == ids)
+
+    out = np.full(clone_origs.size, -1, dtype=np.int64)
+    out[order[is_clone] - orig_ids.size] = np.where(valid, pos[idx], -1)[is_clone]
+    return out
+
+
+def stage_latencies(ts, stages, pairs):
+    """Returns {(from, to): array of latencies in ns} for lifecycles which saw both stages."""
+    out = {}
+    for a, b in pairs:
+        ia, ib = stages.index(a), stages.index(b)
+        ok = (ts[:, ia] > 0) & (ts[:, ib] >= ts[:, ia])
+        out[(a, b)] = (ts[ok, ib] - ts[ok, ia]).astype(np.int64)
+    return out
+
+
+def queue_depth(events):
+    """Returns the timestamps at which the cow queue depth changed and the depth after each change."""
+    ev = events[np.isin(events["type"], [EVENT["BIO_QUEUED"], EVENT["BIO_HANDLE_WRITE"]])]
+    delta = np.where(ev["type"] == EVENT["BIO_QUEUED"], 1, -1)
+    # events recorded before the trace started leave the depth negative, start from the lowest point
+    depth = np.cumsum(delta)
+    if depth.size:
+        depth -= min(depth.min(), 0)
+    return ev["timestamp"], depth
+
+
+def format_ns(ns):
+    for unit, div in (("s", 1e9), ("ms", 1e6), ("us", 1e3)):
+        if ns >= div:
+            return "{:.1f}{}".format(ns / div, unit)
+    return "{:.0f}ns".format(ns)
+
+
+def print_latencies(title, lat):
+    print(title)
+    print("  {:<52} {:>9} {:>9} {:>9} {:>9} {:>9}".format("stage", "count", "p50", "p90", "p99", "max"))
+    for (a, b), values in lat.items():
+        if not values.size:
+            print("  {:<52} {:>9}".format("{} -> {}".format(a, b), 0))
+            continue
+        p50, p90, p99 = np.percentile(values, [50, 90, 99])
+        print("  {:<52} {:>9} {:>9} {:>9} {:>9} {:>9}".format(
+            "{} -> {}".format(a, b), values.size, format_ns(p50), format_ns(p90), format_ns(p99),
+            format_ns(values.max())))
+
+
+def report(path, interval=1.0):
+    events = load(path)
+    if not events.size:
+        print("no events")
+        return
+
+    t0 = int(events["timestamp"][0])
+    span = (int(events["timestamp"][-1]) - t0) / 1e9
+    print("{} events over {:.2f}s".format(events.size, span))
+
+    # gaps in the per cpu sequence numbers are events dropped by a full ring
+    lost = 0
+    for cpu in np.unique(events["cpu"]):
+        seq = np.sort(events["seq_num"][events["cpu"] == cpu])
+        lost += int(np.sum(np.diff(seq) - 1))
+    if lost:
+        print("{} events were lost, some lifecycles are incomplete".format(lost))
+
+    orig_ids, orig_ts, _, _ = lifecycles(events, ORIG_STAGES, "BIO_INCOMING_TRACING_MRF")
+    _, clone_ts, clone_size, clone_origs = lifecycles(events, CLONE_STAGES, "BIO_CLONED")
+
+    # only bios that were copied on write go through BIO_SNAP
+    snap = orig_ts[:, ORIG_STAGES.index("BIO_SNAP")] > 0
+    print("{} traced bios, {} copied on write, {} read clones".format(orig_ids.size, int(snap.sum()), clone_ts.shape[0]))
+
+    print_latencies("\noriginal bios:", stage_latencies(orig_ts, ORIG_STAGES, [
+        ("BIO_INCOMING_TRACING_MRF", "BIO_RELEASED"),
+    ]))
+
+    clone_lat = stage_latencies(clone_ts, CLONE_STAGES, list(zip(CLONE_STAGES, CLONE_STAGES[1:])))
+    clone_lat.update(stage_latencies(clone_ts, CLONE_STAGES, [("BIO_CLONED", "BIO_FREE")]))
+
+    # time from the original bio entering the driver until its clone was made
+    parent = link_clones(orig_ids, orig_ts[:, 0], clone_origs, clone_ts[:, 0])
+    linked = (parent >= 0) & (clone_ts[:, 0] > 0)
+    incoming = orig_ts[parent[linked], 0]
+    ok = incoming > 0
+    clone_lat[("BIO_INCOMING_TRACING_MRF", "BIO_CLONED")] = \
+        (clone_ts[linked, 0][ok] - incoming[ok]).astype(np.int64)
+    print_latencies("\nread clones:", clone_lat)
+
+    # queue residency and throughput per interval
+    step = int(interval * 1e9)
+    nr = int((int(events["timestamp"][-1]) - t0) // step) + 1
+    edges = t0 + np.arange(nr + 1, dtype=np.uint64) * step
+
+    qts, depth = queue_depth(events)
+    bucket = np.clip(np.searchsorted(edges, qts, side="right") - 1, 0, nr - 1)
+    max_depth = np.zeros(nr, dtype=np.int64)
+    np.maximum.at(max_depth, bucket, depth)
+
+    def per_interval(name, field=None):
+        ev = events[events["type"] == EVENT[name]]
+        b = np.clip(np.searchsorted(edges, ev["timestamp"], side="right") - 1, 0, nr - 1)
+        return np.bincount(b, weights=None if field is None else ev[field].astype(np.float64), minlength=nr)
+
+    traced = per_interval("BIO_INCOMING_TRACING_MRF")
+    cow_bytes = per_interval("BIO_HANDLE_WRITE", "size")
+    released = per_interval("BIO_RELEASED")
+
+    print("\n{:>10} {:>12} {:>12} {:>12} {:>10}".format("time", "traced/s", "released/s", "cow MB/s", "max queue"))
+    for i in range(nr):
+        print("{:>10.2f} {:>12.0f} {:>12.0f} {:>12.2f} {:>10}".format(
+            i * interval, traced[i] / interval, released[i] / interval, cow_bytes[i] / interval / 2 ** 20, max_depth[i]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="elastio-snap debug event analyzer")
+    sub = parser.add_subparsers(dest="command")
+    sub.required = True
+
+    rec = sub.add_parser("record", help="record the event rings to a file")
+    rec.add_argument("-o", "--output", required=True)
+    rec.add_argument("--duration", type=float, help="seconds to record, until SIGINT by default")
+    rec.add_argument("--minor", type=int, help="only record the events of this minor")
+
+    rep = sub.add_parser("report", help="report the bio lifecycles of a recorded file")
+    rep.add_argument("file")
+    rep.add_argument("--interval", type=float, default=1.0, help="seconds per throughput row")
+
+    args = parser.parse_args()
+    if args.command == "record":
+        total, lost = record(args.output, args.duration, args.minor)
+        print("recorded {} events, {} lost".format(total, lost))
+    else:
+        report(args.file, args.interval)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
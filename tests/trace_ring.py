@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-2.0-only
+
+#
+# Copyright (C) 2023 Elastio Software
+#
+
+#
+# Consumer of the per-cpu debug event rings of a module built with
+# NETLINK_DEBUG=y (see src/nl_debug.h). The rings are memory-mapped from
+# /dev/elastio-snap-trace and drained in bulk into numpy structured arrays.
+#
+# Usage: sudo ./trace_ring.py [--interval SECONDS] [--minor N] [--events NAME,...]
+#
+
+import argparse
+import mmap
+import os
+import sys
+import time
+
+import numpy as np
+
+TRACE_DEVICE = "/dev/elastio-snap-trace"
+TRACE_RING_VERSION = 1
+TRACE_NO_MINOR = 0xffffffff
+
+PARAMETERS = "/sys/module/elastio-snap/parameters"
+
+# enum msg_type_t from src/nl_debug.h
+EVENTS = [
+    "DRIVER_INIT",
+    "DRIVER_DEINIT",
+    "DRIVER_ERROR",
+    "SETUP_SNAPSHOT",
+    "SETUP_UNVERIFIED_SNAP",
+    "SETUP_UNVERIFIED_INC",
+    "TRANSITION_INC",
+    "TRANSITION_SNAP",
+    "TRANSITION_DORMANT",
+    "TRANSITION_ACTIVE",
+    "TRACING_STARTED",
+    "TRACING_FINISHED",
+    "BIO_INCOMING_TRACING_MRF",
+    "BIO_INCOMING_SNAP_MRF",
+    "BIO_CALL_ORIG",
+    "BIO_SNAP",
+    "BIO_INC",
+    "BIO_CLONED",
+    "BIO_READ_COMPLETE",
+    "BIO_QUEUED",
+    "BIO_RELEASED",
+    "BIO_HANDLE_READ_BASE",
+    "BIO_HANDLE_READ_COW",
+    "BIO_HANDLE_READ_DONE",
+    "BIO_HANDLE_WRITE",
+    "BIO_HANDLE_WRITE_DONE",
+    "BIO_FREE",
+    "COW_READ_MAPPING",
+    "COW_WRITE_MAPPING",
+    "COW_READ_DATA",
+    "COW_WRITE_DATA",
+]
+EVENT = {name: i for i, name in enumerate(EVENTS)}
+
+# struct msg_header_t, packed
+MSG_DTYPE = np.dtype([
+    ("type", "u1"),
+    ("seq_num", "<u8"),
+    ("timestamp", "<u8"),
+    ("id", "<u8"),
+    ("size", "<u4"),
+    ("sector", "<u8"),
+    ("flags", "u1"),
+    ("priv1", "<u8"),
+    ("priv2", "<u8"),
+    ("func", "S32"),
+    ("line", "<u2"),
+    ("minor", "<u4"),
+])
+
+# struct trace_ring_info and struct trace_ring_header
+INFO_DTYPE = np.dtype([("version", "<u4"), ("nr_rings", "<u4"), ("ring_size", "<u4"),
+                       ("record_size", "<u4"), ("nr_records", "<u4")])
+HEAD, TAIL, LOST = range(3)
+
+
+def set_filter(events=None, minor=None):
+    """Records only the given event names (all if None) of the given minor (all if None)."""
+    mask = (1 << 64) - 1 if events is None else sum(1 << EVENT[e] for e in events)
+    with open(os.path.join(PARAMETERS, "trace_mask"), "w") as f:
+        f.write(str(mask))
+    with open(os.path.join(PARAMETERS, "trace_minor"), "w") as f:
+        f.write(str(TRACE_NO_MINOR if minor is None else minor))
+
+
+class TraceRing:
+    def __init__(self, path=TRACE_DEVICE):
+        self._fd = os.open(path, os.O_RDWR)
+        try:
+            page = mmap.PAGESIZE
+            with mmap.mmap(self._fd, page, mmap.MAP_SHARED, mmap.PROT_READ) as m:
+                self.info = np.frombuffer(m, dtype=INFO_DTYPE, count=1)[0].copy()
+
+            if self.info["version"] != TRACE_RING_VERSION or self.info["record_size"] != MSG_DTYPE.itemsize:
+                raise ValueError("{}: unsupported trace ring version {}".format(path, self.info["version"]))
+
+            self.nr_rings = int(self.info["nr_rings"])
+            self.nr_records = int(self.info["nr_records"])
+            ring_size = int(self.info["ring_size"])
+
+            self._mm = mmap.mmap(self._fd, page + self.nr_rings * ring_size, mmap.MAP_SHARED,
+                                 mmap.PROT_READ | mmap.PROT_WRITE)
+        except Exception:
+            os.close(self._fd)
+            raise
+
+        self._headers = [np.frombuffer(self._mm, dtype="<u8", count=3, offset=page + cpu * ring_size)
+                         for cpu in range(self.nr_rings)]
+        self._records = [np.frombuffer(self._mm, dtype=MSG_DTYPE, count=self.nr_records,
+                                       offset=2 * page + cpu * ring_size)
+                         for cpu in range(self.nr_rings)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._mm is None:
+            return
+
+        # the mapping can't be closed while views of it are still alive
+        self._headers = self._records = None
+        self._mm.close()
+        self._mm = None
+        os.close(self._fd)
+
+    @property
+    def lost(self):
+        """Number of events dropped because a ring was full, summed over all cpus."""
+        return int(sum(h[LOST] for h in self._headers))
+
+    def drain(self):
+        """
+        Copies every pending record out of the rings and hands their slots
+        back to the kernel. Returns the records ordered by timestamp and the
+        cpu each of them was recorded on.
+        """
+        chunks, cpus = [], []
+        for cpu, (header, records) in enumerate(zip(self._headers, self._records)):
+            tail = int(header[TAIL])
+            head = int(header[HEAD])
+            if head == tail:
+                continue
+
+            first, last = tail % self.nr_records, head % self.nr_records
+            if first < last:
+                chunk = records[first:last].copy()
+            else:
+                chunk = np.concatenate((records[first:], records[:last]))
+
+            # the copy must be complete before the kernel may reuse the slots
+            header[TAIL] = head
+            chunks.append(chunk)
+            cpus.append(np.full(chunk.size, cpu, dtype=np.uint16))
+
+        if not chunks:
+            return np.empty(0, dtype=MSG_DTYPE), np.empty(0, dtype=np.uint16)
+
+        records = np.concatenate(chunks)
+        cpus = np.concatenate(cpus)
+        order = np.argsort(records["timestamp"], kind="stable")
+        return records[order], cpus[order]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="elastio-snap debug event ring consumer")
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between reports")
+    parser.add_argument("--minor", type=int, help="only record the events of this minor")
+    parser.add_argument("--events", help="comma separated event names to record, e.g. BIO_QUEUED,BIO_FREE")
+    args = parser.parse_args()
+
+    set_filter(args.events.split(",") if args.events else None, args.minor)
+
+    with TraceRing() as ring:
+        try:
+            while True:
+                time.sleep(args.interval)
+                records, _ = ring.drain()
+                counts = np.bincount(records["type"], minlength=len(EVENTS))
+                summary = ", ".join("{} {}".format(EVENTS[t], counts[t]) for t in np.flatnonzero(counts))
+                print("{} events, {} lost: {}".format(records.size, ring.lost, summary))
+        except KeyboardInterrupt:
+            pass
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -134,10 +134,18 @@ def fsck(image, fs="ext4"):
 
     subprocess.check_call(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=10)
 
-def update_img(device, cow_file, bkp):
-    cmd = ["../utils/update-img", device, cow_file, bkp]
+def update_img(device, cow_file, bkp, args=[]):
+    cmd = ["../utils/update-img"] + args + [device, cow_file, bkp]
     subprocess.check_call(cmd, stdout=subprocess.DEVNULL, timeout=180)
 
+def export_img(device, cow_file, output, args=[]):
+    cmd = ["../utils/update-img", "export"] + args + [device, cow_file, output]
+    subprocess.check_call(cmd, stderr=subprocess.DEVNULL, timeout=180)
+
+def apply_img(stream, bkp):
+    cmd = ["../utils/update-img", "apply", stream, bkp]
+    subprocess.check_call(cmd, stderr=subprocess.DEVNULL, timeout=180)
+
 def mktemp_dir():
     cmd = ["mktemp", "-d"]
     temp_dir = subprocess.check_output(cmd, timeout=10).rstrip().decode("utf-8")
@@ -154,6 +162,41 @@ def dev_size_mb(device):
 def dev_size_bytes(device):
     return int(subprocess.check_output("blockdev --getsize64 %s" % device, shell=True))
 
+def ext4_unused_bitmap(device, block_size=4096):
+    """
+    Returns a bitmap of the block_size blocks of an ext4 device that hold no
+    used filesystem block, as read by dumpe2fs. Bit i (least significant bit
+    of each byte first) stands for block i. Refuses filesystems whose journal
+    needs recovery, their maps miss the blocks allocated in the journal.
+    """
+    out = subprocess.check_output(["dumpe2fs", device], stderr=subprocess.DEVNULL, timeout=60).decode("utf-8")
+
+    features = next((line.split(":", 1)[1].split() for line in out.splitlines() if line.startswith("Filesystem features:")), [])
+    if "needs_recovery" in features:
+        raise RuntimeError("{}: the journal needs recovery, the free space maps are out of date".format(device))
+
+    fs_block_size = next(int(line.split(":")[1]) for line in out.splitlines() if line.startswith("Block size:"))
+    per_block = block_size // fs_block_size
+    nr_blocks = dev_size_bytes(device) // block_size
+    bitmap = bytearray((nr_blocks + 7) // 8)
+
+    # the free ranges of each group are listed as "  Free blocks: 1-5, 8, 10-20"
+    for line in out.splitlines():
+        if not line.startswith("  Free blocks: "):
+            continue
+
+        for free in line.split(":", 1)[1].split(","):
+            if not free.strip():
+                continue
+
+            first, _, last = free.strip().partition("-")
+            lo = (int(first) + per_block - 1) // per_block
+            hi = min((int(last or first) + 1) // per_block, nr_blocks)
+            for block in range(lo, hi):
+                bitmap[block // 8] |= 1 << (block % 8)
+
+    return bytes(bitmap)
+
 # This method finds names of the partitions of the disk
 def get_partitions(disk):
     # The output of this command 'lsblk /dev/loop0 -l -o NAME -n' is something like
@@ -12,8 +12,8 @@
 #include <stdlib.h>
 #include <string.h>
 #include <sys/socket.h>
+#include <sys/mman.h>
 #include <arpa/inet.h>
-#include <linux/netlink.h>
 #include <unistd.h>
 #include <stdint.h>
 #include <signal.h>
@@ -33,7 +33,7 @@ struct event_desc {
 	const char *desc;
 };
 
-#define MSG_SIZE 256
+#define TRACE_DEVICE_PATH "/dev/" TRACE_DEVICE_NAME
 
 #define CNRM  "\x1B[0m"
 #define CRED  "\x1B[31m"
@@ -82,18 +82,33 @@ struct event_desc event_text_desc[] = {
 		{ EVENT_COW_WRITE_DATA, KIND_EVENT_COW, TO_STR(EVENT_COW_WRITE_DATA) }
 };
 
-int sock_fd;
+int trace_fd;
 int proxy_fd;
-static uint64_t last_seq_num = 0;
-static uint64_t seq_num_errors = 0;
-static uint64_t packets_lost = 0;
+static const struct trace_ring_info *ring_info;
+static char *rings;
+static uint64_t *lost_seen;
+
+static struct trace_ring_header *get_ring(uint32_t cpu)
+{
+	return (struct trace_ring_header *)(rings + (size_t)cpu * ring_info->ring_size);
+}
+
+static uint64_t events_lost(void)
+{
+	uint32_t cpu;
+	uint64_t lost = 0;
+
+	for (cpu = 0; cpu < ring_info->nr_rings; cpu++)
+		lost += __atomic_load_n(&get_ring(cpu)->lost, __ATOMIC_RELAXED);
+
+	return lost;
+}
 
 static void int_handler(int val) {
 	printf(CRESET "\n");
 	printf("Scanning done.\n");
-	printf("Sequence number errors: %lu\n", seq_num_errors);
-	printf("Packets lost: %lu\n", packets_lost);
-	close(sock_fd);
+	printf("Events lost: %lu\n", events_lost());
+	close(trace_fd);
 	exit(0);
 }
 
@@ -169,8 +184,8 @@ void usage()
 
 int main(int argc, char **argv)
 {
-	struct sockaddr_nl user_sockaddr;
 	struct sockaddr_in server_addr;
+	size_t map_size;
 	uint64_t sector_start = 0;
 	uint64_t sector_end = ~0ULL;
 	bool mute_all = false;
@@ -240,164 +255,141 @@ int main(int argc, char **argv)
 			printf("Filtering sector range: %lu - %lu\n", sector_start, sector_end);
 	}
 
-	sock_fd = socket(PF_NETLINK, SOCK_RAW, NETLINK_USERSOCK);
-	if (sock_fd < 0){
-		printf("Error while creating netlink socket\n");
+	trace_fd = open(TRACE_DEVICE_PATH, O_RDWR);
+	if (trace_fd < 0) {
+		perror("Couldn't open " TRACE_DEVICE_PATH);
 		return -1;
 	}
 
-	proxy_fd = socket(AF_INET, SOCK_DGRAM, IPPROTO_UDP);
-	if (proxy_fd < 0){
-		printf("Error while creating proxy socket\n");
+	ring_info = mmap(NULL, sysconf(_SC_PAGESIZE), PROT_READ, MAP_SHARED, trace_fd, 0);
+	if (ring_info == MAP_FAILED) {
+		perror("Couldn't map the trace ring info");
 		return -1;
 	}
 
-	server_addr.sin_family = AF_INET;
-	server_addr.sin_port = htons(CLIENT_PORT);
-	server_addr.sin_addr.s_addr = inet_addr(CLIENT_ADDR);
-
-	memset(&user_sockaddr, 0, sizeof(user_sockaddr));
-	user_sockaddr.nl_family = AF_NETLINK;
-	user_sockaddr.nl_groups = NL_MCAST_GROUP;
-	user_sockaddr.nl_pid = getpid();
+	if (ring_info->version != TRACE_RING_VERSION || ring_info->record_size != sizeof(struct msg_header_t)) {
+		printf("Trace ring version %u doesn't match this utility\n", ring_info->version);
+		return -1;
+	}
 
-	int ret = bind(sock_fd, (struct sockaddr*)&user_sockaddr, sizeof(user_sockaddr));
-	if (ret) {
-		perror("Couldn't bind the socket");
+	// the rings follow the info page
+	map_size = sysconf(_SC_PAGESIZE) + (size_t)ring_info->nr_rings * ring_info->ring_size;
+	rings = mmap(NULL, map_size, PROT_READ | PROT_WRITE, MAP_SHARED, trace_fd, 0);
+	if (rings == MAP_FAILED) {
+		perror("Couldn't map the trace rings");
 		return -1;
 	}
+	rings += sysconf(_SC_PAGESIZE);
 
-	int flags = fcntl(sock_fd, F_GETFL);
-	fcntl(sock_fd, F_SETFL, flags | O_NONBLOCK);
+	lost_seen = calloc(ring_info->nr_rings, sizeof(uint64_t));
+	if (!lost_seen) {
+		printf("Couldn't allocate memory\n");
+		return -1;
+	}
 
-	int rcvbuf = 500 * 1024 * 1024;
-	if (setsockopt(sock_fd, SOL_SOCKET, SO_RCVBUFFORCE,
-				&rcvbuf, sizeof rcvbuf)) {
-		printf("Couldn't update socket rx buf\n");
-		// also consider this:
-		// echo 500000000 > /proc/sys/net/core/rmem_max
-		// echo 500000000 > /proc/sys/net/core/rmem_default
+	proxy_fd = socket(AF_INET, SOCK_DGRAM, IPPROTO_UDP);
+	if (proxy_fd < 0){
+		printf("Error while creating proxy socket\n");
+		return -1;
 	}
 
-#define MAX_MSGS	5
-#define TIMEOUT 300000
+	server_addr.sin_family = AF_INET;
+	server_addr.sin_port = htons(CLIENT_PORT);
+	server_addr.sin_addr.s_addr = inet_addr(CLIENT_ADDR);
 
 	while (true) {
-		int i;
-		int ret;
-		struct iovec iov[MAX_MSGS];
-		struct mmsghdr msgs[MAX_MSGS];
-		struct timespec timeout;
-		struct nlmsghdr *nl_msghdr[MAX_MSGS];
+		uint32_t cpu;
+		bool idle = true;
 		struct timespec tspec;
 
-		memset(msgs, 0, sizeof(msgs));
-
-		for (i = 0; i < MAX_MSGS; i++) {
-			nl_msghdr[i] = (struct nlmsghdr *) malloc(NLMSG_SPACE(MSG_SIZE));
-			memset(nl_msghdr[i], 0, NLMSG_SPACE(MSG_SIZE));
+		for (cpu = 0; cpu < ring_info->nr_rings; cpu++) {
+			struct trace_ring_header *ring = get_ring(cpu);
+			uint64_t tail = ring->tail;
+			// pairs with the barrier the kernel issues before advancing head
+			uint64_t head = __atomic_load_n(&ring->head, __ATOMIC_ACQUIRE);
+			uint64_t lost = __atomic_load_n(&ring->lost, __ATOMIC_RELAXED);
 
-			iov[i].iov_base = (void*) nl_msghdr[i];
-			iov[i].iov_len = NLMSG_SPACE(MSG_SIZE);
-
-			msgs[i].msg_hdr.msg_iov = &iov[i];
-			msgs[i].msg_hdr.msg_iovlen = 1;
-		}
+			if (lost != lost_seen[cpu]) {
+				if (coloring)
+					printf(CRED);
 
-		timeout.tv_sec = 0;
-		timeout.tv_nsec = 500000;
+				printf("DATA DROPPED: cpu %u lost %lu events\n", cpu, lost - lost_seen[cpu]);
 
-		ret = recvmmsg(sock_fd, msgs, MAX_MSGS, 0, &timeout);
+				if (coloring)
+					printf(CRESET);
+				lost_seen[cpu] = lost;
+			}
 
-		if (ret == -1)
-			goto out;
+			for (; tail < head; tail++) {
+				struct msg_header_t *msg = (struct msg_header_t *)((char *)ring + sysconf(_SC_PAGESIZE) +
+						(tail % ring_info->nr_records) * sizeof(struct msg_header_t));
 
-		for (i = 0; i < ret; i++) {
-			struct msg_header_t *msg = (struct msg_header_t *)NLMSG_DATA(nl_msghdr[i]);
+				idle = false;
 
-			if (mute_all)
-				goto skip_print;
+				if (mute_all)
+					goto skip_print;
 
-			if (is_cow_event(msg->type) && mute_cow_events)
-				goto skip_print;
+				if (is_cow_event(msg->type) && mute_cow_events)
+					goto skip_print;
 
-			if (is_bio_event(msg->type) && mute_bio_events)
-				goto skip_print;
+				if (is_bio_event(msg->type) && mute_bio_events)
+					goto skip_print;
 
-			if (is_bio_event(msg->type) && msg->params.id &&
-					(msg->params.sector < sector_start || msg->params.sector > sector_end))
-				goto skip_print;
+				if (is_bio_event(msg->type) && msg->params.id &&
+						(msg->params.sector < sector_start || msg->params.sector > sector_end))
+					goto skip_print;
 
-			if (is_bio_write(msg) && read_only)
-				goto skip_print;
+				if (is_bio_write(msg) && read_only)
+					goto skip_print;
 
-			if (!is_bio_write(msg) && write_only)
-				goto skip_print;
+				if (!is_bio_write(msg) && write_only)
+					goto skip_print;
 
-			if (coloring) {
-				if (is_generic_event(msg->type)) {
-					if (msg->type == EVENT_DRIVER_ERROR)
-						printf(CRED);
-					else
-						printf(CYEL);
+				if (coloring) {
+					if (is_generic_event(msg->type)) {
+						if (msg->type == EVENT_DRIVER_ERROR)
+							printf(CRED);
+						else
+							printf(CYEL);
+					}
+					else if (is_bio_event(msg->type))
+						printf(CCYN);
+					else if (is_cow_event(msg->type))
+						printf(CMAG);
 				}
-				else if (is_bio_event(msg->type))
-					printf(CCYN);
-				else if (is_cow_event(msg->type))
-					printf(CMAG);
-			}
-
-			u64_to_timespec(msg->timestamp, &tspec);
-			printf("[%6lu] [%7ld:%9ld] %32.32s [%2d] ", msg->seq_num, tspec.tv_sec, tspec.tv_nsec, event2str(msg->type), msg->type);
-			printf("%32.32s(), line %4d", msg->source.func, msg->source.line);
-
-			if (msg->params.id) {
-				printf(", bio ID: %16lx, R/W: %2.2s, sector: %10lu, size: %10d", msg->params.id, is_bio_write(msg) ? "W" : "R", msg->params.sector, msg->params.size);
-			}
-
-			printf(", priv1: %10ld, priv2: %10ld", msg->params.priv1, msg->params.priv2);
-
-			if (coloring)
-				printf(CRESET);
 
-			printf("\n");
+				u64_to_timespec(msg->timestamp, &tspec);
+				printf("[%3u:%6lu] [%7ld:%9ld] %32.32s [%2d] ", cpu, msg->seq_num, tspec.tv_sec, tspec.tv_nsec, event2str(msg->type), msg->type);
+				printf("%32.32s(), line %4d", msg->source.func, msg->source.line);
 
-skip_print:
-			if(sendto(proxy_fd, msg, msgs[i].msg_len, 0,
-						(struct sockaddr*)&server_addr, sizeof(server_addr)) < 0){
-				printf("Unable to send message\n");
-				return -1;
-			}
+				if (msg->minor != TRACE_NO_MINOR)
+					printf(", minor: %u", msg->minor);
 
-			if (msg->type == EVENT_DRIVER_DEINIT) {
-				last_seq_num = 0;
-				goto out;
-			}
+				if (msg->params.id) {
+					printf(", bio ID: %16lx, R/W: %2.2s, sector: %10lu, size: %10d", msg->params.id, is_bio_write(msg) ? "W" : "R", msg->params.sector, msg->params.size);
+				}
 
-			if (!last_seq_num) {
-				last_seq_num = msg->seq_num;
-				goto out;
-			}
+				printf(", priv1: %10ld, priv2: %10ld", msg->params.priv1, msg->params.priv2);
 
-			if (msg->seq_num != last_seq_num + 1) {
-				packets_lost += (msg->seq_num - last_seq_num - 1);
 				if (coloring)
-					printf(CRED);
+					printf(CRESET);
 
-				printf("DATA DROPPED: last seq_num: %lu, seq_num received: %lu\n", last_seq_num, msg->seq_num);
+				printf("\n");
 
-				if (coloring)
-					printf(CRESET);
-				seq_num_errors++;
+skip_print:
+				if(sendto(proxy_fd, msg, sizeof(struct msg_header_t), 0,
+							(struct sockaddr*)&server_addr, sizeof(server_addr)) < 0){
+					printf("Unable to send message\n");
+					return -1;
+				}
 			}
 
-			last_seq_num = msg->seq_num;
-
+			// hand the consumed slots back to the kernel
+			__atomic_store_n(&ring->tail, tail, __ATOMIC_RELEASE);
 		}
 
-out:
-		for (i = 0; i < MAX_MSGS; i++)
-			free(nl_msghdr[i]);
+		if (idle)
+			usleep(1000);
 	}
 
 	return 0;
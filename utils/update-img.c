@@ -5,6 +5,7 @@
  * Additional contributions by Elastio Software, Inc are Copyright (C) 2020 Elastio Software Inc.
  */
 
+#define _GNU_SOURCE
 #define _FILE_OFFSET_BITS 64
 #define __USE_LARGEFILE64
 
@@ -13,52 +14,372 @@
 #include <errno.h>
 #include <unistd.h>
 #include <string.h>
+#include <fcntl.h>
+#include <getopt.h>
+#include <limits.h>
+#include <pthread.h>
 
 #include "kernel-config.h"
 #include "libelastio-snap.h"
 
-#define INDEX_BUFFER_SIZE 8192
+#define INDEX_BUFFER_SIZE 65536
+#define EXTENT_QUEUE_SIZE 256
+#define DEFAULT_JOBS 4
+#define MAX_JOBS 64
+#define DEFAULT_MAX_IO (1024 * 1024)
+#define MAX_MAX_IO (64 * 1024 * 1024)
 
 #define MIN(x, y) (((x) < (y)) ? (x) : (y))
 
 typedef unsigned long long sector_t;
 
-static void print_help(char* progname, int status){
-	fprintf(stderr, "Usage: %s <snapshot device> <cow file> <image file>\n", progname);
+/*
+ * Incremental export stream:
+ *
+ * +--------------+--------+---------+--------+---------+-----+------------+
+ * | delta_header | extent | payload | extent | payload | ... | end extent |
+ * +--------------+--------+---------+--------+---------+-----+------------+
+ *
+ * Each extent header is followed by count * block_size bytes of data. The
+ * stream is terminated by an extent with a count of 0, whose start holds
+ * the total number of blocks in the stream. If DELTA_FLAG_CHECKSUM is set,
+ * every extent carries the CRC-32 (as in zlib) of its payload. All fields
+ * are in the byte order of the exporting machine.
+ */
+#define DELTA_MAGIC "ELSNDLTA"
+#define DELTA_MAGIC_SIZE 8
+#define DELTA_VERSION 1
+#define DELTA_FLAG_CHECKSUM (1 << 0)
+
+struct delta_header{
+	char magic[DELTA_MAGIC_SIZE]; //DELTA_MAGIC
+	uint32_t version; //version of the stream format
+	uint32_t flags; //DELTA_FLAG_* flags
+	uint32_t block_size; //size of a block in bytes
+	uint32_t reserved;
+	uint64_t total_blocks; //size of the snapshot in blocks
+	uint64_t seqid; //sequence id of the snapshot the data was read from
+	uint8_t uuid[COW_UUID_SIZE]; //uuid of the snapshot series
+};
+
+struct delta_extent{
+	uint64_t start; //first block of the extent
+	uint32_t count; //number of blocks in the extent
+	uint32_t checksum; //CRC-32 of the payload
+};
+
+//a run of consecutive changed blocks
+struct extent{
+	sector_t start;
+	sector_t count;
+};
+
+struct merge_ctx{
+	int snap_fd;
+	int img_fd;
+	size_t max_io; //maximum size of a single I/O (in bytes)
+	unsigned int jobs; //number of worker threads, 0 copies extents from the main thread
+	char *buf; //copy buffer of the main thread when there are no workers
+
+	//queue of extents waiting for a worker
+	pthread_mutex_t lock;
+	pthread_cond_t not_empty;
+	pthread_cond_t not_full;
+	struct extent queue[EXTENT_QUEUE_SIZE];
+	unsigned int head;
+	unsigned int count;
+	int done;
+
+	//statistics, protected by lock
+	sector_t blocks_copied;
+	sector_t err_count;
+};
+
+static const char *progname;
+static uint32_t crc32_table[256];
+
+static void print_help(int status){
+	fprintf(stderr, "Usage:\n");
+	fprintf(stderr, "\t%s [-j <jobs>] [-m <max io>] [-d] <snapshot device> <cow file> <image file>\n", progname);
+	fprintf(stderr, "\t%s export [-c] [-m <max io>] [-d] <snapshot device> <cow file> <output file | ->\n", progname);
+	fprintf(stderr, "\t%s apply [-d] <input file | -> <image file>\n", progname);
+	fprintf(stderr, "\t-j, --jobs\tnumber of threads copying data (default %d)\n", DEFAULT_JOBS);
+	fprintf(stderr, "\t-m, --max-io\tmaximum size of a single read or write in bytes (default %d)\n", DEFAULT_MAX_IO);
+	fprintf(stderr, "\t-d, --direct\tbypass the page cache (O_DIRECT) for the snapshot and the image\n");
+	fprintf(stderr, "\t-c, --checksum\tstore a CRC-32 of every exported extent\n");
 	exit(status);
 }
 
-static int copy_block(FILE *snap, FILE *img, sector_t block){
-	char buf[COW_BLOCK_SIZE];
+static void crc32_init(void){
+	uint32_t i, j, c;
+
+	for(i = 0; i < 256; i++){
+		c = i;
+		for(j = 0; j < 8; j++) c = (c & 1)? 0xEDB88320 ^ (c >> 1) : c >> 1;
+		crc32_table[i] = c;
+	}
+}
+
+static uint32_t crc32(uint32_t crc, const unsigned char *buf, size_t len){
+	crc = ~crc;
+	while(len--) crc = crc32_table[(crc ^ *buf++) & 0xFF] ^ (crc >> 8);
+	return ~crc;
+}
+
+static int parse_size(const char *str, unsigned long *out){
+	char *end;
+	unsigned long long tmp;
+
+	errno = 0;
+	tmp = strtoull(str, &end, 0);
+	if(errno) return errno;
+	if(!*str || *end || tmp > ULONG_MAX) return EINVAL;
+
+	*out = (unsigned long)tmp;
+	return 0;
+}
+
+static int io_full(int fd, char *buf, size_t len, off_t off, int write_data){
+	ssize_t bytes;
+
+	while(len){
+		if(write_data) bytes = pwrite(fd, buf, len, off);
+		else bytes = pread(fd, buf, len, off);
+
+		if(bytes < 0){
+			if(errno == EINTR) continue;
+			return errno;
+		}
+
+		//a short read past the end of the device
+		if(bytes == 0) return EIO;
+
+		buf += bytes;
+		len -= bytes;
+		off += bytes;
+	}
+
+	return 0;
+}
+
+//read() and write() on pipes may transfer less than requested
+static int stream_full(int fd, char *buf, size_t len, int write_data){
+	ssize_t bytes;
+
+	while(len){
+		if(write_data) bytes = write(fd, buf, len);
+		else bytes = read(fd, buf, len);
+
+		if(bytes < 0){
+			if(errno == EINTR) continue;
+			return errno;
+		}
+
+		//unexpected end of the stream
+		if(bytes == 0) return EIO;
+
+		buf += bytes;
+		len -= bytes;
+	}
+
+	return 0;
+}
+
+static int copy_range(struct merge_ctx *ctx, char *buf, sector_t block, sector_t count){
 	int ret;
-	size_t bytes;
+	size_t len = count * COW_BLOCK_SIZE;
+	off_t off = (off_t)block * COW_BLOCK_SIZE;
 
-	bytes = pread(fileno(snap), buf, COW_BLOCK_SIZE, block * COW_BLOCK_SIZE);
-	if(bytes != COW_BLOCK_SIZE){
-		ret = errno;
-		errno = 0;
-		fprintf(stderr, "error reading data block from snapshot\n");
-		goto error;
+	ret = io_full(ctx->snap_fd, buf, len, off, 0);
+	if(ret) return ret;
+
+	return io_full(ctx->img_fd, buf, len, off, 1);
+}
+
+static sector_t copy_extent(struct merge_ctx *ctx, char *buf, const struct extent *ext, sector_t *copied){
+	sector_t i, done, count, errs = 0, max_blocks = ctx->max_io / COW_BLOCK_SIZE;
+
+	for(done = 0; done < ext->count; done += count){
+		count = MIN(max_blocks, ext->count - done);
+
+		if(!copy_range(ctx, buf, ext->start + done, count)) continue;
+
+		//retry block by block so errors are accounted exactly as before
+		for(i = 0; i < count; i++){
+			if(copy_range(ctx, buf, ext->start + done + i, 1)){
+				errno = 0;
+				fprintf(stderr, "error copying block %llu to output image\n", ext->start + done + i);
+				errs++;
+			}
+		}
 	}
 
-	bytes = pwrite(fileno(img), buf, COW_BLOCK_SIZE, block * COW_BLOCK_SIZE);
-	if(bytes != COW_BLOCK_SIZE){
-		ret = errno;
+	*copied = ext->count;
+	return errs;
+}
+
+struct merge_worker{
+	pthread_t thread;
+	struct merge_ctx *ctx;
+	char *buf;
+};
+
+static void *merge_worker(void *data){
+	struct merge_worker *w = data;
+	struct merge_ctx *ctx = w->ctx;
+	struct extent ext;
+	sector_t copied, errs;
+
+	pthread_mutex_lock(&ctx->lock);
+	while(1){
+		while(!ctx->count && !ctx->done) pthread_cond_wait(&ctx->not_empty, &ctx->lock);
+		if(!ctx->count) break;
+
+		ext = ctx->queue[ctx->head];
+		ctx->head = (ctx->head + 1) % EXTENT_QUEUE_SIZE;
+		ctx->count--;
+		pthread_cond_signal(&ctx->not_full);
+		pthread_mutex_unlock(&ctx->lock);
+
+		errs = copy_extent(ctx, w->buf, &ext, &copied);
+
+		pthread_mutex_lock(&ctx->lock);
+		ctx->blocks_copied += copied;
+		ctx->err_count += errs;
+	}
+	pthread_mutex_unlock(&ctx->lock);
+
+	return NULL;
+}
+
+static void merge_submit(struct merge_ctx *ctx, const struct extent *ext){
+	sector_t copied, errs;
+
+	if(!ctx->jobs){
+		errs = copy_extent(ctx, ctx->buf, ext, &copied);
+		ctx->blocks_copied += copied;
+		ctx->err_count += errs;
+		return;
+	}
+
+	pthread_mutex_lock(&ctx->lock);
+	while(ctx->count == EXTENT_QUEUE_SIZE) pthread_cond_wait(&ctx->not_full, &ctx->lock);
+	ctx->queue[(ctx->head + ctx->count) % EXTENT_QUEUE_SIZE] = *ext;
+	ctx->count++;
+	pthread_cond_signal(&ctx->not_empty);
+	pthread_mutex_unlock(&ctx->lock);
+}
+
+static int merge_submit_extent(void *data, const struct extent *ext){
+	merge_submit(data, ext);
+	return 0;
+}
+
+static int read_summary(int cow_fd, sector_t total_blocks, unsigned char **summary_out, sector_t *blocks_per_bit){
+	ssize_t bytes;
+	unsigned char *header;
+	struct cow_header *ch;
+	sector_t sect_blocks = sysconf(_SC_PAGESIZE);
+
+	*summary_out = NULL;
+
+	header = malloc(COW_HEADER_SIZE);
+	if(!header){
+		fprintf(stderr, "error allocating cow header\n");
+		return ENOMEM;
+	}
+
+	bytes = pread(cow_fd, header, COW_HEADER_SIZE, 0);
+	if(bytes != COW_HEADER_SIZE){
+		free(header);
 		errno = 0;
-		fprintf(stderr, "error writing data block to output image\n");
-		goto error;
+		fprintf(stderr, "error reading cow header\n");
+		return EIO;
+	}
+
+	//cow files without a summary have to be scanned completely
+	ch = (struct cow_header *)header;
+	if(ch->version < COW_VERSION_SECTION_SUMMARY || !ch->summary_sects ||
+			(total_blocks + sect_blocks * ch->summary_sects - 1) / (sect_blocks * ch->summary_sects) > COW_SUMMARY_BITS){
+		free(header);
+		return 0;
 	}
 
+	*blocks_per_bit = sect_blocks * ch->summary_sects;
+	*summary_out = header;
 	return 0;
+}
 
-error:
-	fprintf(stderr, "error copying sector to output image\n");
+static int for_each_changed_extent(int cow_fd, sector_t total_blocks, sector_t max_blocks, int (*fn)(void *, const struct extent *), void *data){
+	int ret = 0;
+	ssize_t bytes;
+	size_t blocks_to_read;
+	sector_t i, block, bit, blocks_per_bit = 0;
+	uint64_t *mappings;
+	unsigned char *summary;
+	struct extent ext = { 0, 0 };
+
+	ret = read_summary(cow_fd, total_blocks, &summary, &blocks_per_bit);
+	if(ret) return ret;
+
+	mappings = malloc(INDEX_BUFFER_SIZE * sizeof(uint64_t));
+	if(!mappings){
+		free(summary);
+		fprintf(stderr, "error allocating mappings\n");
+		return ENOMEM;
+	}
+
+	if(!summary) posix_fadvise(cow_fd, COW_HEADER_SIZE, total_blocks * sizeof(uint64_t), POSIX_FADV_SEQUENTIAL);
+
+	for(block = 0; block < total_blocks; block += blocks_to_read){
+		blocks_to_read = MIN(INDEX_BUFFER_SIZE, total_blocks - block);
+
+		if(summary){
+			//skip groups of sections without any mappings
+			bit = block / blocks_per_bit;
+			blocks_to_read = MIN(blocks_to_read, (bit + 1) * blocks_per_bit - block);
+			if(!(((unsigned long *)(summary + COW_SUMMARY_OFFSET))[bit / LONG_BIT] & (1UL << (bit % LONG_BIT)))) continue;
+		}
+
+		//read a chunk of mappings from the cow file
+		bytes = pread(cow_fd, mappings, blocks_to_read * sizeof(uint64_t), COW_HEADER_SIZE + block * sizeof(uint64_t));
+		if(bytes < 0 || (size_t)bytes != blocks_to_read * sizeof(uint64_t)){
+			ret = (bytes < 0)? errno : EIO;
+			errno = 0;
+			fprintf(stderr, "error reading mappings into memory\n");
+			goto out;
+		}
+
+		//coalesce blocks where the mapping is set into extents
+		for(i = 0; i < blocks_to_read; i++){
+			if(!mappings[i]) continue;
+
+			if(ext.count && ext.start + ext.count == block + i && ext.count < max_blocks){
+				ext.count++;
+				continue;
+			}
+
+			if(ext.count){
+				ret = fn(data, &ext);
+				if(ret) goto out;
+			}
+
+			ext.start = block + i;
+			ext.count = 1;
+		}
+	}
+
+	if(ext.count) ret = fn(data, &ext);
+
+out:
+	free(summary);
+	free(mappings);
 	return ret;
 }
 
-static int verify_files(FILE *cow, unsigned minor){
+static int verify_files(int cow_fd, unsigned minor, struct cow_header *ch_out){
 	int ret;
-	size_t bytes;
+	ssize_t bytes;
 	struct cow_header ch;
 	struct elastio_snap_info *info = NULL;
 
@@ -81,7 +402,7 @@ static int verify_files(FILE *cow, unsigned minor){
 	}
 
 	//read cow header from cow file
-	bytes = pread(fileno(cow), &ch, sizeof(struct cow_header), 0);
+	bytes = pread(cow_fd, &ch, sizeof(struct cow_header), 0);
 	if(bytes != sizeof(struct cow_header)){
 		ret = errno;
 		errno = 0;
@@ -96,6 +417,13 @@ static int verify_files(FILE *cow, unsigned minor){
 		goto error;
 	}
 
+	//check the cow file's version
+	if(ch.version > COW_VERSION_UNUSED_BLOCKS){
+		ret = EINVAL;
+		fprintf(stderr, "unsupported cow file version: %llu\n", (unsigned long long)ch.version);
+		goto error;
+	}
+
 	//check the uuid
 	if(memcmp(ch.uuid, info->uuid, COW_UUID_SIZE) != 0){
 		ret = EINVAL;
@@ -111,6 +439,7 @@ static int verify_files(FILE *cow, unsigned minor){
 	}
 
 	free(info);
+	if(ch_out) *ch_out = ch;
 
 	return 0;
 
@@ -119,21 +448,16 @@ error:
 	return ret;
 }
 
-int main(int argc, char **argv){
-	int ret;
+static int open_inputs(const char *snap_arg, const char *cow_arg, int open_flags, int *snap_fd_out, int *cow_fd_out, struct cow_header *ch, sector_t *total_blocks){
+	int ret, snap_fd = -1, cow_fd = -1;
 	unsigned minor;
-	size_t snap_size, bytes, blocks_to_read;
-	sector_t total_chunks, total_blocks, i, j, blocks_done = 0, count = 0, err_count = 0;
-	FILE *cow = NULL, *snap = NULL, *img = NULL;
-	uint64_t *mappings = NULL;
+	off_t snap_size;
 	char *snap_path;
 	char snap_path_buf[PATH_MAX];
 
-	if(argc != 4) print_help(argv[0], EINVAL);
-
 	//open snapshot
-	snap = fopen(argv[1], "r");
-	if(!snap){
+	snap_fd = open(snap_arg, O_RDONLY | open_flags);
+	if(snap_fd < 0){
 		ret = errno;
 		errno = 0;
 		fprintf(stderr, "error opening snapshot\n");
@@ -141,25 +465,16 @@ int main(int argc, char **argv){
 	}
 
 	//open cow file
-	cow = fopen(argv[2], "r");
-	if(!cow){
+	cow_fd = open(cow_arg, O_RDONLY);
+	if(cow_fd < 0){
 		ret = errno;
 		errno = 0;
 		fprintf(stderr, "error opening cow file\n");
 		goto error;
 	}
 
-	//open original image
-	img = fopen(argv[3], "r+");
-	if(!img){
-		ret = errno;
-		errno = 0;
-		fprintf(stderr, "error opening image\n");
-		goto error;
-	}
-
-	//get the full path of the cow file
-	snap_path = realpath(argv[1], snap_path_buf);
+	//get the full path of the snapshot
+	snap_path = realpath(snap_arg, snap_path_buf);
 	if(!snap_path){
 		ret = errno;
 		errno = 0;
@@ -177,68 +492,496 @@ int main(int argc, char **argv){
 	}
 
 	//verify all of the inputs before attempting to merge
-	ret = verify_files(cow, minor);
+	ret = verify_files(cow_fd, minor, ch);
 	if(ret) goto error;
 
 	//get size of snapshot, calculate other needed sizes
-	fseeko(snap, 0, SEEK_END);
-	snap_size = ftello(snap);
-	total_blocks = (snap_size + COW_BLOCK_SIZE - 1) / COW_BLOCK_SIZE;
-	total_chunks = (total_blocks + INDEX_BUFFER_SIZE - 1) / INDEX_BUFFER_SIZE;
-	rewind(snap);
+	snap_size = lseek(snap_fd, 0, SEEK_END);
+	if(snap_size < 0){
+		ret = errno;
+		errno = 0;
+		fprintf(stderr, "error determining size of snapshot\n");
+		goto error;
+	}
+	*total_blocks = (snap_size + COW_BLOCK_SIZE - 1) / COW_BLOCK_SIZE;
 
-	printf("snapshot is %llu blocks large\n", total_blocks);
+	*snap_fd_out = snap_fd;
+	*cow_fd_out = cow_fd;
+	return 0;
 
-	//allocate mappings array
-	mappings = malloc(INDEX_BUFFER_SIZE * sizeof(uint64_t));
-	if(!mappings){
-		ret = ENOMEM;
-		fprintf(stderr, "error allocating mappings\n");
+error:
+	if(cow_fd >= 0) close(cow_fd);
+	if(snap_fd >= 0) close(snap_fd);
+	return ret;
+}
+
+static int merge_main(int argc, char **argv){
+	int ret, c, open_flags = 0, cow_fd = -1;
+	unsigned int i, started = 0;
+	unsigned long val;
+	sector_t total_blocks;
+	struct merge_worker workers[MAX_JOBS];
+	struct merge_ctx ctx = {
+		.snap_fd = -1,
+		.img_fd = -1,
+		.max_io = DEFAULT_MAX_IO,
+		.jobs = DEFAULT_JOBS,
+		.lock = PTHREAD_MUTEX_INITIALIZER,
+		.not_empty = PTHREAD_COND_INITIALIZER,
+		.not_full = PTHREAD_COND_INITIALIZER,
+	};
+	static const struct option long_opts[] = {
+		{ "jobs", required_argument, NULL, 'j' },
+		{ "max-io", required_argument, NULL, 'm' },
+		{ "direct", no_argument, NULL, 'd' },
+		{ "help", no_argument, NULL, 'h' },
+		{ NULL, 0, NULL, 0 }
+	};
+
+	memset(workers, 0, sizeof(workers));
+
+	while((c = getopt_long(argc, argv, "j:m:dh", long_opts, NULL)) != -1){
+		switch(c){
+		case 'j':
+			if(parse_size(optarg, &val) || !val || val > MAX_JOBS) print_help(EINVAL);
+			ctx.jobs = val;
+			break;
+		case 'm':
+			if(parse_size(optarg, &val) || val < COW_BLOCK_SIZE || val > MAX_MAX_IO || val % COW_BLOCK_SIZE) print_help(EINVAL);
+			ctx.max_io = val;
+			break;
+		case 'd':
+			open_flags |= O_DIRECT;
+			break;
+		case 'h':
+			print_help(0);
+			break;
+		default:
+			print_help(EINVAL);
+		}
+	}
+
+	if(argc - optind != 3) print_help(EINVAL);
+
+	//a single job is copied from the main thread
+	if(ctx.jobs == 1) ctx.jobs = 0;
+
+	ret = open_inputs(argv[optind], argv[optind + 1], open_flags, &ctx.snap_fd, &cow_fd, NULL, &total_blocks);
+	if(ret) goto error;
+
+	//open original image
+	ctx.img_fd = open(argv[optind + 2], O_RDWR | open_flags);
+	if(ctx.img_fd < 0){
+		ret = errno;
+		errno = 0;
+		fprintf(stderr, "error opening image\n");
 		goto error;
 	}
 
-	//count number of blocks changed while performing merge
+	printf("snapshot is %llu blocks large\n", total_blocks);
+
+	//allocate the copy buffers, the main thread copies if there are no workers
+	for(i = 0; i < ctx.jobs || (!ctx.jobs && i == 0); i++){
+		workers[i].ctx = &ctx;
+		ret = posix_memalign((void **)&workers[i].buf, COW_BLOCK_SIZE, ctx.max_io);
+		if(ret){
+			workers[i].buf = NULL;
+			fprintf(stderr, "error allocating copy buffer\n");
+			goto error;
+		}
+	}
+	ctx.buf = workers[0].buf;
+
+	for(i = 0; i < ctx.jobs; i++){
+		ret = pthread_create(&workers[i].thread, NULL, merge_worker, &workers[i]);
+		if(ret){
+			fprintf(stderr, "error starting worker thread\n");
+			break;
+		}
+		started++;
+	}
+
+	//copy the extents of changed blocks
 	printf("copying blocks\n");
-	for(i = 0; i < total_chunks; i++){
-		//read a chunk of mappings from the cow file
-		blocks_to_read = MIN(INDEX_BUFFER_SIZE, total_blocks - blocks_done);
+	if(!ret) ret = for_each_changed_extent(cow_fd, total_blocks, ctx.max_io / COW_BLOCK_SIZE, merge_submit_extent, &ctx);
+
+	//let the workers drain the queue and exit
+	pthread_mutex_lock(&ctx.lock);
+	ctx.done = 1;
+	pthread_cond_broadcast(&ctx.not_empty);
+	pthread_mutex_unlock(&ctx.lock);
+
+	for(i = 0; i < started; i++) pthread_join(workers[i].thread, NULL);
+	if(ret) goto error;
+
+	if(fsync(ctx.img_fd)){
+		ret = errno;
+		errno = 0;
+		fprintf(stderr, "error syncing image\n");
+		goto error;
+	}
+
+	//print number of blocks changed
+	printf("copying complete: %llu blocks changed, %llu errors\n", ctx.blocks_copied, ctx.err_count);
+
+	for(i = 0; i < MAX_JOBS; i++) free(workers[i].buf);
+	close(cow_fd);
+	close(ctx.snap_fd);
+	close(ctx.img_fd);
+
+	return 0;
+
+error:
+	for(i = 0; i < MAX_JOBS; i++) free(workers[i].buf);
+	if(cow_fd >= 0) close(cow_fd);
+	if(ctx.snap_fd >= 0) close(ctx.snap_fd);
+	if(ctx.img_fd >= 0) close(ctx.img_fd);
+
+	return ret;
+}
+
+struct export_ctx{
+	int snap_fd;
+	int out_fd;
+	int checksum;
+	char *buf;
+	sector_t blocks_written;
+	sector_t err_count;
+};
+
+static int export_run(struct export_ctx *ctx, const char *data, sector_t start, sector_t count){
+	int ret;
+	struct delta_extent de;
+	size_t len = count * COW_BLOCK_SIZE;
+
+	de.start = start;
+	de.count = count;
+	de.checksum = (ctx->checksum)? crc32(0, (const unsigned char *)data, len) : 0;
+
+	ret = stream_full(ctx->out_fd, (char *)&de, sizeof(de), 1);
+	if(!ret) ret = stream_full(ctx->out_fd, (char *)data, len, 1);
+	if(ret){
+		errno = 0;
+		fprintf(stderr, "error writing extent to output\n");
+		return ret;
+	}
+
+	ctx->blocks_written += count;
+	return 0;
+}
+
+static int export_extent(void *data, const struct extent *ext){
+	int ret;
+	struct export_ctx *ctx = data;
+	sector_t i, run = 0;
+
+	if(!io_full(ctx->snap_fd, ctx->buf, ext->count * COW_BLOCK_SIZE, (off_t)ext->start * COW_BLOCK_SIZE, 0)) return export_run(ctx, ctx->buf, ext->start, ext->count);
+
+	//retry block by block so errors are accounted as in merge, the readable blocks are still exported
+	for(i = 0; i < ext->count; i++){
+		if(!io_full(ctx->snap_fd, ctx->buf + i * COW_BLOCK_SIZE, COW_BLOCK_SIZE, (off_t)(ext->start + i) * COW_BLOCK_SIZE, 0)){
+			run++;
+			continue;
+		}
+
+		errno = 0;
+		fprintf(stderr, "error reading block %llu from snapshot\n", ext->start + i);
+		ctx->err_count++;
+
+		if(run){
+			ret = export_run(ctx, ctx->buf + (i - run) * COW_BLOCK_SIZE, ext->start + i - run, run);
+			if(ret) return ret;
+			run = 0;
+		}
+	}
+
+	if(run) return export_run(ctx, ctx->buf + (ext->count - run) * COW_BLOCK_SIZE, ext->start + ext->count - run, run);
+	return 0;
+}
+
+static int export_main(int argc, char **argv){
+	int ret, c, open_flags = 0, cow_fd = -1;
+	unsigned long val;
+	size_t max_io = DEFAULT_MAX_IO;
+	sector_t total_blocks;
+	struct cow_header ch;
+	struct delta_header dh;
+	struct delta_extent de;
+	struct export_ctx ctx = {
+		.snap_fd = -1,
+		.out_fd = -1,
+	};
+	static const struct option long_opts[] = {
+		{ "checksum", no_argument, NULL, 'c' },
+		{ "max-io", required_argument, NULL, 'm' },
+		{ "direct", no_argument, NULL, 'd' },
+		{ "help", no_argument, NULL, 'h' },
+		{ NULL, 0, NULL, 0 }
+	};
+
+	while((c = getopt_long(argc, argv, "cm:dh", long_opts, NULL)) != -1){
+		switch(c){
+		case 'c':
+			ctx.checksum = 1;
+			break;
+		case 'm':
+			if(parse_size(optarg, &val) || val < COW_BLOCK_SIZE || val > MAX_MAX_IO || val % COW_BLOCK_SIZE) print_help(EINVAL);
+			max_io = val;
+			break;
+		case 'd':
+			open_flags |= O_DIRECT;
+			break;
+		case 'h':
+			print_help(0);
+			break;
+		default:
+			print_help(EINVAL);
+		}
+	}
+
+	if(argc - optind != 3) print_help(EINVAL);
+
+	ret = open_inputs(argv[optind], argv[optind + 1], open_flags, &ctx.snap_fd, &cow_fd, &ch, &total_blocks);
+	if(ret) goto error;
+
+	//open the output, "-" writes the stream to stdout
+	if(!strcmp(argv[optind + 2], "-")) ctx.out_fd = STDOUT_FILENO;
+	else ctx.out_fd = open(argv[optind + 2], O_WRONLY | O_CREAT | O_TRUNC, 0644);
+	if(ctx.out_fd < 0){
+		ret = errno;
+		errno = 0;
+		fprintf(stderr, "error opening output\n");
+		goto error;
+	}
+
+	ret = posix_memalign((void **)&ctx.buf, COW_BLOCK_SIZE, max_io);
+	if(ret){
+		ctx.buf = NULL;
+		fprintf(stderr, "error allocating copy buffer\n");
+		goto error;
+	}
+
+	fprintf(stderr, "snapshot is %llu blocks large\n", total_blocks);
+
+	memset(&dh, 0, sizeof(dh));
+	memcpy(dh.magic, DELTA_MAGIC, DELTA_MAGIC_SIZE);
+	dh.version = DELTA_VERSION;
+	dh.flags = (ctx.checksum)? DELTA_FLAG_CHECKSUM : 0;
+	dh.block_size = COW_BLOCK_SIZE;
+	dh.total_blocks = total_blocks;
+	dh.seqid = ch.seqid + 1;
+	memcpy(dh.uuid, ch.uuid, COW_UUID_SIZE);
+
+	ret = stream_full(ctx.out_fd, (char *)&dh, sizeof(dh), 1);
+	if(ret){
+		errno = 0;
+		fprintf(stderr, "error writing stream header\n");
+		goto error;
+	}
+
+	//write the extents of changed blocks
+	ret = for_each_changed_extent(cow_fd, total_blocks, max_io / COW_BLOCK_SIZE, export_extent, &ctx);
+	if(ret) goto error;
+
+	de.start = ctx.blocks_written;
+	de.count = 0;
+	de.checksum = 0;
+
+	ret = stream_full(ctx.out_fd, (char *)&de, sizeof(de), 1);
+	if(ret){
+		errno = 0;
+		fprintf(stderr, "error writing end of stream\n");
+		goto error;
+	}
+
+	fprintf(stderr, "export complete: %llu blocks changed, %llu errors\n", ctx.blocks_written, ctx.err_count);
+
+	free(ctx.buf);
+	close(cow_fd);
+	close(ctx.snap_fd);
+	if(ctx.out_fd != STDOUT_FILENO && close(ctx.out_fd)){
+		ret = errno;
+		errno = 0;
+		fprintf(stderr, "error closing output\n");
+		return ret;
+	}
+
+	return 0;
 
-		bytes = pread(fileno(cow), mappings, blocks_to_read * sizeof(uint64_t), COW_HEADER_SIZE + (INDEX_BUFFER_SIZE * sizeof(uint64_t) * i));
-		if(bytes != blocks_to_read * sizeof(uint64_t)){
-			ret = errno;
+error:
+	free(ctx.buf);
+	if(cow_fd >= 0) close(cow_fd);
+	if(ctx.snap_fd >= 0) close(ctx.snap_fd);
+	if(ctx.out_fd >= 0 && ctx.out_fd != STDOUT_FILENO) close(ctx.out_fd);
+
+	return ret;
+}
+
+static int apply_main(int argc, char **argv){
+	int ret, c, open_flags = 0, in_fd = -1, img_fd = -1;
+	off_t img_size;
+	size_t len;
+	sector_t blocks_applied = 0;
+	char *buf = NULL;
+	struct delta_header dh;
+	struct delta_extent de;
+	static const struct option long_opts[] = {
+		{ "direct", no_argument, NULL, 'd' },
+		{ "help", no_argument, NULL, 'h' },
+		{ NULL, 0, NULL, 0 }
+	};
+
+	while((c = getopt_long(argc, argv, "dh", long_opts, NULL)) != -1){
+		switch(c){
+		case 'd':
+			open_flags |= O_DIRECT;
+			break;
+		case 'h':
+			print_help(0);
+			break;
+		default:
+			print_help(EINVAL);
+		}
+	}
+
+	if(argc - optind != 2) print_help(EINVAL);
+
+	//open the input, "-" reads the stream from stdin
+	if(!strcmp(argv[optind], "-")) in_fd = STDIN_FILENO;
+	else in_fd = open(argv[optind], O_RDONLY);
+	if(in_fd < 0){
+		ret = errno;
+		errno = 0;
+		fprintf(stderr, "error opening input\n");
+		goto error;
+	}
+
+	img_fd = open(argv[optind + 1], O_RDWR | open_flags);
+	if(img_fd < 0){
+		ret = errno;
+		errno = 0;
+		fprintf(stderr, "error opening image\n");
+		goto error;
+	}
+
+	ret = stream_full(in_fd, (char *)&dh, sizeof(dh), 0);
+	if(ret){
+		errno = 0;
+		fprintf(stderr, "error reading stream header\n");
+		goto error;
+	}
+
+	if(memcmp(dh.magic, DELTA_MAGIC, DELTA_MAGIC_SIZE) != 0 || dh.version != DELTA_VERSION){
+		ret = EINVAL;
+		fprintf(stderr, "input is not an update-img stream\n");
+		goto error;
+	}
+
+	if(dh.block_size != COW_BLOCK_SIZE){
+		ret = EINVAL;
+		fprintf(stderr, "stream block size %u does not match %u\n", dh.block_size, COW_BLOCK_SIZE);
+		goto error;
+	}
+
+	//the image must be large enough to hold the whole snapshot
+	img_size = lseek(img_fd, 0, SEEK_END);
+	if(img_size < 0 || dh.total_blocks > (uint64_t)img_size / COW_BLOCK_SIZE){
+		ret = EINVAL;
+		fprintf(stderr, "image is smaller than the snapshot the stream was exported from\n");
+		goto error;
+	}
+
+	ret = posix_memalign((void **)&buf, COW_BLOCK_SIZE, MAX_MAX_IO);
+	if(ret){
+		buf = NULL;
+		fprintf(stderr, "error allocating copy buffer\n");
+		goto error;
+	}
+
+	fprintf(stderr, "applying stream of snapshot %llu\n", (unsigned long long)dh.seqid);
+
+	while(1){
+		ret = stream_full(in_fd, (char *)&de, sizeof(de), 0);
+		if(ret){
 			errno = 0;
-			fprintf(stderr, "error reading mappings into memory\n");
+			fprintf(stderr, "error reading extent header, stream is truncated\n");
+			goto error;
+		}
+
+		if(!de.count) break;
+
+		//checked without sums or products that a hostile stream could overflow
+		if(de.count > MAX_MAX_IO / COW_BLOCK_SIZE || de.start > dh.total_blocks || de.count > dh.total_blocks - de.start){
+			ret = EINVAL;
+			fprintf(stderr, "invalid extent in stream: %llu blocks at %llu\n", (unsigned long long)de.count, (unsigned long long)de.start);
 			goto error;
 		}
+		len = (size_t)de.count * COW_BLOCK_SIZE;
 
-		//copy blocks where the mapping is set
-		for(j = 0; j < blocks_to_read; j++){
-			if(!mappings[j]) continue;
+		ret = stream_full(in_fd, buf, len, 0);
+		if(ret){
+			errno = 0;
+			fprintf(stderr, "error reading extent data, stream is truncated\n");
+			goto error;
+		}
 
-			ret = copy_block(snap, img, (INDEX_BUFFER_SIZE * i) + j);
-			if(ret) err_count++;
+		if((dh.flags & DELTA_FLAG_CHECKSUM) && crc32(0, (unsigned char *)buf, len) != de.checksum){
+			ret = EILSEQ;
+			fprintf(stderr, "checksum mismatch in extent at block %llu\n", (unsigned long long)de.start);
+			goto error;
+		}
 
-			count++;
+		ret = io_full(img_fd, buf, len, (off_t)de.start * COW_BLOCK_SIZE, 1);
+		if(ret){
+			errno = 0;
+			fprintf(stderr, "error writing extent to image\n");
+			goto error;
 		}
 
-		blocks_done += blocks_to_read;
+		blocks_applied += de.count;
 	}
 
-	//print number of blocks changed
-	printf("copying complete: %llu blocks changed, %llu errors\n", count, err_count);
+	if(de.start != blocks_applied){
+		ret = EINVAL;
+		fprintf(stderr, "stream holds %llu blocks, but %llu were applied\n", (unsigned long long)de.start, blocks_applied);
+		goto error;
+	}
 
-	free(mappings);
-	fclose(cow);
-	fclose(snap);
-	fclose(img);
+	if(fsync(img_fd)){
+		ret = errno;
+		errno = 0;
+		fprintf(stderr, "error syncing image\n");
+		goto error;
+	}
+
+	fprintf(stderr, "apply complete: %llu blocks changed\n", blocks_applied);
+
+	free(buf);
+	if(in_fd != STDIN_FILENO) close(in_fd);
+	close(img_fd);
 
 	return 0;
 
 error:
-	if(mappings) free(mappings);
-	if(cow) fclose(cow);
-	if(snap) fclose(snap);
-	if(img) fclose(img);
+	free(buf);
+	if(in_fd >= 0 && in_fd != STDIN_FILENO) close(in_fd);
+	if(img_fd >= 0) close(img_fd);
 
 	return ret;
 }
+
+int main(int argc, char **argv){
+	progname = argv[0];
+
+	if(argc > 1 && !strcmp(argv[1], "export")){
+		crc32_init();
+		return export_main(argc - 1, argv + 1);
+	}
+
+	if(argc > 1 && !strcmp(argv[1], "apply")){
+		crc32_init();
+		return apply_main(argc - 1, argv + 1);
+	}
+
+	return merge_main(argc, argv);
+}